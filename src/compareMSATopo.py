@@ -178,13 +178,18 @@ import re
 import comptopo as ct
 import myfunc
 import libtopologycmp as lcmp
+import libtmsa
 import math
+import numpy as np
 import tempfile
 from operator import itemgetter
 import copy
 #import cProfile
 import subprocess
 import json
+import io
+import collections
+import multiprocessing
 
 
 BLOCK_SIZE = myfunc.BLOCK_SIZE
@@ -232,7 +237,8 @@ Usage: %s topology-alignment-file
 
 Description:
     Compare aligned topology, either pairwise alignment or multiple alignment.
-    Note that topology-alignment-file should be in Fasta format
+    Note that topology-alignment-file should be in Fasta format, for multiple
+    alignment the binary topology MSA (.tmsa) is also accepted
     When the topo-MSA is untrimmed, origmsa is not needed
 
 Options:
@@ -269,6 +275,9 @@ Options:
   -woinv     FILE   Output inverted topology
   -widtmatrix FILE  Output the identical matrix in json format
   -log       FILE   Output the logfile 
+  -cpu       INT   Number of processes, (default: 1)
+                    for the all-to-all topology comparison in mode 1 and the
+                    pairwise comparison in mode 0
   -outpath    DIR   Output the result to outpath, (default: the same folder as the input file)
   -v          INT   Set verbose level, (default: 1)
   -h, --help        Print this help message and exit
@@ -596,24 +605,7 @@ def WriteSortedClusteredTopoMSA(clusterFile, consensusFile, #{{{
 #             sys.stdout.write(" %d"%Mcmp[sortedCntIDTTopoTupleList[i][0]][j])
 #         sys.stdout.write("\n")
 
-    tmpMcmp = copy.deepcopy(Mcmp)
-    markArray = [1]*numSeq
-    clusterList = []
-    cntCluster = 0
-    while 1:
-        cntIDTTopo = [sum(ii) for ii in tmpMcmp]
-        maxCnt = max(cntIDTTopo)
-        maxIndex = cntIDTTopo.index(maxCnt)
-        clusterList.append([])
-        for j in range(numSeq):
-            if tmpMcmp[maxIndex][j] == 1:
-                clusterList[cntCluster].append(j)
-                markArray[j] = 0
-                for i in range(numSeq):
-                    tmpMcmp[i][j] = 0
-        cntCluster += 1
-        if sum(markArray) == 0:
-            break
+    clusterList = lcmp.GreedyClusterBitMatrix(Mcmp)
 #     for i in xrange(len(clusterList)):
 #         print len(clusterList[i]), clusterList[i]
 
@@ -724,25 +716,7 @@ def WriteInvertedTopologyGroup_MSA(outfile, #{{{
 # cluster proteins with identical topology, find the largest two groups with
 # inverted topology
 # 2013-07-11 : not finished
-    tmpMcmp = copy.deepcopy(Mcmp)
-    markArray = [1]*numSeq
-    clusterList = []
-    cntCluster = 0
-    while 1:
-        cntIDTTopo = [sum(ii) for ii in tmpMcmp]
-        maxCnt = max(cntIDTTopo)
-        maxIndex = cntIDTTopo.index(maxCnt)
-        clusterList.append([])
-        tmpCluster = []
-        for j in range(numSeq):
-            if tmpMcmp[maxIndex][j] == 1:
-                tmpCluster.append(j)
-                markArray[j] = 0
-                for i in range(numSeq):
-                    tmpMcmp[i][j] = 0
-        cntCluster += 1
-        if sum(markArray) == 0:
-            break
+    clusterList = lcmp.GreedyClusterBitMatrix(Mcmp)
 #     for i in xrange(len(clusterList)):
 #         print len(clusterList[i]), clusterList[i]
 
@@ -777,16 +751,15 @@ def WriteInvertedTopologyPairwise_MSA(outfile, #{{{
 # 2013-07-11
     Mcmp = GetInvertedTopologyMatrix(topoSeqList, NtermStateList, posTMList)
     seqLenList=[ len(tp.replace(GAP,'')) for tp in topoSeqList]; 
-    numINVpair = sum(a.count(1) for a in Mcmp)
+    numINVpair = Mcmp.Count()
     numAllpair = numSeq*(numSeq-1)/2
     pairIdxList = []
     uniq_inv_idset = set([])
     for i in range (numSeq):
-        for j in range(i+1, numSeq):
-            if Mcmp[i][j] == 1:
-                pairIdxList.append((i,j))
-                uniq_inv_idset.add(idList[i])
-                uniq_inv_idset.add(idList[j])
+        for j in (np.flatnonzero(Mcmp.GetRow(i)[i+1:]) + i + 1).tolist():
+            pairIdxList.append((i,j))
+            uniq_inv_idset.add(idList[i])
+            uniq_inv_idset.add(idList[j])
     try:
         fpout = open(outfile, "w")
         fpout.write("General: %4d %6d %6.3f\n"%(numINVpair, numAllpair,
@@ -975,8 +948,9 @@ def WriteIdenticalTopMatrixFile(outIdenticalTopFile, idList, Mcmp):
     dt = {}
     numSeq = len(idList)
     for i in range(numSeq):
+        row = Mcmp.GetRow(i)
         for j in range(i+1, numSeq):
-            dt[(idList[i] + "\t"+ idList[j])] = Mcmp[i][j]
+            dt[(idList[i] + "\t"+ idList[j])] = int(row[j])
     with open (outIdenticalTopFile, "w") as fpout:
         json.dump(dt, fpout)
 
@@ -1235,6 +1209,17 @@ def PrintMappedArray_method1_2(mapArray1, mapArray2, posTM1, posTM2, seqID1, seq
         fpout.write("TMMap %*s, numTM2 = %2d: %s\n"%(maxSizeID, seqID2, numTM2,
             " ".join(mapstrlist2)))
 #}}}
+def GetSeqIdentityFromAnnotation(anno):#{{{
+    """
+    Extract seqIDT from annotation line, this is for pairwise aligned topology
+    file. Return INIT_SEQUENCE_IDENTITY if not found
+    """
+    seqIdentity = INIT_SEQUENCE_IDENTITY
+    m = re.search('seqIDT=[^\s]* ', anno)
+    if m != None:
+        seqIdentity = float(m.group(0).split('=')[1])
+    return seqIdentity
+#}}}
 def ExtractFromSeqWithAnno(seqWithAnno):#{{{
     """
     Extract information from the record seqWithAnno
@@ -1246,12 +1231,7 @@ def ExtractFromSeqWithAnno(seqWithAnno):#{{{
     anno = anno.lstrip('>')
     seqID = myfunc.GetSeqIDFromAnnotation(anno)
 
-    # extract seqIDT from annotation line, this is for pairwise aligned
-    # topology file 
-    seqIdentity = INIT_SEQUENCE_IDENTITY
-    m = re.search('seqIDT=[^\s]* ', anno)
-    if m != None:
-        seqIdentity = float(m.group(0).split('=')[1])
+    seqIdentity = GetSeqIdentityFromAnnotation(anno)
 
     dgscore = []; # a list of DG scores of the TM regions of the topology
     m = re.search('{[\s]*dgscore.*}', seqWithAnno[posAnnoEnd:].replace('\n', ' '))
@@ -1274,55 +1254,31 @@ def ReadTopoWithDGScore(infile, BLOCK_SIZE=100000): #{{{
     """
     Read enhanced fasta with dg values at the end of sequences and enclosed by
     {dgvalue }
+    The binary topology MSA (.tmsa) is also accepted
     Return recordList
     ==updated 2011-10-30
     """
     recordList = []; #recordList is a list of n-tuples
-    fpin = None
+    if libtmsa.IsTMSAFile(infile):
+        (idList, annotationList, topoSeqList, dgScoreList) = \
+                libtmsa.ReadTopoMSAWithDGScore(infile)
+        for i in range(len(idList)):
+            dgscore = []
+            if dgScoreList != None:
+                dgscore = dgScoreList[i]
+            recordList.append((idList[i], annotationList[i], topoSeqList[i],
+                GetSeqIdentityFromAnnotation(annotationList[i]), dgscore))
+        return recordList
     try:
-        fpin=open(infile,"r")
+        buff = myfunc.OpenFastaBuffer(infile)
     except IOError:
         msg = "Failed to read fastaWithDGScore file %s"
         print(msg%(infile), file=sys.stderr)
         return []
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-                    recordList.append(ExtractFromSeqWithAnno(seqWithAnno))
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    recordList.append(ExtractFromSeqWithAnno(seqWithAnno))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
-
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        recordList.append( ExtractFromSeqWithAnno(seqWithAnno))
-    fpin.close()
+    for (recList, end) in myfunc.ScanFastaBlock(buff):
+        for rec in recList:
+            recordList.append(ExtractFromSeqWithAnno(">"+rec))
+    myfunc.CloseFastaBuffer(buff)
     return recordList
 #}}}
 def RemoveSignalPeptide(topoRecordList, signalpDict):#{{{
@@ -1379,27 +1335,36 @@ def ReadTopoWithDGScoreFromBuffer(buff,recordList, isEOFreached):#{{{
     Return (unprocessedBuffer)"""
     if not buff:
         return ""
-    brokenSeqWithAnnoLine=""
-    beg=0
-    end=0
-    while 1:
-        beg=buff.find(">",beg)
-        end=buff.find("\n>",beg+1)
-        if beg >= 0:
-            if end >=0:
-                seqWithAnno=buff[beg:end]
-                recordList.append(ExtractFromSeqWithAnno(seqWithAnno))
-                beg=end
-            else:
-                brokenSeqWithAnnoLine=buff[beg:]
-                break
-        else:
-            break
-    if isEOFreached and brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        recordList.append( ExtractFromSeqWithAnno(seqWithAnno))
-        brokenSeqWithAnnoLine=""
-    return brokenSeqWithAnnoLine
+    tailBeg = 0
+    for (recList, end) in myfunc.ScanFastaBlock(buff, isEOFreached=isEOFreached):
+        for rec in recList:
+            recordList.append(ExtractFromSeqWithAnno(">"+rec))
+        tailBeg = end + 1
+    if isEOFreached:
+        return ""
+    return buff[tailBeg:]
+#}}}
+def ReadTopoWithDGScorePair(fpin, BLOCK_SIZE=100000):#{{{
+    """
+    Generator of pairs of topology records read from the file handle fpin
+    block by block, yield a list of two records (seqID, anno, seq,
+    seqIdentity, dgscore). Only records of the current block are kept in
+    memory, a trailing unpaired record is ignored.
+    """
+    unprocessedBuffer = ""
+    recordList = []
+    isEOFreached = False
+    while not isEOFreached:
+        buff = fpin.read(BLOCK_SIZE)
+        if len(buff) < BLOCK_SIZE:
+            isEOFreached = True
+        buff = unprocessedBuffer + buff
+        unprocessedBuffer = ReadTopoWithDGScoreFromBuffer(buff, recordList,
+                isEOFreached)
+        numPair = len(recordList)//2
+        for i in range(numPair):
+            yield recordList[2*i:2*i+2]
+        del recordList[:2*numPair]
 #}}}
 
 def IsTrimmedMSA(topoSeqList):#{{{
@@ -3482,24 +3447,16 @@ def GetConsensusTopo(idtTopoSeqList, idtPosTMList, method_consensus):#{{{
         return (None, None)
 
     lengthAlignment=len(idtTopoSeqList[0])
-    (cnt_i, cnt_o, cnt_M, cnt_GAP, 
-            per_i, per_o, per_M, per_GAP) = lcmp.GetTopoStateFraction(
-                    idtTopoSeqList)
+    (cntMatrix, perMatrix) = lcmp.GetTopoStateProfile(idtTopoSeqList)
+    (per_i, per_o, per_M, per_SP, per_GAP) = perMatrix.tolist()
 
     consensusTopo=""
     if method_consensus == 0:
-        state="";#{{{
-        for i in range(lengthAlignment):
-            if per_GAP[i] > 0.5:
-                state=GAP
-            else:
-                if per_M[i] >= per_o[i] and per_M[i] >= per_i[i]:
-                    state="M"
-                elif per_i[i] >= per_M[i] and per_i[i] >= per_o[i]:
-                    state="i"
-                else:
-                    state="o"
-            consensusTopo+=state;#}}}
+        (arr_i, arr_o, arr_M, arr_SP, arr_GAP) = perMatrix;#{{{
+        stateArray = np.where(arr_GAP > 0.5, GAP,
+                np.where((arr_M >= arr_o) & (arr_M >= arr_i), "M",
+                    np.where(arr_i >= arr_o, "i", "o")))
+        consensusTopo = "".join(stateArray.tolist());#}}}
     elif method_consensus == 1:
         TM_extend_threshold=0.5;#{{{
         strlist=[GAP]*lengthAlignment
@@ -3638,9 +3595,9 @@ def GetIDTTopoGroup(idList,topoSeqList):#{{{
 # 1 for identical
     numSeq=len(idList)
     # Initialize a unit matrix of the size (numSeq x numSeq)
-    Mcmp= [[0]*numSeq for x in range(numSeq)]
+    Mcmp = lcmp.BitMatrix(numSeq)
     for i in range(numSeq): 
-        Mcmp[i][i]=1
+        Mcmp.Set(i, i)
     # All-to-all comparison
     for i in range (numSeq):
         for j in range(i+1, numSeq):
@@ -3650,23 +3607,14 @@ def GetIDTTopoGroup(idList,topoSeqList):#{{{
             strProtein2 = idList[j]
             (class_global, num1_global, num2_global) = CompareTrimmedToposGlobally(strTop1, strTop2, strProtein1, strProtein2)
             if class_global == "OK":
-                Mcmp[i][j] = 1
-            else:
-                Mcmp[i][j] = 0
-    #copy the symmetric matrix
-    for i in range (numSeq):
-        for j in range(i+1, numSeq):
-            Mcmp[j][i]=Mcmp[i][j]
+                # the symmetric matrix
+                Mcmp.Set(i, j)
+                Mcmp.Set(j, i)
 
     #get the largest group with the identical topology
-    cntIDTTopo=[sum(ii) for ii in Mcmp]
-    maxCnt=max(cntIDTTopo)
-    maxIndex=cntIDTTopo.index(maxCnt)
-    numIDTTopo=maxCnt
-    indexIDTTopo=[]
-    for j in range(numSeq):
-        if Mcmp[maxIndex][j]==1:
-            indexIDTTopo.append(j)
+    cntIDTTopo = Mcmp.RowSum()
+    maxIndex = int(np.argmax(cntIDTTopo))
+    indexIDTTopo = np.flatnonzero(Mcmp.GetRow(maxIndex) == 1).tolist()
 
     numIDTTopo=len(indexIDTTopo)
 # To get the consensusTopo
@@ -3698,8 +3646,7 @@ def GetIDTTopoGroup(idList,topoSeqList):#{{{
     DEBUG_CONSENSUS = g_params['DEBUG_CONSENSUS']
     if fpLog != None and DEBUG_CONSENSUS:
         for i in range (numSeq):
-            for j in range(numSeq):
-                fpLog.write("%d "%Mcmp[i][j])
+            fpLog.write("".join(["%d "%x for x in Mcmp.GetRow(i)]))
             fpLog.write("\n")
         print("numIDTTopo=",numIDTTopo, file=fpLog)
         print("indexIDTTopo:\n",indexIDTTopo, file=fpLog)
@@ -3730,41 +3677,20 @@ def GetIDTTopoGroup1(topoSeqList, NtermStateList, posTMList):#{{{
 # 0 for different
 # 1 for identical
     numSeq=len(posTMList)
-    numTMList=[ len (posTM) for posTM in posTMList]
 
-    # Initialize a unit matrix of the size (numSeq x numSeq)
-#   Mcmp = [ [(i==j) for i in xrange(numSeq)] for j in xrange(numSeq) ]  
-    Mcmp= [[0]*numSeq for x in range(numSeq)]
-    for i in range(numSeq): 
-        Mcmp[i][i]=1
-    # All-to-all comparison
+    # All-to-all comparison, Mcmp is a symmetric BitMatrix with 1s on the
+    # diagonal, the same as comparing all pairs by lcmp.IsIdenticalTopology
     if g_params['method_comparison'] == 2: # modified 2012-11-22 
         min_TM_overlap = int(g_params['threshold_TM2TM']*21+0.5)
     else:
         min_TM_overlap = g_params['min_TM_overlap']
-    for i in range (numSeq):
-        for j in range(i+1, numSeq):
-            #if lcmp.IsIdenticalTopology(NtermStateList[i], NtermStateList[j], numTMList[i], numTMList[j], posTMList[i], posTMList[j]):
-            if lcmp.IsIdenticalTopology(NtermStateList[i], NtermStateList[j],
-                    numTMList[i], numTMList[j], posTMList[i], posTMList[j],
-                    topoSeqList[i], topoSeqList[j], min_TM_overlap):
-                Mcmp[i][j] = 1
-            else:
-                Mcmp[i][j] = 0
-    #copy the symmetric matrix
-    for i in range (numSeq):
-        for j in range(i+1, numSeq):
-            Mcmp[j][i]=Mcmp[i][j]
+    Mcmp = lcmp.GetTopologyPairMatrix(topoSeqList, NtermStateList, posTMList,
+            min_TM_overlap, isInverted=False, numCPU=g_params['numCPU'])
 
     #get the largest group with the identical topology, bug fixed 2011-09-19 22:26:53 Monday Week 38
-    cntIDTTopo=[sum(ii) for ii in Mcmp]
-    maxCnt=max(cntIDTTopo)
-    maxIndex=cntIDTTopo.index(maxCnt)
-    numIDTTopo=maxCnt
-    indexIDTTopo=[]
-    for j in range(numSeq):
-        if Mcmp[maxIndex][j]==1:
-            indexIDTTopo.append(j)
+    cntIDTTopo = Mcmp.RowSum()
+    maxIndex = int(np.argmax(cntIDTTopo))
+    indexIDTTopo = np.flatnonzero(Mcmp.GetRow(maxIndex) == 1).tolist()
 
     numIDTTopo = len(indexIDTTopo)
 # To get the consensusTopo
@@ -3787,8 +3713,7 @@ def GetIDTTopoGroup1(topoSeqList, NtermStateList, posTMList):#{{{
     DEBUG_CONSENSUS = g_params['DEBUG_CONSENSUS']
     if fpLog != None and DEBUG_CONSENSUS:
         for i in range (numSeq):
-            for j in range(numSeq):
-                fpLog.write("%d "%Mcmp[i][j])
+            fpLog.write("".join(["%d "%x for x in Mcmp.GetRow(i)]))
             fpLog.write("\n")
         print("numIDTTopo=",numIDTTopo, file=fpLog)
         print("indexIDTTopo:\n",indexIDTTopo, file=fpLog)
@@ -3809,21 +3734,10 @@ def GetInvertedTopologyMatrix(topoSeqList, NtermStateList, posTMList):#{{{
 # return ()
 # 0 for not-inverted
 # 1 for inverted
-    numSeq=len(posTMList)
-    numTMList=[ len (posTM) for posTM in posTMList]
-    # Initialize a unit matrix of the size (numSeq x numSeq)
-#   Mcmp = [ [(i==j) for i in xrange(numSeq)] for j in xrange(numSeq) ]  
-    Mcmp= [[0]*numSeq for x in range(numSeq)]
     # All-to-all comparison
     min_TM_overlap = 5
-    for i in range (numSeq):
-        for j in range(i+1, numSeq):
-            if lcmp.IsInvertedTopology(NtermStateList[i], NtermStateList[j],
-                    numTMList[i], numTMList[j], posTMList[i], posTMList[j],
-                    topoSeqList[i], topoSeqList[j], min_TM_overlap):
-                Mcmp[i][j] = 1
-            else:
-                Mcmp[i][j] = 0
+    Mcmp = lcmp.GetTopologyPairMatrix(topoSeqList, NtermStateList, posTMList,
+            min_TM_overlap, isInverted=True, numCPU=g_params['numCPU'])
 # it is a half matrix
     return Mcmp
 #}}}
@@ -4357,10 +4271,11 @@ def GetGroupedTopoMSA(numSeq, idList, topoSeqList, dgScoreList, #{{{
         for pivot in indexThisClass:
             lst = []
             lst.append(pivot)
+            rowPivot = Mcmp.GetRow(pivot)
             for j in indexThisClass:
                 if j == pivot:
                     continue
-                if (Mcmp[pivot][j] == 1 and
+                if (rowPivot[j] == 1 and
                         IsDGScoreSimilar(dgScoreList[pivot], dgScoreList[j],
                             maxDGdifference)):
                     lst.append(j)
@@ -4425,6 +4340,88 @@ def PairwiseTopologyComparison(topoRecordList, g_params):#{{{
         print("Wrong method %d"%(cmpmethod), file=sys.stderr)
         return 1
 #}}}
+def ShiftRecordNumber(content, offset):#{{{
+    """Add offset to the record numbers of //Begin record and //End record
+    lines in content"""
+    if offset == 0:
+        return content
+    return re.sub(r"^(//(?:Begin|End) record) (\d+)$",
+            lambda m: "%s %d"%(m.group(1), int(m.group(2))+offset), content,
+            flags=re.M)
+#}}}
+def PairwiseTopologyComparison_worker(topoRecordList):#{{{
+    """
+    Compare a chunk of pairs in a worker process, the output is written to
+    buffers with record numbers starting from 1
+    Return (numOutputPair, content, contentBadmap, contentLog)
+    """
+    g_params['fpout'] = io.StringIO()
+    g_params['fpout_badmap'] = io.StringIO()
+    if g_params['fpLog'] != None:
+        g_params['fpLog'] = io.StringIO()
+    g_params['cntOutputPair'] = 0
+    if g_params['isRemoveSignalP']:
+        topoRecordList = RemoveSignalPeptide(topoRecordList,
+                g_params['signalpDict'])
+    PairwiseTopologyComparison(topoRecordList, g_params)
+    contentLog = ""
+    if g_params['fpLog'] != None:
+        contentLog = g_params['fpLog'].getvalue()
+    return (g_params['cntOutputPair'], g_params['fpout'].getvalue(),
+            g_params['fpout_badmap'].getvalue(), contentLog)
+#}}}
+def PairwiseTopologyComparison_parallel(pairIterator, g_params, #{{{
+        numPairPerChunk=500):
+    """
+    Pairwise topology comparison with g_params['numCPU'] processes. Pairs
+    are sent to the workers by chunks, the read-only lookups in g_params
+    (signalpDict, pairalnStat, uniprot2pdbMap, dupPairSet...) are shared by
+    the forked workers. Results are written in the order of the input with
+    the same record numbers as the serial comparison
+    """
+    numCPU = g_params['numCPU']
+    try:
+        pool = multiprocessing.get_context("fork").Pool(processes=numCPU)
+    except ValueError:
+        print("Multiprocessing is not supported, run with one process.",
+                file=sys.stderr)
+        for topoRecordList in pairIterator:
+            if g_params['isRemoveSignalP']:
+                topoRecordList = RemoveSignalPeptide(topoRecordList,
+                        g_params['signalpDict'])
+            PairwiseTopologyComparison(topoRecordList, g_params)
+        return 0
+
+    def WriteResult(asyncResult):
+        (numOutputPair, content, contentBadmap, contentLog) = asyncResult.get()
+        offset = g_params['cntOutputPair']
+        g_params['fpout'].write(ShiftRecordNumber(content, offset))
+        g_params['fpout_badmap'].write(contentBadmap)
+        if g_params['fpLog'] != None:
+            g_params['fpLog'].write(ShiftRecordNumber(contentLog, offset))
+        g_params['cntOutputPair'] += numOutputPair
+
+    # at most 2*numCPU chunks are pending so that the memory usage does not
+    # depend on the number of pairs
+    pendingList = collections.deque()
+    chunk = []
+    for topoRecordList in pairIterator:
+        chunk += topoRecordList
+        if len(chunk) >= 2*numPairPerChunk:
+            pendingList.append(pool.apply_async(
+                PairwiseTopologyComparison_worker, (chunk,)))
+            chunk = []
+            if len(pendingList) >= 2*numCPU:
+                WriteResult(pendingList.popleft())
+    if len(chunk) > 0:
+        pendingList.append(pool.apply_async(PairwiseTopologyComparison_worker,
+            (chunk,)))
+    while len(pendingList) > 0:
+        WriteResult(pendingList.popleft())
+    pool.close()
+    pool.join()
+    return 0
+#}}}
 
 def PairwiseTopologyComparison_method0(topoRecordList, g_params):#{{{
     """
@@ -4448,7 +4445,7 @@ def PairwiseTopologyComparison_method0(topoRecordList, g_params):#{{{
     seqIdentityList = [r[3] for r in topoRecordList ]
     dgScoreList = [r[4] for r in topoRecordList ]
 
-    posTMList = [ myfunc.GetTMPosition(topo) for topo in topoSeqList]
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     numTMList = [len(posTM) for posTM in posTMList]
     alignSeqLenList = [len(topo) for topo in topoSeqList ]
 
@@ -4456,10 +4453,9 @@ def PairwiseTopologyComparison_method0(topoRecordList, g_params):#{{{
     seqLenList=[ len(tp.replace(GAP,'')) for tp in topoSeqList]; 
     # Get topology at N terminal of each sequence 
     NtermStateList=[ lcmp.GetNtermState(topo) for topo in topoSeqList]; 
-    numPair = numSeq / 2
+    numPair = numSeq // 2
 
     DGvalueTMList = []
-    gapSeqList=[]
     for i in range(numSeq):
         topo = topoSeqList[i]
         dglist=dgScoreList[i]
@@ -4468,7 +4464,6 @@ def PairwiseTopologyComparison_method0(topoRecordList, g_params):#{{{
             DGvalueTMList.append(dglist)
         else:
             DGvalueTMList.append([INIT_DGVALUE]*numTM)
-        gapSeqList.append ([(s==GAP) for s in topo]); 
 
 
     for i in range (numPair):
@@ -4515,8 +4510,10 @@ def PairwiseTopologyComparison_method0(topoRecordList, g_params):#{{{
             ana2=AnaDIFFTopology1(mapArray2); 
 #check with DG, topcons_single and gap 
 # 1. check if the compared topology are mostly gaps at the aligned region
-            ana1 = CheckGapOfMSA(ana1, posTMList[idx1],gapSeqList[idx2])
-            ana2 = CheckGapOfMSA(ana2, posTMList[idx2],gapSeqList[idx1])
+            ana1 = CheckGapOfMSA(ana1, posTMList[idx1],
+                    [(s==GAP) for s in topo2])
+            ana2 = CheckGapOfMSA(ana2, posTMList[idx2],
+                    [(s==GAP) for s in topo1])
 
 # 2. check the DG value of the TM region to see if the prediction is reliable
 # we should probably also check the DG value of the opposite topology, but it
@@ -4546,9 +4543,7 @@ def PairwiseTopologyComparison_method0(topoRecordList, g_params):#{{{
         g_params['cntOutputPair'] += 1
 
 # remove records that are already compared
-    for i in range (numPair):
-        topoRecordList.pop(0)
-        topoRecordList.pop(0)
+    del topoRecordList[:2*numPair]
 
     return 0
 #}}}
@@ -4585,7 +4580,7 @@ def PairwiseTopologyComparison_method1(topoRecordList, g_params):#{{{
     seqIdentityList = [r[3] for r in topoRecordList ]
     dgScoreList = [r[4] for r in topoRecordList ]
 
-    posTMList = [ myfunc.GetTMPosition(topo) for topo in topoSeqList]
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     numTMList = [len(posTM) for posTM in posTMList]
     alignSeqLenList = [len(topo) for topo in topoSeqList ]
 
@@ -4593,10 +4588,9 @@ def PairwiseTopologyComparison_method1(topoRecordList, g_params):#{{{
     seqLenList=[ len(tp.replace(GAP,'')) for tp in topoSeqList]; 
     # Get topology at N terminal of each sequence 
     NtermStateList=[ lcmp.GetNtermState(topo) for topo in topoSeqList]; 
-    numPair = numSeq / 2
+    numPair = numSeq // 2
 
     DGvalueTMList = []
-    gapSeqList=[]
     for i in range(numSeq):
         topo = topoSeqList[i]
         dglist=dgScoreList[i]
@@ -4605,7 +4599,6 @@ def PairwiseTopologyComparison_method1(topoRecordList, g_params):#{{{
             DGvalueTMList.append(dglist)
         else:
             DGvalueTMList.append([INIT_DGVALUE]*numTM)
-        gapSeqList.append ([(s==GAP) for s in topo]); 
 
 
     for i in range (numPair):
@@ -4676,9 +4669,7 @@ def PairwiseTopologyComparison_method1(topoRecordList, g_params):#{{{
             g_params['cntOutputPair'] += 1
 
 # remove records that are already compared
-    for i in range (numPair):
-        topoRecordList.pop(0)
-        topoRecordList.pop(0)
+    del topoRecordList[:2*numPair]
 
     return 0
 #}}}
@@ -4718,7 +4709,7 @@ def PairwiseTopologyComparison_method2(topoRecordList, g_params):#{{{
     seqIdentityList = [r[3] for r in topoRecordList ]
     dgScoreList = [r[4] for r in topoRecordList ]
 
-    posTMList = [ myfunc.GetTMPosition(topo) for topo in topoSeqList]
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     numTMList = [len(posTM) for posTM in posTMList]
     alignSeqLenList = [len(topo) for topo in topoSeqList ]
 
@@ -4726,10 +4717,9 @@ def PairwiseTopologyComparison_method2(topoRecordList, g_params):#{{{
     seqLenList=[ len(tp.replace(GAP,'')) for tp in topoSeqList]; 
     # Get topology at N terminal of each sequence 
     NtermStateList=[ lcmp.GetNtermState(topo) for topo in topoSeqList]; 
-    numPair = numSeq / 2
+    numPair = numSeq // 2
 
     DGvalueTMList = []
-    gapSeqList=[]
     for i in range(numSeq):
         topo = topoSeqList[i]
         dglist=dgScoreList[i]
@@ -4738,7 +4728,6 @@ def PairwiseTopologyComparison_method2(topoRecordList, g_params):#{{{
             DGvalueTMList.append(dglist)
         else:
             DGvalueTMList.append([INIT_DGVALUE]*numTM)
-        gapSeqList.append ([(s==GAP) for s in topo]); 
 
 
     for i in range (numPair):
@@ -4801,9 +4790,7 @@ def PairwiseTopologyComparison_method2(topoRecordList, g_params):#{{{
             g_params['cntOutputPair'] += 1
 
 # remove records that are already compared
-    for i in range (numPair):
-        topoRecordList.pop(0)
-        topoRecordList.pop(0)
+    del topoRecordList[:2*numPair]
 
     return 0
 #}}}
@@ -4842,7 +4829,7 @@ def PairwiseTopologyComparison_method3(topoRecordList, g_params):#{{{
     seqIdentityList = [r[3] for r in topoRecordList ]
     dgScoreList = [r[4] for r in topoRecordList ]
 
-    posTMList = [ myfunc.GetTMPosition(topo) for topo in topoSeqList]
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     numTMList = [len(posTM) for posTM in posTMList]
     alignSeqLenList = [len(topo) for topo in topoSeqList ]
 
@@ -4850,10 +4837,9 @@ def PairwiseTopologyComparison_method3(topoRecordList, g_params):#{{{
     seqLenList=[ len(tp.replace(GAP,'')) for tp in topoSeqList]; 
     # Get topology at N terminal of each sequence 
     NtermStateList=[ lcmp.GetNtermState(topo) for topo in topoSeqList]; 
-    numPair = numSeq / 2
+    numPair = numSeq // 2
 
     DGvalueTMList = []
-    gapSeqList=[]
     for i in range(numSeq):
         topo = topoSeqList[i]
         dglist=dgScoreList[i]
@@ -4862,7 +4848,6 @@ def PairwiseTopologyComparison_method3(topoRecordList, g_params):#{{{
             DGvalueTMList.append(dglist)
         else:
             DGvalueTMList.append([INIT_DGVALUE]*numTM)
-        gapSeqList.append ([(s==GAP) for s in topo]); 
 
 
     for i in range (numPair):
@@ -4971,12 +4956,20 @@ def PairwiseTopologyComparison_method3(topoRecordList, g_params):#{{{
             g_params['cntOutputPair'] += 1
 
 # remove records that are already compared
-    for i in range (numPair):
-        topoRecordList.pop(0)
-        topoRecordList.pop(0)
+    del topoRecordList[:2*numPair]
 
     return 0
 #}}}
+def GetTopoMSAFromRecordList(topoRecordList):#{{{
+    """
+    Get lcmp.TopoMSA from topology records of n-tuple
+    (seqID, anno, seq, seqIdentity, dgscore)
+    """
+    idList = [r[0] for r in topoRecordList]
+    annotationList = [r[1] for r in topoRecordList]
+    topoSeqList = [r[2] for r in topoRecordList]
+    return lcmp.TopoMSA(idList, annotationList, topoSeqList)
+#}}}
 def MultipleTopologyComparison(topoRecordList, g_params):#{{{
     print("method_topology_comparison=", g_params['method_topology_comparison'])
     if g_params['method_topology_comparison'] == 0:
@@ -4993,27 +4986,19 @@ def MultipleTopologyComparison_numTM(topoRecordList, g_params):#{{{
     Compare multiply aligned topologies by number of TM helices
     """
     numSeq = len(topoRecordList)
-    idList = [r[0] for r in topoRecordList ]
-    topoSeqList = [r[2] for r in topoRecordList ]
-    posTMList = [myfunc.GetTMPosition(topo) for topo in topoSeqList]
-    numTMList = [myfunc.CountTM(topo) for topo in topoSeqList]
-
-    Mcmp= [[0]*numSeq for x in range(numSeq)]
-    for i in range(numSeq): 
-        Mcmp[i][i] = 1
-    # All-to-all comparison
-    for i in range (numSeq):
-        numTM1 = numTMList[i]
-        for j in range(i+1, numSeq):
-            numTM2 = numTMList[j]
-            if numTM1 == numTM2:
-                Mcmp[i][j] = 1
-            else:
-                Mcmp[i][j] = 0
-    #copy the symmetric matrix
-    for i in range (numSeq):
-        for j in range(i+1, numSeq):
-            Mcmp[j][i]=Mcmp[i][j]
+    topomsa = GetTopoMSAFromRecordList(topoRecordList)
+    idList = topomsa.idList
+    topoSeqList = topomsa.topoSeqList
+    posTMList = topomsa.GetPosTMList()
+    numTMList = topomsa.GetNumTMList()
+
+    # All-to-all comparison, topologies with the same numTM are identical
+    Mcmp = lcmp.BitMatrix(numSeq)
+    numTMArray = np.array(numTMList)
+    for numTM in set(numTMList):
+        idxArray = np.flatnonzero(numTMArray == numTM)
+        (rowIdx, colIdx) = np.meshgrid(idxArray, idxArray, indexing='ij')
+        Mcmp.SetPairs(rowIdx.ravel(), colIdx.ravel())
 
     rootname = os.path.basename(os.path.splitext(g_params['inFile'])[0])
     if g_params['outpath'] != "":
@@ -5048,12 +5033,13 @@ def MultipleTopologyComparison_alignment(topoRecordList, g_params):#{{{
         print("You should probably run pairwise comparison.", file=sys.stderr)
         return -1
 
-    idList = [r[0] for r in topoRecordList ]
+    topomsa = GetTopoMSAFromRecordList(topoRecordList)
+    idList = topomsa.idList
     seqIdentityList = [r[3] for r in topoRecordList ]
     dgScoreList = [r[4] for r in topoRecordList ]
-    posTMList=[myfunc.GetTMPosition(topo) for topo in topoSeqList]
+    posTMList = topomsa.GetPosTMList()
     #topology at N terminal of each sequence 
-    NtermStateList=[ lcmp.GetNtermState(topo) for topo in topoSeqList]; 
+    NtermStateList = topomsa.GetNtermStateList()
 
     if g_params['method_getIDTgroup'] == 0:
         if not IsTrimmedMSA(topoSeqList):
@@ -5286,6 +5272,8 @@ def main(g_params):#{{{
                 g_params['isPrintIndexIDTGroup']=True; i += 1
             elif (argv[i] in ['-pdgcons', '--pdgcons' ]):
                 g_params['isPrintDGCons']=True; i += 1
+            elif (argv[i] in ["-cpu", "--cpu"]):
+                g_params['numCPU'], i = myfunc.my_getopt_int(argv, i)
             elif (argv[i] in [ "-mino" ,  "--mino", "-minoverlap", "--minoverlap"]):
                 g_params['min_TM_overlap'], i = myfunc.my_getopt_int(argv, i)
             elif (argv[i] in ['-debug-grouping', '--debug-grouping' ]):
@@ -5406,22 +5394,16 @@ def main(g_params):#{{{
             msg =  "Failed to open input file %s. Exit."
             print(msg%(g_params['inFile']), file=sys.stderr)
             return -1
-        unprocessedBuffer=""
-        topoRecordList=[]
-        isEOFreached = False
-        while 1:
-            buff = fpin.read(BLOCK_SIZE)
-            if len(buff) < BLOCK_SIZE:
-                isEOFreached=True
-            buff = unprocessedBuffer + buff
-            unprocessedBuffer = ReadTopoWithDGScoreFromBuffer(buff,
-                    topoRecordList, isEOFreached)
-            if len(topoRecordList) >= 2: 
+        # pairs are compared and written as they are read, so that the
+        # memory usage does not depend on the number of pairs
+        pairIterator = ReadTopoWithDGScorePair(fpin, BLOCK_SIZE)
+        if g_params['numCPU'] > 1:
+            PairwiseTopologyComparison_parallel(pairIterator, g_params)
+        else:
+            for topoRecordList in pairIterator:
                 if g_params['isRemoveSignalP']:
                     topoRecordList = RemoveSignalPeptide(topoRecordList, g_params['signalpDict'])
                 PairwiseTopologyComparison(topoRecordList, g_params)
-            if isEOFreached == True:
-                break
         fpin.close()
     elif g_params['mode_comparison'] == 1: # multiple sequence alignment
         # for multiple aligment, Read in topoRecordList at once, but in that
@@ -5498,6 +5480,7 @@ def InitGlobalParameter():#{{{
     g_params['logFile'] = ""
     g_params['origTopoMSAFile'] = ""
     g_params['min_TM_overlap'] = 5
+    g_params['numCPU'] = 1
     # maximum allowed DG difference for similar DGs
     g_params['maxDGdifference'] = 0.5; 
 
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import click
+import libtmsa
+
+@click.command()
+@click.argument('infile')
+@click.argument('outfile')
+
+def action(infile, outfile):
+    """
+    Convert topology MSA between FASTA format and the binary format (.tmsa),
+    the direction is determined by the extension of OUTFILE. DG scores in the
+    .topowithdgscore format are kept
+    """
+    (idList, annotationList, topoSeqList, dgScoreList) = \
+            libtmsa.ReadTopoMSAWithDGScore(infile)
+    if len(idList) == 0:
+        click.echo("No topology read from %s"%(infile), err=True)
+        sys.exit(1)
+    if libtmsa.IsTMSAFile(outfile):
+        status = libtmsa.WriteTMSA(outfile, idList, annotationList,
+                topoSeqList, dgScoreList)
+    else:
+        status = libtmsa.WriteTopoMSAFasta(outfile, idList, annotationList,
+                topoSeqList, dgScoreList)
+    if status != 0:
+        click.echo("Failed to write to file %s"%(outfile), err=True)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    action()
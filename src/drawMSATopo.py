@@ -16,6 +16,8 @@ import os
 import myfunc
 import math
 import libtopologycmp as lcmp
+import libdgprofile
+import libtmsa
 import numpy as np
 import Bio.SubsMat.MatrixInfo
 import subprocess
@@ -25,19 +27,24 @@ from colour import Color
 alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
 rundir = os.path.dirname(os.path.realpath(__file__))
-# pySVG
-# import pysvg.structure
-# import pysvg.builders
-# import pysvg.text
-
 # matplotlib
 # from matplotlib.font_manager import FontProperties
 # from pylab import *
 import matplotlib
 from matplotlib import pyplot as plt
 import matplotlib.gridspec as gridspec
+import matplotlib.collections
+import matplotlib.transforms
 
 import tempfile
+import xml.sax.saxutils
+import time
+import traceback
+import multiprocessing
+import hashlib
+import pickle
+import shutil
+import glob
 
 import logging
 import logging.config
@@ -55,6 +62,33 @@ colorList_DG_profile = ["red", "black", "green", "cyan", "yellow"]
 
 ylabel_DGprofile =  "\u0394G (kcal/mol)"
 
+# g_params after parsing the arguments, restored before drawing each file
+g_params_init = {}
+# process-wide caches of fonts, text sizes and glyph atlases
+g_fontCache = {}
+g_textSizeCache = {}
+g_glyphAtlasCache = {}
+
+# render cache, bump RENDER_CACHE_VERSION when the drawing code changes the
+# output for the same input
+RENDER_CACHE_VERSION = 1
+# parameters that do not change the image
+RUNTIME_PARAM_KEYS = ['outpath', 'numCPU', 'statusfile', 'log_config_file',
+        'logger', 'isQuiet', 'cacheDir', 'DGProfileStore', 'cacheKeyShrink', 'cacheKeyLayout',
+        'cacheKeyRender']
+# parameters that change the image but not the layout
+COLOR_PARAM_KEYS = ['mode', 'rasterBackend', 'isUseGlyphAtlas',
+        'isColorWholeTMbox', 'isColorByKingdom', 'colorhtml',
+        'memcolor_out_to_in', 'memcolor_in_to_out', 'memcolor_out_to_in_MSA',
+        'memcolor_in_to_out_MSA', 'loopcolor_in', 'loopcolor_in_MSA',
+        'loopcolor_out', 'loopcolor_out_MSA', 'spcolor']
+# parameters used by the shrinking of the alignment
+SHRINK_PARAM_KEYS = ['method', 'isShrink', 'method_shrink', 'isDrawKRBias',
+        'shrinkrate_TM', 'max_hold_loop', 'GAP']
+# files written by the drawing methods, $outpath/$rootname$suffix
+RENDER_OUTPUT_SUFFIXES = ['.png', '.dzi', '_files', '.svg', '.pdf',
+        '-crop.pdf', '-crop.png', '-crop.thumb.png', '.txtplot', '.html']
+
 PIL_user_path = os.environ['HOME'] + "/usr/lib64/python2.6/site-packages/PIL"
 if nodename.find("uppmax") != -1:
     sys.path.append(PIL_user_path)
@@ -62,6 +96,7 @@ if nodename.find("uppmax") != -1:
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
+from PIL import ImageColor
 
 GAP = myfunc.GAP
 
@@ -125,12 +160,17 @@ GAP = myfunc.GAP
 
 usage="""
 Usage:   drawMSATopo.py [-i] topomsa-in-fasta-format
+         the binary topology MSA (.tmsa) is also accepted
 Options:
   -method    STR   Modules to use for plotting, (default: pil)
                    Can be pyx, svg, pil, mat, core-rainbow
   -of        STR   Output format, can be png
   -l        FILE   Set input file list
   -mode      STR   Image mode, P or RGB, (default: P)
+  -raster    STR   Backend to paint the MSA region for the pil method, numpy
+                   or pil, (default: numpy)
+                   numpy: paint blocks of rows as arrays, much faster for
+                   large alignments
   -fontsize  INT   Set the font size, (default: 9)
   -text  y|n       Wether draw text i, o or M in the alignment, (default:  yes)
                    if no, then only the background color is shown
@@ -144,10 +184,21 @@ Options:
                    If MSA region is not drawn, this will also be disabled.
   -ptag y|n        Whether draw a vertical bar for proteins in different groups, (default: no)
   -dgpfile FILE    DG profile file produced by myscanDG.pl
+  -dgscanprog PROG Program to calculate DG profiles that are not given by
+                   -dgpfile, (default: $rundir/myscanDG.pl)
+                   stub: a simple hydrophobicity scan in Python, for tests
+  -dgpstore  DIR   Store calculated DG profiles in DIR, keyed by the
+                   sequence, so that they are not calculated again,
+                   (default: $cachedir/dgprofile if -cachedir is set)
   -aapath  DIR     Set path for amino acid sequence file, if set, sequence file
                    will be searched as $ID.fa
   -outpath DIR     Set outpath, (default: $dirname(infile))
   -autosize y|n    Whether autosize font, (default: yes)
+  -tilesize  INT   Render the image as a DeepZoom tile pyramid with tiles of
+                   INT pixels, $rootname.dzi and $rootname_files/, for the pil
+                   method. The image is rendered at full resolution without
+                   autosizing and only one strip of tiles is kept in memory
+                   (default: 0, no tiling)
   -shrink   y|n    Whether shrink gap regions, (default: yes)
   -m-shrink INT    method of shrinking, (default: 1)
                    0: shrink both non-TM region and TM region
@@ -170,6 +221,17 @@ Options:
   -h2wratio FLOAT       Set the height to width ratio (default: None). If not set, it use the original ratio
   -cleanplot       Make clean plot, works only for the PIL mode
   -showgap         Show gap as blank region, works only for the PIL mode
+  -cpu       INT   Number of processes to draw the input files in parallel,
+                   (default: 1)
+  -status   FILE   Write the status of drawing each input file to FILE
+  -cachedir  DIR   Cache the drawn files and the intermediate results (the
+                   shrinked alignment and the image layout) in DIR. They are
+                   keyed by the content of the input files and the drawing
+                   parameters, so that redrawing an unchanged input copies the
+                   files from DIR, and changing only the colors skips the
+                   shrinking and the layout, (default: not set)
+  -glyphatlas y|n  Whether draw the sequence text of the pil method from
+                   pre-rendered glyphs, (default: yes)
   -debug                Print debug information, (default: no)
 
 Created 2011-09-05, updated 2020-06-26, Nanjiang Shu
@@ -198,7 +260,7 @@ def WriteTXTAlignment(idList, annoList, alignedTopoSeqList,#{{{
     maxSizeAnno = max([len(x) for x in annoList])
     lengthAlignment = len(alignedTopoSeqList[0])
     numSeq = len(idList)
-    posTMList = [myfunc.GetTMPosition(x) for x in alignedTopoSeqList]
+    posTMList = lcmp.GetTMPositionList(alignedTopoSeqList)
 
     fpout = open(outfile, "w")
 
@@ -247,7 +309,7 @@ def WriteHTMLAlignment(idList, annoList, alignedTopoSeqList,#{{{
     maxSizeAnno = max([len(x) for x in annoList])
     lengthAlignment = len(alignedTopoSeqList[0])
     numSeq = len(idList)
-    posTMList = [myfunc.GetTMPosition(x) for x in alignedTopoSeqList]
+    posTMList = lcmp.GetTMPositionList(alignedTopoSeqList)
 
     fpout = open(outfile, "w")
     header = """
@@ -315,7 +377,7 @@ def WriteHTMLAlignment2(idList, annoList, alignedTopoSeqList,#{{{
     maxSizeAnno = max([len(x) for x in annoList])
     lengthAlignment = len(alignedTopoSeqList[0])
     numSeq = len(idList)
-    posTMList = [myfunc.GetTMPosition(x) for x in alignedTopoSeqList]
+    posTMList = lcmp.GetTMPositionList(alignedTopoSeqList)
 
     blosum62 = Bio.SubsMat.MatrixInfo.blosum62
 
@@ -420,7 +482,7 @@ def WriteHTMLAlignment3(idList, annoList, alignedTopoSeqList,#{{{
     maxSizeAnno = max([len(x) for x in annoList])
     lengthAlignment = len(alignedTopoSeqList[0])
     numSeq = len(idList)
-    posTMList = [myfunc.GetTMPosition(x) for x in alignedTopoSeqList]
+    posTMList = lcmp.GetTMPositionList(alignedTopoSeqList)
 
     fpout = open(outfile, "w")
     header = """
@@ -597,39 +659,24 @@ def MatchToAlignedSeq(unalignedseq, alignedseq, seqID): #{{{
     else:
         return newseq
 #}}}
+def DGProfileToList(dgp):#{{{
+    """Convert the DG profile (posArray, dgArray) to a list of tuples"""
+    return list(zip(dgp[0].tolist(), dgp[1].tolist()))
+#}}}
 def ReadInDGProfile(infile):#{{{
     """Read in DG profile output by myscanDG.pl"""
-    dgpDict = {}
     try:
-        fpin = open(infile, 'r')
-        buff = fpin.read()
-        fpin.close()
-        lines = buff.split('\n')
-        numLine = len(lines)
-        i = 0
-        seqid = ''
-        while i < numLine:
-            line = lines[i]
-            if line.find("#SeqID") == 0:
-                seqid = line.split()[1]
-            elif line.find("#Number of sliding windows") == 0:
-                numWin = int(line.split(':')[1])
-                dgp = []
-                for j in range(numWin):
-                    strs = lines[i+j+1].split()
-                    if len(strs) != 2:
-                        logger.debug("dgscan file error. strs=%s"%(str(strs)))
-                        sys.exit(1)
-                    dgp.append((int(strs[0]), float(strs[1])))
-                i += numWin
-                dgpDict[seqid] = dgp
-            i += 1
-        #print (dgpDict)
-        return dgpDict
-    except IOError:
-        print("Failed to read dgprofile", infile, file=sys.stderr)
+        dgpArrayDict = libdgprofile.ReadInDGProfile_array(infile)
+    except ValueError as e:
+        logger.debug("dgscan file error. %s"%(str(e)))
+        sys.exit(1)
+    if dgpArrayDict == None:
+        return None
+    dgpDict = {}
+    for seqid in dgpArrayDict:
+        dgpDict[seqid] = DGProfileToList(dgpArrayDict[seqid])
+    return dgpDict
 #}}}
-
 def MatchAlignedDGP(dgp, idxmap_aligne2seq, posindexmap, aligned_toposeq):#{{{
     """
     match dgp (a list of tuples) to the aligned toposeq
@@ -665,6 +712,113 @@ def MatchAlignedDGP(dgp, idxmap_aligne2seq, posindexmap, aligned_toposeq):#{{{
 #}}}
 
 
+def GetFont(fontfile, size):#{{{
+    """Get the truetype font of size from the process-wide font cache"""
+    key = (fontfile, size)
+    try:
+        return g_fontCache[key]
+    except KeyError:
+        fnt = ImageFont.truetype(fontfile, size)
+        g_fontCache[key] = fnt
+        return fnt
+#}}}
+def GetTextSize(fnt, text):#{{{
+    """Memoized fnt.getsize(text)"""
+    try:
+        key = (fnt.path, fnt.size, text)
+    except AttributeError: # not a truetype font
+        return fnt.getsize(text)
+    try:
+        return g_textSizeCache[key]
+    except KeyError:
+        size = fnt.getsize(text)
+        g_textSizeCache[key] = size
+        return size
+#}}}
+def GetGlyphAtlas(fnt, fontmode):#{{{
+    """
+    Get the glyph atlas of printable ASCII characters for a monospace font,
+    each glyph is rendered once to a mask of the same cell size.
+    Return (advance, pad, atlas), atlas is a uint8 array (256 x H x W),
+    or None if text blitted from the atlas is not the same as draw.text,
+    e.g. when advances are not whole pixels at tiny font sizes
+    """
+    key = (fnt.path, fnt.size, fontmode)
+    if key in g_glyphAtlasCache:
+        return g_glyphAtlasCache[key]
+    advance = GetTextSize(fnt, "a")[0]
+    pad = fnt.size
+    heightCell = GetTextSize(fnt, "Ay")[1] + 2*pad
+    widthCell = advance + 2*pad
+    atlas = np.zeros((256, heightCell, widthCell), dtype=np.uint8)
+    chars = "".join([chr(i) for i in range(32, 127)])
+    for c in chars:
+        im = Image.new("L", (widthCell, heightCell), 0)
+        draw = ImageDraw.Draw(im)
+        draw.fontmode = fontmode
+        draw.text((pad, pad), c, font=fnt, fill=255)
+        atlas[ord(c)] = np.asarray(im)
+    result = (advance, pad, atlas)
+    # verify with a text of all glyphs
+    if (advance < 1 or
+            GetTextSize(fnt, chars)[0] != len(chars)*advance):
+        result = None
+    else:
+        im1 = Image.new("L", (widthCell*(len(chars)+2), heightCell+2*pad), 0)
+        im2 = im1.copy()
+        draw = ImageDraw.Draw(im1)
+        draw.fontmode = fontmode
+        draw.text((pad, pad), chars, font=fnt, fill=255)
+        ImageDraw.Draw(im2).bitmap((0, 0), Image.fromarray(
+            GetGlyphRowMask(chars, result)), fill=255)
+        if not np.array_equal(np.asarray(im1), np.asarray(im2)):
+            result = None
+    g_glyphAtlasCache[key] = result
+    return result
+#}}}
+def GetGlyphRowMask(text, glyphAtlas):#{{{
+    """
+    Compose the mask of a single line text from the glyph atlas, glyphs
+    overlapping their neighbours are combined by maximum as FreeType does.
+    The mask is to be drawn at (x-pad, y-pad)
+    """
+    (advance, pad, atlas) = glyphAtlas
+    (heightCell, widthCell) = atlas.shape[1:]
+    codeList = np.frombuffer(text.encode('latin-1'), dtype=np.uint8)
+    # glyphs k positions apart do not overlap
+    k = (widthCell + advance - 1)//advance
+    mask = np.zeros((heightCell, (len(codeList)+k)*advance+widthCell),
+            dtype=np.uint8)
+    for p in range(k):
+        sel = codeList[p::k]
+        if len(sel) == 0:
+            continue
+        tiles = np.zeros((len(sel), heightCell, k*advance), dtype=np.uint8)
+        tiles[:, :, :widthCell] = atlas[sel]
+        strip = tiles.transpose(1, 0, 2).reshape(heightCell, -1)
+        region = mask[:, p*advance:p*advance+strip.shape[1]]
+        np.maximum(region, strip, out=region)
+    return mask
+#}}}
+def DrawTextMonospace(draw, xy, text, fnt, fill):#{{{
+    """
+    Draw a single line text of a monospace font, blitted from the glyph
+    atlas when it is enabled and applicable, otherwise with draw.text
+    """
+    glyphAtlas = None
+    if (g_params['isUseGlyphAtlas'] and len(text) > 0 and
+            isinstance(draw, ImageDraw.ImageDraw) and hasattr(fnt, 'path')
+            and isinstance(xy[0], int) and isinstance(xy[1], int)):
+        if text.isascii() and text.isprintable(): # printable ASCII
+            glyphAtlas = GetGlyphAtlas(fnt, draw.fontmode)
+    if glyphAtlas == None:
+        draw.text(xy, text, font=fnt, fill=fill)
+    else:
+        pad = glyphAtlas[1]
+        draw.bitmap((xy[0]-pad, xy[1]-pad),
+                Image.fromarray(GetGlyphRowMask(text, glyphAtlas)), fill=fill)
+#}}}
+
 def GetFontDimension(font_size):#{{{
     if font_size == 3:
         return (2,4)
@@ -708,8 +862,8 @@ def AutoSizeFontHistogram(ylabel, yticList, widthBox, heigthBox, #{{{
     while 1:
         if fs < 9:
             break
-        fnt = ImageFont.truetype(g_params['font_dir'] + g_params['font'], fs)
-        (fw, fh) = fnt.getsize("a")
+        fnt = GetFont(g_params['font_dir'] + g_params['font'], fs)
+        (fw, fh) = GetTextSize(fnt, "a")
         if fw <= maxAllowedFontWidth  and fh <= maxAllowdFontHeight:
             break
         else:
@@ -735,7 +889,7 @@ def AutoSizeFontTMBox(fontWidthAlign, fontHeightAlign, numSeq, specialProIdxDict
     while 1:
         if fs < 2:
             break
-        fnt = ImageFont.truetype(g_params['font_dir'] + g_params['font'], fs)
+        fnt = GetFont(g_params['font_dir'] + g_params['font'], fs)
         maxMargin = -9999999
         minMargin = 9999999
         for idx in specialProIdxList: # check all topologies with TMbox
@@ -749,7 +903,7 @@ def AutoSizeFontTMBox(fontWidthAlign, fontHeightAlign, numSeq, specialProIdxDict
                     ss = "TM %d"%(j+1)
                 ss = "%d"%(j+1)
                 boxWidth = fontWidthAlign * (e-b)
-                textWidth, textHeight = fnt.getsize(ss)
+                textWidth, textHeight = GetTextSize(fnt, ss)
                 margin = boxWidth - textWidth
                 #print ("margin, boxwidth, textwidth)=", (margin, boxWidth, textWidth))
                 if margin > maxMargin:
@@ -772,17 +926,17 @@ def AutoSizeFontTMBox(fontWidthAlign, fontHeightAlign, numSeq, specialProIdxDict
 
     g_params['font_size_TMbox'] = fs
     g_params['font_size_scalebar'] = int(fs*0.9+0.5)
-    g_params['fntScaleBar'] = ImageFont.truetype(g_params['font_dir'] +
+    g_params['fntScaleBar'] = GetFont(g_params['font_dir'] +
             g_params['font'], g_params['font_size_scalebar'])
-    g_params['fntTMbox'] = ImageFont.truetype(g_params['font_dir'] +
+    g_params['fntTMbox'] = GetFont(g_params['font_dir'] +
             g_params['font'], g_params['font_size_TMbox'])
-    g_params['fntTMbox_label'] = ImageFont.truetype(g_params['font_dir'] +
+    g_params['fntTMbox_label'] = GetFont(g_params['font_dir'] +
             "DejaVuSerif.ttf", g_params['font_size_TMbox']+1)
-    fnt = ImageFont.truetype(g_params['font_dir'] + g_params['font'], fs)
+    fnt = GetFont(g_params['font_dir'] + g_params['font'], fs)
 
     logger.debug("font_size_TMbox=%d", g_params['font_size_TMbox'])
     #print "fs=",fs
-    return fnt.getsize("M")
+    return GetTextSize(fnt, "M")
 #}}}
 def AutoSizeFontDGProfileLabel(dgprofileRegionHeight):# {{{
     """
@@ -796,8 +950,8 @@ def AutoSizeFontDGProfileLabel(dgprofileRegionHeight):# {{{
     while 1:
         if fs < 2:
             break
-        fnt = ImageFont.truetype(g_params['font_dir']+"DejaVuSerif-Bold.ttf", fs)
-        textWidth = fnt.getsize(ylabel_DGprofile)[0]
+        fnt = GetFont(g_params['font_dir']+"DejaVuSerif-Bold.ttf", fs)
+        textWidth = GetTextSize(fnt, ylabel_DGprofile)[0]
         diff = dgprofileRegionHeight - textWidth
 
         if  diff < margin:
@@ -811,8 +965,8 @@ def AutoSizeFontDGProfileLabel(dgprofileRegionHeight):# {{{
         if itr > MAX_ITR:
             break
     g_params['fntDGprofileLable'] = fnt
-    g_params['fntDGprofileTic'] = ImageFont.truetype(g_params['font_dir']+"DejaVuSerif.ttf", max(2, int(fs*0.65)))
-    g_params['fntDGprofileLegend'] = ImageFont.truetype(g_params['font_dir']+"DejaVuSerif.ttf", max(2, int(fs*0.7)))
+    g_params['fntDGprofileTic'] = GetFont(g_params['font_dir']+"DejaVuSerif.ttf", max(2, int(fs*0.65)))
+    g_params['fntDGprofileLegend'] = GetFont(g_params['font_dir']+"DejaVuSerif.ttf", max(2, int(fs*0.7)))
 
 # }}}
 
@@ -1103,7 +1257,7 @@ def ShrinkGapInMSA_obsolete(topoSeqList, specialProIdxList=[]):#{{{
     newList = [""]*numSeq
     posindexmap = {}
     num_specialpro = len(specialProIdxList)
-    posTMList = [myfunc.GetTMPosition(x) for x in topoSeqList]
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     (begTM_MSA, endTM_MSA) = GetPosTM_MSA(posTMList, specialProIdxList)
 
     cnt = 0
@@ -1218,10 +1372,148 @@ def ShrinkGapInMSA_obsolete(topoSeqList, specialProIdxList=[]):#{{{
     return posindexmap
 
 #}}}
-def ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[]): #{{{
+class ShrinkedTopoMSA: #{{{
+# Description:
+#   Shrinked topology MSA built column by column by ShrinkGapInMSA_0, with the
+#   data of the original MSA precomputed once, so that whether a region of
+#   the original MSA can be deleted is checked for all sequences at once
+#   instead of rescanning the sequences for each region
+# variables:
+#     rawMatrix     :  uint8 matrix (numSeq x lengthAlignment) of the
+#                      characters of the original MSA
+#     cumStateMatrix:  prefix counts of 'i', 'o' and 'M' of each sequence,
+#                      (3 x numSeq x lengthAlignment+1)
+#     nextNonGap    :  index of the first non-gap at or after j, or
+#                      lengthAlignment (numSeq x lengthAlignment+1)
+#     prevNonGap    :  index+1 of the last non-gap at or before j, or 0
+#     cumKR         :  prefix counts of columns with K or R
+#     columnList    :  columns of the shrinked MSA, ' ' for the filled gaps
+#     leftState     :  for each sequence, the state at the left side of the
+#                      next column, i.e. the last non-gap of the shrinked
+#                      sequence at index >= 1, or the state at index 0
+# Functions:
+#     AppendColumn(column)           : add a column to the shrinked MSA
+#     IsSafetoDeleteTheRegion(b, e)  : same as IsSafetoDeleteTheRegionNew
+#     HasState(state, b, e)          : whether each sequence has state in
+#                                      the region
+#     GetFirstNonGap(b, e)           : first non-gap of each sequence in the
+#                                      region, or ' '
+#     GetTopoSeqList()               : the shrinked topoSeqList
+    STATE_LIST = 'ioM'
+    def __init__(self, topoSeqList, per_K=[], per_R=[]):#{{{
+        self.numSeq = len(topoSeqList)
+        self.lengthAlignment = len(topoSeqList[0])
+        L = self.lengthAlignment
+        buff = "".join(topoSeqList).encode('ascii', 'replace')
+        self.rawMatrix = np.frombuffer(buff, dtype=np.uint8).reshape(
+                self.numSeq, L)
+        self.GAP = ord(g_params['GAP'])
+        idxType = np.min_scalar_type(L+1)
+
+        self.cumStateMatrix = np.zeros((len(self.STATE_LIST), self.numSeq,
+            L+1), dtype=idxType)
+        for k in range(len(self.STATE_LIST)):
+            np.cumsum(self.rawMatrix == ord(self.STATE_LIST[k]), axis=1,
+                    out=self.cumStateMatrix[k, :, 1:])
+
+        isNonGap = self.rawMatrix != self.GAP
+        idx = np.arange(L, dtype=idxType)
+        self.nextNonGap = np.full((self.numSeq, L+1), L, dtype=idxType)
+        self.nextNonGap[:, :L] = np.minimum.accumulate(
+                np.where(isNonGap, idx, L)[:, ::-1], axis=1)[:, ::-1]
+        self.prevNonGap = np.maximum.accumulate(
+                np.where(isNonGap, idx+1, 0), axis=1).astype(idxType)
+
+        self.isDrawKRBias = g_params['isDrawKRBias']
+        self.cumKR = np.zeros(L+1, dtype=np.int64)
+        if self.isDrawKRBias:
+            isKR = (np.array(per_K) + np.array(per_R)) > 0.0
+            np.cumsum(isKR, out=self.cumKR[1:])
+
+        self.columnList = []
+        self.leftState = np.zeros(self.numSeq, dtype=np.uint8)
+#}}}
+    def AppendColumn(self, column):#{{{
+        if len(self.columnList) == 0:
+            self.leftState = np.array(column, dtype=np.uint8)
+        else:
+            self.leftState = np.where(column != self.GAP, column,
+                    self.leftState)
+        self.columnList.append(column)
+#}}}
+    def GetColumn(self, j):#{{{
+        return self.rawMatrix[:, j]
+#}}}
+    def GetStateColumn(self, state):#{{{
+        return np.full(self.numSeq, ord(state), dtype=np.uint8)
+#}}}
+    def HasState(self, state, start, end):#{{{
+        cum = self.cumStateMatrix[self.STATE_LIST.index(state)]
+        return cum[:, end] > cum[:, start]
+#}}}
+    def GetFirstIndexOfState(self, state, start, end):#{{{
+        """Index of the first state in the region of each sequence, or end"""
+        isState = self.rawMatrix[:, start:end] == ord(state)
+        return np.where(isState.any(axis=1), start + isState.argmax(axis=1),
+                end)
+#}}}
+    def GetFirstNonGap(self, start, end):#{{{
+        p = self.nextNonGap[:, start]
+        isFound = p < end
+        return np.where(isFound, self.rawMatrix[np.arange(self.numSeq),
+            np.minimum(p, self.lengthAlignment-1)], ord(' ')).astype(np.uint8)
+#}}}
+    def IsSafetoDeleteTheRegion(self, startOrig, endOrig):#{{{
+        """Check whether the deletion of the region [startOrig, endOrig) of
+        the original MSA will affect the topology of any of the sequence, the
+        left side is checked with the shrinked MSA"""
+        L = self.lengthAlignment
+        if self.isDrawKRBias and self.cumKR[endOrig] > self.cumKR[startOrig]:
+            return False
+        if startOrig < 1 or endOrig >= L -1:
+            return False
+        cntFoundState = np.zeros(self.numSeq, dtype=np.int32)
+        for state in self.STATE_LIST:
+            cntFoundState += self.HasState(state, startOrig, endOrig)
+        if np.any(cntFoundState >= 3):
+            return False
+        idxSeq = np.flatnonzero(cntFoundState >= 1)
+        if idxSeq.size == 0:
+            return True
+        if len(self.columnList) == 0: # no left side
+            return False
+        # first and last non-gap of the region, and the first non-gap at the
+        # right side
+        p2 = np.minimum(self.nextNonGap[idxSeq, endOrig], L-1)
+        if np.any(p2 == L-1):
+            return False
+        raw = self.rawMatrix
+        firstT = raw[idxSeq, self.nextNonGap[idxSeq, startOrig]]
+        lastT = raw[idxSeq, self.prevNonGap[idxSeq, endOrig-1].astype(
+            np.int64)-1]
+        firstRightSideState = raw[idxSeq, p2]
+        firstLeftSideState = self.leftState[idxSeq]
+        isSameRight = (lastT == firstRightSideState)
+        isSameLeft = (firstT == firstLeftSideState)
+        isSafe = np.where(cntFoundState[idxSeq] == 2, isSameRight & isSameLeft,
+                isSameRight | isSameLeft)
+        return bool(isSafe.all())
+#}}}
+    def GetTopoSeqList(self):#{{{
+        if len(self.columnList) == 0:
+            return [""]*self.numSeq
+        matrix = np.ascontiguousarray(np.array(self.columnList,
+            dtype=np.uint8).T)
+        return [matrix[i].tobytes().decode('ascii').replace(" ", "-")
+                for i in range(self.numSeq)]
+#}}}
+#}}}
+def ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[], #{{{
+        topomsa=None):
     """Shrink the gap regions
     topoSeqList will be updated and return the maparray
-    by default ShrinkGapInMSA_0 is used"""
+    by default ShrinkGapInMSA_0 is used
+    topomsa: lcmp.TopoMSA of topoSeqList, cached data are reused if given"""
 # For columns without 'M', shrink the region of each sequencs in the block to 
 #     1. '' if there are no 'i' or 'o' in the block
 #     2. 'i' or ' ' if there is no 'o' in the block
@@ -1237,14 +1529,19 @@ def ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[]): #{{{
 #     For flat regions with length > 5, shrink them to  min(L, L/5*N/2)
 #     For smooth profile with a peak, take the region above 50% 
 #
-    (cnt_i, cnt_o, cnt_M, cnt_GAP, 
-            per_i, per_o, per_M, per_GAP) = lcmp.GetTopoStateFraction(
-                    topoSeqList)
+# The shrinked MSA is built by ShrinkedTopoMSA, which checks the safety of
+# deleting a region for all sequences at once, the result is the same as
+# with IsSafetoDeleteTheRegionNew
+    if topomsa == None:
+        topomsa = lcmp.TopoMSA(idList, [], topoSeqList)
+    (cntMatrix, perMatrix) = topomsa.GetStateProfile()
+    (cnt_i, cnt_o, cnt_M, cnt_SP, cnt_GAP) = cntMatrix.tolist()
+    (per_i, per_o, per_M, per_SP, per_GAP) = perMatrix.tolist()
     isDrawKRBias = g_params['isDrawKRBias']
 
     num_specialpro = len(specialProIdxList)
     #print ("num_specialpro=%d"%(num_specialpro))
-    posTMList = [myfunc.GetTMPosition(x) for x in topoSeqList]
+    posTMList = topomsa.GetPosTMList()
     (begTM_MSA, endTM_MSA) = GetPosTM_MSA(posTMList, specialProIdxList)
 
     if isDrawKRBias:
@@ -1267,7 +1564,7 @@ def ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[]): #{{{
     lengthAlignment = len(topoSeqList[0])
     i = 0
     numSeq = len(topoSeqList)
-    newList = [""]*numSeq
+    shrinked = ShrinkedTopoMSA(topoSeqList, per_K, per_R)
     posindexmap = {}
 
     cnt = 0
@@ -1280,95 +1577,50 @@ def ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[]): #{{{
             sumPer_o += per_o[i+j]
             j += 1
         if j >= 1:  #{{{ # non TM region
-#             print "per_i:", per_i[i:i+j]
-#             print "per_o:", per_o[i:i+j]
-#             print "sumPer_i:", sumPer_i, "sumPer_o:", sumPer_o
-#             print "Non M region: (%d, %d)"%(i,i+j)
             if sumPer_i > 0.0 or sumPer_o > 0.0: 
-#                 print "With i or o: region: (%d, %d)"%(i,i+j)
-                if not IsSafetoDeleteTheRegionNew(topoSeqList, i, i+j, newList,
-                        cnt, per_K, per_R):
+                if not shrinked.IsSafetoDeleteTheRegion(i, i+j):
                     # otherwise, just delete this region
                     if isDrawKRBias:
-                        repStatList = [] # state to be replaced
-                        for iseq in range(numSeq):
-                            subseq = topoSeqList[iseq][i:i+j].replace('-','')
-                            if len(subseq) == 0:
-                                repStatList.append(' ')
-                            else:
-                                repStatList.append(subseq[0])
-
+                        # state to be replaced
+                        repStatColumn = shrinked.GetFirstNonGap(i, i+j)
                         tmpcnt = 0
                         for pp in range(i, i+j):
                             if per_K[pp] > 0.0 or per_R[pp] > 0.0:
-                                for iseq in range(numSeq):
-                                    newList[iseq] += repStatList[iseq]
+                                shrinked.AppendColumn(repStatColumn)
                                 posindexmap[cnt] = pp
                                 cnt += 1
                                 tmpcnt += 1
                         if tmpcnt == 0:
                             pp = i
-                            for iseq in range(numSeq):
-                                newList[iseq] += repStatList[iseq]
+                            shrinked.AppendColumn(repStatColumn)
                             posindexmap[cnt] = pp
                             cnt += 1
                     else:
-                        if sumPer_i == 0.0 or sumPer_o == 0.0:#{{{
-                            for iseq in range(numSeq):
-                                segment = topoSeqList[iseq][i:i+j]
-                                if segment.find('o') >= 0:
-                                    newList[iseq] += 'o'
-                                elif segment.find('i') >= 0:
-                                    newList[iseq] += 'i'
-                                else:
-                                    newList[iseq] += ' '
+                        isHas_i = shrinked.HasState('i', i, i+j)
+                        isHas_o = shrinked.HasState('o', i, i+j)
+                        column = np.where(isHas_o, ord('o'), np.where(isHas_i,
+                            ord('i'), ord(' '))).astype(np.uint8)
+                        if ((sumPer_i == 0.0 or sumPer_o == 0.0) or
+                                not np.any(isHas_i & isHas_o)):
+                            shrinked.AppendColumn(column)
                             posindexmap[cnt] = i+j-1
                             cnt += 1
                         else:
-                            stateList = 'io'
-                            maxCntFoundState = 0
-                            for iseq in range(numSeq):
-                                cntFoundState = 0
-                                segment = topoSeqList[iseq][i:i+j]
-                                for state in stateList:
-                                    if segment.find(state) >= 0:
-                                        cntFoundState += 1
-                                if cntFoundState > maxCntFoundState:
-                                    maxCntFoundState = cntFoundState
-                                if maxCntFoundState >= 2:
-                                    break
-                            if maxCntFoundState == 2:
-                                for iseq in range(numSeq):
-                                    ss = topoSeqList[iseq][i:i+j]
-                                    p1 = ss.find('i')
-                                    p2 = ss.find('o')
-
-                                    if p1 >= 0 and p2 >= 0:
-                                        if p1 < p2:
-                                            newList[iseq] += 'io'
-                                        else:
-                                            newList[iseq] += 'oi'
-                                    else:
-                                        if p1 >= 0:
-                                            newList[iseq]+='ii'
-                                        elif p2 >= 0:
-                                            newList[iseq] += 'oo'
-                                        else:
-                                            newList[iseq] += '  '
-                                posindexmap[cnt] = i
-                                posindexmap[cnt+1] = i+j-1
-                                cnt += 2
-                            else:
-                                for iseq in range(numSeq):
-                                    segment = topoSeqList[iseq][i:i+j]
-                                    if segment.find('o') >= 0:
-                                        newList[iseq] += 'o'
-                                    elif segment.find('i') >= 0:
-                                        newList[iseq] += 'i'
-                                    else:
-                                        newList[iseq] += ' '
-                                posindexmap[cnt] = i+j-1
-                                cnt += 1#}}}
+                            # 'io' or 'oi' depending on which comes first,
+                            # 'ii', 'oo' or '  ' if not both exist
+                            isIOrder = (shrinked.GetFirstIndexOfState('i', i,
+                                i+j) < shrinked.GetFirstIndexOfState('o', i,
+                                    i+j))
+                            isBoth = isHas_i & isHas_o
+                            column1 = np.where(isBoth, np.where(isIOrder,
+                                ord('i'), ord('o')), column).astype(np.uint8)
+                            column2 = np.where(isBoth, np.where(isIOrder,
+                                ord('o'), ord('i')), column).astype(np.uint8)
+                            shrinked.AppendColumn(column1)
+                            shrinked.AppendColumn(column2)
+                            posindexmap[cnt] = i
+                            posindexmap[cnt+1] = i+j-1
+                            cnt += 2
 
             i += j;#}}}
         else: # starts a region with M#{{{
@@ -1376,21 +1628,15 @@ def ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[]): #{{{
                 if (IsAtTMregionOfSpecialPro(i, topoSeqList, specialProIdxList) 
                     #and (i < begTM_MSA and i>=endTM_MSA)
                     ):
-                    for iseq in range(numSeq):
-                        newList[iseq] +=  topoSeqList[iseq][i]
+                    shrinked.AppendColumn(shrinked.GetColumn(i))
                     posindexmap[cnt] = i
                     cnt += 1
                     print((i, lengthAlignment))
                 i += 1
             else:
-                sumPer_i = 0.0
-                sumPer_o + 0.0
                 while i+j < lengthAlignment and per_M[i+j] > 0.0:
-                    sumPer_i += per_i[i+j]
-                    sumPer_o += per_i[i+j]
                     j += 1
                 if j > 0:
-#                print "M region: (%d, %d)"%(i,i+j)
 #find all flat regions with >=5 residues
                     posFlatRegionList = GetPositionIdenticalAdjacentNumber(
                             cnt_M[i:i+j], i, 5)
@@ -1405,22 +1651,14 @@ def ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[]): #{{{
                     mergedRegionList = sorted(mergedRegionList, key=lambda
                             tup:tup[1])
 
-#             if i >= 1320 and i+j <= 1460:
-#                 print "region (%d, %d)"%(i, i+j)
-#                 print cnt_M[i:i+j]
-#                 print "posFlatRegionList:", posFlatRegionList
                     for (state, b, e) in mergedRegionList:
                         if state == 'flat':
                             if (per_GAP[b] > 0.95 and
-                                    IsSafetoDeleteTheRegionNew(topoSeqList, b, e,
-                                        newList, cnt, per_K, per_R)):
+                                    shrinked.IsSafetoDeleteTheRegion(b, e)):
                                 shrinkedwidth = 0
                             else:
                                 shrinkedwidth = max(5, int(round((e-b)* min(1.0,
                                     per_M[b]*1.5))))
-#                     if b >= 1320 and e <= 1460:
-#                         print ("per_M[b]:",per_M[b], "len(%d, %d)="%(b, e),
-#                         e-b, "shrinkedwidth=",shrinkedwidth)
                                 selectedIndexList = [b +
                                         int(round(k*(e-b-1)/float(shrinkedwidth-1)))
                                         for k in range(shrinkedwidth)]
@@ -1428,45 +1666,37 @@ def ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[]): #{{{
                                     for pp in range(b, e):
                                         if (per_K[pp] + per_R[pp] > 0.0):
                                             selectedIndexList.append(pp)
-                                    selectedIndexList = sorted(
-                                            list(set(selectedIndexList)))
+                                selectedIndexSet = set(selectedIndexList)
                                 for k in range(b, e):
-                                    if (k in selectedIndexList or
-                                            not IsSafetoDeleteTheRegionNew(
-                                                topoSeqList, k, k+1, newList, 
-                                                cnt, per_K, per_R)):
-                                        for iseq in range(numSeq):
-                                            newList[iseq] += topoSeqList[iseq][k]
-                                            posindexmap[cnt] = k
+                                    if (k in selectedIndexSet or
+                                            not shrinked.IsSafetoDeleteTheRegion(
+                                                k, k+1)):
+                                        shrinked.AppendColumn(
+                                                shrinked.GetColumn(k))
+                                        posindexmap[cnt] = k
                                         cnt += 1
                         else: #'nonflat'
                             minPerM = min(per_M[b:e])
                             maxPerM = max(per_M[b:e])
                             middlePerM = minPerM + (maxPerM - minPerM)*0.5 
-                            selectedIndexList = []
+                            selectedIndexSet = set([])
                             for k in range(b,e):
                                 if ((per_GAP[k] < 0.95 and per_M[k] > middlePerM) or
                                     per_M[k] > 0.65 or
                                     (isDrawKRBias and (per_K[k]+per_R[k])>0.0)):
-                                    selectedIndexList.append(k)
+                                    selectedIndexSet.add(k)
                             for k in range(b, e):
-                                if (k in selectedIndexList or
-                                        not IsSafetoDeleteTheRegionNew(topoSeqList,
-                                            k, k+1, newList, cnt, per_K, per_R)):
-                                    for iseq in range(numSeq):
-                                        newList[iseq] += topoSeqList[iseq][k]
-                                        posindexmap[cnt] = k
+                                if (k in selectedIndexSet or
+                                        not shrinked.IsSafetoDeleteTheRegion(
+                                            k, k+1)):
+                                    shrinked.AppendColumn(shrinked.GetColumn(k))
+                                    posindexmap[cnt] = k
                                     cnt += 1
-#                 if b >= 1320 and e <= 1460:
-#                     print ("numSelectedColumn=", numSelectedColumn, maxPerM,
-#                     "len(%d, %d)=%d"%(b, e, e-b))
                     i += j
                 else:
                     i += 1
 #}}}
-    for iseq in range(numSeq):
-        topoSeqList[iseq] = newList[iseq].replace(" ", "-")
-        #print ("%10s: %s"%(idList[iseq], topoSeqList[iseq]))
+    topoSeqList[:] = shrinked.GetTopoSeqList()
     return posindexmap
 #}}}
 def ShrinkGapInMSA_exclude_TMregion(idList, topoSeqList): #{{{
@@ -1556,8 +1786,7 @@ def ShrinkMSA_Method_2(topoSeqList, aaSeqList=[], posTMList=[],#{{{
         idxmap_shrink2align       map shrink-alignemnt          -> original-alignment
     """
     if posTMList == []:
-        for topo in topoSeqList:
-            posTMList.append(myfunc.GetTMPosition(topo))
+        posTMList.extend(lcmp.GetTMPositionList(topoSeqList))
 
     numSeq = len(topoSeqList)
 
@@ -1640,25 +1869,31 @@ def ShrinkMSA_Method_2(topoSeqList, aaSeqList=[], posTMList=[],#{{{
     return (idxmap_align2shrink, idxmap_shrink2align)
 #}}}
 
+def RunDGScanBatch(seqDict):# {{{
+    """
+    Calculate the DG profiles of seqDict {seqID: aaseq} by using the
+    dgscanProg, all sequences not in the DG profile store are scanned with one
+    call of dgscanProg
+    return {seqID: dgp}
+    """
+    if len(seqDict) == 0:
+        return {}
+    store = None
+    if g_params['DGProfileStore'] != "":
+        store = libdgprofile.DGProfileStore(g_params['DGProfileStore'])
+    dgpArrayDict = libdgprofile.GetDGProfileDict(seqDict,
+            g_params['dgscanProg'], store)
+    dgpDict = {}
+    for seqID in dgpArrayDict:
+        dgpDict[seqID] = DGProfileToList(dgpArrayDict[seqID])
+    return dgpDict
+# }}}
 def RunDGScan(aaseq, seqID):# {{{
     """
     Calculate the DG profile by using the dgscanProg
     return dgp
     """
-    dgp = None
-    tmpaaseqfile = tempfile.mktemp()
-    tmpdgpfile = tempfile.mktemp()
-    tmpfp = open(tmpaaseqfile, 'w')
-    tmpfp.write(">%s\n"%seqID)
-    tmpfp.write("%s\n"%aaseq)
-    tmpfp.close()
-    os.system("%s %s -lmin 21 -lmax 21 -o %s"%(g_params['dgscanProg'],
-        tmpaaseqfile, tmpdgpfile))
-    dgpDict = ReadInDGProfile(tmpdgpfile)
-    os.system("rm -f %s %s" %(tmpaaseqfile, tmpdgpfile))
-    if dgpDict and seqID in dgpDict:
-        dgp = dgpDict[seqID]
-    return dgp
+    return RunDGScanBatch({seqID: aaseq}).get(seqID)
 # }}}
 
 def DrawTMOfConsensus(posTM, xy0, fontWidth, fontHeight, draw): #{{{
@@ -1668,7 +1903,7 @@ def DrawTMOfConsensus(posTM, xy0, fontWidth, fontHeight, draw): #{{{
     font_size_TMbox = g_params['font_size_TMbox']
     fntTMbox = g_params['fntTMbox']
     heightTMbox = g_params['heightTMbox']
-    (fontWidthTMbox, fontHeightTMbox) = fntTMbox.getsize("M")
+    (fontWidthTMbox, fontHeightTMbox) = GetTextSize(fntTMbox, "M")
 
     fntTMbox = g_params['fntTMbox']
     (x0,y0) = xy0
@@ -1688,7 +1923,7 @@ def DrawTMOfConsensus(posTM, xy0, fontWidth, fontHeight, draw): #{{{
         draw.rectangle(box, fill="violet", outline="black")
 # draw text
         s = "TM %d"%(cnt+1)
-        (textwidth, textheight) = fntTMbox.getsize(s)
+        (textwidth, textheight) = GetTextSize(fntTMbox, s)
         textheight+=2
         x3 = int(round((x1+x2-textwidth)/2.0))
         y3 = int(round((y1+y2-textheight)/2.0))
@@ -1754,7 +1989,7 @@ def DrawDGProfile(dgpList, lengthAlignment, maxDG, minDG, xy0, #{{{
         y2 = y1
         draw.line([x1, y1, x2, y2],fill="black", width=ticline_width)
         text = "%.1f"%ytic
-        (textWidth,textHeight) = fnt.getsize(text)
+        (textWidth,textHeight) = GetTextSize(fnt, text)
         draw.text((x1-textWidth-lengthtic,y1-textHeight/2), text, font=fnt,
                 fill='black')
         ytic += step
@@ -1767,7 +2002,7 @@ def DrawDGProfile(dgpList, lengthAlignment, maxDG, minDG, xy0, #{{{
         y2 = y1
         draw.line([x1, y1, x2, y2],fill="black")
         text = "%.1f"%ytic
-        (textWidth,textHeight) = fnt.getsize(text)
+        (textWidth,textHeight) = GetTextSize(fnt, text)
         draw.text((x1-textWidth-lengthtic,y1-textHeight/2), text, font=fnt,
                 fill='black')
         ytic -= step
@@ -1799,7 +2034,7 @@ def DrawDGProfile(dgpList, lengthAlignment, maxDG, minDG, xy0, #{{{
     # draw legend
     if g_params['isDrawDGProfileLegend']:
         fnt = g_params['fntDGprofileLegend']
-        textWidth, textHeight = fnt.getsize("Initial Topology 1")
+        textWidth, textHeight = GetTextSize(fnt, "Initial Topology 1")
         bar_width = textWidth/3
         gap_item = textWidth/4
         gap_text_bar = bar_width/2
@@ -1821,7 +2056,7 @@ def DrawDGProfile(dgpList, lengthAlignment, maxDG, minDG, xy0, #{{{
                 text = "Initial Topology"
             else:
                 text = "Initial Topology %s"%(seqID.lstrip("rep"))
-            (textWidth,textHeight) = fnt.getsize(text)
+            (textWidth,textHeight) = GetTextSize(fnt, text)
             x = x0 + ii*item_width + x_padding
             y = y0 + dgprofileRegionHeight + textHeight/4
             draw.text((x,y), text, font=fnt, fill='black')
@@ -1842,7 +2077,7 @@ def DrawTMOfConsensus2(topoSeq, posTM, typeTM, TMname, foldType, xy0, fontWidth,
     font_size_TMbox = g_params['font_size_TMbox']
     fntTMbox = g_params['fntTMbox']
     heightTMbox = g_params['heightTMbox']
-    (fontWidthTMbox, fontHeightTMbox) = fntTMbox.getsize("M")
+    (fontWidthTMbox, fontHeightTMbox) = GetTextSize(fntTMbox, "M")
 
     fntTMbox = g_params['fntTMbox']
     (x0,y0) = xy0
@@ -1900,7 +2135,7 @@ def DrawTMOfConsensus2(topoSeq, posTM, typeTM, TMname, foldType, xy0, fontWidth,
             draw.rectangle(box, fill="violet", outline=outline_color, width=outline_width)
         last=x2
         # draw text_TMlabel
-        (textwidth, textheight) = fntTMbox.getsize(text_TMlabel)
+        (textwidth, textheight) = GetTextSize(fntTMbox, text_TMlabel)
         textheight+=2
         x3 = int(round((x1+x2-textwidth)/2.0))
         y3 = int(round((y1+y2-textheight)/2.0))
@@ -1944,7 +2179,7 @@ def DrawScale(length, posindexmap, xy0, font_size_alignment, #{{{
     widthAnnotation = g_params['widthAnnotation']
     annoSeqInterval = g_params['annoSeqInterval']
     fntTMbox = g_params['fntTMbox']
-    (fontWidthTMbox, fontHeightTMbox) = fntTMbox.getsize("a")
+    (fontWidthTMbox, fontHeightTMbox) = GetTextSize(fntTMbox, "a")
 
     isShrinked = False
 
@@ -1954,7 +2189,7 @@ def DrawScale(length, posindexmap, xy0, font_size_alignment, #{{{
 
     font_size_scalebar = g_params['font_size_scalebar']
     fntScaleBar = g_params['fntScaleBar']
-    (fontWidthScaleBar, fontHeightScaleBar) = fntScaleBar.getsize("a")
+    (fontWidthScaleBar, fontHeightScaleBar) = GetTextSize(fntScaleBar, "a")
     (x0,y0) = xy0
     x = x0 + widthAnnotation*fontWidth +annoSeqInterval* fontWidthTMbox
     y = y0
@@ -2004,9 +2239,9 @@ def DrawHistogram(histoList, xy0, histoRegionWidth, histoRegionHeight, #{{{
     font_size = AutoSizeFontHistogram(ylabel, yticList, widthBox, heightBox,
             spaceToLeftBorder)
     #font_size = 12
-    fnt = ImageFont.truetype(g_params['font_dir'] + g_params['font'],
+    fnt = GetFont(g_params['font_dir'] + g_params['font'],
             font_size)
-    (fw, fh) = fnt.getsize('-')
+    (fw, fh) = GetTextSize(fnt, '-')
     lengthtic = fw
     maxTicWidth = 0
     for ytic in yticList:
@@ -2018,13 +2253,13 @@ def DrawHistogram(histoList, xy0, histoRegionWidth, histoRegionHeight, #{{{
         box=[x1, y1 , x2, y2]
         draw.line(box, fill="black")
         text = str(ytic)
-        (textWidth, textHeight) = fnt.getsize(text)
+        (textWidth, textHeight) = GetTextSize(fnt, text)
         if textWidth > maxTicWidth:
             maxTicWidth = textWidth
         draw.text((x1-textWidth-lengthtic-3, y1-textHeight/2), text, font=fnt,
                 fill='black')
     text = ylabel
-    (textWidth, textHeight) = fnt.getsize(text)
+    (textWidth, textHeight) = GetTextSize(fnt, text)
     x = x0
     y = (y0 + marginTop + y0 + marginTop + heightBox) / 2
     xt = x - textWidth - 2*lengthtic - maxTicWidth - 3 - 10 
@@ -2175,6 +2410,119 @@ def GetSeqTag(anno):#{{{
         tag = ""
     return tag
 #}}}
+def GetTagColumnColor(anno, tag):#{{{
+    """Get the fill color of the tag column for a sequence"""
+    if tag.find("ClusterNo") != -1:
+        numCluster = int(tag.split("=")[1])
+        numTM = int(re.search("nTM=[0-9]+", anno).group(0).split("=")[1])
+        cntColor = 0
+        fillColor = "white"
+        if cntColor > 10 or numTM == 1:
+            fillColor = "black"
+        else:
+            if numCluster == 1:
+                fillColor = "#008000"
+            elif numCluster == 2:
+                fillColor = "#239C23"
+            elif numCluster == 3:
+                fillColor = "#35A835"
+            elif numCluster == 4:
+                fillColor = "#53B953"
+            elif numCluster == 5:
+                fillColor = "#6CC66C"
+            elif numCluster == 6:
+                fillColor = "#84D084"
+            elif numCluster == 7:
+                fillColor = "#A5DEA5"
+            elif numCluster == 8:
+                fillColor = "#CEEECE"
+            elif numCluster == 9:
+                fillColor = "#E2F5E2"
+            elif numCluster == 10:
+                fillColor = "#F5FCF5"
+            else:
+                numCluster = "black"
+        return fillColor
+    else:
+        fill_color = "white"
+        if tag == "IDT":
+            fill_color = "red"
+        elif tag == "INV":
+            fill_color ="blue"
+        elif tag == "TM2GAP":
+            fill_color ="green"
+        elif tag == "TM2SEQ":
+            fill_color ="violet"
+        elif tag == "TM2GAP_AND_TM2SEQ":
+            fill_color ="cyan"
+        elif tag == "Consensus":
+            fill_color = "purple"
+        elif tag == "OK":
+            fill_color = "red"
+        elif tag == "SHIFT":
+            fill_color = "pink"
+        elif tag == "INV_SHIFT":
+            fill_color ="lightgreen"
+        elif tag == "DIFF":
+            fill_color ="black"
+        elif tag == "Archaea":
+            fill_color ="blue"
+        elif tag == "Bacteria":
+            fill_color ="purple"
+        elif tag == "Eukaryota":
+            fill_color ="green"
+        return fill_color
+#}}}
+def GetMemColorOfRow(anno):#{{{
+    """Get the color for gaps within the TM region of a sequence"""
+    memcolor = "#FF0000"
+    if g_params['isColorByKingdom']:
+        if ("Eukaryota" in anno):
+            memcolor="#0000FF"; #blue
+        elif ("Archaea" in anno):
+            memcolor="#00FF00"; #Green
+        elif ("Bacteria" in anno):
+            memcolor="#FF0000"; #red
+        else:  
+            memcolor="#808080"; #grey
+    return memcolor
+#}}}
+def DrawTopologyText(anno, toposeq, aaseq, posTM, xy0, fnt, fontWidth, #{{{
+        draw):
+    """Draw the annotation and the sequence text of a topology MSA row"""
+    annoSeqInterval = g_params['annoSeqInterval']
+    widthAnnotation = g_params['widthAnnotation']
+    (fontWidthTMbox, fontHeightTMbox) = GetTextSize(g_params['fntTMbox'], "a")
+    lengthSeq = len(toposeq)
+    (x, y) = xy0
+    #ss = string.ljust(anno[0:widthAnnotation], widthAnnotation, " ")
+    ss = anno[0:widthAnnotation].ljust(widthAnnotation, " ")
+#    print "ss=%s, anno=%s" %(ss, anno)
+    fg="#000000";# black
+    DrawTextMonospace(draw, (x,y), ss, fnt, fg)
+    x += (widthAnnotation*fontWidth)
+    x += (annoSeqInterval*fontWidthTMbox)
+
+    fg = "#000000" #black
+# it is much faster to draw a block of text than drawing characters one by one
+    if g_params['isShowTMIndex']: # show TM1 TM2 TM3 ... in the middle of the TMbox
+        tmpli = [' ']*lengthSeq
+        for kk in range(len(posTM)):
+            (bb, ee) = posTM[kk]
+            tmpstr = "TM%d"%(kk+1)
+            mid = (bb+ee)//2
+            bb1 = min(mid - len(tmpstr)//2, lengthSeq - len(tmpstr)-1)
+            for jj in range(len(tmpstr)):
+                tmpli[bb1+jj] = tmpstr[jj]
+        seq = "".join(tmpli)
+    else:
+        if aaseq != "":
+            seq = aaseq
+        else:
+            seq = toposeq
+        seq = seq.replace('-',' ')
+    DrawTextMonospace(draw, (x,y), seq, fnt, fg)
+#}}}
 def DrawTopology(anno, tag, toposeq, aaseq, xy0, fnt, fontWidth, #{{{
         fontHeight, isDrawText, draw):
     """Draw the topology MSA region with the PIL library"""
@@ -2182,7 +2530,7 @@ def DrawTopology(anno, tag, toposeq, aaseq, xy0, fnt, fontWidth, #{{{
     annoSeqInterval = g_params['annoSeqInterval']
     widthAnnotation = g_params['widthAnnotation']
     fntTMbox = g_params['fntTMbox']
-    (fontWidthTMbox, fontHeightTMbox) = fntTMbox.getsize("a")
+    (fontWidthTMbox, fontHeightTMbox) = GetTextSize(fntTMbox, "a")
 
     (x0,y0) = xy0
     x = x0
@@ -2195,77 +2543,13 @@ def DrawTopology(anno, tag, toposeq, aaseq, xy0, fnt, fontWidth, #{{{
         
     #Draw a vertical bar for proteins in different groups
     if g_params['isDrawTagColumn']:
-        if tag.find("ClusterNo") != -1:#{{{
-            numCluster = int(tag.split("=")[1])
-            numTM = int(re.search("nTM=[0-9]+", anno).group(0).split("=")[1])
-            cntColor = 0
-            fillColor = "white"
-            if cntColor > 10 or numTM == 1:
-                fillColor = "black"
-            else:
-                if numCluster == 1:
-                    fillColor = "#008000"
-                elif numCluster == 2:
-                    fillColor = "#239C23"
-                elif numCluster == 3:
-                    fillColor = "#35A835"
-                elif numCluster == 4:
-                    fillColor = "#53B953"
-                elif numCluster == 5:
-                    fillColor = "#6CC66C"
-                elif numCluster == 6:
-                    fillColor = "#84D084"
-                elif numCluster == 7:
-                    fillColor = "#A5DEA5"
-                elif numCluster == 8:
-                    fillColor = "#CEEECE"
-                elif numCluster == 9:
-                    fillColor = "#E2F5E2"
-                elif numCluster == 10:
-                    fillColor = "#F5FCF5"
-                else:
-                    numCluster = "black"
-            box=[x+fontWidthTMbox*1,y,x+fontWidthTMbox*3,y+fontHeight]
-            draw.rectangle(box, fill=fillColor)
-        else:
-            fill_color = "white"
-            if tag == "IDT":
-                fill_color = "red"
-            elif tag == "INV":
-                fill_color ="blue"
-            elif tag == "TM2GAP":
-                fill_color ="green"
-            elif tag == "TM2SEQ":
-                fill_color ="violet"
-            elif tag == "TM2GAP_AND_TM2SEQ":
-                fill_color ="cyan"
-            elif tag == "Consensus":
-                fill_color = "purple"
-            elif tag == "OK":
-                fill_color = "red"
-            elif tag == "SHIFT":
-                fill_color = "pink"
-            elif tag == "INV_SHIFT":
-                fill_color ="lightgreen"
-            elif tag == "DIFF":
-                fill_color ="black"
-            elif tag == "Archaea":
-                fill_color ="blue"
-            elif tag == "Bacteria":
-                fill_color ="purple"
-            elif tag == "Eukaryota":
-                fill_color ="green"
-            #print ("TEST",x,y,tag,fill_color)
-            #fill_color='green'
-            box=[x+fontWidthTMbox*1,y,x+fontWidthTMbox*3,y+fontHeight]
-            draw.rectangle(box, fill=fill_color)
-
+        fill_color = GetTagColumnColor(anno, tag)
+        box=[x+fontWidthTMbox*1,y,x+fontWidthTMbox*3,y+fontHeight]
+        draw.rectangle(box, fill=fill_color)
         x += annoSeqInterval * fontWidthTMbox
-#}}}
 
 
     bg="#FFFFFF"; #white
-    memcolor = "#FF0000"
 
     lengthSeq = len(toposeq)
     (posTM, typeTM) = lcmp.GetTMType(toposeq)
@@ -2281,15 +2565,7 @@ def DrawTopology(anno, tag, toposeq, aaseq, xy0, fnt, fontWidth, #{{{
 
 # it is much faster to draw a block of text than drawing characters one by one
     i=0
-    if g_params['isColorByKingdom']:
-        if ("Eukaryota" in anno):
-            memcolor="#0000FF"; #blue
-        elif ("Archaea" in anno):
-            memcolor="#00FF00"; #Green
-        elif ("Bacteria" in anno):
-            memcolor="#FF0000"; #red
-        else:  
-            memcolor="#808080"; #grey
+    memcolor = GetMemColorOfRow(anno)
 
     while i < lengthSeq:
         j=i
@@ -2325,55 +2601,314 @@ def DrawTopology(anno, tag, toposeq, aaseq, xy0, fnt, fontWidth, #{{{
 
 # draw text, foreground
     if isDrawText:
-        x = x0
-        y = y0
-        #ss = string.ljust(anno[0:widthAnnotation], widthAnnotation, " ")
-        ss = label[0:widthAnnotation].ljust(widthAnnotation, " ")
-#    print "ss=%s, anno=%s" %(ss, anno)
-        fg="#000000";# black
-        draw.text((x,y), ss, font=fnt, fill=fg)
-        x += (widthAnnotation*fontWidth)
-        x += (annoSeqInterval*fontWidthTMbox)
+        DrawTopologyText(anno, toposeq, aaseq, posTM, (x0,y0), fnt, fontWidth,
+                draw)
+#}}}
+def GetInk(image, color):#{{{
+    """Get the pixel value of color for image, allocating a palette entry
+    for mode P in the same way as ImageDraw does"""
+    ink = ImageColor.getcolor(color, image.mode)
+    if image.mode == "P":
+        ink = image.palette.getcolor(ink, image)
+    return ink
+#}}}
+def GetTopologyColorCodeMatrix(rowList, colorList):#{{{
+    """
+    Encode the background colors of a block of topology MSA rows as a
+    uint8 matrix (numRow x lengthAlignment) of indices to colorList, new
+    colors are appended to colorList. Colors are the same as DrawTopology
+    """
+    codeDict = {}
+    def GetCode(color):
+        if color not in codeDict:
+            codeDict[color] = len(colorList)
+            colorList.append(color)
+        return codeDict[color]
+    codeWhite = GetCode("#FFFFFF")
+    buff = "".join([row[2] for row in rowList]).encode('ascii', 'replace')
+    rawMatrix = np.frombuffer(buff, dtype=np.uint8).reshape(len(rowList), -1)
+    codeMatrix = np.full(rawMatrix.shape, codeWhite, dtype=np.uint8)
+    for (char, key) in [('i', 'loopcolor_in_MSA'), ('o', 'loopcolor_out_MSA'),
+            ('S', 'spcolor')]:
+        codeMatrix[rawMatrix == ord(char)] = GetCode(g_params[key])
+    colorTMDict = {'M': g_params['memcolor_out_to_in_MSA'],
+            'W': g_params['memcolor_in_to_out_MSA']}
+    isOtherState = ((rawMatrix != ord('M')) & (rawMatrix != ord('i')) &
+            (rawMatrix != ord('o')) & (rawMatrix != ord('S')))
+    tmTypeList = lcmp.GetTMTypeList([row[2] for row in rowList])
+    for k in range(len(rowList)):
+        (anno, toposeq) = (rowList[k][0], rowList[k][2])
+        (posTM, typeTM) = tmTypeList[k]
+        codeRow = codeMatrix[k]
+        isM = (rawMatrix[k] == ord('M'))
+        if g_params['isColorWholeTMbox']:
+            codeMem = GetCode(GetMemColorOfRow(anno))
+            for (b,e) in posTM:
+                codeRow[b:e][isOtherState[k,b:e]] = codeMem
+        for jj in range(len(posTM)):
+            (b,e) = posTM[jj]
+            if typeTM[jj] in colorTMDict:
+                codeRow[b:e][isM[b:e]] = GetCode(colorTMDict[typeTM[jj]])
+            else: # DrawTopology keeps the color of the previous segment
+                i = b
+                while i < e:
+                    if isM[i]:
+                        j = i
+                        while j < e and isM[j]:
+                            j += 1
+                        codeRow[i:j] = codeRow[i-1] if i > 0 else codeWhite
+                        i = j
+                    else:
+                        i += 1
+    return codeMatrix
+#}}}
+def DrawTopologyBlock_numpy(rowList, fnt, fontWidth, fontHeight, #{{{
+        isDrawText, image, draw):
+    """
+    Draw a block of consecutive topology MSA rows, rowList is a list of
+    (anno, tag, toposeq, aaseq, (x,y)) with y increased by fontHeight.
+    The background of the rows is painted as NumPy arrays of colors and
+    pasted to image with Image.fromarray, text is drawn on top row by row.
+    The result is the same as calling DrawTopology for each row.
+    """
+    if len(rowList) == 0:
+        return
+    if isinstance(image, TiledImage):
+        image.AddRowBlock(rowList, fnt, fontWidth, fontHeight, isDrawText)
+        return
+    annoSeqInterval = g_params['annoSeqInterval']
+    widthAnnotation = g_params['widthAnnotation']
+    (fontWidthTMbox, fontHeightTMbox) = GetTextSize(g_params['fntTMbox'], "a")
+    (x0, y0) = rowList[0][4]
+    x = x0 + widthAnnotation * fontWidth
+    xTag = x + fontWidthTMbox
+    if g_params['isDrawTagColumn']:
+        x += annoSeqInterval * fontWidthTMbox
 
-        fg = "#000000" #black
-# it is much faster to draw a block of text than drawing characters one by one
-        if g_params['isShowTMIndex']: # show TM1 TM2 TM3 ... in the middle of the TMbox
-            tmpli = [' ']*lengthSeq
-            for kk in range(len(posTM)):
-                (bb, ee) = posTM[kk]
-                tmpstr = "TM%d"%(kk+1)
-                mid = (bb+ee)/2
-                bb1 = min(mid - len(tmpstr)/2, lengthSeq - len(tmpstr)-1)
-                for jj in range(len(tmpstr)):
-                    tmpli[bb1+jj] = tmpstr[jj]
-            seq = "".join(tmpli)
-        else:
-            if aaseq != "":
-                seq = aaseq
+    colorList = []
+    codeMatrix = GetTopologyColorCodeMatrix(rowList, colorList)
+    tagCodeList = []
+    if g_params['isDrawTagColumn']:
+        for row in rowList:
+            color = GetTagColumnColor(row[0], row[1])
+            if color not in colorList:
+                colorList.append(color)
+            tagCodeList.append(colorList.index(color))
+    inkList = [GetInk(image, color) for color in colorList]
+    if image.mode == "P":
+        inkArray = np.array(inkList, dtype=np.uint8)
+    else:
+        inkArray = np.array(inkList, dtype=np.uint8).reshape(len(inkList), -1)
+
+    def ToImage(cellMatrix, cellWidth):
+        # each cell is fontHeight x cellWidth pixels, the rectangles of
+        # DrawTopology include one more column and row at the bottom right
+        pixelMatrix = np.repeat(np.repeat(cellMatrix, fontHeight, axis=0),
+                cellWidth, axis=1)
+        pixelMatrix = np.concatenate((pixelMatrix, pixelMatrix[:, -1:]),
+                axis=1)
+        pixelMatrix = np.concatenate((pixelMatrix, pixelMatrix[-1:, :]),
+                axis=0)
+        return Image.fromarray(np.ascontiguousarray(inkArray[pixelMatrix]),
+                image.mode)
+
+    (numRow, lengthSeq) = codeMatrix.shape
+    numRowPerBlock = max(1, (1<<24)//max(1, lengthSeq*fontWidth*fontHeight))
+    for start in range(0, numRow, numRowPerBlock):
+        end = min(numRow, start+numRowPerBlock)
+        y = y0 + start*fontHeight
+        tagImage = None
+        if g_params['isDrawTagColumn']:
+            tagMatrix = np.array(tagCodeList[start:end],
+                    dtype=np.uint8).reshape(-1, 1)
+            tagImage = ToImage(tagMatrix, 2*fontWidthTMbox)
+            image.paste(tagImage, (xTag, y))
+        seqImage = ToImage(codeMatrix[start:end], fontWidth)
+        image.paste(seqImage, (x, y))
+        if isDrawText:
+            for k in range(start, end):
+                (anno, tag, toposeq, aaseq, xy0) = rowList[k]
+                # restore the background of the row as it was before its
+                # text is drawn
+                dy = (k-start)*fontHeight
+                if tagImage != None:
+                    image.paste(tagImage.crop((0, dy, tagImage.size[0],
+                        dy+fontHeight+1)), (xTag, xy0[1]))
+                image.paste(seqImage.crop((0, dy, seqImage.size[0],
+                    dy+fontHeight+1)), (x, xy0[1]))
+                (posTM, typeTM) = lcmp.GetTMType(toposeq)
+                DrawTopologyText(anno, toposeq, aaseq, posTM, xy0, fnt,
+                        fontWidth, draw)
+#}}}
+def ShiftY(xy, dy):#{{{
+    """Shift the y coordinates of xy, given as [x0, y0, x1, y1, ...] or
+    [(x0,y0), (x1,y1), ...], by dy"""
+    if len(xy) > 0 and isinstance(xy[0], (tuple, list)):
+        return [(p[0], p[1]+dy) for p in xy]
+    return [xy[i]+dy if i%2 == 1 else xy[i] for i in range(len(xy))]
+#}}}
+def GetYRange(xy):#{{{
+    if len(xy) > 0 and isinstance(xy[0], (tuple, list)):
+        yList = [p[1] for p in xy]
+    else:
+        yList = xy[1::2]
+    return (min(yList), max(yList))
+#}}}
+class TiledImage(object):#{{{
+    """
+    An image for DrawMSATopo_PIL that is rendered as a DeepZoom tile pyramid
+    instead of one canvas in memory. It is used both as the image and the
+    ImageDraw object. Drawing calls are recorded with their vertical extent
+    and replayed on one strip of tiles at a time, rows of the MSA region are
+    kept as sequences, so that the peak memory is bounded by the size of a
+    strip whatever the number of sequences.
+
+    variables:
+        mode       image mode
+        size       (width, height) of the full resolution image
+        color      background color
+        tileSize   size of the square tiles in pixels
+        tileFormat image format of the tiles, e.g. png
+        opList     recorded operations (ymin, ymax, name, args, kwargs)
+
+    functions:
+        rectangle, line, ellipse, text, paste   as ImageDraw.Draw and Image
+        AddRowBlock(rowList, fnt, fontWidth, fontHeight, isDrawText)
+        RenderStrip(top, height)
+        save(outFile)   write $rootname.dzi and $rootname_files/
+    """
+    def __init__(self, mode, size, color, tileSize, tileFormat="png"):
+        self.mode = mode
+        self.size = size
+        self.color = color
+        self.tileSize = tileSize
+        self.tileFormat = tileFormat
+        self.opList = []
+
+    def _AddShape(self, name, xy, kwargs):
+        xy = list(xy)
+        (ymin, ymax) = GetYRange(xy)
+        margin = kwargs.get('width', 1) + 1
+        self.opList.append((ymin-margin, ymax+margin, name, (xy,), kwargs))
+
+    def rectangle(self, xy, **kwargs):
+        self._AddShape('rectangle', xy, kwargs)
+
+    def line(self, xy, **kwargs):
+        self._AddShape('line', xy, kwargs)
+
+    def ellipse(self, xy, **kwargs):
+        self._AddShape('ellipse', xy, kwargs)
+
+    def text(self, xy, text, **kwargs):
+        font = kwargs.get('font', None)
+        if font == None:
+            font = ImageFont.load_default()
+        heightLine = GetTextSize(font, "Ay")[1]
+        y = xy[1]
+        self.opList.append((y-heightLine, y+heightLine*(text.count("\n")+2),
+            'text', (list(xy), text), kwargs))
+
+    def paste(self, im, box, mask=None):
+        y = box[1]
+        self.opList.append((y, y+im.size[1], 'paste', (im, list(box)),
+            {'mask':mask}))
+
+    def AddRowBlock(self, rowList, fnt, fontWidth, fontHeight, isDrawText):
+        if len(rowList) > 0:
+            y0 = rowList[0][4][1]
+            self.opList.append((y0-fontHeight,
+                y0+(len(rowList)+2)*fontHeight, 'rowblock',
+                (rowList, fnt, fontWidth, fontHeight, isDrawText), {}))
+
+    def RenderStrip(self, top, height):
+        """Render the region of rows [top, top+height) of the image"""
+        strip = Image.new(self.mode, (self.size[0], height), self.color)
+        draw = ImageDraw.Draw(strip)
+        bottom = top + height
+        for (ymin, ymax, name, args, kwargs) in self.opList:
+            if ymax < top or ymin >= bottom:
+                continue
+            if name == 'text':
+                draw.text(ShiftY(args[0], -top), args[1], **kwargs)
+            elif name == 'paste':
+                strip.paste(args[0], tuple(ShiftY(args[1], -top)), **kwargs)
+            elif name == 'rowblock':
+                (rowList, fnt, fontWidth, fontHeight, isDrawText) = args
+                y0 = rowList[0][4][1]
+                # rows overlapping the strip, one more row on each side for
+                # text extending out of its row
+                b = max(0, (top-y0)//fontHeight-1)
+                e = min(len(rowList), (bottom-y0)//fontHeight+2)
+                subRowList = [row[:4] + ((row[4][0], row[4][1]-top),)
+                        for row in rowList[b:e]]
+                DrawTopologyBlock_numpy(subRowList, fnt, fontWidth,
+                        fontHeight, isDrawText, strip, draw)
             else:
-                seq = toposeq
-            seq = seq.replace('-',' ')
-        draw.text((x,y), seq, font=fnt, fill=fg)
-#         i=0
-#         while i < lengthSeq:
-#             j=i
-#             while j < lengthSeq and seq[j] == seq[i]:
-#                 j+=1
-#             lengthSegment=j-i
-#             if seq[i] == "-":
-#                 fg="#FFFFFF"
-#             else:
-#                 fg="#000000"
-#             draw.text((x,y), seq[i:j], font=fnt, fill=fg)
-#             x+=(fontWidth*lengthSegment)
-#             i=j
+                getattr(draw, name)(ShiftY(args[0], -top), **kwargs)
+        return strip
+
+    def save(self, outFile):
+        """Write the image as a DeepZoom pyramid, tiles of the full
+        resolution level are rendered strip by strip and each lower level is
+        downsampled from the tiles of the level above"""
+        rootname = os.path.splitext(outFile)[0]
+        tiledir = rootname + "_files"
+        ext = self.tileFormat
+        tileSize = self.tileSize
+        (width, height) = self.size
+        maxLevel = int(math.ceil(math.log(max(width, height, 1), 2)))
+        levelDir = "%s%s%d"%(tiledir, os.sep, maxLevel)
+        if not os.path.exists(levelDir):
+            os.makedirs(levelDir)
+        for row in range(int(math.ceil(height/float(tileSize)))):
+            top = row*tileSize
+            strip = self.RenderStrip(top, min(tileSize, height-top))
+            for col in range(int(math.ceil(width/float(tileSize)))):
+                tile = strip.crop((col*tileSize, 0,
+                    min(width, (col+1)*tileSize), strip.size[1]))
+                tile.save("%s%s%d_%d.%s"%(levelDir, os.sep, col, row, ext))
+            del strip
+        for level in range(maxLevel-1, -1, -1):
+            upperDir = levelDir
+            levelDir = "%s%s%d"%(tiledir, os.sep, level)
+            if not os.path.exists(levelDir):
+                os.makedirs(levelDir)
+            scale = 2**(maxLevel-level)
+            (w, h) = (int(math.ceil(width/float(scale))),
+                    int(math.ceil(height/float(scale))))
+            (wu, hu) = (int(math.ceil(width/float(scale//2))),
+                    int(math.ceil(height/float(scale//2))))
+            for row in range(int(math.ceil(h/float(tileSize)))):
+                for col in range(int(math.ceil(w/float(tileSize)))):
+                    x0 = col*2*tileSize
+                    y0 = row*2*tileSize
+                    merged = Image.new("RGB", (min(2*tileSize, wu-x0),
+                        min(2*tileSize, hu-y0)))
+                    for (dc, dr) in [(0,0), (1,0), (0,1), (1,1)]:
+                        tilefile = "%s%s%d_%d.%s"%(upperDir, os.sep,
+                                2*col+dc, 2*row+dr, ext)
+                        if os.path.exists(tilefile):
+                            merged.paste(Image.open(tilefile).convert("RGB"),
+                                    (dc*tileSize, dr*tileSize))
+                    tile = merged.resize((min(tileSize, w-col*tileSize),
+                        min(tileSize, h-row*tileSize)), Image.LANCZOS)
+                    tile.save("%s%s%d_%d.%s"%(levelDir, os.sep, col, row,
+                        ext))
+        fpout = open(rootname + ".dzi", "w")
+        fpout.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fpout.write('<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"'
+                ' TileSize="%d" Overlap="0" Format="%s">\n'%(tileSize, ext))
+        fpout.write('  <Size Width="%d" Height="%d"/>\n'%(width, height))
+        fpout.write('</Image>\n')
+        fpout.close()
 #}}}
 def CalculateImageParameter(fontWidth, fontHeight, lengthAlignment, numSeq, numSeprationLine, sectionSepSpace, specialProIdxDict, posTMList, TMnameList,  widthAdjustRatio):# {{{
     """
     Calculate image parameters for the PIL method
     """
-    (fontWidthScaleBar, fontHeightScaleBar) = g_params['fntScaleBar'].getsize("a")
-    fontHeightDGProfileLegend = g_params['fntDGprofileLegend'].getsize("a")[1]
+    (fontWidthScaleBar, fontHeightScaleBar) = GetTextSize(g_params['fntScaleBar'], "a")
+    fontHeightDGProfileLegend = GetTextSize(g_params['fntDGprofileLegend'], "a")[1]
     (fontWidthTMbox, fontHeightTMbox) = AutoSizeFontTMBox(fontWidth, fontHeight, numSeq, specialProIdxDict, posTMList, TMnameList)
 
     width = ((g_params['widthAnnotation'] + lengthAlignment) * (fontWidth) +
@@ -2407,16 +2942,186 @@ def CalculateImageParameter(fontWidth, fontHeight, lengthAlignment, numSeq, numS
             )
     return (width, height, fontWidthTMbox, fontHeightTMbox, dgprofileRegionWidth, dgprofileRegionHeight, histoRegionWidth, histoRegionHeight)
 # }}}
+class ImageLayout: #{{{
+# Description:
+#   Layout of the image drawn by DrawMSATopo_PIL, as solved by
+#   SolveImageLayout. It can be reused to draw the same alignment again
+#   without solving, e.g. with different colors
+# variables:
+#     fnt, font_size           :  font of the alignment and its size
+#     fontWidth, fontHeight    :  size of an alignment cell in pixels
+#     isDrawText               :  whether text can be drawn
+#     width, height            :  size of the image
+#     fontWidthTMbox, fontHeightTMbox, dgprofileRegionWidth,
+#     dgprofileRegionHeight, histoRegionWidth, histoRegionHeight
+#                              :  as returned by CalculateImageParameter
+#     widthAdjustRatio         :  adjustment of width to get H2W_ratio
+#     fontParams               :  fonts in g_params set by
+#                                 CalculateImageParameter and marginY
+# Functions:
+#     Apply(g_params)          : set fontParams to g_params
+#   fonts are pickled as (fontfile, size) and taken from the font cache when
+#   unpickled, so that a layout can be stored in the render cache
+    FONT_PARAM_KEYS = ['font_size_TMbox', 'font_size_scalebar', 'fntScaleBar',
+            'fntTMbox', 'fntTMbox_label', 'fntDGprofileLable',
+            'fntDGprofileTic', 'fntDGprofileLegend', 'marginY']
+    def __init__(self, fnt, font_size, fontWidth, fontHeight, isDrawText,#{{{
+            imageParameter, widthAdjustRatio, g_params):
+        self.fnt = fnt
+        self.font_size = font_size
+        self.fontWidth = fontWidth
+        self.fontHeight = fontHeight
+        self.isDrawText = isDrawText
+        (self.width, self.height, self.fontWidthTMbox, self.fontHeightTMbox,
+                self.dgprofileRegionWidth, self.dgprofileRegionHeight,
+                self.histoRegionWidth, self.histoRegionHeight) = imageParameter
+        self.widthAdjustRatio = widthAdjustRatio
+        self.fontParams = {}
+        for key in self.FONT_PARAM_KEYS:
+            if key in g_params:
+                self.fontParams[key] = g_params[key]
+#}}}
+    def Apply(self, g_params):#{{{
+        g_params.update(self.fontParams)
+#}}}
+    def __getstate__(self):#{{{
+        state = dict(self.__dict__)
+        state['fnt'] = (self.fnt.path, self.fnt.size)
+        state['fontParams'] = dict(self.fontParams)
+        for key in state['fontParams']:
+            if key.startswith('fnt'):
+                fnt = state['fontParams'][key]
+                state['fontParams'][key] = (fnt.path, fnt.size)
+        return state
+#}}}
+    def __setstate__(self, state):#{{{
+        self.__dict__.update(state)
+        self.fnt = GetFont(*self.fnt)
+        for key in self.fontParams:
+            if key.startswith('fnt'):
+                self.fontParams[key] = GetFont(*self.fontParams[key])
+#}}}
+#}}}
+def SolveImageLayout(inFile, lengthAlignment, numSeq, numSeprationLine, #{{{
+        sectionSepSpace, specialProIdxDict, posTMList, TMnameList,
+        isAutoSize):
+    """
+    Solve the layout of the image for DrawMSATopo_PIL. With isAutoSize, the
+    largest font_size (and then the largest cell) for which the image is not
+    larger than MAXIMAGESIZE is found by binary search, the image size is
+    monotonic in them. Fonts are cached, so each probe is cheap.
+    Return an ImageLayout
+    """
+    H2W_ratio = g_params['H2W_ratio']
+    fontfile = g_params['font_dir'] + g_params['font']
+    maxImageSize = g_params['MAXIMAGESIZE']
+    def Calc(fontWidth, fontHeight, widthAdjustRatio):
+        return CalculateImageParameter(fontWidth, fontHeight, lengthAlignment,
+                numSeq, numSeprationLine, sectionSepSpace, specialProIdxDict,
+                posTMList, TMnameList, widthAdjustRatio)
+    def IsFit(para):
+        return para[0]*para[1] <= maxImageSize
+    def SaveFontState():
+        return dict((key, g_params[key]) for key in ImageLayout.FONT_PARAM_KEYS
+                if key in g_params)
+    def AdjustH2WRatio(fontWidth, fontHeight, para):
+        widthAdjustRatio = 1.0
+        (width, height) = para[:2]
+        if (H2W_ratio != None and height/float(width)!=H2W_ratio):
+            widthAdjustRatio = height/float(width)/H2W_ratio
+            fontWidth = int(fontWidth * widthAdjustRatio + 0.5)
+            g_params['marginY'] += int(widthAdjustRatio*10+0.5)
+            para = Calc(fontWidth, fontHeight, widthAdjustRatio)
+        return (fontWidth, para, widthAdjustRatio)
+
+    font_size = g_params['font_size']
+    fnt = GetFont(fontfile, int(g_params['image_scale']*font_size))
+    (fontWidth, fontHeight) = GetTextSize(fnt, "a")
+    para = Calc(fontWidth, fontHeight, 1.0)
+    (fontWidth, para, widthAdjustRatio) = AdjustH2WRatio(fontWidth,
+            fontHeight, para)
+    isDrawText = g_params['isDrawText']
+
+    if isAutoSize:
+        # CalculateImageParameter sizes the scale bar and the legend with the
+        # fonts set by its previous call, so each probe replays the call that
+        # precedes it when font_size and the cell are decreased one by one
+        isFit = IsFit(para)
+        initFontState = SaveFontState()
+        initFontSize = font_size
+        def CalcFontSize(fs):
+            if fs < initFontSize - 1:
+                Calc(*(GetTextSize(GetFont(fontfile, fs+1), "a") + (1.0,)))
+            else:
+                g_params.update(initFontState)
+            return Calc(*(GetTextSize(GetFont(fontfile, fs), "a") + (1.0,)))
+        if not isFit and font_size > 3:
+            # largest font_size in [3, font_size-1] that fits
+            lo = 3
+            hi = font_size - 1
+            while lo < hi:
+                mid = (lo + hi + 1)//2
+                if IsFit(CalcFontSize(mid)):
+                    lo = mid
+                else:
+                    hi = mid - 1
+            font_size = lo
+            fnt = GetFont(fontfile, font_size)
+            (fontWidth, fontHeight) = GetTextSize(fnt, "a")
+            para = CalcFontSize(font_size)
+            isFit = IsFit(para)
+        if not isFit:
+            # then shrink the cell by the smallest k pixels that fits
+            def ShrinkCell(k):
+                return (max(fontWidth-k, 1) if fontWidth > 1 else fontWidth,
+                        max(fontHeight-k, 1) if fontHeight > 1 else fontHeight)
+            cellFontState = SaveFontState()
+            def CalcCell(k):
+                if k > 1:
+                    Calc(*(ShrinkCell(k-1) + (1.0,)))
+                else:
+                    g_params.update(cellFontState)
+                return Calc(*(ShrinkCell(k) + (1.0,)))
+            lo = 1
+            hi = max(1, max(fontWidth, fontHeight) - 1)
+            while lo < hi:
+                mid = (lo + hi)//2
+                if IsFit(CalcCell(mid)):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            para = CalcCell(lo)
+            (fontWidth, fontHeight) = ShrinkCell(lo)
+        (width, height) = para[:2]
+        logger.debug("height (%d) *width (%d) = %d"%(height, width, height*width))
+
+        (fontWidth, para, widthAdjustRatio) = AdjustH2WRatio(fontWidth,
+                fontHeight, para)
+        (width, height) = para[:2]
+        if height*width > maxImageSize:
+            msg = "%s: (fontWidth, fontHeight) have been reduced to (%d, %d)"\
+                  ", but the image size is still too big (%dM)"%(
+                          inFile, fontWidth, fontHeight, height*width/1024/1024)
+            print(msg)
+        else:
+            msg = "font is autosized to %d, isDrawText = %s, "\
+                    "(fontWidth, fontHeight) = (%d, %d)"%(
+                            font_size,isDrawText, fontWidth, fontHeight)
+            print(msg)
+    return ImageLayout(fnt, font_size, fontWidth, fontHeight, isDrawText,
+            para, widthAdjustRatio, g_params)
+#}}}
 def DrawMSATopo_PIL(inFile, g_params):#{{{
     """Draw multiple alignment of topologies using the PIL library"""
     lcmp.SetMakeTMplotColor_g_params(g_params)
     isDrawSeqLable = True
-    (idList, annotationList, topoSeqList) = myfunc.ReadFasta(inFile)
+    topomsa = lcmp.ReadTopoMSA(inFile)
+    (idList, annotationList) = (topomsa.idList, topomsa.annotationList)
+    topoSeqList = list(topomsa.topoSeqList)
 
     H2W_ratio = g_params['H2W_ratio']
     widthAdjustRatio = 1.0
 
-    topoSeqList = lcmp.RemoveUnnecessaryGap(topoSeqList)
     numSeq = len(idList)
     if numSeq < 1:
         print("No sequence in the file %s. Ignore." %(inFile), file=sys.stderr)
@@ -2431,7 +3136,7 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
     for i in range(numSeq):
         seqIDIndexDict[idList[i]] = i
 
-    (fontWidthScaleBar, fontHeightScaleBar) = g_params['fntScaleBar'].getsize("a")
+    (fontWidthScaleBar, fontHeightScaleBar) = GetTextSize(g_params['fntScaleBar'], "a")
     sectionSepSpace = int(g_params['image_scale']*g_params['heightTMbox']/2+0.5)
 
     rootname = os.path.basename(os.path.splitext(inFile)[0])
@@ -2467,7 +3172,6 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
             specialProIdxDict['reppro'] = [0]
 
     specialProIdxList = specialProIdxDict['reppro'] + specialProIdxDict['pdb'] + specialProIdxDict['final']
-    posTMList = [myfunc.GetTMPosition(x) for x in topoSeqList]
     TMnameList = [] # note that TMname is also a list, TMnameList is a list of list
     foldTypeList = []
     for i in range(numSeq):
@@ -2480,7 +3184,7 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
             TMnameList.append([])
             foldTypeList.append("")
 
-    origPosTMList = [myfunc.GetTMPosition(x) for x in topoSeqList]
+    origPosTMList = topomsa.GetPosTMList()
     VerifyTerminalStatus(topoSeqList, origPosTMList)
 
 # posindexmap: map of the residue position to the original MSA
@@ -2490,17 +3194,26 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
     origTopoSeqList = []
     for seq in topoSeqList:
         origTopoSeqList.append(seq)
+    # topoSeqList may have been modified by VerifyTerminalStatus
+    if origTopoSeqList != topomsa.topoSeqList:
+        topomsa = lcmp.TopoMSA(idList, annotationList, origTopoSeqList)
 
 
     posindexmap = {}
     if g_params['isShrink']:
         if g_params['method_shrink'] == 0:
-            posindexmap = ShrinkGapInMSA_0(idList, topoSeqList, specialProIdxList=[])
+            posindexmap = ShrinkCached(topoSeqList, ShrinkGapInMSA_0,
+                    idList, topoSeqList, specialProIdxList=[], topomsa=topomsa)
         elif g_params['method_shrink'] == 1:
-            posindexmap = ShrinkGapInMSA_exclude_TMregion(idList, topoSeqList)
+            posindexmap = ShrinkCached(topoSeqList,
+                    ShrinkGapInMSA_exclude_TMregion, idList, topoSeqList)
 
     # get posTMList for the shink version of MSA
-    posTMList = [myfunc.GetTMPosition(x) for x in topoSeqList]
+    if posindexmap == {}:
+        shrinkedTopoMSA = topomsa
+    else:
+        shrinkedTopoMSA = lcmp.TopoMSA(idList, annotationList, topoSeqList)
+    posTMList = shrinkedTopoMSA.GetPosTMList()
 
 #     for i in range(len(topoSeqList)):
 #         print ("%10s: %s" %(idList[i], topoSeqList[i]))
@@ -2518,65 +3231,39 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
 
     lengthAlignment = len(topoSeqList[0])
 
-    fnt = ImageFont.truetype(g_params['font_dir'] + g_params['font'],
-            int(g_params['image_scale']*g_params['font_size']))
-    (fontWidth, fontHeight) = fnt.getsize("a")
-    (width, height, fontWidthTMbox, fontHeightTMbox, dgprofileRegionWidth, dgprofileRegionHeight, histoRegionWidth, histoRegionHeight) = CalculateImageParameter(fontWidth, fontHeight, lengthAlignment, numSeq,  numSeprationLine, sectionSepSpace, specialProIdxDict, posTMList, TMnameList, 1.0)
-
-    if (H2W_ratio != None and height/float(width)!=H2W_ratio):
-        widthAdjustRatio = height/float(width)/H2W_ratio
-        fontWidth = int(fontWidth * widthAdjustRatio + 0.5)
-        g_params['marginY'] += int(widthAdjustRatio*10+0.5)
-        (width, height, fontWidthTMbox, fontHeightTMbox, dgprofileRegionWidth, dgprofileRegionHeight, histoRegionWidth, histoRegionHeight) = CalculateImageParameter(fontWidth, fontHeight, lengthAlignment, numSeq,  numSeprationLine, sectionSepSpace,specialProIdxDict, posTMList, TMnameList,  widthAdjustRatio)
-
-    isDrawText = g_params['isDrawText']
-    font_size = g_params['font_size']
-    if g_params['isAutoSize']:
-        while height*width > g_params['MAXIMAGESIZE']:
-            if font_size > 3:
-                font_size -= 1
-                fnt = ImageFont.truetype(g_params['font_dir'] +
-                        g_params['font'], font_size)
-                (fontWidth, fontHeight) = fnt.getsize("a")
-            else:
-                if fontWidth > 1:
-                    fontWidth -= 1
-                if fontHeight > 1:
-                    fontHeight -= 1
-
-            (width, height, fontWidthTMbox, fontHeightTMbox, dgprofileRegionWidth, dgprofileRegionHeight, histoRegionWidth, histoRegionHeight) = CalculateImageParameter(fontWidth, fontHeight, lengthAlignment, numSeq,  numSeprationLine, sectionSepSpace,specialProIdxDict, posTMList, TMnameList,  1.0)
-
-            if font_size < 3:
-                isDrawText = False
-            if fontWidth < 2 and fontHeight < 2:
-                break
-        logger.debug("height (%d) *width (%d) = %d"%(height, width, height*width))
-
-        if (H2W_ratio != None and height/float(width)!=H2W_ratio):
-            widthAdjustRatio = height/float(width)/H2W_ratio
-            fontWidth = int(fontWidth * widthAdjustRatio + 0.5)
-            g_params['marginY'] += int(widthAdjustRatio*10+0.5)
-            (width, height, fontWidthTMbox, fontHeightTMbox, dgprofileRegionWidth, dgprofileRegionHeight, histoRegionWidth, histoRegionHeight) = CalculateImageParameter(fontWidth, fontHeight, lengthAlignment, numSeq,  numSeprationLine, sectionSepSpace, specialProIdxDict, posTMList, TMnameList,  widthAdjustRatio)
-
-        if height*width > g_params['MAXIMAGESIZE']:
-            msg = "%s: (fontWidth, fontHeight) have been reduced to (%d, %d)"\
-                  ", but the image size is still too big (%dM)"%(
-                          inFile, fontWidth, fontHeight, height*width/1024/1024)
-            print(msg)
-        else:
-            msg = "font is autosized to %d, isDrawText = %s, "\
-                    "(fontWidth, fontHeight) = (%d, %d)"%(
-                            font_size,isDrawText, fontWidth, fontHeight)
-            print(msg.format(font_size, isDrawText, fontWidth, fontHeight))
-
+    isTiled = (g_params['tileSize'] > 0)
+    if isTiled: # tiles are rendered at full resolution
+        outFile = "%s%s%s%s.dzi"%(outpath, os.sep, rootname, str_krbias)
+    layout = ReadCacheObject("layout", g_params['cacheKeyLayout'])
+    if layout != None:
+        layout.Apply(g_params)
+    else:
+        layout = SolveImageLayout(inFile, lengthAlignment, numSeq,
+                numSeprationLine, sectionSepSpace, specialProIdxDict,
+                posTMList, TMnameList, g_params['isAutoSize'] and not isTiled)
+        WriteCacheObject("layout", g_params['cacheKeyLayout'], layout)
+    (fnt, font_size, isDrawText) = (layout.fnt, layout.font_size,
+            layout.isDrawText)
+    (fontWidth, fontHeight) = (layout.fontWidth, layout.fontHeight)
+    (width, height) = (layout.width, layout.height)
+    (fontWidthTMbox, fontHeightTMbox) = (layout.fontWidthTMbox,
+            layout.fontHeightTMbox)
+    (dgprofileRegionWidth, dgprofileRegionHeight) = (
+            layout.dgprofileRegionWidth, layout.dgprofileRegionHeight)
+    (histoRegionWidth, histoRegionHeight) = (layout.histoRegionWidth,
+            layout.histoRegionHeight)
+    widthAdjustRatio = layout.widthAdjustRatio
 
     bg_color="#FFFFFF"; # white
-    if g_params['mode'] == "RGB":
-        newImage = Image.new(g_params['mode'], (width, height),bg_color)
-    elif g_params['mode'] == "P":
-        newImage = Image.new(g_params['mode'], (width, height),255)
-
-    draw = ImageDraw.Draw(newImage); # setup to draw on the main image
+    if g_params['mode'] == "P":
+        bg_color = 255
+    if isTiled: # tiles are always RGB, each tile would have its own palette
+        newImage = TiledImage("RGB", (width, height), "#FFFFFF",
+                g_params['tileSize'], g_params['outFormat'])
+        draw = newImage
+    else:
+        newImage = Image.new(g_params['mode'], (width, height), bg_color)
+        draw = ImageDraw.Draw(newImage); # setup to draw on the main image
     x = g_params['marginX']
     y = g_params['marginY']
 
@@ -2614,7 +3301,7 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
         #y += sectionSepSpace*fontHeightTMbox
 
 # Draw a scale bar of the residue position
-    (fontWidthScaleBar, fontHeightScaleBar) = g_params['fntScaleBar'].getsize("a")
+    (fontWidthScaleBar, fontHeightScaleBar) = GetTextSize(g_params['fntScaleBar'], "a")
     if g_params['isDrawMSA']:
         if g_params['isDrawScaleBar']:
             DrawScale(lengthAlignment, posindexmap, (x,y), font_size, fontWidth,
@@ -2624,6 +3311,8 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
         maxDistKR = g_params['maxDistKR'] 
         isDrawKRBias = g_params['isDrawKRBias']
 
+        isRasterNumpy = (g_params['rasterBackend'] == "numpy")
+        rowList = [] # rows to be drawn as a block by the numpy backend
         tagFormer = tagList[0]
         for i in range(numSeq):
             tagCurrent = tagList[i]
@@ -2635,6 +3324,9 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
             if tagCurrent != tagFormer:
                 tagFormer = tagCurrent
                 if g_params['isDrawSeprationLine'] == True:
+                    DrawTopologyBlock_numpy(rowList, fnt, fontWidth,
+                            fontHeight, isDrawText, newImage, draw)
+                    rowList = []
                     box = [x, y+1, width-marginX, y+fontHeight*scaleSeprationLine-1]
                     draw.rectangle(box, fill="grey",outline="white")
                     y += fontHeight
@@ -2664,14 +3356,19 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
                 if isDrawKRBias:
                     aaseq = HideNonKRResidue(aaseq)
 #        print aaseq
-            DrawTopology(anno, tag, toposeq, aaseq, (x,y), fnt, fontWidth,
-                    fontHeight, isDrawText, draw)
+            if isRasterNumpy:
+                rowList.append((anno, tag, toposeq, aaseq, (x,y)))
+            else:
+                DrawTopology(anno, tag, toposeq, aaseq, (x,y), fnt, fontWidth,
+                        fontHeight, isDrawText, draw)
 #       if tagCurrent == "Consensus":
 #           y+=fontHeight
             y += fontHeight
             if y >= height:
                 print(("Error! position y(%d) exceeds height (%d)" %
                         (y, height)), file=sys.stderr)
+        DrawTopologyBlock_numpy(rowList, fnt, fontWidth, fontHeight,
+                isDrawText, newImage, draw)
 
 # Draw special topologies
     idxPDBList = specialProIdxDict['pdb']
@@ -2710,25 +3407,34 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
 # Draw DGprofile
     if g_params['isDrawDGprofile']:
         dgpList = []
+        dgprofileDictList = []
+        toScanSeqDict = {}
         for idx in specialProIdxDict['reppro']:
             seqID = idList[idx]
-            toposeq = topoSeqList[idx]
-            lengthAlignment = len(toposeq)
             DGProfileFile = GetDGProfileFileName(inFile, seqID)
-            isDrawSeqID = True
             dgprofileDict = None
             logger.debug("seqID=%s, DGProfileFile=%s"%(seqID, DGProfileFile))
             if os.path.exists(DGProfileFile):
                 dgprofileDict = ReadInDGProfile(DGProfileFile)
+            elif seqID in aaSeqDict: #if dg profile file is not provided, calculate it
+                toScanSeqDict[seqID] = aaSeqDict[seqID]
+            dgprofileDictList.append(dgprofileDict)
+        # profiles to calculate are scanned in one batch
+        scannedDGPDict = RunDGScanBatch(toScanSeqDict)
+        for ii in range(len(specialProIdxDict['reppro'])):
+            idx = specialProIdxDict['reppro'][ii]
+            seqID = idList[idx]
+            toposeq = topoSeqList[idx]
+            lengthAlignment = len(toposeq)
+            dgprofileDict = dgprofileDictList[ii]
             dgp = None
             if dgprofileDict:
                 if seqID in dgprofileDict:
                     dgp = dgprofileDict[seqID]
                 elif 'query' in dgprofileDict:
                     dgp = dgprofileDict['query']
-            elif seqID in aaSeqDict: #if dg profile file is not provided, calculate it
-                aaseq = aaSeqDict[seqID]
-                dgp = RunDGScan(aaseq, seqID)
+            elif seqID in scannedDGPDict:
+                dgp = scannedDGPDict[seqID]
             if dgp:
                 idxmap_aligne2seq = lcmp.GetAlign2SeqMap(origTopoSeqList[idx],
                         origTopoSeqList[idx].replace(GAP,""))  
@@ -2754,7 +3460,7 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
 
             # Add ylabel deltaG (kcal/mol)
             fnt_label = g_params['fntDGprofileLable']
-            (fw_l, fh_l) = fnt_label.getsize(ylabel_DGprofile)
+            (fw_l, fh_l) = GetTextSize(fnt_label, ylabel_DGprofile)
             image2 = Image.new('RGBA', (int(fw_l*1.1+0.5)+5, int(fh_l*1.2+0.5)+5))
             draw2 = ImageDraw.Draw(image2)
             draw2.text((5, 5), text=ylabel_DGprofile, font=fnt_label, fill="black")
@@ -2770,8 +3476,8 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
 
 # draw distribution of 'M' percentage
     if g_params['isDrawPerMDistribution']:
-        (cnt_i, cnt_o, cnt_M, cnt_GAP, per_i, per_o, per_M, per_GAP) =\
-                lcmp.GetTopoStateFraction( topoSeqList)
+        (cntMatrix, perMatrix) = shrinkedTopoMSA.GetStateProfile()
+        per_M = perMatrix[lcmp.TOPO_STATE_LIST.index('M')].tolist()
 # histoList is a list of 2-tuples (width, height) where height is a value
 # ranging to 1, and sum of width equals 1.
         histoList = []
@@ -2794,8 +3500,51 @@ def DrawMSATopo_PIL(inFile, g_params):#{{{
     newImage.save(outFile)
     del newImage
 #}}}
+def GetTopologySegmentList(toposeq, memClass):#{{{
+    """
+    Get the run-length merged segments of a topology for the vector backend
+    as a list of (begin, end, cssClass). Colors are the same as DrawTopology,
+    segments on the white background are omitted
+    """
+    (posTM, typeTM) = lcmp.GetTMType(toposeq)
+    segList = []
+    cssClass = None
+    jj = 0
+    for m in re.finditer(r"(.)\1*", toposeq):
+        (b, e) = m.span()
+        state = toposeq[b]
+        if state == "M":
+            while jj < len(posTM) and posTM[jj][1] <= b:
+                jj += 1
+            if jj < len(posTM) and typeTM[jj] in ["M", "W"]:
+                cssClass = typeTM[jj]
+            # else keep the color of the previous segment as DrawTopology
+        elif state in ["i", "o", "S"]:
+            cssClass = state
+        elif g_params['isColorWholeTMbox'] and lcmp.IsWithinTMRegion(b, posTM):
+            cssClass = memClass
+        else:
+            cssClass = None
+        if cssClass == None:
+            continue
+        if segList != [] and segList[-1][1] == b and segList[-1][2] == cssClass:
+            segList[-1] = (segList[-1][0], e, cssClass)
+        else:
+            segList.append((b, e, cssClass))
+    return segList
+#}}}
+def GetCSSClassOfColor(prefix, color):#{{{
+    """Get the name of the css class for a color, e.g. g#FF0000 -> gFF0000"""
+    return prefix + re.sub("[^0-9A-Za-z]", "", color)
+#}}}
 def DrawMSATopo_SVG(inFile, g_params):#{{{
-    (idList, annotationList, topoSeqList) = myfunc.ReadFasta(inFile)
+    """
+    Draw multiple alignment of topologies as vector graphics. The SVG is
+    written as a stream, each row is a group of rectangles, one for each run
+    of the same state, and colors are shared by css classes, so the size of
+    the file scales with the number of segments but not residues
+    """
+    (idList, annotationList, topoSeqList) = libtmsa.ReadTopoMSAFile(inFile)
     topoSeqList = lcmp.RemoveUnnecessaryGap(topoSeqList)
     numSeq = len(idList)
     if numSeq < 1:
@@ -2805,13 +3554,8 @@ def DrawMSATopo_SVG(inFile, g_params):#{{{
     marginX = g_params['marginX']
     marginY = g_params['marginY']
     annoSeqInterval = g_params['annoSeqInterval']
-    widthAnnotation = g_params['widthAnnotation']
-    heightScaleBar = g_params['heightScaleBar']
-    heightTMbox = g_params['heightTMbox']
     scaleSeprationLine = g_params['scaleSeprationLine']
-    font_size_scalebar = g_params['font_size_scalebar']
-    fntScaleBar = g_params['fntScaleBar']
-    (fontWidthScaleBar, fontHeightScaleBar) = fntScaleBar.getsize("a")
+    isDrawText = g_params['isDrawText']
 
     rootname = os.path.basename(os.path.splitext(inFile)[0])
     aaSeqDict = GetAASeqDict(inFile)
@@ -2826,74 +3570,201 @@ def DrawMSATopo_SVG(inFile, g_params):#{{{
     if g_params['isDrawKRBias'] == True:
         str_krbias = ".krbias"
     svgfile = "%s%s%s%s.%s"%(outpath, os.sep, rootname, str_krbias, 'svg')
-    pdffile = "%s%s%s%s.%s"%(outpath, os.sep, rootname, str_krbias, 'pdf')
 
 # posindexmap: map of the residue position to the original MSA
 # e.g. pos[0] = 5 means the first residue is actually the 6th residue position
 # in the original MSA
 #   backup original aligned topoSeqList
     alignedTopoSeqList = []
-    posTMList = []
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     for seq in topoSeqList:
         alignedTopoSeqList.append(seq)
-        posTMList.append(myfunc.GetTMPosition(seq))
 
     posindexmap = {}
     if g_params['isShrink']:
-        posindexmap = ShrinkGapInMSA_0(idList, topoSeqList)
+        posindexmap = ShrinkCached(topoSeqList, ShrinkGapInMSA_0,
+                idList, topoSeqList)
 
-    posTM = myfunc.GetTMPosition(topoSeqList[0])
     g_params['widthAnnotation'] = GetSizeAnnotationToDraw(annotationList)
     widthAnnotation = g_params['widthAnnotation']
     tagList = []
     for seqAnno in annotationList:
         tagList.append(GetSeqTag(seqAnno))
-#     print tagList
-    numSeprationLine = len(set(tagList))
+    numSeprationLine = 0
+    for i in range(1, numSeq):
+        if tagList[i] != tagList[i-1]:
+            numSeprationLine += 1
     lengthAlignment = len(topoSeqList[0])
 
-    svg_document = pysvg.structure.svg()
-#     shape_builder = pysvg.builders.ShapeBuilder()
-# 
-#     svg_document.addElement(shape_builder.createRect(0, 0,
-#                                                  "200px", "100px",
-#                                                  strokewidth = 1,
-#                                                  stroke = "black",
-#                                                  fill = "rgb(255, 255, 0)"))
-    myStyle = pysvg.builders.StyleBuilder()
-    myStyle.setFontFamily(fontfamily="monospace")
-#    myStyle.setFontSize('5pt')
-    myStyle.setFillOpacity('0.5')
-    myStyle.setFilling(fill="grey")
-#    myStyle.setStroke("green")
-#    myStyle.fill = "blue"
-    
-    
-    newAnnoList = []
-    for i in range(len(topoSeqList)):
-        newAnnoList.append("%s %s"%(idList[i], tagList[i]))
-    maxSizeAnno = max([len(x) for x in newAnnoList])
+    fnt = GetFont(g_params['font_dir'] + g_params['font'],
+            g_params['font_size'])
+    (fontWidth, fontHeight) = GetTextSize(fnt, "a")
 
-    print("maxSizeAnno=",maxSizeAnno)
+    xSeq = marginX + widthAnnotation*fontWidth
+    if g_params['isDrawTagColumn']:
+        xSeq += annoSeqInterval*fontWidth
+    width = xSeq + lengthAlignment*fontWidth + marginX
+    height = (marginY*2 + numSeq*fontHeight +
+            g_params['isDrawSeprationLine']*numSeprationLine*
+            scaleSeprationLine*fontHeight)
+
+# css classes are collected before writing since the style comes first
+    cssDict = {}
+    for (state, key) in [('i', 'loopcolor_in_MSA'), ('o', 'loopcolor_out_MSA'),
+            ('M', 'memcolor_out_to_in_MSA'), ('W', 'memcolor_in_to_out_MSA'),
+            ('S', 'spcolor')]:
+        cssDict[state] = g_params[key]
+    for anno in set(annotationList):
+        memcolor = GetMemColorOfRow(anno)
+        cssDict[GetCSSClassOfColor("g", memcolor)] = memcolor
+    if g_params['isDrawTagColumn']:
+        for i in range(numSeq):
+            fill_color = GetTagColumnColor(annotationList[i], tagList[i])
+            cssDict[GetCSSClassOfColor("t", fill_color)] = fill_color
 
-    x0 = 10
-    y0 = 10
-    for i in range(len(topoSeqList)):
-        y = y0 + (i)*20
-        string = "%-*s %s"%(maxSizeAnno+5, newAnnoList[i], topoSeqList[i])
-        #print len(string)
-        print(string)
-        t1 = pysvg.text.text(string, x=x0, y=y)
-        t1.set_style(myStyle.getStyle())
-        svg_document.addElement(t1)
-    svg_document.save(svgfile)
-    cmd = "svg2pdf %s %s"%(svgfile, pdffile)
-    os.system(cmd)
+    maxDistKR = g_params['maxDistKR']
+    isDrawKRBias = g_params['isDrawKRBias']
+    try:
+        fpout = open(svgfile, "w")
+    except IOError:
+        print("Failed to write to file %s"%(svgfile), file=sys.stderr)
+        return 1
+    fpout.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    fpout.write('<svg xmlns="http://www.w3.org/2000/svg" width="%d" '
+            'height="%d" viewBox="0 0 %d %d">\n'%(width, height, width, height))
+    fpout.write('<style>\n')
+    fpout.write('text{font-family:monospace;font-size:%dpx;'
+            'white-space:pre}\n'%(g_params['font_size']))
+    fpout.write('.sep{fill:grey}\n')
+    for cssClass in sorted(cssDict):
+        fpout.write('.%s{fill:%s}\n'%(cssClass, cssDict[cssClass]))
+    fpout.write('</style>\n')
+    fpout.write('<rect width="100%" height="100%" fill="white"/>\n')
+
+    y = marginY
+    fpout.write('<g class="group">\n')
+    for i in range(numSeq):
+        anno = annotationList[i]
+        tag = tagList[i]
+        toposeq = topoSeqList[i]
+        if i > 0 and tag != tagList[i-1]:
+            fpout.write('</g>\n')
+            if g_params['isDrawSeprationLine']:
+                fpout.write('<rect class="sep" x="%d" y="%d" width="%d" '
+                        'height="%d"/>\n'%(marginX, y, width-2*marginX,
+                            scaleSeprationLine*fontHeight))
+                y += scaleSeprationLine*fontHeight
+            fpout.write('<g class="group">\n')
+
+        fpout.write('<g transform="translate(0,%d)">'%(y))
+        if g_params['isDrawTagColumn']:
+            fill_color = GetTagColumnColor(anno, tag)
+            fpout.write('<rect class="%s" x="%d" width="%d" height="%d"/>'%(
+                GetCSSClassOfColor("t", fill_color),
+                xSeq-(annoSeqInterval-1)*fontWidth, 2*fontWidth, fontHeight))
+        memClass = GetCSSClassOfColor("g", GetMemColorOfRow(anno))
+        for (b, e, cssClass) in GetTopologySegmentList(toposeq, memClass):
+            fpout.write('<rect class="%s" x="%d" width="%d" height="%d"/>'%(
+                cssClass, xSeq+b*fontWidth, (e-b)*fontWidth, fontHeight))
+
+        if isDrawText:
+            seqID = idList[i]
+            aaseq = ""
+            if seqID in aaSeqDict:
+                aaseq = MatchToAlignedSeq(aaSeqDict[seqID],
+                        alignedTopoSeqList[i], seqID)
+                if posindexmap != {}:
+                    tmpli = []
+                    for pp in range(len(posindexmap)):
+                        aa = aaseq[posindexmap[pp]]
+                        if (isDrawKRBias and aa in ["K", "R"] and
+                                IsOutofMaxDistKR(posTMList[i], posindexmap[pp],
+                                    maxDistKR)):
+                            aa = " "
+                        tmpli.append(aa)
+                    aaseq = "".join(tmpli)
+                if isDrawKRBias:
+                    aaseq = HideNonKRResidue(aaseq)
+            if aaseq != "":
+                seq = aaseq
+            else:
+                seq = toposeq.replace('-',' ')
+            ss = anno[0:widthAnnotation]
+            yText = int(fontHeight*0.8+0.5)
+            fpout.write('<text x="%d" y="%d">%s</text>'%(marginX, yText,
+                xml.sax.saxutils.escape(ss)))
+            fpout.write('<text x="%d" y="%d" textLength="%d">%s</text>'%(
+                xSeq, yText, lengthAlignment*fontWidth,
+                xml.sax.saxutils.escape(seq)))
+        fpout.write('</g>\n')
+        y += fontHeight
+    fpout.write('</g>\n')
+    fpout.write('</svg>\n')
+    fpout.close()
+    print("Topology MSA is drawn and output to \"%s\""%(svgfile))
+    return 0
+#}}}
+def GetFontPropertiesOnGrid(fp, ax, widthSingleCharInAxes):#{{{
+    """
+    Get a copy of the monospace font fp scaled so that its advance is
+    widthSingleCharInAxes in the axes coordinates of ax, so that a row drawn
+    as one text artist stays on the grid of residue columns
+    """
+    fig = ax.get_figure()
+    widthSingleCharInPoint = (widthSingleCharInAxes * ax.get_position().width *
+            fig.get_figwidth() * 72)
+    w1 = matplotlib.textpath.TextPath((0, 0), "M", prop=fp).get_extents().width
+    w2 = matplotlib.textpath.TextPath((0, 0), "MM", prop=fp).get_extents().width
+    fp_grid = fp.copy()
+    fp_grid.set_size(fp.get_size_in_points()*widthSingleCharInPoint/(w2-w1))
+    return fp_grid
+#}}}
+def AddRectCollections(ax, rectDict):#{{{
+    """
+    Add rectangles in axes coordinates to ax as one PolyCollection for each
+    color, rectDict = {(facecolor, edgecolor): [(x, y, width, height)]}
+    """
+    for (facecolor, edgecolor) in rectDict:
+        verts = [[(x, y), (x+w, y), (x+w, y+h), (x, y+h)]
+                for (x, y, w, h) in rectDict[(facecolor, edgecolor)]]
+        coll = matplotlib.collections.PolyCollection(verts,
+                facecolors=facecolor, edgecolors=edgecolor, joinstyle='miter',
+                transform=ax.transAxes)
+        ax.add_collection(coll, autolim=False)
+#}}}
+def AddLineCollections(ax, lineDict, linewidth):#{{{
+    """
+    Add line segments in axes coordinates to ax as one LineCollection for each
+    color, lineDict = {color: [[(x1, y1), (x2, y2)]]}
+    """
+    for color in lineDict:
+        coll = matplotlib.collections.LineCollection(lineDict[color],
+                colors=color, linewidths=linewidth, linestyles='-',
+                capstyle='projecting', transform=ax.transAxes)
+        ax.add_collection(coll, autolim=False)
+#}}}
+def SaveFigureWithCrop(fig, pdffile):#{{{
+    """
+    Save fig to pdffile, and to $rootname-crop.pdf cropped to the tight
+    bounding box of the figure plus the pdfcrop_margin_* (in bp) of g_params,
+    in the same way as running pdfcrop on pdffile
+    Return the name of the cropped file
+    """
+    fig.savefig(pdffile)
     print("%s output"%(pdffile))
-
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer())
+    bp = 1/72.0 # bbox is in inches
+    bbox = matplotlib.transforms.Bbox.from_extents(
+            bbox.x0 - g_params['pdfcrop_margin_left']*bp,
+            bbox.y0 - g_params['pdfcrop_margin_bottom']*bp,
+            bbox.x1 + g_params['pdfcrop_margin_right']*bp,
+            bbox.y1 + g_params['pdfcrop_margin_top']*bp)
+    pdf_cropfile = os.path.splitext(pdffile)[0]+"-crop.pdf"
+    fig.savefig(pdf_cropfile, bbox_inches=bbox)
+    return pdf_cropfile
 #}}}
 def DrawMSATopo_MAT(inFile, g_params):#{{{
-    (idList, annotationList, topoSeqList) = myfunc.ReadFasta(inFile)
+    (idList, annotationList, topoSeqList) = libtmsa.ReadTopoMSAFile(inFile)
     numSeq = len(idList)
     if numSeq < 1:
         print("No sequence in the file %s. Ignore." %(inFile), file=sys.stderr)
@@ -2912,14 +3783,10 @@ def DrawMSATopo_MAT(inFile, g_params):#{{{
     scaleSeprationLine = g_params['scaleSeprationLine']
     font_size_scalebar = g_params['font_size_scalebar']
     fntScaleBar = g_params['fntScaleBar']
-    (fontWidthScaleBar, fontHeightScaleBar) = fntScaleBar.getsize("a")
+    (fontWidthScaleBar, fontHeightScaleBar) = GetTextSize(fntScaleBar, "a")
 
 
 
-    pdfcrop_margin_left = g_params['pdfcrop_margin_left']
-    pdfcrop_margin_top = g_params['pdfcrop_margin_top']
-    pdfcrop_margin_right = g_params['pdfcrop_margin_right']
-    pdfcrop_margin_bottom = g_params['pdfcrop_margin_bottom']
 
     rootname = os.path.basename(os.path.splitext(inFile)[0])
     aaSeqDict = GetAASeqDict(inFile)
@@ -2942,10 +3809,9 @@ def DrawMSATopo_MAT(inFile, g_params):#{{{
 # in the original MSA
 #   backup original aligned topoSeqList
     alignedTopoSeqList = []
-    posTMList = []
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     for seq in topoSeqList:
         alignedTopoSeqList.append(seq)
-        posTMList.append(myfunc.GetTMPosition(seq))
 
     posindexmap = {}
     method_shrink = g_params['method_shrink']
@@ -2954,9 +3820,11 @@ def DrawMSATopo_MAT(inFile, g_params):#{{{
 
     if g_params['isShrink']:
         if g_params['method_shrink'] == 0:
-            posindexmap = ShrinkGapInMSA_0(idList, topoSeqList)
+            posindexmap = ShrinkCached(topoSeqList, ShrinkGapInMSA_0,
+                    idList, topoSeqList)
         elif g_params['method_shrink'] == 1:
-            posindexmap = ShrinkGapInMSA_exclude_TMregion(idList, topoSeqList)
+            posindexmap = ShrinkCached(topoSeqList,
+                    ShrinkGapInMSA_exclude_TMregion, idList, topoSeqList)
 
     posTM = myfunc.GetTMPosition(topoSeqList[0])
     g_params['widthAnnotation'] = GetSizeAnnotationToDraw(annotationList)
@@ -3163,6 +4031,10 @@ def DrawMSATopo_MAT(inFile, g_params):#{{{
     y = y0
     yshift=0
 
+# segments are collected by color and drawn as one collection per color, the
+# sequence of a row is drawn as one text on the grid of columns
+    fp_grid = GetFontPropertiesOnGrid(fp, ax, widthSingleCharInAxes)
+    rectDict = {}
     for i in range(len(topoSeqList)):
         y -= yshift
         anno = "%-*s"%(maxSizeAnno+5, newAnnoList[i])
@@ -3177,19 +4049,20 @@ def DrawMSATopo_MAT(inFile, g_params):#{{{
             seq = topoSeqList[i]
         topo = topoSeqList[i]
         posTM = myfunc.GetTMPosition(topo)
+        height = heightSingleCharInAxes + linespaceInAxes
+        y2 = y - linespaceInAxes/2.0
         if len(posTM) == 0:
             txt = seq
-            plt.text(x, y, txt, fontproperties=fp, transform=ax.transAxes)
+            plt.text(x, y, txt, fontproperties=fp_grid, transform=ax.transAxes)
             width = widthSingleCharInAxes * len(txt)
-            height = heightSingleCharInAxes + linespaceInAxes
-            edgecolor = 'none'
-            y2 = y - linespaceInAxes/2.0
-            rec = matplotlib.patches.Rectangle((x, y2), width, height,
-                    transform=ax.transAxes)
-            ax.add_patch(rec)
+            # default color of matplotlib.patches.Rectangle
+            rectDict.setdefault(('C0', 'none'), []).append((x, y2, width,
+                height))
             xshift = width
             yshift = height
         else:
+            txt = seq[:lengthAlignment].replace("-", " ")
+            plt.text(x, y, txt, fontproperties=fp_grid, transform=ax.transAxes)
             li = []
             for (b, e) in posTM:
                 li.append(b)
@@ -3205,71 +4078,37 @@ def DrawMSATopo_MAT(inFile, g_params):#{{{
                 else:
                     end = lengthAlignment
 
-                txt = seq[begin:end]
-                txt = txt.replace("-", " ")
-
                 txt_topo = topo[begin:end].replace(GAP," ")
-
-                x_char = x
-                for char in txt:
-                    plt.text(x_char, y, char, fontproperties=fp, transform=ax.transAxes)
-                    x_char += widthSingleCharInAxes
-
-
-                #t = matplotlib.textpath.TextPath((0,0), txt, prop=fp)
-                #bb = t.get_extents(transform=inv)
-
                 if txt_topo.find('M')!=-1:
-                    edgecolor = 'black'
-                    facecolor = 'red'
                     color = 'red'
                 elif txt_topo.find('i') != -1:
                     color = 'lightyellow'
                 elif txt_topo.find('o') != -1:
                     color = 'lightblue'
                 else:
-                    facecolor = 'none'
-                    edgecolor = 'none'
-                width = widthSingleCharInAxes * len(txt)
-                #width = bb.width
-                #print "w1, w2=", widthSingleCharInAxes*len(txt), bb.width
-                height = heightSingleCharInAxes + linespaceInAxes
-                y2 = y - linespaceInAxes/2.0
-#                 rec = matplotlib.patches.Rectangle((x, y2), width, height,
-#                         facecolor=facecolor, edgecolor=edgecolor, alpha=0.5,transform=ax.transAxes)
-                rec = matplotlib.patches.Rectangle((x, y2), width, height,
-                        color=color, transform=ax.transAxes)
-                ax.add_patch(rec)
+                    color = None
+                width = widthSingleCharInAxes * len(seq[begin:end])
+                if color != None:
+                    rectDict.setdefault((color, color), []).append((x, y2,
+                        width, height))
                 xshift = width
                 x += xshift
                 yshift = height
-                cnttextlength += len(txt)
-        #print "%3d: %4d %4d %s"%(i, cnttextlength, len(seq), seq), posTM
+    AddRectCollections(ax, rectDict)
 
     if g_params['isDrawDGprofile']:
         dgprofileDict = {} #{{{
         if os.path.exists(g_params['DGProfileFile']):
             dgprofileDict = ReadInDGProfile(g_params['DGProfileFile'])
+        # profiles not in DGProfileFile are scanned in one batch
+        toScanSeqDict = {}
         for i in range(numSeq):
             seqID = idList[i]
             toposeq = topoSeqList[i]
             lengthAlignment = len(toposeq)
             if (not seqID in dgprofileDict) and (seqID in aaSeqDict):
-                aaseq = aaSeqDict[seqID]
-                #print "aaseq=", aaseq
-                tmpaaseqfile = tempfile.mktemp()
-                tmpdgpfile = tempfile.mktemp()
-                tmpfp = open(tmpaaseqfile, 'w')
-                tmpfp.write(">%s\n"%seqID)
-                tmpfp.write("%s\n"%aaseq)
-                tmpfp.close()
-                os.system("%s %s -lmin 21 -lmax 21 -o %s"%(g_params['dgscanProg'],
-                    tmpaaseqfile, tmpdgpfile))
-                tmpDGPDict = ReadInDGProfile(tmpdgpfile)
-                os.system("rm -f %s %s" %(tmpaaseqfile, tmpdgpfile))
-                for seqid in tmpDGPDict:
-                    dgprofileDict[seqid] = tmpDGPDict[seqid]
-                    #print dgprofileDict[seqid]
+                toScanSeqDict[seqID] = aaSeqDict[seqID]
+        dgprofileDict.update(RunDGScanBatch(toScanSeqDict))
         #}}}
         ax = fig.add_subplot(gs[1])
         #ax.set_xlim(0, lengthAlignmentOriginal)
@@ -3331,12 +4170,7 @@ def DrawMSATopo_MAT(inFile, g_params):#{{{
                 print("no dgprofile for %s"%(seqid))
                 pass
 
-    plt.savefig(pdffile)
-    print("%s output"%(pdffile))
-    cmd = "pdfcrop --margins '%d %d %d %d' --clip %s"%(pdfcrop_margin_left,
-            pdfcrop_margin_top, pdfcrop_margin_right, pdfcrop_margin_bottom,
-            pdffile)
-    os.system(cmd)
+    SaveFigureWithCrop(fig, pdffile)
 
 
 #   Write Txtformat alignment
@@ -3370,12 +4204,13 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
     white box           TM helix (out->in)
     """
     logger = logging.getLogger(__name__)
-    (idList, annotationList, topoSeqList) = myfunc.ReadFasta(inFile)
+    topomsa = lcmp.ReadTopoMSA(inFile)
+    (idList, annotationList) = (topomsa.idList, topomsa.annotationList)
+    topoSeqList = list(topomsa.topoSeqList)
     numSeq = len(idList)
     if numSeq < 1:
         logger.debug("No sequence in the file %s. Ignore." %(inFile))
         return 1
-    topoSeqList = lcmp.RemoveUnnecessaryGap(topoSeqList)
 
     lengthAlignmentOriginal = len(topoSeqList[0])
 
@@ -3389,12 +4224,8 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
     scaleSeprationLine = g_params['scaleSeprationLine']
     font_size_scalebar = g_params['font_size_scalebar']
     fntScaleBar = g_params['fntScaleBar']
-    (fontWidthScaleBar, fontHeightScaleBar) = fntScaleBar.getsize("a")
+    (fontWidthScaleBar, fontHeightScaleBar) = GetTextSize(fntScaleBar, "a")
 
-    pdfcrop_margin_left = g_params['pdfcrop_margin_left']
-    pdfcrop_margin_top = g_params['pdfcrop_margin_top']
-    pdfcrop_margin_right = g_params['pdfcrop_margin_right']
-    pdfcrop_margin_bottom = g_params['pdfcrop_margin_bottom']
 
     rootname = os.path.basename(os.path.splitext(inFile)[0])
     aaSeqDict = GetAASeqDict(inFile)
@@ -3417,11 +4248,8 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
 # e.g. pos[0] = 5 means the first residue is actually the 6th residue position
 # in the original MSA
 #   backup original aligned topoSeqList
-    alignedTopoSeqList = []
-    posTMList = []
-    for seq in topoSeqList:
-        alignedTopoSeqList.append(seq)
-        posTMList.append(myfunc.GetTMPosition(seq))
+    alignedTopoSeqList = list(topoSeqList)
+    posTMList = topomsa.GetPosTMList()
 
     posindexmap = {}
     method_shrink = g_params['method_shrink']
@@ -3441,12 +4269,15 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
 
     if g_params['isShrink']:
         if g_params['method_shrink'] == 0:
-            posindexmap = ShrinkGapInMSA_0(idList, topoSeqList)
+            posindexmap = ShrinkCached(topoSeqList, ShrinkGapInMSA_0,
+                    idList, topoSeqList, topomsa=topomsa)
         elif g_params['method_shrink'] == 1:
-            posindexmap = ShrinkGapInMSA_exclude_TMregion(idList, topoSeqList)
+            posindexmap = ShrinkCached(topoSeqList,
+                    ShrinkGapInMSA_exclude_TMregion, idList, topoSeqList)
         elif g_params['method_shrink'] == 2:
             (idxmap_align2shrink, idxmap_shrink2align) =\
-                    ShrinkMSA_Method_2(topoSeqList, aaSeqAlignList, posTMList,
+                    ShrinkCached(topoSeqList, ShrinkMSA_Method_2,
+                            topoSeqList, aaSeqAlignList, posTMList,
                             g_params['shrinkrate_TM'], g_params['max_hold_loop'],
                             g_params['isDrawKRBias'])
             posindexmap = idxmap_shrink2align
@@ -3714,7 +4545,11 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
             2.0), ncol=4, fancybox=False, shadow=False)
     legend.draw_frame(False)
 
-
+# TM boxes and loops are collected by color and drawn as one collection per
+# color, K and R of a row are drawn as one text on the grid of columns
+    fp_grid = GetFontPropertiesOnGrid(fp, ax, widthSingleCharInAxes)
+    rectDict = {}
+    lineDict = {}
     for i in range(len(topoSeqList)):
         # write sequence description
         anno = "%-*s"%(maxSizeAnno+5, newAnnoList[i])
@@ -3740,6 +4575,7 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
             plt.text(x, y, txt, fontproperties=fp, transform=ax.transAxes)
         else: # draw TM regions and loops
             # terminal gaps are ignored
+            krli = [' ']*(lengthAlignmentShrinked+1)
             li = []
             for (b, e) in posTM: # get list of segment borders
                 li.append(b)
@@ -3761,13 +4597,10 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
                     end = lengthAlignment - len(m.group(0))
 
                 if isDrawKRBias: # draw positively charged K and R if enabled
-                    y = y0 - row_height*i
                     for jpos in range(begin, end):
                         char = seq[jpos]
                         if char in ["K", "R"]:
-                            x = x0 + jpos*widthSingleCharInAxes/shrinkrate
-                            plt.text(x, y, char, fontproperties=fp,
-                                    transform=ax.transAxes)
+                            krli[int(jpos/shrinkrate+0.5)] = char
 
                 txt_topo = topo[begin:end].replace(GAP," ")
                 type_topo_stat = ""  #the state can be [IN, OUT, TM_IN_OUT, TM_OUT_IN]
@@ -3795,10 +4628,8 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
                 if type_topo_stat.find("TM") != -1: # draw TM regions
                     x = x0 + begin*widthSingleCharInAxes/shrinkrate
                     y = y0 - row_height*i - linespaceInAxes/4.0
-                    rec = matplotlib.patches.Rectangle((x, y), width,
-                            height, facecolor=facecolor,
-                            edgecolor=edgecolor, transform=ax.transAxes)
-                    ax.add_patch(rec)
+                    rectDict.setdefault((facecolor, edgecolor), []).append(
+                            (x, y, width, height))
                 elif type_topo_stat in ["IN", "OUT"]: # draw loops
                     if type_topo_stat == "IN":
                         x1 = x0 + begin*widthSingleCharInAxes/shrinkrate
@@ -3810,41 +4641,28 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
                         y1 = y0 - row_height*i + heightSingleCharInAxes + linespaceInAxes/4.0
                         x2 = x1 + width
                         y2 = y1
-                    ax.plot([x1, x2], [y1, y2], color=color, linestyle='-',
-                            linewidth=2, transform=ax.transAxes)
+                    lineDict.setdefault(color, []).append([(x1, y1), (x2, y2)])
+            if isDrawKRBias:
+                plt.text(x0, y0 - row_height*i, "".join(krli).rstrip(),
+                        fontproperties=fp_grid, transform=ax.transAxes)
+    AddRectCollections(ax, rectDict)
+    AddLineCollections(ax, lineDict, 2)
 
     if g_params['isDrawDGprofile']:
         dgprofileDict = {} #{{{
         if os.path.exists(g_params['DGProfileFile']):
             dgprofileDict = ReadInDGProfile(g_params['DGProfileFile'])
+        # profiles not in DGProfileFile are scanned in one batch
+        toScanSeqDict = {}
         for i in range(numSeq):
             seqID = idList[i]
             toposeq = topoSeqList[i]
             lengthAlignment = len(toposeq)
             if (not seqID in dgprofileDict) and (seqID in aaSeqDict):
-                aaseq = aaSeqDict[seqID]
-                #print "aaseq=", aaseq
-                tmpaaseqfile = tempfile.mktemp()
-                tmpdgpfile = tempfile.mktemp()
-                tmpfp = open(tmpaaseqfile, 'w')
-                tmpfp.write(">%s\n"%seqID)
-                tmpfp.write("%s\n"%aaseq)
-                tmpfp.close()
-                cmd =  [g_params['dgscanProg'], tmpaaseqfile,  "-lmin", "21", "-lmax",
-                        "21", "-o", tmpdgpfile]
-                cmdline = " ".join(cmd)
-                print(cmdline)
-                try:
-                    subprocess.check_output(cmd)
-                except subprocess.CalledProcessError as e:
-                    print(e)
-                tmpDGPDict = ReadInDGProfile(tmpdgpfile)
-                os.remove(tmpaaseqfile)
-                os.remove(tmpdgpfile)
-                for seqid in tmpDGPDict:
-                    dgprofileDict[seqid] = tmpDGPDict[seqid]
-                if g_params['isPrintDebugInfo']:
-                    print(dgprofileDict)
+                toScanSeqDict[seqID] = aaSeqDict[seqID]
+        dgprofileDict.update(RunDGScanBatch(toScanSeqDict))
+        if g_params['isPrintDebugInfo']:
+            print(dgprofileDict)
         #}}}
         ax = fig.add_subplot(gs[1])
         #ax.set_xlim(0, lengthAlignmentOriginal)
@@ -3907,13 +4725,7 @@ def DrawMSATopo_MAT2(inFile, g_params):#{{{
                 print("no dgprofile for %s"%(seqid))
                 pass
 
-    plt.savefig(pdffile)
-    print("%s output"%(pdffile))
-    cmd = "pdfcrop --margins '%d %d %d %d' --clip %s"%(pdfcrop_margin_left,
-            pdfcrop_margin_top, pdfcrop_margin_right, pdfcrop_margin_bottom,
-            pdffile)
-    os.system(cmd)
-    pdf_cropfile = os.path.splitext(pdffile)[0]+"-crop.pdf"
+    pdf_cropfile = SaveFigureWithCrop(fig, pdffile)
     pngfile = os.path.splitext(pdffile)[0] + "-crop.png"
     thumb_pngfile = os.path.splitext(pdffile)[0] + "-crop.thumb.png"
     cmd = ["convert", pdffile, pngfile] 
@@ -3974,7 +4786,7 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
     """
     logger = logging.getLogger(__name__)
     logger.debug("method=%s"%(g_params['method']))
-    (idList, annotationList, orig_topoSeqList) = myfunc.ReadFasta(inFile)
+    (idList, annotationList, orig_topoSeqList) = libtmsa.ReadTopoMSAFile(inFile)
     lst_aligned_region = GetAlignedRegion(annotationList, orig_topoSeqList)
     numSeq = len(idList)
     if numSeq < 1:
@@ -3996,7 +4808,7 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
     maxlen_unaligned_nterm = max([len(x) for x in lst_unalignedNterm])
     maxlen_unaligned_cterm = max([len(x) for x in lst_unalignedCterm])
 
-    orig_posTMList = [ myfunc.GetTMPosition(topo) for topo in orig_topoSeqList]
+    orig_posTMList = lcmp.GetTMPositionList(orig_topoSeqList)
     numTMList=[ len (posTM) for posTM in orig_posTMList]
 
     blue = Color("blue")
@@ -4015,12 +4827,8 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
     scaleSeprationLine = g_params['scaleSeprationLine']
     font_size_scalebar = g_params['font_size_scalebar']
     fntScaleBar = g_params['fntScaleBar']
-    (fontWidthScaleBar, fontHeightScaleBar) = fntScaleBar.getsize("a")
+    (fontWidthScaleBar, fontHeightScaleBar) = GetTextSize(fntScaleBar, "a")
 
-    pdfcrop_margin_left = g_params['pdfcrop_margin_left']
-    pdfcrop_margin_top = g_params['pdfcrop_margin_top']
-    pdfcrop_margin_right = g_params['pdfcrop_margin_right']
-    pdfcrop_margin_bottom = g_params['pdfcrop_margin_bottom']
 
     rootname = os.path.basename(os.path.splitext(inFile)[0])
     aaSeqDict = GetAASeqDict(inFile)
@@ -4052,7 +4860,7 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
     # to be too short, topoSeqList is the aligned region
     # 1. for the N-terminal at the aligned region
     MIN_LENGTH_OF_TM_TO_DRAWN = 6
-    posTMList = [myfunc.GetTMPosition(x) for x in topoSeqList]
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     for posTM in posTMList:
         lst_length_of_first_TM_withgaps = []
         if len(posTM) > 0:
@@ -4073,7 +4881,7 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
         topoSeqList = newTopoSeqList
 
     # 2. dealing with the last TM in the aligned region
-    posTMList = [myfunc.GetTMPosition(x) for x in topoSeqList]
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     for posTM in posTMList:
         lst_length_of_last_TM_withgaps = []
         if len(posTM) > 0:
@@ -4093,7 +4901,7 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
                 newTopoSeqList.append(top+ "-"*num_Ms_to_add)
         topoSeqList = newTopoSeqList
 
-    posTMList = [myfunc.GetTMPosition(x) for x in topoSeqList]
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     alignedTopoSeqList = topoSeqList
 
 
@@ -4118,12 +4926,15 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
 
     if g_params['isShrink']:
         if g_params['method_shrink'] == 0:
-            posindexmap = ShrinkGapInMSA_0(idList, topoSeqList)
+            posindexmap = ShrinkCached(topoSeqList, ShrinkGapInMSA_0,
+                    idList, topoSeqList)
         elif g_params['method_shrink'] == 1:
-            posindexmap = ShrinkGapInMSA_exclude_TMregion(idList, topoSeqList)
+            posindexmap = ShrinkCached(topoSeqList,
+                    ShrinkGapInMSA_exclude_TMregion, idList, topoSeqList)
         elif g_params['method_shrink'] == 2:
             (idxmap_align2shrink, idxmap_shrink2align) =\
-                    ShrinkMSA_Method_2(topoSeqList, aaSeqAlignList, posTMList,
+                    ShrinkCached(topoSeqList, ShrinkMSA_Method_2,
+                            topoSeqList, aaSeqAlignList, posTMList,
                             g_params['shrinkrate_TM'], g_params['max_hold_loop'],
                             g_params['isDrawKRBias'])
             posindexmap = idxmap_shrink2align
@@ -4562,34 +5373,17 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
         dgprofileDict = {} #{{{
         if os.path.exists(g_params['DGProfileFile']):
             dgprofileDict = ReadInDGProfile(g_params['DGProfileFile'])
+        # profiles not in DGProfileFile are scanned in one batch
+        toScanSeqDict = {}
         for i in range(numSeq):
             seqID = idList[i]
             toposeq = topoSeqList[i]
             lengthAlignment = len(toposeq)
             if (not seqID in dgprofileDict) and (seqID in aaSeqDict):
-                aaseq = aaSeqDict[seqID]
-                #print "aaseq=", aaseq
-                tmpaaseqfile = tempfile.mktemp()
-                tmpdgpfile = tempfile.mktemp()
-                tmpfp = open(tmpaaseqfile, 'w')
-                tmpfp.write(">%s\n"%seqID)
-                tmpfp.write("%s\n"%aaseq)
-                tmpfp.close()
-                cmd =  [g_params['dgscanProg'], tmpaaseqfile,  "-lmin", "21", "-lmax",
-                        "21", "-o", tmpdgpfile]
-                cmdline = " ".join(cmd)
-                print(cmdline)
-                try:
-                    subprocess.check_output(cmd)
-                except subprocess.CalledProcessError as e:
-                    print(e)
-                tmpDGPDict = ReadInDGProfile(tmpdgpfile)
-                os.remove(tmpaaseqfile)
-                os.remove(tmpdgpfile)
-                for seqid in tmpDGPDict:
-                    dgprofileDict[seqid] = tmpDGPDict[seqid]
-                if g_params['isPrintDebugInfo']:
-                    print(dgprofileDict)
+                toScanSeqDict[seqID] = aaSeqDict[seqID]
+        dgprofileDict.update(RunDGScanBatch(toScanSeqDict))
+        if g_params['isPrintDebugInfo']:
+            print(dgprofileDict)
         #}}}
         ax = fig.add_subplot(gs[1])
         #ax.set_xlim(0, lengthAlignmentOriginal)
@@ -4652,13 +5446,7 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
                 print("no dgprofile for %s"%(seqid))
                 pass
 
-    plt.savefig(pdffile)
-    print("%s output"%(pdffile))
-    cmd = "pdfcrop --margins '%d %d %d %d' --clip %s"%(pdfcrop_margin_left,
-            pdfcrop_margin_top, pdfcrop_margin_right, pdfcrop_margin_bottom,
-            pdffile)
-    os.system(cmd)
-    pdf_cropfile = os.path.splitext(pdffile)[0]+"-crop.pdf"
+    pdf_cropfile = SaveFigureWithCrop(fig, pdffile)
     pngfile = os.path.splitext(pdffile)[0] + "-crop.png"
     thumb_pngfile = os.path.splitext(pdffile)[0] + "-crop.thumb.png"
     cmd = ["convert", pdffile, pngfile] 
@@ -4693,7 +5481,7 @@ def DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params):#{{{
 
 #}}}
 def DrawMSATopo_PYX(inFile, g_params):#{{{
-    (idList, annotationList, topoSeqList) = myfunc.ReadFasta(inFile)
+    (idList, annotationList, topoSeqList) = libtmsa.ReadTopoMSAFile(inFile)
     topoSeqList = lcmp.RemoveUnnecessaryGap(topoSeqList)
     numSeq = len(idList)
     if numSeq < 1:
@@ -4709,7 +5497,7 @@ def DrawMSATopo_PYX(inFile, g_params):#{{{
     scaleSeprationLine = g_params['scaleSeprationLine']
     font_size_scalebar = g_params['font_size_scalebar']
     fntScaleBar = g_params['fntScaleBar']
-    (fontWidthScaleBar, fontHeightScaleBar) = fntScaleBar.getsize("a")
+    (fontWidthScaleBar, fontHeightScaleBar) = GetTextSize(fntScaleBar, "a")
 
     rootname = os.path.basename(os.path.splitext(inFile)[0])
     aaSeqDict = GetAASeqDict(inFile)
@@ -4732,14 +5520,14 @@ def DrawMSATopo_PYX(inFile, g_params):#{{{
 # in the original MSA
 #   backup original aligned topoSeqList
     alignedTopoSeqList = []
-    posTMList = []
+    posTMList = lcmp.GetTMPositionList(topoSeqList)
     for seq in topoSeqList:
         alignedTopoSeqList.append(seq)
-        posTMList.append(myfunc.GetTMPosition(seq))
 
     posindexmap = {}
     if g_params['isShrink']:
-        posindexmap = ShrinkGapInMSA_0(idList, topoSeqList)
+        posindexmap = ShrinkCached(topoSeqList, ShrinkGapInMSA_0,
+                idList, topoSeqList)
 
     posTM = myfunc.GetTMPosition(topoSeqList[0])
     g_params['widthAnnotation'] = GetSizeAnnotationToDraw(annotationList)
@@ -4782,6 +5570,224 @@ def DrawMSATopo_PYX(inFile, g_params):#{{{
 
 #}}}
 
+def UpdateDigest(h, obj):#{{{
+    """
+    Update the hash object h with obj, dicts, lists and tuples are hashed by
+    their items, so that the digest does not depend on the order of dict keys,
+    fonts by their file and size
+    """
+    if isinstance(obj, dict):
+        h.update(b"{")
+        for key in sorted(obj, key=str):
+            UpdateDigest(h, key)
+            UpdateDigest(h, obj[key])
+        h.update(b"}")
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for item in obj:
+            UpdateDigest(h, item)
+        h.update(b"]")
+    elif isinstance(obj, ImageFont.FreeTypeFont):
+        UpdateDigest(h, ("font", obj.path, obj.size))
+    else:
+        h.update(repr(obj).encode("utf-8") + b";")
+#}}}
+def UpdateDigestWithFile(h, infile):#{{{
+    """Update the hash object h with the content of infile, if it exists"""
+    try:
+        fpin = open(infile, "rb")
+    except IOError:
+        h.update(b"nofile;")
+        return
+    while 1:
+        buff = fpin.read(1024*1024)
+        if not buff:
+            break
+        h.update(buff)
+    fpin.close()
+    h.update(b";")
+#}}}
+def GetDGProfileFileList(inFile):#{{{
+    """
+    Get the DG profile files that GetDGProfileFileName may find for inFile
+    """
+    dirname_infile = myfunc.my_dirname(inFile)
+    rootname_infile = os.path.basename(os.path.splitext(inFile)[0])
+    fileList = [g_params['DGProfileFile'],
+            dirname_infile + os.sep + rootname_infile + "_dg.txt"]
+    fileList += sorted(glob.glob(dirname_infile + os.sep +
+        glob.escape(rootname_infile) + "-*_dg.txt"))
+    return fileList
+#}}}
+def SetRenderCacheKey(inFile, g_params):#{{{
+    """
+    Set the keys of the render cache for inFile to g_params
+        cacheKeyShrink: the alignment, amino acid sequences and
+                        SHRINK_PARAM_KEYS
+        cacheKeyLayout: all inputs and drawing parameters but the colors
+        cacheKeyRender: all inputs and drawing parameters
+    """
+    h = hashlib.sha1()
+    UpdateDigestWithFile(h, inFile)
+    UpdateDigest(h, GetAASeqDict(inFile))
+    inputDigest = h.hexdigest()
+
+    h = hashlib.sha1()
+    if g_params['isDrawDGprofile']:
+        for dgpfile in GetDGProfileFileList(inFile):
+            UpdateDigest(h, os.path.basename(dgpfile))
+            UpdateDigestWithFile(h, dgpfile)
+    dgpDigest = h.hexdigest()
+
+    params = {}
+    for key in g_params:
+        if not key in RUNTIME_PARAM_KEYS:
+            params[key] = g_params[key]
+    shrinkParams = dict((key, params[key]) for key in SHRINK_PARAM_KEYS)
+    layoutParams = dict((key, params[key]) for key in params
+            if not key in COLOR_PARAM_KEYS)
+
+    for (name, item) in [
+            ('cacheKeyShrink', [inputDigest, shrinkParams]),
+            ('cacheKeyLayout', [inputDigest, dgpDigest, layoutParams]),
+            ('cacheKeyRender', [os.path.basename(inFile), inputDigest,
+                dgpDigest, params])]:
+        h = hashlib.sha1()
+        UpdateDigest(h, [RENDER_CACHE_VERSION, name, item])
+        g_params[name] = h.hexdigest()
+#}}}
+def GetCacheFile(category, key):#{{{
+    """Get the path of the item key in the category of the render cache"""
+    return os.path.join(g_params['cacheDir'], category, key)
+#}}}
+def ReadCacheObject(category, key):#{{{
+    """
+    Read the pickled object key from the render cache
+    Return None if the cache is not enabled or key is not cached
+    """
+    if g_params['cacheDir'] == "" or key == "":
+        return None
+    try:
+        fpin = open(GetCacheFile(category, key), "rb")
+    except IOError:
+        return None
+    try:
+        obj = pickle.load(fpin)
+    except (EOFError, pickle.UnpicklingError):
+        print("Ignore broken cache file %s"%(GetCacheFile(category, key)),
+                file=sys.stderr)
+        obj = None
+    fpin.close()
+    return obj
+#}}}
+def WriteCacheObject(category, key, obj):#{{{
+    """
+    Pickle obj as key to the render cache, the file is written to a temporary
+    name and then renamed, so that parallel processes never read it partially
+    """
+    if g_params['cacheDir'] == "" or key == "":
+        return
+    cachefile = GetCacheFile(category, key)
+    if not os.path.exists(os.path.dirname(cachefile)):
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(cachefile))
+    fpout = os.fdopen(fd, "wb")
+    pickle.dump(obj, fpout, pickle.HIGHEST_PROTOCOL)
+    fpout.close()
+    os.replace(tmpfile, cachefile)
+#}}}
+def ShrinkCached(topoSeqList, ShrinkFunc, *args, **kwargs):#{{{
+    """
+    Call ShrinkFunc(*args, **kwargs), which shrinks topoSeqList in place, and
+    return its result. With the render cache, the shrinked topoSeqList and the
+    result are stored and reused for the same inputs and SHRINK_PARAM_KEYS
+    """
+    key = ""
+    if g_params['cacheKeyShrink'] != "":
+        key = hashlib.sha1(("%s %s"%(g_params['cacheKeyShrink'],
+            ShrinkFunc.__name__)).encode("utf-8")).hexdigest()
+    obj = ReadCacheObject("shrink", key)
+    if obj != None:
+        (topoSeqList[:], result) = obj
+        return result
+    result = ShrinkFunc(*args, **kwargs)
+    WriteCacheObject("shrink", key, (list(topoSeqList), result))
+    return result
+#}}}
+def GetRenderOutputMTime(path):#{{{
+    """Get the mtime of an output file, or the latest one in an output dir"""
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    mtime = os.path.getmtime(path)
+    for (root, dirs, files) in os.walk(path):
+        for f in files:
+            mtime = max(mtime, os.path.getmtime(os.path.join(root, f)))
+    return mtime
+#}}}
+def GetRenderOutputState(stemname):#{{{
+    """
+    Get {path: mtime} of the existing output files of stemname, i.e.
+    $outpath/$rootname
+    """
+    state = {}
+    for suffix in RENDER_OUTPUT_SUFFIXES + [".%s"%(g_params['outFormat'])]:
+        path = stemname + suffix
+        if os.path.exists(path):
+            state[path] = GetRenderOutputMTime(path)
+    return state
+#}}}
+def CopyRenderOutput(src, dst):#{{{
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, dirs_exist_ok=True)
+    else:
+        shutil.copy2(src, dst)
+#}}}
+def DrawMSATopo_cached(inFile, g_params):#{{{
+    """
+    Draw inFile with the render cache in g_params['cacheDir']. If the same
+    input has been drawn with the same parameters, the output files are
+    copied from the cache without drawing, otherwise inFile is drawn and the
+    output files written by the drawing are added to the cache
+    """
+    SetRenderCacheKey(inFile, g_params)
+    if g_params['outpath'] == "":
+        outpath = myfunc.my_dirname(inFile)
+    else:
+        outpath = g_params['outpath']
+    rootname = os.path.basename(os.path.splitext(inFile)[0])
+    if g_params['isDrawKRBias']:
+        rootname += ".krbias"
+    stemname = "%s%s%s"%(outpath, os.sep, rootname)
+
+    renderDir = GetCacheFile("render", g_params['cacheKeyRender'])
+    if os.path.isdir(renderDir):
+        for name in sorted(os.listdir(renderDir)):
+            outfile = "%s%s%s"%(outpath, os.sep, name)
+            CopyRenderOutput(os.path.join(renderDir, name), outfile)
+            print("%s output (cached)"%(outfile))
+        return 0
+
+    origState = GetRenderOutputState(stemname)
+    status = DrawMSATopo_method(inFile, g_params)
+    if status == 1:
+        return status
+    outfileList = []
+    for (path, mtime) in GetRenderOutputState(stemname).items():
+        if not path in origState or origState[path] != mtime:
+            outfileList.append(path)
+    if len(outfileList) > 0:
+        if not os.path.exists(os.path.dirname(renderDir)):
+            os.makedirs(os.path.dirname(renderDir), exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(renderDir))
+        for path in outfileList:
+            CopyRenderOutput(path, os.path.join(tmpdir,
+                rootname + path[len(stemname):]))
+        try:
+            os.rename(tmpdir, renderDir)
+        except OSError: # added by another process meanwhile
+            shutil.rmtree(tmpdir)
+    return status
+#}}}
 def main(g_params):#{{{
     logger = logging.getLogger(__name__)
     argv = sys.argv
@@ -4824,10 +5830,30 @@ def main(g_params):#{{{
                 (g_params['font_size'], i) = myfunc.my_getopt_int(argv, i)
             elif argv[i] in ["-mode", "--mode"]:
                 (g_params['mode'], i) = myfunc.my_getopt_str(argv, i)
+            elif (argv[i] in ["-glyphatlas", "--glyphatlas"]):
+                if (argv[i+1].lower())[0] == "y": 
+                    g_params['isUseGlyphAtlas'] = True
+                else:
+                    g_params['isUseGlyphAtlas'] = False
+                i = i + 2
+            elif argv[i] in ["-cpu", "--cpu"]:
+                (g_params['numCPU'], i) = myfunc.my_getopt_int(argv, i)
+            elif argv[i] in ["-status", "--status"]:
+                (g_params['statusfile'], i) = myfunc.my_getopt_str(argv, i)
+            elif argv[i] in ["-cachedir", "--cachedir"]:
+                (g_params['cacheDir'], i) = myfunc.my_getopt_str(argv, i)
+            elif argv[i] in ["-tilesize", "--tilesize"]:
+                (g_params['tileSize'], i) = myfunc.my_getopt_int(argv, i)
+            elif argv[i] in ["-raster", "--raster"]:
+                (g_params['rasterBackend'], i) = myfunc.my_getopt_str(argv, i)
             elif argv[i] in ["-log", "--log"]:
                 (g_params['log_config_file'],i) = myfunc.my_getopt_str(argv, i)
             elif argv[i] in ["-dgpfile", "--dgpfile"]:
                 (g_params['DGProfileFile'],i) =  myfunc.my_getopt_str(argv, i)
+            elif argv[i] in ["-dgscanprog", "--dgscanprog"]:
+                (g_params['dgscanProg'],i) =  myfunc.my_getopt_str(argv, i)
+            elif argv[i] in ["-dgpstore", "--dgpstore"]:
+                (g_params['DGProfileStore'],i) =  myfunc.my_getopt_str(argv, i)
             elif argv[i] in ["-text", "--text"]:
                 (tmpstr, i) =  myfunc.my_getopt_str(argv, i)
                 if (tmpstr.lower())[0] == "y": 
@@ -4934,8 +5960,11 @@ def main(g_params):#{{{
             i=i+1
 #}}}
 
-    if g_params['isDrawDGprofile']:
+    if g_params['isDrawDGprofile'] and g_params['dgscanProg'] == "":
         g_params['dgscanProg'] = "%s/myscanDG.pl"%(rundir)
+    if g_params['DGProfileStore'] == "" and g_params['cacheDir'] != "":
+        g_params['DGProfileStore'] = os.path.join(g_params['cacheDir'],
+                "dgprofile")
 
     myfunc.setup_logging(g_params['log_config_file'])
     logger = logging.getLogger(__name__)
@@ -4970,11 +5999,11 @@ def main(g_params):#{{{
     if len(filelist) < 1:
         print("Error! Input file not set.", file=sys.stderr)
 
-    g_params['fntScaleBar'] = ImageFont.truetype(g_params['font_dir'] +
+    g_params['fntScaleBar'] = GetFont(g_params['font_dir'] +
             g_params['font'], g_params['font_size_scalebar'])
-    g_params['fntTMbox'] = ImageFont.truetype(g_params['font_dir'] +
+    g_params['fntTMbox'] = GetFont(g_params['font_dir'] +
         g_params['font'], g_params['font_size_TMbox'])
-    g_params['fntDGprofileLegend'] = ImageFont.truetype(g_params['font_dir'] +
+    g_params['fntDGprofileLegend'] = GetFont(g_params['font_dir'] +
         g_params['font'], g_params['font_size_scalebar'])
 
     if aaSeqFile != "" and os.path.exists(aaSeqFile):
@@ -4989,22 +6018,87 @@ def main(g_params):#{{{
 
 
     logger.debug("method=%s"%(g_params['method']))
-    for inFile in filelist:
-        if g_params['method'] == 'pil':
-            DrawMSATopo_PIL(inFile, g_params)
-        elif g_params['method'] == 'svg':
-            DrawMSATopo_SVG(inFile, g_params)
-        elif g_params['method'] == 'mat':
-            #DrawMSATopo_MAT(inFile, g_params)
-            DrawMSATopo_MAT2(inFile, g_params)
-        elif g_params['method'] == 'core-rainbow':
-            DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params)
-        elif g_params['method'] == 'matfull':
-            DrawMSATopo_MAT(inFile, g_params)
-        elif g_params['method'] == 'pyx':
-            DrawMSATopo_PYX(inFile, g_params)
+    g_params_init.clear()
+    g_params_init.update(g_params)
+    numCPU = min(g_params['numCPU'], len(filelist))
+    if numCPU > 1:
+        # fork, so that workers share the fonts loaded above
+        pool = multiprocessing.get_context("fork").Pool(processes=numCPU)
+        statusIterator = pool.imap(DrawMSATopo_worker, filelist, chunksize=1)
+    else:
+        pool = None
+        statusIterator = (DrawMSATopo_worker(inFile) for inFile in filelist)
+    fpstatus = None
+    if g_params['statusfile'] != "":
+        fpstatus = open(g_params['statusfile'], "w")
+        fpstatus.write("#File\tStatus\tRunTime(s)\tMessage\n")
+    numFailed = 0
+    for (inFile, status, runtime, message) in statusIterator:
+        if status != "OK":
+            numFailed += 1
+            print("%s: %s %s"%(inFile, status, message), file=sys.stderr)
+        if fpstatus:
+            fpstatus.write("%s\t%s\t%.3f\t%s\n"%(inFile, status, runtime,
+                message))
+            fpstatus.flush()
+    if pool:
+        pool.close()
+        pool.join()
+    if fpstatus:
+        fpstatus.close()
+    if numFailed > 0:
+        print("%d of %d files failed"%(numFailed, len(filelist)), file=sys.stderr)
+    g_params.clear()
+    g_params.update(g_params_init)
+    if numFailed > 0:
+        return 1
     return 0
 #}}}
+def DrawMSATopo(inFile, g_params):#{{{
+    """Draw the topology MSA inFile, using the render cache if it is set"""
+    if g_params['cacheDir'] != "":
+        return DrawMSATopo_cached(inFile, g_params)
+    return DrawMSATopo_method(inFile, g_params)
+#}}}
+def DrawMSATopo_method(inFile, g_params):#{{{
+    """Draw the topology MSA inFile with the method in g_params"""
+    if g_params['method'] == 'pil':
+        return DrawMSATopo_PIL(inFile, g_params)
+    elif g_params['method'] == 'svg':
+        return DrawMSATopo_SVG(inFile, g_params)
+    elif g_params['method'] == 'mat':
+        #DrawMSATopo_MAT(inFile, g_params)
+        return DrawMSATopo_MAT2(inFile, g_params)
+    elif g_params['method'] == 'core-rainbow':
+        return DrawMSATopo_MAT_Core_unalign_rainbow(inFile, g_params)
+    elif g_params['method'] == 'matfull':
+        return DrawMSATopo_MAT(inFile, g_params)
+    elif g_params['method'] == 'pyx':
+        return DrawMSATopo_PYX(inFile, g_params)
+#}}}
+def DrawMSATopo_worker(inFile):#{{{
+    """
+    Draw one file with g_params restored from g_params_init, so that
+    per-file changes (marginX, marginY, widthAnnotation, fonts ...) do not
+    leak to the next file. Exceptions are caught and reported.
+    Return (inFile, status, runtime, message)
+    """
+    g_params.clear()
+    g_params.update(g_params_init)
+    t0 = time.time()
+    status = "OK"
+    message = ""
+    try:
+        if DrawMSATopo(inFile, g_params) == 1:
+            status = "FAILED"
+            message = "no output, see the error message"
+    except Exception as e:
+        traceback.print_exc()
+        status = "FAILED"
+        message = "%s: %s"%(type(e).__name__, str(e).replace("\n", " "))
+    plt.close('all')
+    return (inFile, status, time.time()-t0, message)
+#}}}
 def InitGlobalParameter():#{{{
     g_params = {}
     g_params['outpath'] = ""
@@ -5028,11 +6122,22 @@ def InitGlobalParameter():#{{{
     g_params['isDrawKRBias'] = False
 
     g_params['DGProfileFile'] = ''
+    g_params['DGProfileStore'] = ''
 
     #draw distribution of percentage of M
     g_params['isDrawPerMDistribution'] = True
     g_params['isDrawDGprofile'] = False
     g_params['isDrawTagColumn'] = False
+    g_params['rasterBackend'] = "numpy"
+    g_params['tileSize'] = 0
+    g_params['numCPU'] = 1
+    g_params['isUseGlyphAtlas'] = True
+    g_params['statusfile'] = ""
+    g_params['cacheDir'] = ""
+    # keys of the render cache, set for each input file
+    g_params['cacheKeyShrink'] = ""
+    g_params['cacheKeyLayout'] = ""
+    g_params['cacheKeyRender'] = ""
     g_params['maxDistKR'] = 12
     g_params['isShrink'] = True
     g_params['aapath'] = ""
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# Description:
+#   DG profile (the apparent free energy of membrane insertion of sliding
+#   windows, as output by myscanDG.pl) of amino acid sequences
+#   * read the output of myscanDG.pl into arrays
+#   * scan many sequences in one call of the scan program
+#   * cache the profiles on disk, keyed by the sequence and the content of
+#     the scan program
+#   * a stub scanner in Python, for tests without myscanDG.pl
+#
+# A DG profile is a tuple of arrays (posArray, dgArray), posArray (int32) is
+# the position of each window and dgArray (float64) the DG value
+
+import os
+import sys
+import hashlib
+import tempfile
+import shutil
+import subprocess
+import fcntl
+import numpy as np
+
+# window size used by drawMSATopo.py
+DEFAULT_WINDOW_SIZE = 21
+# name of the scan program for ScanDGProfile_stub
+STUB_SCANNER = "stub"
+# {dgscanProg: identity of the program in the keys of DG profiles}
+g_scannerIDCache = {}
+
+# biological hydrophobicity scale, DG (kcal/mol) of each amino acid at the
+# center of a TM segment, Hessa et al. Nature 2005
+HESSA_SCALE = {
+        'A':  0.11, 'C': -0.13, 'D':  3.49, 'E':  2.68, 'F': -0.32,
+        'G':  0.74, 'H':  2.06, 'I': -0.60, 'K':  2.71, 'L': -0.55,
+        'M': -0.10, 'N':  2.05, 'P':  2.23, 'Q':  2.36, 'R':  2.58,
+        'S':  0.84, 'T':  0.52, 'V': -0.31, 'W':  0.30, 'Y':  0.68}
+HESSA_SCALE_TABLE = np.zeros(256, dtype=np.float64)
+for aa in HESSA_SCALE:
+    HESSA_SCALE_TABLE[ord(aa)] = HESSA_SCALE[aa]
+    HESSA_SCALE_TABLE[ord(aa.lower())] = HESSA_SCALE[aa]
+
+def ReadInDGProfile_array(infile):#{{{
+    """
+    Read in DG profile output by myscanDG.pl, the values of each profile are
+    parsed in bulk
+    Return {seqid: (posArray, dgArray)}, or None if infile can not be read
+    Raise ValueError if the number of values of a profile is wrong
+    """
+    try:
+        fpin = open(infile, 'r')
+        buff = fpin.read()
+        fpin.close()
+    except IOError:
+        print("Failed to read dgprofile", infile, file=sys.stderr)
+        return None
+    dgpDict = {}
+    lines = buff.split('\n')
+    numLine = len(lines)
+    i = 0
+    seqid = ''
+    while i < numLine:
+        line = lines[i]
+        if line.find("#SeqID") == 0:
+            seqid = line.split()[1]
+        elif line.find("#Number of sliding windows") == 0:
+            numWin = int(line.split(':')[1])
+            block = lines[i+1:i+1+numWin]
+            values = " ".join(block).split()
+            if len(block) != numWin or len(values) != 2*numWin:
+                raise ValueError("dgscan file error in %s, seqid=%s"%(infile,
+                    seqid))
+            values = np.array(values).reshape(numWin, 2)
+            dgpDict[seqid] = (values[:,0].astype(np.int32),
+                    values[:,1].astype(np.float64))
+            i += numWin
+        i += 1
+    return dgpDict
+#}}}
+def ScanDGProfile_stub(seq, windowSize=DEFAULT_WINDOW_SIZE):#{{{
+    """
+    DG profile of seq from the sum of HESSA_SCALE in each sliding window,
+    with the windows positioned as by myscanDG.pl. This is not the DG
+    predictor of myscanDG.pl, it is used to test the drawing without it
+    """
+    seq = seq.replace('-', '')
+    numWin = len(seq) - windowSize + 1
+    if numWin < 1:
+        return (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64))
+    values = HESSA_SCALE_TABLE[np.frombuffer(seq.encode('ascii', 'replace'),
+        dtype=np.uint8)]
+    cumValues = np.concatenate(([0.0], np.cumsum(values)))
+    dgArray = np.round(cumValues[windowSize:] - cumValues[:numWin], 3)
+    posArray = np.arange(numWin, dtype=np.int32) + (windowSize+1)//2
+    return (posArray, dgArray)
+#}}}
+def RunDGScanBatch(seqList, dgscanProg, windowSize=DEFAULT_WINDOW_SIZE):#{{{
+    """
+    Scan all sequences in seqList with one call of dgscanProg, or
+    ScanDGProfile_stub if dgscanProg is STUB_SCANNER
+    Return the list of DG profiles, None for sequences failed to scan
+    """
+    if dgscanProg == STUB_SCANNER:
+        return [ScanDGProfile_stub(seq, windowSize) for seq in seqList]
+    if len(seqList) == 0:
+        return []
+    tmpdir = tempfile.mkdtemp()
+    seqfile = os.path.join(tmpdir, "seq.fa")
+    dgpfile = os.path.join(tmpdir, "seq_dg.txt")
+    fpout = open(seqfile, "w")
+    for i in range(len(seqList)):
+        fpout.write(">s%d\n%s\n"%(i, seqList[i]))
+    fpout.close()
+    cmd = [dgscanProg, seqfile, "-lmin", str(windowSize), "-lmax",
+            str(windowSize), "-o", dgpfile]
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print("Failed to run %s: %s"%(" ".join(cmd), e), file=sys.stderr)
+    dgpDict = None
+    if os.path.exists(dgpfile):
+        dgpDict = ReadInDGProfile_array(dgpfile)
+    shutil.rmtree(tmpdir)
+    if not dgpDict:
+        return [None]*len(seqList)
+    if len(seqList) == 1 and not "s0" in dgpDict and "query" in dgpDict:
+        dgpDict["s0"] = dgpDict["query"]
+    return [dgpDict.get("s%d"%(i)) for i in range(len(seqList))]
+#}}}
+def GetScannerID(dgscanProg):#{{{
+    """
+    Identity of the scan program in the keys of DG profiles, the content
+    digest of the program file, so that profiles of a replaced program are
+    not reused. It is computed once per process
+    """
+    if dgscanProg in g_scannerIDCache:
+        return g_scannerIDCache[dgscanProg]
+    scannerID = os.path.basename(dgscanProg)
+    path = dgscanProg
+    if dgscanProg != STUB_SCANNER and not os.path.isfile(path):
+        path = shutil.which(dgscanProg)
+    if dgscanProg != STUB_SCANNER and path != None and os.path.isfile(path):
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as fpin:
+            sha1.update(fpin.read())
+        scannerID = "%s:%s"%(scannerID, sha1.hexdigest())
+    g_scannerIDCache[dgscanProg] = scannerID
+    return scannerID
+#}}}
+def GetDGProfileKey(seq, dgscanProg, windowSize=DEFAULT_WINDOW_SIZE):#{{{
+    """Key of the DG profile of seq in DGProfileStore"""
+    text = "%s %d %s"%(GetScannerID(dgscanProg), windowSize, seq)
+    return hashlib.sha1(text.encode('utf-8')).digest()
+#}}}
+class DGProfileStore: #{{{
+# Description:
+#   On-disk cache of DG profiles keyed by GetDGProfileKey, in the directory
+#   storedir
+#       dgprofile.data      : the profiles appended one after another, the
+#                             positions (int32) and then the DG values
+#                             (float64)
+#       dgprofile.index.npy : key, offset and number of windows of each
+#                             profile (INDEX_DTYPE)
+#       dgprofile.lock      : lock for adding profiles, so that the store can
+#                             be shared by parallel processes
+# Functions:
+#     Get(key)              : the DG profile of key, or None
+#     Add(itemList)         : add [(key, dgp)] to the store
+    INDEX_DTYPE = np.dtype([('key', 'S20'), ('offset', '<u8'),
+        ('numWin', '<u4')])
+    def __init__(self, storedir):#{{{
+        self.storedir = storedir
+        if not os.path.exists(storedir):
+            os.makedirs(storedir, exist_ok=True)
+        self.datafile = os.path.join(storedir, "dgprofile.data")
+        self.indexfile = os.path.join(storedir, "dgprofile.index.npy")
+        self.lockfile = os.path.join(storedir, "dgprofile.lock")
+        self.indexDict = {}
+        self.ReadIndex()
+#}}}
+    def ReadIndex(self):#{{{
+        if os.path.exists(self.indexfile):
+            index = np.load(self.indexfile)
+            for rec in index:
+                self.indexDict[bytes(rec['key'])] = (int(rec['offset']),
+                        int(rec['numWin']))
+#}}}
+    def Get(self, key):#{{{
+        if not key in self.indexDict:
+            return None
+        (offset, numWin) = self.indexDict[key]
+        fpin = open(self.datafile, "rb")
+        fpin.seek(offset)
+        buff = fpin.read(numWin*12)
+        fpin.close()
+        if len(buff) != numWin*12:
+            return None
+        posArray = np.frombuffer(buff, dtype='<i4', count=numWin).astype(
+                np.int32)
+        dgArray = np.frombuffer(buff, dtype='<f8', count=numWin,
+                offset=numWin*4).astype(np.float64)
+        return (posArray, dgArray)
+#}}}
+    def Add(self, itemList):#{{{
+        if len(itemList) == 0:
+            return
+        fplock = open(self.lockfile, "w")
+        fcntl.flock(fplock, fcntl.LOCK_EX)
+        try:
+            self.ReadIndex() # added by other processes
+            fpout = open(self.datafile, "ab")
+            fpout.seek(0, os.SEEK_END)
+            for (key, dgp) in itemList:
+                if key in self.indexDict:
+                    continue
+                (posArray, dgArray) = dgp
+                offset = fpout.tell()
+                fpout.write(np.asarray(posArray, dtype='<i4').tobytes())
+                fpout.write(np.asarray(dgArray, dtype='<f8').tobytes())
+                self.indexDict[key] = (offset, len(posArray))
+            fpout.close()
+            index = np.zeros(len(self.indexDict), dtype=self.INDEX_DTYPE)
+            for (i, key) in enumerate(self.indexDict):
+                index[i] = (key,) + self.indexDict[key]
+            (fd, tmpfile) = tempfile.mkstemp(dir=self.storedir)
+            with os.fdopen(fd, "wb") as fpindex:
+                np.save(fpindex, index)
+            os.chmod(tmpfile, 0o644)
+            os.replace(tmpfile, self.indexfile)
+        finally:
+            fcntl.flock(fplock, fcntl.LOCK_UN)
+            fplock.close()
+#}}}
+#}}}
+def GetDGProfileDict(seqDict, dgscanProg, store=None, #{{{
+        windowSize=DEFAULT_WINDOW_SIZE):
+    """
+    Get the DG profiles of seqDict {seqid: aaseq}, profiles in store are
+    reused and the others are scanned with one call of dgscanProg and added to
+    store
+    Return {seqid: dgp} for sequences with a DG profile
+    """
+    keyDict = {}
+    for seqid in seqDict:
+        keyDict[seqid] = GetDGProfileKey(seqDict[seqid], dgscanProg,
+                windowSize)
+    dgpByKey = {}
+    toScanDict = {} # key: seq
+    for seqid in seqDict:
+        key = keyDict[seqid]
+        if key in dgpByKey or key in toScanDict:
+            continue
+        dgp = None
+        if store != None:
+            dgp = store.Get(key)
+        if dgp != None:
+            dgpByKey[key] = dgp
+        else:
+            toScanDict[key] = seqDict[seqid]
+
+    keyList = list(toScanDict.keys())
+    dgpList = RunDGScanBatch([toScanDict[key] for key in keyList], dgscanProg,
+            windowSize)
+    newItemList = []
+    for (key, dgp) in zip(keyList, dgpList):
+        if dgp != None:
+            dgpByKey[key] = dgp
+            newItemList.append((key, dgp))
+    if store != None:
+        store.Add(newItemList)
+
+    dgpDict = {}
+    for seqid in seqDict:
+        if keyDict[seqid] in dgpByKey:
+            dgpDict[seqid] = dgpByKey[keyDict[seqid]]
+    return dgpDict
+#}}}
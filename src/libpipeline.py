@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# Description:
+#   Manifest of the steps run by topoana_TMpro.sh for a family, so that a
+#   rerun of the pipeline skips the steps whose inputs have not changed
+#   * the content digest (sha1) of input and output files
+#   * a manifest per family, JSON, written in one piece by os.replace
+#   * check whether a stage is up to date, record a stage after it is run
+#     successfully and forget it after it failed
+#
+# The manifest is {stage: {'param': str, 'inputs': [[file, digest]],
+# 'outputs': [[file, digest]]}}. A stage is up to date if its parameters and
+# the digests of its inputs (compared in order, not by file name, since the
+# input files may be extracted to a temporary directory in each run) are the
+# same as when it was recorded and its outputs exist with the recorded
+# digests. A stage rerun on changed inputs that writes the same outputs as
+# before leaves the later stages up to date
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+
+BLOCK_SIZE = 1024*1024
+# digest of an input file that does not exist
+MISSING_FILE = "missing"
+
+def GetFileDigest(infile):#{{{
+    """
+    Return the sha1 hex digest of the content of infile, or MISSING_FILE if
+    infile does not exist
+    """
+    if not os.path.isfile(infile):
+        return MISSING_FILE
+    sha1 = hashlib.sha1()
+    with open(infile, "rb") as fpin:
+        buff = fpin.read(BLOCK_SIZE)
+        while buff:
+            sha1.update(buff)
+            buff = fpin.read(BLOCK_SIZE)
+    return sha1.hexdigest()
+#}}}
+def GetFileDigestList(fileList):#{{{
+    """Return [[file, digest]] of the files in fileList"""
+    return [[f, GetFileDigest(f)] for f in fileList]
+#}}}
+def ReadManifest(manifestfile):#{{{
+    """
+    Read the manifest of a family, return {} if manifestfile does not exist
+    or can not be parsed, so that all stages are rerun
+    """
+    if not os.path.exists(manifestfile):
+        return {}
+    try:
+        with open(manifestfile, "r") as fpin:
+            manifest = json.load(fpin)
+    except (IOError, ValueError) as e:
+        print("Failed to read manifest %s: %s"%(manifestfile, e),
+                file=sys.stderr)
+        return {}
+    if not isinstance(manifest, dict):
+        return {}
+    return manifest
+#}}}
+def WriteManifest(manifestfile, manifest):#{{{
+    """
+    Write manifest to manifestfile through a temporary file, so that an
+    interrupted run does not leave a truncated manifest
+    Return 0 on success and 1 on failure
+    """
+    outdir = os.path.dirname(os.path.abspath(manifestfile))
+    try:
+        (fd, tmpfile) = tempfile.mkstemp(dir=outdir)
+        with os.fdopen(fd, "w") as fpout:
+            json.dump(manifest, fpout, indent=1, sort_keys=True)
+            fpout.write("\n")
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, manifestfile)
+    except (IOError, OSError) as e:
+        print("Failed to write manifest %s: %s"%(manifestfile, e),
+                file=sys.stderr)
+        return 1
+    return 0
+#}}}
+def IsDigestList(digestList):#{{{
+    """Whether digestList is a list of [file, digest] as in the manifest"""
+    if not isinstance(digestList, list):
+        return False
+    for item in digestList:
+        if not (isinstance(item, list) and len(item) == 2 and
+                isinstance(item[0], str) and isinstance(item[1], str)):
+            return False
+    return True
+#}}}
+def GetStageChange(manifest, stage, inFileList, outFileList, param):#{{{
+    """
+    Return the reason why stage has to be run as a string, or "" if the stage
+    is up to date in manifest
+    """
+    if not stage in manifest:
+        return "not run before"
+    record = manifest[stage]
+    if not (isinstance(record, dict) and
+            IsDigestList(record.get('inputs')) and
+            IsDigestList(record.get('outputs'))):
+        return "manifest entry malformed"
+    if record.get('param') != param:
+        return "parameters changed"
+    recordInList = record['inputs']
+    if len(recordInList) != len(inFileList):
+        return "number of input files changed"
+    for i in range(len(inFileList)):
+        if GetFileDigest(inFileList[i]) != recordInList[i][1]:
+            return "input %s changed"%(inFileList[i])
+    recordOutList = record['outputs']
+    if [f for (f, digest) in recordOutList] != outFileList:
+        return "list of output files changed"
+    for (f, digest) in recordOutList:
+        if not os.path.isfile(f):
+            return "output %s missing"%(f)
+        if GetFileDigest(f) != digest:
+            return "output %s changed"%(f)
+    return ""
+#}}}
+def RecordStage(manifest, stage, inFileList, outFileList, param):#{{{
+    """
+    Record in manifest that stage has been run on the current inputs,
+    outputs which do not exist are not recorded so that the stage is rerun
+    Return the list of missing outputs
+    """
+    missingList = [f for f in outFileList if not os.path.isfile(f)]
+    if len(missingList) > 0:
+        if stage in manifest:
+            del manifest[stage]
+        return missingList
+    manifest[stage] = {
+            'param': param,
+            'inputs': GetFileDigestList(inFileList),
+            'outputs': GetFileDigestList(outFileList)}
+    return missingList
+#}}}
+def ForgetStage(manifest, stage):#{{{
+    """Remove stage from manifest, so that it is run next time"""
+    if stage in manifest:
+        del manifest[stage]
+#}}}
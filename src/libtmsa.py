@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+# Description:
+#   Binary container of topology MSA (.tmsa), so that the topology MSA is
+#   not parsed again from text by each program of the pipeline
+#   * sequence IDs and annotations
+#   * the matrix of topology states, packed with 2, 4 or 8 bits per state
+#     depending on the number of distinct states in the file
+#   * positions of TM segments of each sequence (as myfunc.GetTMPosition)
+#   * DG scores of TM segments, optional, as in the .topowithdgscore file
+#
+# File layout, little-endian
+#   magic       b"TMSA" and 4 bytes of version
+#   headerSize  uint64
+#   header      JSON: numSeq, lengthAlignment, alphabet, bitsPerState and
+#               the offset, dtype and shape of each section
+#   sections    aligned to SECTION_ALIGN bytes, each one is memory mapped
+#               when read, so that a row or a range of columns is read
+#               without loading the rest of the file
+#       id_offset, id_data          IDs, utf-8, id i is
+#                                   id_data[id_offset[i]:id_offset[i+1]]
+#       anno_offset, anno_data      annotations, as the IDs
+#       state                       numSeq x rowBytes, states of each row
+#                                   packed from the most significant bit,
+#                                   the code of a state is its index in
+#                                   alphabet
+#       tm_offset, tm_data          (begin, end) of TM segments
+#       dg_offset, dg_data          DG scores, if hasDGScore
+
+import sys
+import re
+import json
+import struct
+import numpy as np
+import myfunc
+GAP = myfunc.GAP
+
+TMSA_SUFFIX = ".tmsa"
+TMSA_MAGIC = b"TMSA"
+TMSA_VERSION = 1
+SECTION_ALIGN = 64
+# number of rows encoded at once when writing
+WRITE_CHUNK_SIZE = 4096
+
+def IsTMSAFile(infile):#{{{
+    """Whether infile is a binary topology MSA, decided by the file extension"""
+    return infile.endswith(TMSA_SUFFIX)
+#}}}
+def GetBitsPerState(numState):#{{{
+    """Number of bits used to store a state given the number of states"""
+    if numState <= 4:
+        return 2
+    elif numState <= 16:
+        return 4
+    else:
+        return 8
+#}}}
+def PackStateMatrix(codeMatrix, bitsPerState):#{{{
+    """
+    Pack the uint8 matrix of state codes, bitsPerState bits for each code,
+    from the most significant bit
+    Return the uint8 matrix of the shape (numSeq, rowBytes)
+    """
+    (numSeq, lengthAlignment) = codeMatrix.shape
+    perByte = 8//bitsPerState
+    rowBytes = (lengthAlignment+perByte-1)//perByte
+    padded = np.zeros((numSeq, rowBytes*perByte), dtype=np.uint8)
+    padded[:, :lengthAlignment] = codeMatrix
+    padded = padded.reshape(numSeq, rowBytes, perByte)
+    packed = np.zeros((numSeq, rowBytes), dtype=np.uint8)
+    for k in range(perByte):
+        packed |= padded[:, :, k] << (8-bitsPerState*(k+1))
+    return packed
+#}}}
+def GetUnpackTable(bitsPerState):#{{{
+    """Codes packed in each byte value, uint8 array (256, 8/bitsPerState)"""
+    perByte = 8//bitsPerState
+    shifts = 8-bitsPerState*(np.arange(perByte)+1)
+    mask = (1 << bitsPerState) - 1
+    return ((np.arange(256)[:, np.newaxis] >> shifts) & mask).astype(np.uint8)
+#}}}
+def UnpackStateMatrix(packed, bitsPerState, table=None):#{{{
+    """
+    Inverse of PackStateMatrix, the padding codes are kept. If table is given,
+    table[byte] is used instead of GetUnpackTable, e.g. to map the codes to
+    states at the same time
+    """
+    if table is None:
+        table = GetUnpackTable(bitsPerState)
+    perByte = table.shape[1]
+    # gather the codes of a byte at once as a single integer
+    wordType = {1: np.uint8, 2: np.uint16, 4: np.uint32}[perByte]
+    wordTable = np.ascontiguousarray(table).view(wordType).reshape(256)
+    return wordTable[packed].view(np.uint8).reshape(packed.shape[0],
+            packed.shape[1]*perByte)
+#}}}
+def GetTMPositionOfCodeMatrix(codeMatrix, alphabet):#{{{
+    """
+    Get the TM segments of all rows of the code matrix, the same as
+    myfunc.GetTMPosition on each row: a TM segment begins at 'M' and ends
+    before the next 'i' or 'o', trailing gaps are excluded
+    Return (rowIndex, begin, end), arrays of all segments in the order of rows
+    """
+    (numRow, width) = codeMatrix.shape
+    empty = np.zeros(0, dtype=np.int64)
+    if not 'M' in alphabet or numRow*width == 0:
+        return (empty, empty, empty)
+    codes = codeMatrix.ravel()
+    isIO = np.zeros(len(alphabet), dtype=bool)
+    for state in "io":
+        if state in alphabet:
+            isIO[alphabet.index(state)] = True
+    isIO = isIO[codes]
+    posM = np.nonzero(codes == alphabet.index('M'))[0]
+    if len(posM) == 0:
+        return (empty, empty, empty)
+    # region between two i/o states (or the ends of the row)
+    isBoundary = isIO.copy()
+    isBoundary[::width] = True
+    regionOfM = np.cumsum(isBoundary)[posM]
+    isFirst = np.ones(len(posM), dtype=bool)
+    isFirst[1:] = regionOfM[1:] != regionOfM[:-1]
+    isLast = np.ones(len(posM), dtype=bool)
+    isLast[:-1] = isFirst[1:]
+    begin = posM[isFirst]
+    lastM = posM[isLast]
+    # a segment ends at the next i/o state or at the end of the row
+    isStop = np.zeros(len(codes)+1, dtype=bool)
+    isStop[:-1] = isIO
+    isStop[width::width] = True
+    stopPos = np.nonzero(isStop)[0]
+    end = stopPos[np.searchsorted(stopPos, lastM, side='right')]
+    if GAP in alphabet:
+        isGapBefore = codes[end-1] == alphabet.index(GAP)
+        end[isGapBefore] = lastM[isGapBefore] + 1
+    rowIndex = begin//width
+    return (rowIndex, begin - rowIndex*width, end - rowIndex*width)
+#}}}
+def EncodeStrings(strList):#{{{
+    """Encode a list of strings as (offsetArray, dataArray) of utf-8 bytes"""
+    bytesList = [s.encode('utf-8') for s in strList]
+    offset = np.zeros(len(bytesList)+1, dtype='<u8')
+    np.cumsum([len(b) for b in bytesList], out=offset[1:])
+    data = np.frombuffer(b"".join(bytesList), dtype=np.uint8)
+    return (offset, data)
+#}}}
+def EncodeRagged(itemList, dtype):#{{{
+    """
+    Encode a list of lists as (offsetArray, dataArray), data of item i is
+    dataArray[offsetArray[i]:offsetArray[i+1]]
+    """
+    offset = np.zeros(len(itemList)+1, dtype='<u8')
+    np.cumsum([len(li) for li in itemList], out=offset[1:])
+    data = np.zeros(int(offset[-1]), dtype=dtype)
+    for i in range(len(itemList)):
+        if len(itemList[i]) > 0:
+            data[offset[i]:offset[i+1]] = itemList[i]
+    return (offset, data)
+#}}}
+def GetAlphabet(topoSeqList):#{{{
+    """Return the string of distinct states (latin-1 characters) sorted"""
+    isPresent = np.zeros(256, dtype=bool)
+    for i in range(0, len(topoSeqList), WRITE_CHUNK_SIZE):
+        buff = "".join(topoSeqList[i:i+WRITE_CHUNK_SIZE]).encode('latin-1')
+        isPresent |= np.bincount(np.frombuffer(buff, dtype=np.uint8),
+                minlength=256) > 0
+    return bytes(np.nonzero(isPresent)[0].astype(np.uint8)).decode('latin-1')
+#}}}
+def WriteTMSA(outfile, idList, annotationList, topoSeqList, #{{{
+        dgScoreList=None):
+    """
+    Write the topology MSA to outfile in the binary format, dgScoreList is
+    the list of DG scores of each sequence, or None
+    Return 0 on success and 1 on failure
+    """
+    numSeq = len(topoSeqList)
+    lengthAlignment = 0
+    if numSeq > 0:
+        lengthAlignment = len(topoSeqList[0])
+    for i in range(numSeq):
+        if len(topoSeqList[i]) != lengthAlignment:
+            msg = "Error! topoSeqList with un-equal length (%s), can not "\
+                    "write to %s"
+            print(msg%(idList[i], outfile), file=sys.stderr)
+            return 1
+    try:
+        alphabet = GetAlphabet(topoSeqList)
+    except UnicodeEncodeError:
+        msg = "Error! non latin-1 character in topology, can not write to %s"
+        print(msg%(outfile), file=sys.stderr)
+        return 1
+    bitsPerState = GetBitsPerState(len(alphabet))
+    perByte = 8//bitsPerState
+    rowBytes = (lengthAlignment+perByte-1)//perByte
+    codeTable = np.zeros(256, dtype=np.uint8)
+    for j in range(len(alphabet)):
+        codeTable[ord(alphabet[j])] = j
+
+    packedList = []
+    tmRowList = []
+    tmPosList = []
+    for i in range(0, numSeq, WRITE_CHUNK_SIZE):
+        chunk = topoSeqList[i:i+WRITE_CHUNK_SIZE]
+        buff = "".join(chunk).encode('latin-1')
+        codeMatrix = codeTable[np.frombuffer(buff, dtype=np.uint8)].reshape(
+                len(chunk), lengthAlignment)
+        packedList.append(PackStateMatrix(codeMatrix, bitsPerState))
+        (rowIndex, begin, end) = GetTMPositionOfCodeMatrix(codeMatrix,
+                alphabet)
+        tmRowList.append(rowIndex + i)
+        tmPosList.append(np.column_stack((begin, end)))
+    state = np.zeros((numSeq, rowBytes), dtype=np.uint8)
+    if numSeq > 0:
+        state = np.concatenate(packedList)
+    tm_offset = np.zeros(numSeq+1, dtype='<u8')
+    tm_data = np.zeros((0, 2), dtype='<i4')
+    if len(tmRowList) > 0:
+        np.cumsum(np.bincount(np.concatenate(tmRowList), minlength=numSeq),
+                out=tm_offset[1:])
+        tm_data = np.concatenate(tmPosList).astype('<i4')
+
+    (id_offset, id_data) = EncodeStrings(idList)
+    (anno_offset, anno_data) = EncodeStrings(annotationList)
+    sectionList = [('id_offset', id_offset), ('id_data', id_data),
+            ('anno_offset', anno_offset), ('anno_data', anno_data),
+            ('state', state), ('tm_offset', tm_offset), ('tm_data', tm_data)]
+    if dgScoreList != None:
+        (dg_offset, dg_data) = EncodeRagged(dgScoreList, '<f8')
+        sectionList += [('dg_offset', dg_offset), ('dg_data', dg_data)]
+
+    header = {'version': TMSA_VERSION, 'numSeq': numSeq,
+            'lengthAlignment': lengthAlignment, 'alphabet': alphabet,
+            'bitsPerState': bitsPerState, 'hasDGScore': dgScoreList != None,
+            'sections': {}}
+    # the header is written with offsets relative to the end of the header,
+    # so that its size does not depend on the offsets
+    offset = 0
+    for (name, item) in sectionList:
+        (dtype, shape) = (item.dtype, item.shape)
+        header['sections'][name] = {'offset': offset, 'dtype': dtype.str,
+                'shape': list(shape)}
+        size = dtype.itemsize*int(np.prod(shape))
+        offset += (size+SECTION_ALIGN-1)//SECTION_ALIGN*SECTION_ALIGN
+    headerBuff = json.dumps(header).encode('utf-8')
+    dataBeg = len(TMSA_MAGIC) + 4 + 8 + len(headerBuff)
+    dataBeg = (dataBeg+SECTION_ALIGN-1)//SECTION_ALIGN*SECTION_ALIGN
+
+    try:
+        fpout = open(outfile, "wb")
+    except IOError:
+        print("Failed to write to file %s"%(outfile), file=sys.stderr)
+        return 1
+    fpout.write(TMSA_MAGIC)
+    fpout.write(struct.pack("<I", TMSA_VERSION))
+    fpout.write(struct.pack("<Q", len(headerBuff)))
+    fpout.write(headerBuff)
+    for (name, item) in sectionList:
+        fpout.seek(dataBeg + header['sections'][name]['offset'])
+        fpout.write(item.tobytes())
+    fpout.truncate(dataBeg + offset)
+    fpout.close()
+    return 0
+#}}}
+class TMSAFile: #{{{
+# Description:
+#   Reader of the binary topology MSA file written by WriteTMSA. Sections
+#   are memory mapped, so that opening the file takes constant time and a row
+#   or a range of columns is decoded on demand
+# variables:
+#     numSeq          : number of sequences
+#     lengthAlignment : number of columns
+#     alphabet        : string of the states, code of a state is its index
+#     hasDGScore      : whether DG scores are stored
+#
+# Functions:
+#     GetID(i), GetIDList()
+#     GetAnnotation(i), GetAnnotationList()
+#     GetTopo(i, beg, end)    : topology of row i of columns [beg, end)
+#     GetTopoList(rowBeg, rowEnd, beg, end)
+#     GetCodeMatrix(rowBeg, rowEnd, beg, end) : uint8 matrix of state codes
+#     GetPosTM(i)             : [(begin, end)] of TM segments of row i
+#     GetPosTMList()          : GetPosTM of all rows
+#     GetDGScore(i)           : list of DG scores of row i
+#
+# Usage:
+# hdl = TMSAFile(infile)
+# if hdl.failure:
+#   return 1
+# topo = hdl.GetTopo(i)
+    def __init__(self, infile):#{{{
+        self.failure = False
+        self.filename = infile
+        try:
+            fpin = open(infile, "rb")
+            buff = fpin.read(len(TMSA_MAGIC) + 4 + 8)
+            if (len(buff) != len(TMSA_MAGIC) + 4 + 8 or
+                    buff[:len(TMSA_MAGIC)] != TMSA_MAGIC):
+                fpin.close()
+                print("Bad tmsa file %s"%(infile), file=sys.stderr)
+                self.failure = True
+                return None
+            (version, headerSize) = struct.unpack("<IQ",
+                    buff[len(TMSA_MAGIC):])
+            header = json.loads(fpin.read(headerSize).decode('utf-8'))
+            fpin.close()
+        except (IOError, ValueError):
+            print("Failed to read tmsa file %s"%(infile), file=sys.stderr)
+            self.failure = True
+            return None
+        if version > TMSA_VERSION:
+            msg = "Unsupported version %d of tmsa file %s"
+            print(msg%(version, infile), file=sys.stderr)
+            self.failure = True
+            return None
+        self.numSeq = header['numSeq']
+        self.lengthAlignment = header['lengthAlignment']
+        self.alphabet = header['alphabet']
+        self.bitsPerState = header['bitsPerState']
+        self.hasDGScore = header['hasDGScore']
+        self.perByte = 8//self.bitsPerState
+        self.unpackTable = GetUnpackTable(self.bitsPerState)
+        # states packed in each byte value, padding codes are mapped to ' '
+        stateTable = np.full(1 << self.bitsPerState, ord(' '), dtype=np.uint8)
+        stateTable[:len(self.alphabet)] = np.frombuffer(
+                self.alphabet.encode('latin-1'), dtype=np.uint8)
+        self.charTable = stateTable[self.unpackTable]
+        dataBeg = len(TMSA_MAGIC) + 4 + 8 + headerSize
+        dataBeg = (dataBeg+SECTION_ALIGN-1)//SECTION_ALIGN*SECTION_ALIGN
+        self.section = {}
+        for name in header['sections']:
+            sec = header['sections'][name]
+            shape = tuple(sec['shape'])
+            if np.prod(shape) == 0:
+                self.section[name] = np.zeros(shape, dtype=sec['dtype'])
+            else:
+                self.section[name] = np.memmap(infile, dtype=sec['dtype'],
+                        mode='r', offset=dataBeg+sec['offset'], shape=shape)
+#}}}
+    def close(self):#{{{
+        self.section = {}
+#}}}
+    def GetString(self, name, i):#{{{
+        offset = self.section[name+'_offset']
+        return self.section[name+'_data'][offset[i]:offset[i+1]].tobytes(
+                ).decode('utf-8')
+#}}}
+    def GetStringList(self, name):#{{{
+        offset = self.section[name+'_offset'].tolist()
+        buff = self.section[name+'_data'].tobytes()
+        return [buff[offset[i]:offset[i+1]].decode('utf-8') for i in
+                range(self.numSeq)]
+#}}}
+    def GetID(self, i):#{{{
+        return self.GetString('id', i)
+#}}}
+    def GetIDList(self):#{{{
+        return self.GetStringList('id')
+#}}}
+    def GetAnnotation(self, i):#{{{
+        return self.GetString('anno', i)
+#}}}
+    def GetAnnotationList(self):#{{{
+        return self.GetStringList('anno')
+#}}}
+    def GetCodeMatrix(self, rowBeg=0, rowEnd=None, beg=0, end=None,#{{{
+            table=None):
+        """
+        State codes of rows [rowBeg, rowEnd) and columns [beg, end), only
+        the bytes holding these columns are read
+        """
+        if table is None:
+            table = self.unpackTable
+        if rowEnd == None:
+            rowEnd = self.numSeq
+        if end == None:
+            end = self.lengthAlignment
+        byteBeg = beg//self.perByte
+        byteEnd = (end+self.perByte-1)//self.perByte
+        packed = np.asarray(self.section['state'][rowBeg:rowEnd,
+            byteBeg:byteEnd])
+        codes = UnpackStateMatrix(packed, self.bitsPerState, table)
+        shift = beg - byteBeg*self.perByte
+        return codes[:, shift:shift+end-beg]
+#}}}
+    def GetTopoList(self, rowBeg=0, rowEnd=None, beg=0, end=None):#{{{
+        """Topologies of rows [rowBeg, rowEnd) and columns [beg, end)"""
+        chars = self.GetCodeMatrix(rowBeg, rowEnd, beg, end, self.charTable)
+        (numRow, width) = chars.shape
+        buff = chars.tobytes().decode('latin-1')
+        return [buff[i*width:(i+1)*width] for i in range(numRow)]
+#}}}
+    def GetTopo(self, i, beg=0, end=None):#{{{
+        return self.GetTopoList(i, i+1, beg, end)[0]
+#}}}
+    def GetPosTM(self, i):#{{{
+        offset = self.section['tm_offset']
+        return [tuple(x) for x in
+                self.section['tm_data'][offset[i]:offset[i+1]].tolist()]
+#}}}
+    def GetPosTMList(self):#{{{
+        offset = self.section['tm_offset'].tolist()
+        posTM = [tuple(x) for x in self.section['tm_data'].tolist()]
+        return [posTM[offset[i]:offset[i+1]] for i in range(self.numSeq)]
+#}}}
+    def GetDGScore(self, i):#{{{
+        if not self.hasDGScore:
+            return []
+        offset = self.section['dg_offset']
+        return self.section['dg_data'][offset[i]:offset[i+1]].tolist()
+#}}}
+    def GetDGScoreList(self):#{{{
+        if not self.hasDGScore:
+            return None
+        return [self.GetDGScore(i) for i in range(self.numSeq)]
+#}}}
+#}}}
+def ReadTMSA(infile):#{{{
+    """
+    Read the binary topology MSA
+    Return (idList, annotationList, topoSeqList), empty lists on failure
+    """
+    hdl = TMSAFile(infile)
+    if hdl.failure:
+        return ([], [], [])
+    idList = hdl.GetIDList()
+    annotationList = hdl.GetAnnotationList()
+    topoSeqList = hdl.GetTopoList()
+    hdl.close()
+    return (idList, annotationList, topoSeqList)
+#}}}
+def ReadTopoMSAFile(infile):#{{{
+    """
+    Read topology MSA either in the binary format (.tmsa) or in FASTA format
+    Return (idList, annotationList, topoSeqList)
+    """
+    if IsTMSAFile(infile):
+        return ReadTMSA(infile)
+    else:
+        return myfunc.ReadFasta(infile)
+#}}}
+def ParseDGScore(text):#{{{
+    """
+    Get the list of DG scores from the text "{dgscore v1 v2 ... }" following
+    the topology in the .topowithdgscore file, return None if not found
+    """
+    m = re.search(r'{\s*dgscore([^}]*)}', text)
+    if m == None:
+        return None
+    dgscore = []
+    for s in m.group(1).lstrip(':').split():
+        try:
+            dgscore.append(float(s))
+        except ValueError:
+            pass
+    return dgscore
+#}}}
+def ReadTopoMSAWithDGScore(infile):#{{{
+    """
+    Read topology MSA either in the binary format or in FASTA format with
+    optional DG scores enclosed by {dgscore } after each topology
+    Return (idList, annotationList, topoSeqList, dgScoreList), dgScoreList
+    is None if no DG score is given
+    """
+    if IsTMSAFile(infile):
+        hdl = TMSAFile(infile)
+        if hdl.failure:
+            return ([], [], [], None)
+        idList = hdl.GetIDList()
+        annotationList = hdl.GetAnnotationList()
+        topoSeqList = hdl.GetTopoList()
+        dgScoreList = hdl.GetDGScoreList()
+        hdl.close()
+        return (idList, annotationList, topoSeqList, dgScoreList)
+
+    idList = []
+    annotationList = []
+    topoSeqList = []
+    dgScoreList = []
+    isDGScoreFound = False
+    try:
+        buff = myfunc.OpenFastaBuffer(infile)
+    except IOError:
+        print("Failed to read fasta file %s "%(infile), file=sys.stderr)
+        return ([], [], [], None)
+    for (recList, end) in myfunc.ScanFastaBlock(buff):
+        for rec in recList:
+            (anno, tmp, body) = rec.partition("\n")
+            anno = anno.rstrip("\r").lstrip('>')
+            dgscore = []
+            b = body.find('{')
+            if b >= 0:
+                dgscore = ParseDGScore(body[b:])
+                if dgscore != None:
+                    isDGScoreFound = True
+                else:
+                    dgscore = []
+                body = body[:b]
+            idList.append(myfunc.GetSeqIDFromAnnotation(anno))
+            annotationList.append(anno)
+            topoSeqList.append(body.translate(myfunc.FASTA_WHITESPACE_TABLE))
+            dgScoreList.append(dgscore)
+    myfunc.CloseFastaBuffer(buff)
+    if not isDGScoreFound:
+        dgScoreList = None
+    return (idList, annotationList, topoSeqList, dgScoreList)
+#}}}
+def WriteTopoMSAFasta(outfile, idList, annotationList, topoSeqList, #{{{
+        dgScoreList=None):
+    """
+    Write topology MSA in FASTA format, DG scores, if given, are written in
+    the format of the .topowithdgscore file
+    Return 0 on success and 1 on failure
+    """
+    if outfile == "":
+        fpout = sys.stdout
+    else:
+        try:
+            fpout = open(outfile, "w")
+        except IOError:
+            print("Failed to open file %s for writing"%(outfile),
+                    file=sys.stderr)
+            return 1
+    for i in range(len(topoSeqList)):
+        fpout.write(">%s\n"%(annotationList[i]))
+        fpout.write("%s\n"%(topoSeqList[i]))
+        if dgScoreList != None:
+            fpout.write("{dgscore ")
+            for dg in dgScoreList[i]:
+                fpout.write("%s "%(dg))
+            fpout.write("}\n")
+    myfunc.myclose(fpout)
+    return 0
+#}}}
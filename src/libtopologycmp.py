@@ -4,8 +4,22 @@ import os
 import sys
 import myfunc
 import re
+import multiprocessing
+import numpy as np
+import libtmsa
 GAP = '-'
 
+# topology states in the encoded topology MSA, the code of a state is its index
+TOPO_STATE_LIST = ['i', 'o', 'M', 'S', GAP]
+TOPO_STATE_OTHER = len(TOPO_STATE_LIST) # code for any other character
+TOPO_STATE_CODE_TABLE = np.full(256, TOPO_STATE_OTHER, dtype=np.uint8)
+TOPO_STATE_CODE_TABLE[[ord(s) for s in TOPO_STATE_LIST]] = np.arange(
+        len(TOPO_STATE_LIST))
+# number of 1 bits of each byte value
+RE_M_RUN = re.compile('M+') # runs of 'M', see CountCommonM
+POPCOUNT_TABLE = np.array([bin(x).count('1') for x in range(256)],
+        dtype=np.uint8)
+
 def FilterSignalPeptideInTopology(topo, sp_pos):#{{{
     """
     Filter signal peptide in topology
@@ -64,7 +78,7 @@ def RemoveUnnecessaryGap_old(seqList): #{{{
         newSeqList.append(newseq)
     return newSeqList
 #}}}
-def RemoveUnnecessaryGap(seqList): #{{{
+def RemoveUnnecessaryGap_set(seqList): #{{{
     """Remove unnecessary gaps in the alignment, i.e. colums with all gaps
     this method is slightly faster than RemoveUnnecessaryGap_old
     However, compared to the C version, it takes 20+ times more time.
@@ -117,7 +131,122 @@ def RemoveUnnecessaryGap(seqList): #{{{
         newSeqList.append(trimmedseq)
     return newSeqList
 #}}}
+def SeqListToMatrix(seqList):#{{{
+    """Return the aligned sequences as a uint8 matrix of characters
+    (numSeq x lengthAlignment), or None if sequences are of un-equal length
+    """
+    numSeq = len(seqList)
+    lengthAlignment = len(seqList[0])
+    buff = "".join(seqList).encode('ascii', 'replace')
+    if len(buff) != numSeq*lengthAlignment:
+        return None
+    return np.frombuffer(buff, dtype=np.uint8).reshape(numSeq,
+            lengthAlignment)
+#}}}
+def UpdateAllGapColumnMask(seqList, isAllGap=None):#{{{
+    """
+    Update the boolean mask of all-gap columns with a block of aligned
+    sequences, a new mask is created if isAllGap is None, so that the mask
+    can be built over blocks of a large alignment
+    Return isAllGap, or None if sequences are of un-equal length
+    """
+    seqMatrix = SeqListToMatrix(seqList)
+    if (seqMatrix is None or
+            (isAllGap is not None and len(isAllGap) != seqMatrix.shape[1])):
+        print("Error! seqList with un-equal length.", file=sys.stderr)
+        return None
+    isAllGapBlock = np.all(seqMatrix == ord(GAP), axis=0)
+    if isAllGap is None:
+        return isAllGapBlock
+    isAllGap &= isAllGapBlock
+    return isAllGap
+#}}}
+def SliceColumn(seqList, columnIndex):#{{{
+    """Get columns of aligned sequences given by the index array columnIndex
+    """
+    numSeq = len(seqList)
+    newLength = len(columnIndex)
+    seqMatrix = SeqListToMatrix(seqList)
+    buff = seqMatrix[:, columnIndex].tobytes().decode('ascii')
+    return [buff[i*newLength:(i+1)*newLength] for i in range(numSeq)]
+#}}}
+def RemoveUnnecessaryGap_numpy(seqList, blockSize=1000):#{{{
+    """Remove unnecessary gaps in the alignment, i.e. colums with all gaps
+    The all-gap column mask is computed in a vectorized pass, blockSize
+    sequences at a time so that the alignment is not copied as a whole
+    Return (newSeqList, keptColumnIndex), keptColumnIndex[k] is the column
+    index in seqList for column k in newSeqList, i.e. the posindexmap
+    """
+    numSeq = len(seqList)
+    if numSeq < 1:
+        return (seqList, np.zeros(0, dtype=np.int64))
+
+    isAllGap = None
+    for b in range(0, numSeq, blockSize):
+        isAllGap = UpdateAllGapColumnMask(seqList[b:b+blockSize], isAllGap)
+        if isAllGap is None:
+            return (seqList, np.arange(len(seqList[0])))
+    keptColumnIndex = np.flatnonzero(~isAllGap)
+    if len(keptColumnIndex) == len(isAllGap):
+        return (list(seqList), keptColumnIndex)
 
+    newSeqList = []
+    for b in range(0, numSeq, blockSize):
+        newSeqList += SliceColumn(seqList[b:b+blockSize], keptColumnIndex)
+    return (newSeqList, keptColumnIndex)
+#}}}
+def RemoveUnnecessaryGap(seqList): #{{{
+    """Remove unnecessary gaps in the alignment, i.e. colums with all gaps
+    use RemoveUnnecessaryGap_numpy to get also the map of kept columns
+    """
+    return RemoveUnnecessaryGap_numpy(seqList)[0]
+#}}}
+def RemoveUnnecessaryGapInFile(infile, outfile, BLOCK_SIZE=100000):#{{{
+    """Remove unnecessary gaps in an alignment file in FASTA format.
+    The file is read twice by block, the first time to get the all-gap column
+    mask and the second time to write the trimmed sequences, so that the
+    alignment is never loaded in memory as a whole
+    Return keptColumnIndex, or None at failure
+    """
+    hdl = myfunc.ReadFastaByBlock(infile, method_seqid=1, method_seq=0,
+            BLOCK_SIZE=BLOCK_SIZE)
+    if hdl.failure:
+        return None
+    isAllGap = None
+    recordList = hdl.readseq()
+    while recordList != None:
+        if len(recordList) > 0:
+            isAllGap = UpdateAllGapColumnMask([rd.seq for rd in recordList],
+                    isAllGap)
+            if isAllGap is None:
+                hdl.close()
+                return None
+        recordList = hdl.readseq()
+    hdl.close()
+    if isAllGap is None:
+        keptColumnIndex = np.zeros(0, dtype=np.int64)
+    else:
+        keptColumnIndex = np.flatnonzero(~isAllGap)
+
+    fpout = myfunc.myopen(outfile, sys.stdout, "w", False)
+    hdl = myfunc.ReadFastaByBlock(infile, method_seqid=1, method_seq=0,
+            BLOCK_SIZE=BLOCK_SIZE)
+    if hdl.failure:
+        myfunc.myclose(fpout)
+        return None
+    recordList = hdl.readseq()
+    while recordList != None:
+        if len(recordList) > 0:
+            newSeqList = SliceColumn([rd.seq for rd in recordList],
+                    keptColumnIndex)
+            for i in range(len(recordList)):
+                fpout.write(">%s\n"%(recordList[i].description))
+                fpout.write("%s\n"%(newSeqList[i]))
+        recordList = hdl.readseq()
+    hdl.close()
+    myfunc.myclose(fpout)
+    return keptColumnIndex
+#}}}
 def Get_nongap_uppstream(topo, begin_TM):#{{{
     """
     Get the first non gap state uppstream
@@ -560,25 +689,8 @@ def IsIdenticalTopology(Nterm1, Nterm2, numTM1, numTM2, posTM1, posTM2, #{{{
         if Nterm1 != Nterm2:
             return False
         else:
-            for i in range (numTM1): 
-                (b1,e1) = posTM1[i]
-                (b2,e2) = posTM2[i]
-                (common_b, common_e) = (max(b1,b2), min(e1,e2))
-                overlap = common_e - common_b
-                if overlap <= 0:
-                    return False
-                else:
-                    cntCommonM = 0
-                    for j in range(common_b, common_e):
-                        if topo1[j] == 'M' and topo2[j] == 'M':
-                            cntCommonM += 1
-                        if cntCommonM >= min_TM_overlap:
-                            break
-#                     print ("cntCommonM=", cntCommonM, "min_TM_overlap=",
-#                             min_TM_overlap)
-                    if cntCommonM < min_TM_overlap:
-                        return False
-    return True
+            return IsTMOverlapped(posTM1, posTM2, topo1, topo2,
+                    min_TM_overlap)
 #}}}
 def IsIdenticalTopology_simple( topo1, topo2, min_TM_overlap = 5):#{{{
 
@@ -602,25 +714,8 @@ def IsIdenticalTopology_simple( topo1, topo2, min_TM_overlap = 5):#{{{
         if Nterm1 != Nterm2:
             return False
         else:
-            for i in range (numTM1): 
-                (b1,e1) = posTM1[i]
-                (b2,e2) = posTM2[i]
-                (common_b, common_e) = (max(b1,b2), min(e1,e2))
-                overlap = common_e - common_b
-                if overlap <= 0:
-                    return False
-                else:
-                    cntCommonM = 0
-                    for j in range(common_b, common_e):
-                        if topo1[j] == 'M' and topo2[j] == 'M':
-                            cntCommonM += 1
-                        if cntCommonM >= min_TM_overlap:
-                            break
-#                     print ("cntCommonM=", cntCommonM, "min_TM_overlap=",
-#                             min_TM_overlap)
-                    if cntCommonM < min_TM_overlap:
-                        return False
-    return True
+            return IsTMOverlapped(posTM1, posTM2, topo1, topo2,
+                    min_TM_overlap)
 #}}}
 def IsInvertedTopology(Nterm1, Nterm2, numTM1, numTM2, posTM1, posTM2, #{{{
         topo1, topo2, min_TM_overlap = 5):
@@ -634,24 +729,183 @@ def IsInvertedTopology(Nterm1, Nterm2, numTM1, numTM2, posTM1, posTM2, #{{{
     if numTM1 != numTM2 or Nterm1 == Nterm2:
         return False
     else:
-        for i in range (numTM1): 
-            (b1,e1) = posTM1[i]
-            (b2,e2) = posTM2[i]
-            (common_b, common_e) = (max(b1,b2), min(e1,e2))
-            overlap = common_e - common_b
-            if overlap <= 0:
-                return False
-            else:
-                cntCommonM = 0
-                for j in range(common_b, common_e):
-                    if topo1[j] == 'M' and topo2[j] == 'M':
-                        cntCommonM += 1
-                    if cntCommonM >= min_TM_overlap:
-                        break
-                if cntCommonM < min_TM_overlap:
-                    return False
+        return IsTMOverlapped(posTM1, posTM2, topo1, topo2, min_TM_overlap)
+#}}}
+def CountCommonM(topo1, topo2, b, e):#{{{
+    """
+    Count positions in [b, e) that are 'M' in both topo1 and topo2, the runs
+    of 'M' of the two topologies in the region are merged, so that the cost
+    is linear in the number of runs
+    """
+    seg2 = [m.span() for m in RE_M_RUN.finditer(topo2, b, e)]
+    num2 = len(seg2)
+    cntCommonM = 0
+    j = 0
+    for m in RE_M_RUN.finditer(topo1, b, e):
+        (b1, e1) = m.span()
+        while j < num2 and seg2[j][1] <= b1:
+            j += 1
+        k = j
+        while k < num2 and seg2[k][0] < e1:
+            cntCommonM += min(e1, seg2[k][1]) - max(b1, seg2[k][0])
+            k += 1
+    return cntCommonM
+#}}}
+def IsTMOverlapped(posTM1, posTM2, topo1, topo2, min_TM_overlap):#{{{
+    """
+    Check whether each TM helix in posTM1 overlaps the TM helix of the same
+    index in posTM2 by at least min_TM_overlap common 'M'
+    """
+    for i in range(len(posTM1)):
+        (b1,e1) = posTM1[i]
+        (b2,e2) = posTM2[i]
+        (common_b, common_e) = (max(b1,b2), min(e1,e2))
+        overlap = common_e - common_b
+        if overlap < max(min_TM_overlap, 1):
+            return False
+        # the number of common M is between cntM1+cntM2-overlap and
+        # min(cntM1, cntM2), the runs of M are merged only if undecided
+        cntM1 = topo1.count('M', common_b, common_e)
+        cntM2 = topo2.count('M', common_b, common_e)
+        if min(cntM1, cntM2) < min_TM_overlap:
+            return False
+        if (cntM1+cntM2-overlap < min_TM_overlap and
+                CountCommonM(topo1, topo2, common_b, common_e) <
+                min_TM_overlap):
+            return False
     return True
 #}}}
+def IntersectSegment(seg1, seg2):#{{{
+    """
+    Intersection of two sorted lists of disjoint segments, given as (n, 2)
+    arrays of (begin, end). Each segment of seg1 is paired with the range of
+    segments of seg2 overlapping it, so that the number of pairs is linear in
+    the number of segments
+    Return the intersection as an (n, 2) array of sorted disjoint segments
+    """
+    jBeg = np.searchsorted(seg2[:,1], seg1[:,0], side='right')
+    jEnd = np.searchsorted(seg2[:,0], seg1[:,1], side='left')
+    cnt = np.maximum(jEnd - jBeg, 0)
+    idx1 = np.repeat(np.arange(len(seg1)), cnt)
+    idx2 = (np.arange(cnt.sum()) + np.repeat(jBeg - (np.cumsum(cnt) - cnt),
+        cnt))
+    return np.stack((np.maximum(seg1[idx1,0], seg2[idx2,0]),
+        np.minimum(seg1[idx1,1], seg2[idx2,1])), axis=1)
+#}}}
+def GetSegmentCoverage(seg, pos, cumLength=None):#{{{
+    """Number of positions covered by the sorted disjoint segments seg (an
+    (n, 2) array) before each position in pos, cumLength is the cumulative
+    length of seg starting from 0, computed if not given"""
+    if cumLength is None:
+        cumLength = np.zeros(len(seg)+1, dtype=np.int64)
+        np.cumsum(seg[:,1] - seg[:,0], out=cumLength[1:])
+    k = np.searchsorted(seg[:,0], pos, side='left')
+    coverage = cumLength[k]
+    # the last segment begun before pos may end after it
+    isBegun = k > 0
+    last = k[isBegun] - 1
+    coverage[isBegun] -= np.maximum(seg[last,1] - pos[isBegun], 0)
+    return coverage
+#}}}
+class TMOverlapEngine: #{{{
+# Description:
+#   Check the TM helix overlap of a query topology with many candidate
+#   topologies by one NumPy call, the vectorized IsTMOverlapped. Topologies
+#   are kept in the coordinates of an EncodedTopology, in which each
+#   topology is at an offset of its own. The numbers of 'M' in the overlaps
+#   of the helices bound the number of common 'M', only for the undecided
+#   candidates the runs of 'M' of the query, shifted to each candidate, are
+#   intersected with the runs of 'M' of the candidates to get the exact count
+# variables:
+#     rowStart      :  offset of each topology, see EncodedTopology
+#     segM          :  runs of 'M' of all topologies, (n, 2) array
+#     cumLengthM    :  cumulative length of segM starting from 0
+#     cumM          :  cumulative count of 'M' over all topologies, only if
+#                      isCumulativeM, it makes GetMCount faster for engines
+#                      queried many times
+#     segRowOffset  :  runs of topology i are segM[segRowOffset[i]:
+#                      segRowOffset[i+1]]
+# Functions:
+#     GetMCount(rows, b, e)   : number of 'M' in [b, e) of the topologies
+#     GetCommonMCount(query, a, cand, b, e)
+#                             : number of common 'M' in [b, e) of topology a
+#                               of the engine query and the topologies cand
+#     IsOverlapped(query, a, posTM, cand, posTMArray, min_TM_overlap)
+#                             : IsTMOverlapped of topology a of query and each
+#                               of the topologies cand
+    def __init__(self, encodedTopo, isCumulativeM=False):#{{{
+        self.rowStart = encodedTopo.rowStart
+        idx = np.nonzero(encodedTopo.runState == ord('M'))[0]
+        self.segM = np.stack((encodedTopo.runStart[idx],
+            encodedTopo.runEnd[idx]), axis=1)
+        self.cumLengthM = np.zeros(len(idx)+1, dtype=np.int64)
+        np.cumsum(self.segM[:,1] - self.segM[:,0], out=self.cumLengthM[1:])
+        self.segRowOffset = np.searchsorted(self.segM[:,0],
+                np.append(self.rowStart, len(encodedTopo.code)))
+        self.cumM = None
+        if isCumulativeM:
+            self.cumM = np.zeros(len(encodedTopo.code)+1, dtype=np.int32)
+            np.cumsum(encodedTopo.code == ord('M'), out=self.cumM[1:])
+#}}}
+    def GetMCount(self, rows, b, e):#{{{
+        offset = self.rowStart[rows].reshape(-1, 1)
+        if self.cumM is not None:
+            return self.cumM[offset+e] - self.cumM[offset+b]
+        return (GetSegmentCoverage(self.segM, offset+e, self.cumLengthM) -
+                GetSegmentCoverage(self.segM, offset+b, self.cumLengthM))
+#}}}
+    def GetCommonMCount(self, query, a, cand, b, e):#{{{
+        """
+        b and e are arrays of the shape (len(cand), numRegion), the regions
+        within topology a of query and topologies cand of self
+        """
+        numSeg = self.segRowOffset[cand+1] - self.segRowOffset[cand]
+        idx = (np.arange(numSeg.sum()) + np.repeat(self.segRowOffset[cand] -
+            (np.cumsum(numSeg) - numSeg), numSeg))
+        segCand = self.segM[idx]
+        # runs of 'M' of the query, shifted to the offset of each candidate
+        segQuery = query.segM[query.segRowOffset[a]:query.segRowOffset[a+1]]
+        shift = self.rowStart[cand] - query.rowStart[a]
+        segQuery = (np.tile(segQuery, (len(cand), 1)) +
+                np.repeat(shift, len(segQuery))[:,None])
+        segCommon = IntersectSegment(segQuery, segCand)
+        offset = self.rowStart[cand][:,None]
+        e = np.maximum(e, b)
+        return (GetSegmentCoverage(segCommon, (offset+e).ravel()) -
+                GetSegmentCoverage(segCommon, (offset+b).ravel())).reshape(
+                        b.shape)
+#}}}
+    def IsOverlapped(self, query, a, posTM, cand, posTMArray, #{{{
+            min_TM_overlap):
+        """
+        posTM are the TM positions of topology a of query, posTMArray the TM
+        positions of topologies cand of self, of the shape
+        (len(cand), numTM, 2)
+        Return a bool array, IsTMOverlapped of topology a and each candidate
+        """
+        posTM = np.asarray(posTM, dtype=np.int64).reshape(-1, 2)
+        common_b = np.maximum(posTM[:,0], posTMArray[:,:,0])
+        common_e = np.minimum(posTM[:,1], posTMArray[:,:,1])
+        overlap = common_e - common_b
+        isPair = np.all(overlap >= max(min_TM_overlap, 1), axis=1)
+        idx = np.flatnonzero(isPair)
+        (common_b, common_e, overlap) = (common_b[idx], common_e[idx],
+                overlap[idx])
+        # the number of common M is between cntM1+cntM2-overlap and
+        # min(cntM1, cntM2)
+        cntM1 = query.GetMCount(np.full(len(idx), a), common_b, common_e)
+        cntM2 = self.GetMCount(cand[idx], common_b, common_e)
+        isFailed = np.any(np.minimum(cntM1, cntM2) < min_TM_overlap, axis=1)
+        isSure = np.all(cntM1+cntM2-overlap >= min_TM_overlap, axis=1)
+        isPair[idx[isFailed]] = False
+        k = np.flatnonzero(~isFailed & ~isSure)
+        if len(k) > 0:
+            cntCommonM = self.GetCommonMCount(query, a, cand[idx[k]],
+                    common_b[k], common_e[k])
+            isPair[idx[k]] = np.all(cntCommonM >= min_TM_overlap, axis=1)
+        return isPair
+#}}}
+#}}}
 def MatchTopology(targetTopo, topoList, min_TM_overlap = 5, seqid = ""):#{{{
 ## compare targetTopo to all topologies in the topoList
 # return (matchList, numIDTtopo, numPredictor
@@ -673,21 +927,33 @@ def MatchTopology(targetTopo, topoList, min_TM_overlap = 5, seqid = ""):#{{{
 #     print
 
     NtermStateTarget = GetNtermState(targetTopo)
-    posTMtarget = myfunc.GetTMPosition(targetTopo)
-    numTMtarget = len(posTMtarget)
+    encodedTopo = EncodedTopology([targetTopo] + list(topoList))
+    (row, begin, end) = encodedTopo.GetTMSegment()
+    numTMList = np.bincount(row, minlength=numList+1)
+    numTMtarget = numTMList[0]
+    # topologies with the same number of TM helices and N-terminal state as
+    # the target, the TM overlap of them is checked by one call
+    candList = []
     for i in range(numList):
         if topoList[i] == "":
             matchList.append(-1)
         else:
-            NtermState = GetNtermState(topoList[i])
-            posTM = myfunc.GetTMPosition(topoList[i])
-            numTM = len(posTM)
-            if IsIdenticalTopology(NtermStateTarget, NtermState,
-                    numTMtarget, numTM, posTMtarget, posTM, targetTopo,
-                    topoList[i], min_TM_overlap):
-                matchList.append(1)
-            else:
-                matchList.append(0)
+            matchList.append(0)
+            if (numTMList[i+1] == numTMtarget and
+                    GetNtermState(topoList[i]) == NtermStateTarget):
+                candList.append(i+1)
+    if len(candList) > 0:
+        posTM = (np.stack((begin, end), axis=1) -
+                encodedTopo.rowStart[row][:,None])
+        cand = np.array(candList, dtype=np.int64)
+        isCandTM = np.zeros(numList+1, dtype=bool)
+        isCandTM[cand] = True
+        posTMArray = posTM[isCandTM[row]].reshape(len(cand), numTMtarget, 2)
+        engine = TMOverlapEngine(encodedTopo)
+        isMatch = engine.IsOverlapped(engine, 0, posTM[:numTMtarget], cand,
+                posTMArray, min_TM_overlap)
+        for i in cand[isMatch]:
+            matchList[i-1] = 1
 
     numIDTtopo = matchList.count(1)
     numPredictor = matchList.count(1) + matchList.count(0)
@@ -1051,130 +1317,568 @@ def IsWithinTMRegion(pos, posTM):#{{{
     return False
 #}}}
 
-def GetTopoStateFraction(topoSeqList):#{{{
-    """return (cnt_i, cnt_o, cntM, cnt_GAP, per_i, per_o, per_M, per_GAP)"""
-    lengthAlignment=len(topoSeqList[0])
+def EncodeTopoMSA(topoSeqList):#{{{
+    """Encode aligned topology sequences as a uint8 matrix of state codes
+    (numSeq x lengthAlignment), the code of a state is its index in
+    TOPO_STATE_LIST, other characters are encoded as TOPO_STATE_OTHER
+    Return None if sequences are of un-equal length
+    """
     numSeq = len(topoSeqList)
-    cnt_i = [0]*lengthAlignment
-    cnt_o = [0]*lengthAlignment
-    cnt_M = [0]*lengthAlignment
-    cnt_GAP = [0]*lengthAlignment
-    for i in range(numSeq):
-        topo = topoSeqList[i]
-        for j in range(lengthAlignment):
-            s = topo[j]
-            if s == GAP:
-                cnt_GAP[j] += 1
-            elif s == 'i':
-                cnt_i[j] += 1
-            elif s == 'o':
-                cnt_o[j] += 1
-            elif s == 'M':
-                cnt_M[j] += 1
-
-    per_GAP = [0.0]*lengthAlignment
-    per_o = [0.0]*lengthAlignment
-    per_M = [0.0]*lengthAlignment
-    per_i = [0.0]*lengthAlignment
-    numSeq_float = float(numSeq)
-    for j in range(lengthAlignment):
-        per_o[j] = cnt_o[j]/(numSeq_float)
-        per_M[j] = cnt_M[j]/(numSeq_float)
-        per_i[j] = cnt_i[j]/(numSeq_float)
-        per_GAP[j] = cnt_GAP[j]/(numSeq_float)
+    if numSeq < 1:
+        return np.zeros((0, 0), dtype=np.uint8)
+    lengthAlignment = len(topoSeqList[0])
+    buff = "".join(topoSeqList).encode('ascii', 'replace')
+    if len(buff) != numSeq*lengthAlignment:
+        print("Error! topoSeqList with un-equal length.", file=sys.stderr)
+        return None
+    rawMatrix = np.frombuffer(buff, dtype=np.uint8).reshape(numSeq,
+            lengthAlignment)
+    return TOPO_STATE_CODE_TABLE[rawMatrix]
+#}}}
+def GetTopoStateProfile(topoMSA):#{{{
+    """Get the per-column counts and fractions of topology states
+    topoMSA is either a list of aligned topology sequences or the matrix
+    returned by EncodeTopoMSA
+    Return (cntMatrix, perMatrix), numpy arrays of the shape
+    (len(TOPO_STATE_LIST), lengthAlignment), row k is for TOPO_STATE_LIST[k]
+    Raise ValueError if the sequences are of un-equal length
+    """
+    if topoMSA is not None and not isinstance(topoMSA, np.ndarray):
+        topoMSA = EncodeTopoMSA(topoMSA)
+    if topoMSA is None:
+        raise ValueError("topology MSA with un-equal length")
+    (numSeq, lengthAlignment) = topoMSA.shape
+    numState = len(TOPO_STATE_LIST)
+    cntMatrix = np.zeros((numState, lengthAlignment), dtype=np.int64)
+    for k in range(numState):
+        cntMatrix[k] = np.count_nonzero(topoMSA == k, axis=0)
+    perMatrix = cntMatrix/float(max(numSeq, 1))
+    return (cntMatrix, perMatrix)
+#}}}
+def GetTopoStateFraction(topoSeqList):#{{{
+    """return (cnt_i, cnt_o, cntM, cnt_GAP, per_i, per_o, per_M, per_GAP)
+    topoSeqList can also be the matrix returned by EncodeTopoMSA"""
+    (cntMatrix, perMatrix) = GetTopoStateProfile(topoSeqList)
+    (cnt_i, cnt_o, cnt_M, cnt_SP, cnt_GAP) = cntMatrix.tolist()
+    (per_i, per_o, per_M, per_SP, per_GAP) = perMatrix.tolist()
     return (cnt_i, cnt_o, cnt_M, cnt_GAP, per_i, per_o, per_M, per_GAP)
-
 #}}}
 def GetTopoStateFraction_withSP(topoSeqList):#{{{
-    """return (cnt_i, cnt_o, cntM, cnt_SP, cnt_GAP, per_i, per_o, per_M, per_SP, per_GAP)"""
-    lengthAlignment=len(topoSeqList[0])
+    """return (cnt_i, cnt_o, cntM, cnt_SP, cnt_GAP, per_i, per_o, per_M, per_SP, per_GAP)
+    topoSeqList can also be the matrix returned by EncodeTopoMSA"""
+    (cntMatrix, perMatrix) = GetTopoStateProfile(topoSeqList)
+    (cnt_i, cnt_o, cnt_M, cnt_SP, cnt_GAP) = cntMatrix.tolist()
+    (per_i, per_o, per_M, per_SP, per_GAP) = perMatrix.tolist()
+    return (cnt_i, cnt_o, cnt_M, cnt_SP, cnt_GAP, per_i, per_o, per_M, per_SP, per_GAP)
+#}}}
+class EncodedTopology: #{{{
+# Description:
+#   A list of topologies, aligned or not, encoded as one uint8 array of the
+#   states (the ASCII code of the characters) in which topologies are
+#   separated by SEP. The runs of identical states are computed once, so that
+#   the TM, gap, loop and signal peptide segments of all topologies come from
+#   vectorized passes over the runs instead of a regex scan of each string
+# variables:
+#     numTopo       :  number of topologies
+#     code          :  uint8 array of the states of all topologies
+#     rowStart      :  start of each topology in code
+#     runStart      :  start of each run of identical states in code
+#     runEnd        :  end of each run
+#     runState      :  state of each run
+#
+# Functions:
+#     GetRow(pos)            : index of the topology of positions in code
+#     GetSegPosList(state)   : runs of state in each topology, the same as
+#                              myfunc.GetSegPos(topo, state)
+#     GetTMPositionList()    : myfunc.GetTMPosition of each topology
+#     GetTMTypeList()        : GetTMType of each topology
+#     GetGapPositionList()   : myfunc.GetGapPosition of each topology
+#     GetLoopPositionList()  : runs of 'i' or 'o' in each topology
+#     GetSPPositionList()    : myfunc.GetSPPosition of each topology
+
+    SEP = ord('\n')
+    def __init__(self, topoList):#{{{
+        self.numTopo = len(topoList)
+        lengthArray = np.array([len(topo) for topo in topoList],
+                dtype=np.int64)
+        self.rowStart = np.zeros(self.numTopo, dtype=np.int64)
+        self.rowStart[1:] = np.cumsum(lengthArray+1)[:-1]
+        buff = b""
+        if self.numTopo > 0:
+            buff = ("\n".join(topoList) + "\n").encode('ascii', 'replace')
+        self.code = np.frombuffer(buff, dtype=np.uint8)
+
+        isRunStart = np.ones(len(self.code), dtype=bool)
+        np.not_equal(self.code[1:], self.code[:-1], out=isRunStart[1:])
+        self.runStart = np.nonzero(isRunStart)[0]
+        self.runEnd = np.append(self.runStart[1:], len(self.code))
+        self.runState = self.code[self.runStart]
+#}}}
+    def GetRow(self, pos):#{{{
+        return np.searchsorted(self.rowStart, pos, side='right') - 1
+#}}}
+    def SplitByRow(self, row, begin, end):#{{{
+        """
+        Split segments given in the order of topologies, as arrays of the
+        topology index and the begin and end in code, into lists of
+        (begin, end) within each topology
+        """
+        offset = self.rowStart[row]
+        posList = list(zip((begin-offset).tolist(), (end-offset).tolist()))
+        bound = np.zeros(self.numTopo+1, dtype=np.int64)
+        bound[1:] = np.cumsum(np.bincount(row, minlength=self.numTopo))
+        bound = bound.tolist()
+        return [posList[bound[i]:bound[i+1]] for i in range(self.numTopo)]
+#}}}
+    def GetSegPosList(self, state):#{{{
+        idx = np.nonzero(self.runState == ord(state))[0]
+        return self.SplitByRow(self.GetRow(self.runStart[idx]),
+                self.runStart[idx], self.runEnd[idx])
+#}}}
+    def GetGapPositionList(self):#{{{
+        return self.GetSegPosList(GAP)
+#}}}
+    def GetLoopPositionList(self):#{{{
+        idx = np.nonzero((self.runState == ord('i')) |
+                (self.runState == ord('o')))[0]
+        return self.SplitByRow(self.GetRow(self.runStart[idx]),
+                self.runStart[idx], self.runEnd[idx])
+#}}}
+    def GetSPPositionList(self):#{{{
+        # from the first to the last 'S' of each topology
+        idx = np.nonzero(self.runState == ord('S'))[0]
+        row = self.GetRow(self.runStart[idx])
+        isFirst = np.ones(len(idx), dtype=bool)
+        isFirst[1:] = row[1:] != row[:-1]
+        isLast = np.ones(len(idx), dtype=bool)
+        isLast[:-1] = isFirst[1:]
+        return self.SplitByRow(row[isFirst], self.runStart[idx[isFirst]],
+                self.runEnd[idx[isLast]])
+#}}}
+    def GetTMSegment(self):#{{{
+        """
+        Get the TM segments of all topologies as arrays (row, begin, end) in
+        code. A TM segment begins at the first 'M' of a region between two i/o
+        states (or the ends of the topology) and ends at the end of the
+        region, or after the last 'M' if the region ends with gaps
+        """
+        isStop = ((self.runState == ord('i')) | (self.runState == ord('o')) |
+                (self.runState == self.SEP))
+        idxM = np.nonzero(self.runState == ord('M'))[0]
+        region = np.cumsum(isStop)[idxM]
+        isFirst = np.ones(len(idxM), dtype=bool)
+        isFirst[1:] = region[1:] != region[:-1]
+        isLast = np.ones(len(idxM), dtype=bool)
+        isLast[:-1] = isFirst[1:]
+        first = idxM[isFirst]
+        last = idxM[isLast]
+        idxStop = np.nonzero(isStop)[0]
+        nextStop = idxStop[np.searchsorted(idxStop, last)]
+        end = self.runStart[nextStop]
+        isGapBefore = self.runState[nextStop-1] == ord(GAP)
+        end[isGapBefore] = self.runEnd[last[isGapBefore]]
+        return (self.GetRow(self.runStart[first]), self.runStart[first], end)
+#}}}
+    def GetTMPositionList(self):#{{{
+        return self.SplitByRow(*self.GetTMSegment())
+#}}}
+    def GetNearestRun(self, state, row, pos, isBefore):#{{{
+        """
+        Position of the nearest run of state before pos (the last residue of
+        it) or at and after pos (the first residue of it) in the same
+        topology, -1 or len(code) if not found
+        """
+        idx = np.nonzero(self.runState == ord(state))[0]
+        if isBefore:
+            k = np.searchsorted(self.runEnd[idx], pos, side='right') - 1
+            found = np.full(len(pos), -1, dtype=np.int64)
+            isValid = k >= 0
+            k = np.maximum(k, 0)
+            if len(idx) > 0:
+                isValid &= self.GetRow(self.runStart[idx[k]]) == row
+                found[isValid] = self.runEnd[idx[k[isValid]]] - 1
+        else:
+            k = np.searchsorted(self.runStart[idx], pos, side='left')
+            found = np.full(len(pos), len(self.code), dtype=np.int64)
+            isValid = k < len(idx)
+            k = np.minimum(k, len(idx)-1)
+            if len(idx) > 0:
+                isValid &= self.GetRow(self.runStart[idx[k]]) == row
+                found[isValid] = self.runStart[idx[k[isValid]]]
+        return found
+#}}}
+    def GetTMTypeList(self):#{{{
+        """
+        Get (posTM, typeTM) of each topology, the type of a TM helix is
+        determined by the nearest i/o states before and after it, see
+        GetTMType
+        """
+        (row, begin, end) = self.GetTMSegment()
+        ib = self.GetNearestRun('i', row, begin, True)
+        ob = self.GetNearestRun('o', row, begin, True)
+        ia = self.GetNearestRun('i', row, end-1, False)
+        oa = self.GetNearestRun('o', row, end-1, False)
+        typeArray = np.select([(ib > ob) & (ia > oa), (ib < ob) & (ia < oa),
+            (ib > ob) & (ia < oa), (ib < ob) & (ia > oa)],
+            ["M", "W", "R", "r"], "X")
+        posTMList = self.SplitByRow(row, begin, end)
+        typeTMList = []
+        k = 0
+        typeArray = typeArray.tolist()
+        for posTM in posTMList:
+            typeTMList.append(typeArray[k:k+len(posTM)])
+            k += len(posTM)
+        return list(zip(posTMList, typeTMList))
+#}}}
+#}}}
+def GetTMPositionList(topoList):#{{{
+    """Get TM positions of each topology in topoList, see EncodedTopology"""
+    return EncodedTopology(topoList).GetTMPositionList()
+#}}}
+def GetTMTypeList(topoList):#{{{
+    """Get (posTM, typeTM) of each topology in topoList, see EncodedTopology"""
+    return EncodedTopology(topoList).GetTMTypeList()
+#}}}
+class TopoMSA: #{{{
+# Description:
+#   Topology MSA shared by the drawing and comparison functions. Derived data
+#   are computed lazily, at most once, and cached
+# variables:
+#     idList          :  list of sequence IDs
+#     annotationList  :  list of annotation lines
+#     topoSeqList     :  list of aligned topology sequences (a private copy,
+#                        changing the list passed to __init__ does not affect
+#                        the cache)
+#
+# Functions:
+#     GetMatrix()            : uint8 matrix of state codes, see EncodeTopoMSA
+#     GetStateProfile()      : (cntMatrix, perMatrix), see GetTopoStateProfile
+#     GetPosTMList()         : TM positions of each sequence
+#     GetNumTMList()         : number of TM helices of each sequence
+#     GetNtermStateList()    : N-terminal state of each sequence
+#     GetSeqLengthList()     : gapless length of each sequence
+#     GetAlign2SeqMapMatrix(): alignment-to-sequence index map for all
+#                              sequences, see GetAlign2SeqMap
+
+    def __init__(self, idList, annotationList, topoSeqList):#{{{
+        self.idList = idList
+        self.annotationList = annotationList
+        self.topoSeqList = list(topoSeqList)
+        # column index in the input alignment of each column in topoSeqList,
+        # set when all-gap columns are removed by ReadTopoMSA
+        self.keptColumnIndex = None
+        self.numSeq = len(self.topoSeqList)
+        if self.numSeq > 0:
+            self.lengthAlignment = len(self.topoSeqList[0])
+        else:
+            self.lengthAlignment = 0
+        self.cache = {}
+#}}}
+    def GetMatrix(self):#{{{
+        if not 'matrix' in self.cache:
+            matrix = EncodeTopoMSA(self.topoSeqList)
+            if matrix is None:
+                raise ValueError("topology MSA with un-equal length")
+            self.cache['matrix'] = matrix
+        return self.cache['matrix']
+#}}}
+    def GetStateProfile(self):#{{{
+        if not 'profile' in self.cache:
+            self.cache['profile'] = GetTopoStateProfile(self.GetMatrix())
+        return self.cache['profile']
+#}}}
+    def GetPosTMList(self):#{{{
+        if not 'posTMList' in self.cache:
+            self.cache['posTMList'] = GetTMPositionList(self.topoSeqList)
+        return self.cache['posTMList']
+#}}}
+    def GetNumTMList(self):#{{{
+        if not 'numTMList' in self.cache:
+            self.cache['numTMList'] = [len(posTM) for posTM in
+                    self.GetPosTMList()]
+        return self.cache['numTMList']
+#}}}
+    def GetNtermStateList(self):#{{{
+        if not 'NtermStateList' in self.cache:
+            self.cache['NtermStateList'] = [GetNtermState(topo) for topo in
+                    self.topoSeqList]
+        return self.cache['NtermStateList']
+#}}}
+    def GetSeqLengthList(self):#{{{
+        if not 'seqLengthList' in self.cache:
+            isNonGap = self.GetMatrix() != TOPO_STATE_LIST.index(GAP)
+            self.cache['seqLengthList'] = np.count_nonzero(isNonGap,
+                    axis=1).tolist()
+        return self.cache['seqLengthList']
+#}}}
+    def GetAlign2SeqMapMatrix(self):#{{{
+        """
+        Row i maps index in the aligned sequence i to the original sequence,
+        gap positions are mapped in the same way as GetAlign2SeqMap
+        """
+        if not 'align2seq' in self.cache:
+            isNonGap = (self.GetMatrix() != TOPO_STATE_LIST.index(GAP)).astype(
+                    np.int32)
+            self.cache['align2seq'] = np.cumsum(isNonGap, axis=1) - isNonGap
+        return self.cache['align2seq']
+#}}}
+#}}}
+def ReadTopoMSA(infile, isRemoveUnnecessaryGap=True):#{{{
+    """
+    Read topology MSA in FASTA format or in the binary format (.tmsa) and
+    return a TopoMSA object
+    columns with all gaps are removed if isRemoveUnnecessaryGap is True
+    """
+    posTMList = None
+    if libtmsa.IsTMSAFile(infile):
+        hdl = libtmsa.TMSAFile(infile)
+        if hdl.failure:
+            (idList, annotationList, topoSeqList) = ([], [], [])
+        else:
+            idList = hdl.GetIDList()
+            annotationList = hdl.GetAnnotationList()
+            topoSeqList = hdl.GetTopoList()
+            posTMList = hdl.GetPosTMList()
+            hdl.close()
+    else:
+        (idList, annotationList, topoSeqList) = myfunc.ReadFasta(infile)
+    keptColumnIndex = None
+    if isRemoveUnnecessaryGap:
+        (topoSeqList, keptColumnIndex) = RemoveUnnecessaryGap_numpy(
+                topoSeqList)
+    topomsa = TopoMSA(idList, annotationList, topoSeqList)
+    topomsa.keptColumnIndex = keptColumnIndex
+    if posTMList != None:
+        # TM positions stored in the file, mapped to the kept columns. The
+        # number of kept columns before a position is its new index
+        if keptColumnIndex is not None:
+            posTMList = [[tuple(x) for x in np.searchsorted(keptColumnIndex,
+                posTM).tolist()] for posTM in posTMList]
+        topomsa.cache['posTMList'] = posTMList
+    return topomsa
+#}}}
+class BitMatrix: #{{{
+# Description:
+#   Square 0/1 matrix stored bit-packed, used for the all-to-all topology
+#   comparison matrix (Mcmp) so that it takes numSeq*numSeq/8 bytes instead
+#   of numSeq*numSeq Python ints
+# variables:
+#     size  :  number of rows (and columns)
+#     data  :  uint8 array of shape (size, ceil(size/8)), bits of row i in
+#              the order of numpy.packbits
+#
+# Functions:
+#     Set(i, j, value)        : set a single element
+#     SetPairs(rowIdx, colIdx): set the elements given by two index arrays to 1
+#     GetRow(i)               : row i as an int8 array of 0/1, also M[i]
+#     GetColumn(j)            : column j as an int8 array of 0/1
+#     RowSum()                : number of 1s of each row
+#     Count()                 : number of 1s in the matrix
+#     M[i, j]                 : a single element
+
+    def __init__(self, size):#{{{
+        self.size = size
+        self.data = np.zeros((size, (size+7)//8), dtype=np.uint8)
+#}}}
+    def __len__(self):#{{{
+        return self.size
+#}}}
+    def __getitem__(self, key):#{{{
+        if isinstance(key, tuple):
+            (i, j) = key
+            return int((self.data[i, j >> 3] >> (7 - (j & 7))) & 1)
+        return self.GetRow(key)
+#}}}
+    def __iter__(self):#{{{
+        for i in range(self.size):
+            yield self.GetRow(i)
+#}}}
+    def Set(self, i, j, value=1):#{{{
+        mask = 0x80 >> (j & 7)
+        if value:
+            self.data[i, j >> 3] |= mask
+        else:
+            self.data[i, j >> 3] &= ~mask & 0xFF
+#}}}
+    def SetPairs(self, rowIdx, colIdx):#{{{
+        rowIdx = np.asarray(rowIdx, dtype=np.int64)
+        colIdx = np.asarray(colIdx, dtype=np.int64)
+        masks = (0x80 >> (colIdx & 7)).astype(np.uint8)
+        np.bitwise_or.at(self.data, (rowIdx, colIdx >> 3), masks)
+#}}}
+    def GetRow(self, i):#{{{
+        return np.unpackbits(self.data[i])[:self.size].astype(np.int8)
+#}}}
+    def GetColumn(self, j):#{{{
+        return ((self.data[:, j >> 3] >> (7 - (j & 7))) & 1).astype(np.int8)
+#}}}
+    def RowSum(self):#{{{
+        return POPCOUNT_TABLE[self.data].sum(axis=1, dtype=np.int64)
+#}}}
+    def Count(self):#{{{
+        return int(self.RowSum().sum())
+#}}}
+#}}}
+def GreedyClusterBitMatrix(Mcmp):#{{{
+    """
+    Cluster items of the 0/1 matrix Mcmp (a BitMatrix) greedily, the item with
+    the most 1s among the unclustered columns and all its unclustered
+    neighbours form a cluster, repeated until all items are clustered
+    Return clusterList, a list of lists of item indices
+    """
+    numSeq = Mcmp.size
+    cntIDTTopo = Mcmp.RowSum()
+    isUnclustered = np.ones(numSeq, dtype=bool)
+    clusterList = []
+    while np.any(isUnclustered):
+        maxIndex = int(np.argmax(cntIDTTopo))
+        members = np.flatnonzero((Mcmp.GetRow(maxIndex) == 1) & isUnclustered)
+        clusterList.append(members.tolist())
+        if len(members) == 0:
+            break
+        isUnclustered[members] = False
+        for j in members:
+            cntIDTTopo -= Mcmp.GetColumn(j)
+    return clusterList
+#}}}
+def CompareTopologyBucket(task):#{{{
+    """
+    Compare topologies of one bucket with another bucket, or with itself if
+    bucket2 is None. All topologies in a bucket have the same number of TM
+    helices and the same N-terminal state, so that only the TM overlap
+    is checked, by TMOverlapEngine, for all candidates of each topology.
+    task = (bucket1, bucket2, begin, end, min_TM_overlap, isInverted),
+    bucket = (idxList, topoList, posTMList, NtermStateList), only
+    topologies begin..end-1 in bucket1 are compared
+    Return (rowIdx, colIdx), global indices of the identical (or inverted if
+    isInverted) pairs, with rowIdx < colIdx for a bucket compared to itself
+    """
+    (bucket1, bucket2, begin, end, min_TM_overlap, isInverted) = task
+    isSameBucket = bucket2 is None
+    if isSameBucket:
+        bucket2 = bucket1
+    (idxList1, topoList1, posTMList1, NtermStateList1) = bucket1
+    (idxList2, topoList2, posTMList2, NtermStateList2) = bucket2
+    numTM = len(posTMList1[0])
+    num2 = len(idxList2)
+    idxArray2 = np.asarray(idxList2, dtype=np.int64)
+    if numTM > 0:
+        posTM1 = np.asarray(posTMList1, dtype=np.int64)
+        posTM2 = np.asarray(posTMList2, dtype=np.int64)
+        engine1 = TMOverlapEngine(EncodedTopology(topoList1), True)
+        if isSameBucket:
+            engine2 = engine1
+        else:
+            engine2 = TMOverlapEngine(EncodedTopology(topoList2), True)
+
+    rowIdxList = []
+    colIdxList = []
+    for a in range(begin, end):
+        if isSameBucket:
+            cand = np.arange(a+1, num2)
+        else:
+            cand = np.arange(num2)
+        if len(cand) == 0:
+            continue
+        if numTM > 0:
+            cand = cand[engine2.IsOverlapped(engine1, a, posTM1[a], cand,
+                posTM2[cand], min_TM_overlap)]
+        rowIdxList.append(np.full(len(cand), idxList1[a], dtype=np.int64))
+        colIdxList.append(idxArray2[cand])
+    if len(rowIdxList) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    return (np.concatenate(rowIdxList), np.concatenate(colIdxList))
+#}}}
+def GetTopologyPairMatrix(topoSeqList, NtermStateList, posTMList, #{{{
+        min_TM_overlap=5, isInverted=False, numCPU=1, chunkSize=500):
+    """
+    All-to-all comparison of topologies, the same as comparing all pairs by
+    IsIdenticalTopology (or IsInvertedTopology if isInverted)
+    Topologies are bucketed by (numTM, Nterm state) so that only pairs that
+    can be identical (or inverted) are compared. Buckets are split into tasks
+    of chunkSize topologies and run in a process pool if numCPU > 1
+    Return Mcmp, a BitMatrix, for identical topology it is symmetric with
+    1s on the diagonal, for inverted topology only Mcmp[i,j] with i < j is set
+    """
     numSeq = len(topoSeqList)
-    cnt_i = [0]*lengthAlignment
-    cnt_o = [0]*lengthAlignment
-    cnt_M = [0]*lengthAlignment
-    cnt_SP = [0]*lengthAlignment
-    cnt_GAP = [0]*lengthAlignment
+    Mcmp = BitMatrix(numSeq)
+    bucketDict = {}
     for i in range(numSeq):
-        topo = topoSeqList[i]
-        for j in range(lengthAlignment):
-            s = topo[j]
-            if s == GAP:
-                cnt_GAP[j] += 1
-            elif s == 'i':
-                cnt_i[j] += 1
-            elif s == 'o':
-                cnt_o[j] += 1
-            elif s == 'M':
-                cnt_M[j] += 1
-            elif s == 'S':
-                cnt_SP[j] += 1
-
-    per_GAP = [0.0]*lengthAlignment
-    per_o = [0.0]*lengthAlignment
-    per_M = [0.0]*lengthAlignment
-    per_SP = [0.0]*lengthAlignment
-    per_i = [0.0]*lengthAlignment
-    numSeq_float = float(numSeq)
-    for j in range(lengthAlignment):
-        per_o[j] = cnt_o[j]/(numSeq_float)
-        per_M[j] = cnt_M[j]/(numSeq_float)
-        per_SP[j] = cnt_SP[j]/(numSeq_float)
-        per_i[j] = cnt_i[j]/(numSeq_float)
-        per_GAP[j] = cnt_GAP[j]/(numSeq_float)
-    return (cnt_i, cnt_o, cnt_M, cnt_SP, cnt_GAP, per_i, per_o, per_M, per_SP, per_GAP)
+        key = (len(posTMList[i]), NtermStateList[i])
+        if not key in bucketDict:
+            bucketDict[key] = []
+        bucketDict[key].append(i)
+    keyList = list(bucketDict.keys())
+    bucketList = []
+    for key in keyList:
+        idxList = bucketDict[key]
+        bucketList.append((idxList, [topoSeqList[i] for i in idxList],
+            [posTMList[i] for i in idxList],
+            [NtermStateList[i] for i in idxList]))
+
+    taskList = []
+    for p in range(len(keyList)):
+        if isInverted:
+            pairBucketList = [bucketList[q] for q in range(p+1, len(keyList))
+                    if keyList[q][0] == keyList[p][0]]
+        else:
+            pairBucketList = [None]
+        for pairBucket in pairBucketList:
+            for begin in range(0, len(bucketList[p][0]), chunkSize):
+                end = min(begin+chunkSize, len(bucketList[p][0]))
+                taskList.append((bucketList[p], pairBucket, begin, end,
+                    min_TM_overlap, isInverted))
+
+    if numCPU > 1 and len(taskList) > 1:
+        pool = multiprocessing.Pool(processes=numCPU)
+        resultList = pool.imap_unordered(CompareTopologyBucket, taskList)
+    else:
+        pool = None
+        resultList = map(CompareTopologyBucket, taskList)
+    for (rowIdx, colIdx) in resultList:
+        if isInverted:
+            Mcmp.SetPairs(np.minimum(rowIdx, colIdx), np.maximum(rowIdx,
+                colIdx))
+        else:
+            Mcmp.SetPairs(rowIdx, colIdx)
+            Mcmp.SetPairs(colIdx, rowIdx)
+    if pool != None:
+        pool.close()
+        pool.join()
+    if not isInverted:
+        Mcmp.SetPairs(np.arange(numSeq), np.arange(numSeq))
+    return Mcmp
 #}}}
 def GetTMType(topo):#{{{
     """Get types of TM helices given a topology
     Return two lists posTM and typeTM
+    For a list of topologies, GetTMTypeList is faster
     """
-    #    print topo
-    posTM=[]
-    typeTM=[]
-    type=''
-    lengthTopo=len(topo)
-    b=0
-    e=0
-    while 1:
-        b=topo.find('M',e)
-        if b != -1:
-            m = re.search('[io]', topo[b+1:])
-            if m != None:
-                e = m.start(0)+b+1
-            else:
-                e=lengthTopo
-            if topo[e-1] == GAP:
-                e=topo[:e-1].rfind('M')+1
-#           print (b,e)
-            if b == e:
-                print("Error topo[b-10:e+10]=", topo[b-30:e+30])
-                #sys.exit(1)
-                return []
-            posTM.append((b,e))
-            # Now we need to devide the type (can be one of four)
-            before=topo[0:b]
-            after=topo[e-1:]
-            ib=before.rfind('i')
-            ob=before.rfind('o')
-            ia=after.find('i')
-            oa=after.find('o')
-            if (ia==-1):
-                ia=lengthTopo
-            if (oa==-1):
-                oa=lengthTopo
-            if (ib>ob and ia>oa):
-                type="M" # out -> in
-            elif(ib<ob and ia<oa):
-                type="W" # in -> out
-            elif(ib>ob and ia<oa):
-                type="R"
-            elif(ib<ob and ia>oa):
-                type="r"
-            else:
-                type="X"
-            typeTM.append(type)
-            #print (before, after,ib,ob,ia,oa,type)
+    posTM = myfunc.GetTMPosition(topo)
+    typeTM = []
+    lengthTopo = len(topo)
+    for (b, e) in posTM:
+        # Now we need to devide the type (can be one of four) by the nearest
+        # i/o state before and after the TM helix
+        ib = topo.rfind('i', 0, b)
+        ob = topo.rfind('o', 0, b)
+        ia = topo.find('i', e-1)
+        oa = topo.find('o', e-1)
+        if (ia==-1):
+            ia=lengthTopo
+        if (oa==-1):
+            oa=lengthTopo
+        if (ib>ob and ia>oa):
+            type="M" # out -> in
+        elif(ib<ob and ia<oa):
+            type="W" # in -> out
+        elif(ib>ob and ia<oa):
+            type="R"
+        elif(ib<ob and ia>oa):
+            type="r"
         else:
-            break
+            type="X"
+        typeTM.append(type)
     return posTM,typeTM
 #}}}
 def SetMakeTMplotColor_g_params(g_params):# {{{
@@ -56,6 +56,26 @@ def MakeTMplot(seqAlnFile, topAlnFile, outpath, tmpdir):# {{{
     basename_seqAlnFile = os.path.basename(seqAlnFile)
     basename_topAlnFile = os.path.basename(topAlnFile)
     ext_topAlnFile = os.path.splitext(topAlnFile)[1].lstrip('.')
+    final_targetfile =  os.path.join(outpath, "%s.seqtopaln.pdf"%(rootname))
+
+    # the merged figure is cached by the content of the alignments and the
+    # options
+    cachefile = ""
+    if g_params['cacheDir'] != "":
+        h = hashlib.sha1()
+        for infile in [seqAlnFile, topAlnFile]:
+            with open(infile, "rb") as fpin:
+                h.update(hashlib.sha1(fpin.read()).digest())
+        h.update(repr([rootname, ext_topAlnFile, g_params['H2W_ratio'],
+            g_params['figure_resize'], g_params['window_size'],
+            g_params['isBreakTM']]).encode("utf-8"))
+        cachefile = os.path.join(g_params['cacheDir'], "tmplot",
+                "%s.seqtopaln.pdf"%(h.hexdigest()))
+        if os.path.exists(cachefile):
+            shutil.copy2(cachefile, final_targetfile)
+            if g_params['verbose']:
+                print(("Copy the cached result to final target %s"%(final_targetfile)))
+            return 0
 
     shutil.copy2(seqAlnFile, os.path.join(tmpdir, basename_seqAlnFile))
     shutil.copy2(topAlnFile, os.path.join(tmpdir, basename_topAlnFile))
@@ -68,6 +88,8 @@ def MakeTMplot(seqAlnFile, topAlnFile, outpath, tmpdir):# {{{
         "-pfm", "n",  "-pmsa", "y", "-ptag", "y", "-showTMidx", "-sep", "n",
         "--advtopo",   "-cleanplot", "-h2wratio", str(g_params["H2W_ratio"]),
         "-shrink", "no", "-showgap", basename_topAlnFile]
+    if g_params['cacheDir'] != "":
+        cmd += ["-cachedir", g_params['cacheDir']]
 
     if g_params['verbose']:
         print(("Generating toplogy alignment figure for %s"%(rootname)))
@@ -162,8 +184,17 @@ def MakeTMplot(seqAlnFile, topAlnFile, outpath, tmpdir):# {{{
     outfile_crop =  "tt1-crop.pdf"
 
     if os.path.exists(outfile_crop):
-        final_targetfile =  os.path.join(outpath, "%s.seqtopaln.pdf"%(rootname))
         shutil.copy2(outfile_crop, final_targetfile)
+        if cachefile != "":
+            if not os.path.exists(os.path.dirname(cachefile)):
+                os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+            # copy to a temporary file in the cache dir first, so that an
+            # interrupted or concurrent run does not leave a partial entry
+            (fd, tmpcachefile) = tempfile.mkstemp(
+                    dir=os.path.dirname(cachefile))
+            os.close(fd)
+            shutil.copy2(outfile_crop, tmpcachefile)
+            os.replace(tmpcachefile, cachefile)
 
     if g_params['verbose']:
         print(("Copy the result to final target %s"%(os.path.join(outpath, outfile))))
@@ -202,6 +233,11 @@ Examples:
     parser.add_argument('-h2wratio', dest='H2W_ratio',
             metavar='H2W_ratio', type=float, default=0.08,
             help='Set the H2W ratio')
+    parser.add_argument('-cachedir', '--cachedir', metavar='DIR',
+            dest='cacheDir', default="",
+            help='Cache the figures in DIR, keyed by the content of the '
+            'alignments and the options, so that unchanged inputs are not '
+            'plotted again')
 
     args = parser.parse_args()
 
@@ -212,6 +248,8 @@ Examples:
     outpath = os.path.abspath(outpath)
     if args.breakTM:
         g_params['isBreakTM'] = True
+    if args.cacheDir != "":
+        g_params['cacheDir'] = os.path.abspath(args.cacheDir)
 
     if not CheckPrerequisite():
         return 1
@@ -236,6 +274,7 @@ def InitGlobalParameter():#{{{
     g_params['window_size'] = 100
     g_params['isBreakTM'] = False
     g_params['verbose'] = True
+    g_params['cacheDir'] = ""
     return g_params
 #}}}
 if __name__ == '__main__' :
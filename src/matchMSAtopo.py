@@ -3,6 +3,7 @@
 import os
 import sys
 import myfunc
+import libtmsa
 progname =  os.path.basename(sys.argv[0])
 wspace = ''.join([" "]*len(progname))
 GAP = "-"
@@ -15,10 +16,12 @@ usage_ext="""
 Description: 
     Output the topology alignment given sequence alignment.  All files should
     be in Fasta format.  Sequences are matched by seqID identified from the
-    annotation line
+    annotation line. The topology file and OUTFILE can also be the binary
+    topology MSA (.tmsa), the format is determined by the file extension
 
 OPTIONS:
-  -o OUTFILE     Output the result to OUTFILE
+  -o OUTFILE     Output the result to OUTFILE, in the binary format if
+                 OUTFILE ends with .tmsa
   -topodb DBNAME Input topology is a formatted db
   -localaln      Treat the alignment as local alignment, in this case,
                  Lower case letters will be considered as non-aligned and 
@@ -38,19 +41,52 @@ Created 2013-05-15, updated 2013-05-15, Nanjiang Shu
 usage_exp="""
 Examples:
     %s -msa test.mfa -topo test.topo -o test.topomsa.fa
-"""%(progname)
+    %s -msa test.mfa -topo test.topo -o test.topomsa.tmsa
+"""%(progname, progname)
 
 def PrintHelp(fpout=sys.stdout):#{{{
     print(usage_short, file=fpout)
     print(usage_ext, file=fpout)
     print(usage_exp, file=fpout)#}}}
 def GetTopoDict(topofile):#{{{
-    (idList, topoList) = myfunc.ReadFasta_without_annotation(topofile)
+    if libtmsa.IsTMSAFile(topofile):
+        (idList, annotationList, topoList) = libtmsa.ReadTMSA(topofile)
+        topoList = [topo.replace(GAP, "") for topo in topoList]
+    else:
+        (idList, topoList) = myfunc.ReadFasta_without_annotation(topofile)
     topoDict = {}
     for i in range(len(idList)):
         topoDict[idList[i]] = topoList[i]
     return topoDict
 #}}}
+def OpenTopoMSAOutput(outfile):#{{{
+    """
+    Open outfile for the matched topologies, records are collected in a list
+    if the output is in the binary format (.tmsa)
+    """
+    if libtmsa.IsTMSAFile(outfile):
+        return []
+    return myfunc.myopen(outfile, sys.stdout, "w", False)
+#}}}
+def WriteMatchedTopo(rd, matchedtopo, fpout):#{{{
+    if isinstance(fpout, list):
+        if matchedtopo == "BADSEQ":
+            print("BADSEQ %s not written to the binary output"%(rd.seqid),
+                    file=sys.stderr)
+        else:
+            fpout.append((rd.seqid, rd.description, matchedtopo))
+    else:
+        print(">%s"%(rd.description), file=fpout)
+        print("%s"%(matchedtopo), file=fpout)
+#}}}
+def CloseTopoMSAOutput(fpout, outfile):#{{{
+    """Close the output, return 0 on success and 1 on failure"""
+    if isinstance(fpout, list):
+        return libtmsa.WriteTMSA(outfile, [x[0] for x in fpout],
+                [x[1] for x in fpout], [x[2] for x in fpout])
+    myfunc.myclose(fpout)
+    return 0
+#}}}
 def MatchSeqToTopo(alignedseq, topo, method_match):
     gaplessseq = alignedseq.replace(GAP, "")
     if len(topo) != len(gaplessseq):
@@ -98,7 +134,7 @@ def MatchMSATopo_using_topofile(msafile, topofile, isIgnoreBadseq, #{{{
     if hdl.failure:
         return 1
 
-    fpout = myfunc.myopen(outfile, sys.stdout, "w", False)
+    fpout = OpenTopoMSAOutput(outfile)
 
     recordList = hdl.readseq()
     while recordList != None:
@@ -110,14 +146,13 @@ def MatchMSATopo_using_topofile(msafile, topofile, isIgnoreBadseq, #{{{
                 topo = ""
             matchedtopo = MatchSeqToTopo(rd.seq, topo, method_match)
             if not (matchedtopo == "BADSEQ" and isIgnoreBadseq):
-                print(">%s"%(rd.description), file=fpout)
-                print("%s"%(matchedtopo), file=fpout)
+                WriteMatchedTopo(rd, matchedtopo, fpout)
         recordList = hdl.readseq()
 
-    myfunc.myclose(fpout)
+    status = CloseTopoMSAOutput(fpout, outfile)
     hdl.close()
 
-    return 0
+    return status
 #}}}
 def MatchMSATopo_using_topodb(msafile, topodb, isIgnoreBadseq, #{{{
         method_match, outfile):
@@ -129,12 +164,14 @@ def MatchMSATopo_using_topodb(msafile, topodb, isIgnoreBadseq, #{{{
     if hdl.failure:
         return 1
 
-    fpout = myfunc.myopen(outfile, sys.stdout, "w", False)
+    fpout = OpenTopoMSAOutput(outfile)
 
     recordList = hdl.readseq()
     while recordList != None:
-        for rd in recordList:
-            topowithanno = hdl_topo.GetRecord(rd.seqid)
+        # topologies of a block of records are retrieved by sorted reads
+        topoList = [topowithanno for (seqid, topowithanno) in
+                hdl_topo.GetRecords([rd.seqid for rd in recordList])]
+        for (rd, topowithanno) in zip(recordList, topoList):
             if topowithanno != None:
                 (topoid, topoanno, topo) = myfunc.ExtractFromSeqWithAnno(topowithanno)
             else:
@@ -142,15 +179,14 @@ def MatchMSATopo_using_topodb(msafile, topodb, isIgnoreBadseq, #{{{
                 topo = ""
             matchedtopo = MatchSeqToTopo(rd.seq, topo, method_match)
             if not (matchedtopo == "BADSEQ" and isIgnoreBadseq):
-                print(">%s"%(rd.description), file=fpout)
-                print("%s"%(matchedtopo), file=fpout)
+                WriteMatchedTopo(rd, matchedtopo, fpout)
         recordList = hdl.readseq()
 
-    myfunc.myclose(fpout)
+    status = CloseTopoMSAOutput(fpout, outfile)
     hdl.close()
     hdl_topo.close()
 
-    return 0
+    return status
 #}}}
 def main(g_params):#{{{
     argv = sys.argv
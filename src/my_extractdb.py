@@ -43,7 +43,8 @@ Options:
                 (default: read from database or "")
   -dp, -dataprefix STR  
                 Set the prefix of datafile (default: read from database or "")
-  -format  STR  Set the format of the index file, binary or text (default: text)
+  -format  STR  Set the format of the index file, binary, text or hash
+                (default: text)
   -split        Split the output to individual files for every supplied ID
   -splitall     Split the output to individual files for all IDs in the
                 database
@@ -98,6 +99,10 @@ def ReadRecordNumber(indexfile):#{{{
     if g_params['formatindex']==FORMAT_TEXT:
         (headerinfo, dbfileindexList, index) = ReadIndex_text(indexfile);
         numRecord = len(index);
+    elif g_params['formatindex']==FORMAT_HASH:
+        hashIndex = HashIndex(indexfile)
+        numRecord = hashIndex.numRecord
+        hashIndex.close()
     else:
         numRecord = ReadNumRecord_binary(indexfile);
     return numRecord;
@@ -121,48 +126,37 @@ def ReadIndex(indexfile):#{{{
 # return (indexList, headerinfo, dbfileindexList)
     if g_params['formatindex'] == FORMAT_TEXT:
         return ReadIndex_text(indexfile, g_params['isPrintWarning'])
+    elif g_params['formatindex'] == FORMAT_HASH:
+        return ReadIndex_hash(indexfile, g_params['isPrintWarning'])
     else:
         return ReadIndex_binary(indexfile, g_params['isPrintWarning'])
 #}}}
-def ExtractDBForEachIDWithIndexDict(idList, origext, origprefix, #{{{
-        indexList, indexDict, fpdbList, indexfile, fpout):
+def ExtractDBByBatch(idList, origext, origprefix, hdl, fpout):#{{{
 # @params
-# idd               ID
-# indexDict         A dictionary storing record location for each ID
-# fpdbList          A list of FILE handles for dbfiles
-# indexedKeysSet    Unique set of IDs in the index file
-# indexfile         Index file
-    outfile="";
-
-    indexedIDList = indexList[0]
-    v1 = indexList[1]
-    v2 = indexList[2]
-    v3 = indexList[3]
+# idList            IDs to extract
+# hdl               MyDB handle of the database, records are retrieved by
+#                   hdl.GetRecords, which sorts and coalesces the reads
+    outfile=""
     isSplit = g_params['isSplit']
     isSplitAll = g_params['isSplitAll']
     isQuiet = g_params['isQuiet']
-    for idd in idList:
-        try: 
-            idxItem = indexDict[idd]
+    for (idd, data) in hdl.GetRecords(idList):
+        if data == None:
+            msg = "{}: ID {} not found in the index file {}"
+            print(msg.format(sys.argv[0], idd, hdl.indexfile), file=sys.stderr)
+            continue
+        try:
             if isSplit or isSplitAll:
-                outfile=GetOutfileName(idd,origext,origprefix);
-                fpout = open (outfile,"wb");
-
-            fpdb = fpdbList[v1[idxItem]];
-            fpdb.seek(v2[idxItem]);
-            data = fpdb.read(v3[idxItem]);
-
-            fpout.write(data) ;
+                outfile=GetOutfileName(idd,origext,origprefix)
+                fpout = open (outfile,"wb")
+            fpout.write(data)
             if isSplit or isSplitAll:
                 fpout.close()
                 if not isQuiet:
-                    print("%s output"%(outfile), file=sys.stdout);
-        except (KeyError, IndexError):
-            msg = "{}: ID {} not found in the index file {}"
-            print(msg.format(sys.argv[0], idd, indexfile ), file=sys.stderr);
+                    print("%s output"%(outfile), file=sys.stdout)
         except IOError:
             msg = "{}: Failed to read or write record {}"
-            print(msg.format(sys.argv[0], idd), file=sys.stderr);
+            print(msg.format(sys.argv[0], idd), file=sys.stderr)
 #}}}
 def ExtractDBForEachIDWithIndexList(idList, origext, origprefix, #{{{
         indexList, fpdbList, indexfile, fpout):
@@ -212,6 +206,23 @@ def ExtractDB(idList, g_params, fpout):#{{{
         print(msg.format(sys.argv[0],dbname), file=sys.stderr);
         return 1;
 
+    if g_params['typeindex'] != TYPE_LIST or g_params['isSplitAll']:
+        # many IDs, e.g. given by -l, are extracted by batched reads
+        hdl = myfunc.MyDB(dbname, formatindex, g_params['isPrintWarning'])
+        if hdl.failure or hdl.numRecord <= 0:
+            msg = "{}: Read index file {} failed. Exit."
+            print(msg.format(sys.argv[0],indexfile), file=sys.stderr);
+            return 1;
+        (origdbname, origversion, origext, origprefix) = hdl.headerinfo
+        if g_params['isSplitAll']:
+            if hdl.hashIndex != None:
+                idList = hdl.hashIndex.GetIDList()
+            else:
+                idList = hdl.indexedIDList
+        ExtractDBByBatch(idList, origext, origprefix, hdl, fpout)
+        hdl.close()
+        return 0
+
     (indexList, headerinfo, dbfileindexList) = ReadIndex(indexfile)
     (origdbname, origversion, origext, origprefix) = headerinfo
     numRecord = len(indexList[0])
@@ -219,8 +230,6 @@ def ExtractDB(idList, g_params, fpout):#{{{
         msg = "{}: Read index file {} failed. Exit."
         print(msg.format(sys.argv[0],indexfile), file=sys.stderr);
         return 1;
-    if g_params['isSplitAll']:
-        idList = indexList[0]
 
     fpdbList = []
     for i in dbfileindexList:
@@ -232,16 +241,8 @@ def ExtractDB(idList, g_params, fpout):#{{{
             print(msg.format(sys.argv[0],dbfile), file=sys.stderr);
             raise
 
-    if g_params['typeindex'] == TYPE_LIST:
-        ExtractDBForEachIDWithIndexList(idList, origext, origprefix, indexList,
-                fpdbList, indexfile, fpout)
-    else:
-        indexDict = {}
-        #t = np.arange(0, numRecord, 1, dtype=np.int32)
-        for i in range(numRecord):
-            indexDict[indexList[0][i]] = i
-        ExtractDBForEachIDWithIndexDict(idList, origext, origprefix, indexList,
-                indexDict, fpdbList, indexfile, fpout);
+    ExtractDBForEachIDWithIndexList(idList, origext, origprefix, indexList,
+            fpdbList, indexfile, fpout)
 
     for fp in fpdbList:
         fp.close();
@@ -290,6 +291,8 @@ def main(g_params):#{{{
             elif (sys.argv[i] in ["-format" , "--format"]):
                 if sys.argv[i+1].lower()[0]== "b":
                     g_params['formatindex']=FORMAT_BINARY;
+                elif sys.argv[i+1].lower()[0]== "h":
+                    g_params['formatindex']=FORMAT_HASH;
                 else:
                     g_params['formatindex']=FORMAT_TEXT;
                 i += 2;
@@ -34,6 +34,9 @@
 
 import os
 import sys
+import threading
+import numpy
+from concurrent.futures import ThreadPoolExecutor
 from array import array
 from .mydb_common import *
 import myfunc
@@ -61,8 +64,18 @@ Options:
   -dataprefix STR   Set the prefix of datafile, (default: "")
   -dbname  DBNAME   Set the output database name
   -mode       STR   Set the mode, new or append (default: new)
-  -format     STR   Set the format of the index file, binary or text 
+  -format     STR   Set the format of the index file, binary, text or hash
                     (default: binary)
+                    hash: open-addressing hash table of ID, accessed by mmap,
+                    for large databases, $DBNAME.indexhash
+  -cpu        INT   Build the database with INT threads, input files are read
+                    and INT db files are written concurrently. The index of
+                    each chunk of IDs is committed to $INDEXFILE.journal and
+                    the index file is written at the end, so that an
+                    interrupted build can be resumed with -mode append
+                    (default: 1)
+  -chunk      INT   Number of IDs per commit to the journal in the threaded
+                    build, (default: 100000)
   -wall             Print warning message, (default: no)
   -h, --help        Print this help message and exit
 
@@ -70,6 +83,7 @@ Created 2011-09-18, updated 2014-12-17, Nanjiang Shu
 
 Examples:
     my_formatdb.py -l idlist.txt -datapath test -dbname out1/dumpdb
+    my_formatdb.py -l idlist.txt -datapath test -dbname out1/dumpdb -cpu 8
 """%(progname, wspace, wspace)
 
 MAXDBFILESIZE=1024*1024*1024*8; # 8GB # changed 2014-12-17
@@ -106,7 +120,7 @@ def WriteDBForEachID(idd, origIdListSet, datapath, dataext, dataprefix, #{{{
             indexList[3].append(sizeblock)
 #            indexList.append((idd,cntdbfile, offset, sizeblock))
 
-            print(data, file=fpdb)
+            fpdb.write(data)
             size_dbfile += sizeblock
             if size_dbfile >= MAXDBFILESIZE:
                 fpdb.close()
@@ -140,7 +154,6 @@ def CreateNewFormattedDB(idList,datapath,dataext, dataprefix, #{{{
     size_dbfile=0
     cntdbfile=0
     dbfile=dbname+"%d"%cntdbfile+".db"
-    fpindex=open(indexfile,"wb")
     fpdb=open(dbfile,"wb")
     indexList = []
     if not isQuiet:
@@ -149,12 +162,19 @@ def CreateNewFormattedDB(idList,datapath,dataext, dataprefix, #{{{
     indexFileHeaderText=["DEF_VERSION %s"%version, "DEF_DBNAME %s"%dbname,
             "DEF_EXTENSION %s"%dataext,"DEF_PREFIX %s"%dataprefix ]
     formatindex = g_params['formatindex']
-    WriteIndexHeader(indexFileHeaderText, formatindex, fpindex)
     WriteDB(idList, set([]), datapath, dataext, dataprefix, cntdbfile,
             size_dbfile, dbname, fpdb, indexList)
 #Write indexList
-    WriteIndexContent(indexList, formatindex, fpindex)
-    fpindex.close()
+    if formatindex == FORMAT_HASH:
+        WriteIndex_hash(indexFileHeaderText, indexList, indexfile)
+    else:
+        if formatindex == FORMAT_TEXT:
+            fpindex=open(indexfile,"w")
+        else:
+            fpindex=open(indexfile,"wb")
+        WriteIndexHeader(indexFileHeaderText, formatindex, fpindex)
+        WriteIndexContent(indexList, formatindex, fpindex)
+        fpindex.close()
     if not isQuiet:
         msg = "{} records have been added to the database {}."
         print(msg.format(len(indexList[0]), dbname))
@@ -173,6 +193,12 @@ def AppendFormattedDB(idList,datapath,dataext, dataprefix, #{{{
                 g_params['isPrintWarning'])
         origIdListSet = set(indexList[0])
         lastDBFileIndex = indexList[1][len(indexList[0])-1]
+    elif formatindex == FORMAT_HASH:
+        (indexList, headerinfo, dbfileindexList) = ReadIndex_hash(indexfile,
+                g_params['isPrintWarning'])
+        origIdListSet = set(indexList[0])
+        indexFileHeaderText = GetIndexFileHeaderText(headerinfo)
+        lastDBFileIndex = indexList[1][len(indexList[0])-1]
     else:
         (indexList, headerinfo, dbfileindexList) = ReadIndex_binary(indexfile,
                 g_params['isPrintWarning'])
@@ -192,7 +218,9 @@ def AppendFormattedDB(idList,datapath,dataext, dataprefix, #{{{
     size_dbfile=fpdb.tell()
     WriteDB(idList,origIdListSet, datapath, dataext, dataprefix, cntdbfile,
             size_dbfile, dbname, fpdb, indexList)
-    if len(indexList[0]) > numOrigRecord:
+    if len(indexList[0]) > numOrigRecord and formatindex == FORMAT_HASH:
+        WriteIndex_hash(indexFileHeaderText, indexList, indexfile)
+    elif len(indexList[0]) > numOrigRecord:
         fpindex=None
         if formatindex==FORMAT_TEXT:
             fpindex=open(indexfile,"ab+")
@@ -207,6 +235,251 @@ def AppendFormattedDB(idList,datapath,dataext, dataprefix, #{{{
             print(msg.format(len(indexList[0])-numOrigRecord, dbname))
 #}}}
 
+def ReadIndexByFormat(indexfile, formatindex):#{{{
+    isPrintWarning = g_params['isPrintWarning']
+    if formatindex == FORMAT_TEXT:
+        return ReadIndex_text(indexfile, isPrintWarning)
+    elif formatindex == FORMAT_HASH:
+        return ReadIndex_hash(indexfile, isPrintWarning)
+    else:
+        return ReadIndex_binary(indexfile, isPrintWarning)
+#}}}
+def OpenDBFile_append(dbname, cntdbfile, shardState):#{{{
+    """
+    Open the db file cntdbfile for appending, a new db file is allocated if
+    cntdbfile == None. shardState is shared by the writing threads
+    Return (fpdb, cntdbfile, size_dbfile)
+    """
+    if cntdbfile == None:
+        with shardState['lock']:
+            cntdbfile = shardState['next']
+            shardState['next'] += 1
+        dbfile = dbname+"%d.db"%(cntdbfile)
+        fpdb = open(dbfile, "wb")
+        if not g_params['isQuiet']:
+            print("dbfile %s is created."%dbfile)
+    else:
+        fpdb = open(dbname+"%d.db"%(cntdbfile), "ab")
+    fpdb.seek(0, os.SEEK_END)
+    return (fpdb, cntdbfile, fpdb.tell())
+#}}}
+def CloseDBFile_sync(fpdb):#{{{
+    fpdb.flush()
+    os.fsync(fpdb.fileno())
+    fpdb.close()
+#}}}
+def WriteDBForIDGroup(idGroup, origIdListSet, datapath, dataext, #{{{
+        dataprefix, cntdbfile, dbname, shardState):
+    """
+    Write data files of idGroup to the db file cntdbfile (None for a new db
+    file), new db files are allocated when the size exceeds MAXDBFILESIZE.
+    Records are only referred to after the index is committed, so data
+    written by an interrupted build is never read.
+    Return (indexList, cntdbfile, size_dbfile) of the last db file
+    """
+    indexList = [[], array('B'), array('L'), array('I')]
+    (fpdb, cntdbfile, size_dbfile) = OpenDBFile_append(dbname, cntdbfile,
+            shardState)
+    try:
+        for idd in idGroup:
+            datafile = datapath+os.sep+dataprefix+idd+dataext
+            if idd in origIdListSet:
+                msg = "ID {} already exists in the database. Ignore.\n"
+                sys.stderr.write(msg.format(idd))
+                continue
+            try:
+                fpin = open(datafile, "rb")
+                data = fpin.read()
+                fpin.close()
+            except IOError:
+                msg = "datafile {} does not exist. Ignore.\n"
+                sys.stderr.write(msg.format(datafile))
+                continue
+            if size_dbfile >= MAXDBFILESIZE:
+                CloseDBFile_sync(fpdb)
+                (fpdb, cntdbfile, size_dbfile) = OpenDBFile_append(dbname,
+                        None, shardState)
+            indexList[0].append(idd)
+            indexList[1].append(cntdbfile)
+            indexList[2].append(size_dbfile)
+            indexList[3].append(len(data))
+            fpdb.write(data)
+            size_dbfile += len(data)
+    finally:
+        CloseDBFile_sync(fpdb)
+    return (indexList, cntdbfile, size_dbfile)
+#}}}
+def MergeIndexList(indexList, groupIndexList):#{{{
+    """
+    Merge per-shard index lists to indexList, records are sorted by
+    (dbfile, offset) so that the last record is in the last db file, as
+    assumed by the index readers
+    """
+    idList = list(indexList[0])
+    for li in groupIndexList:
+        idList.extend(li[0])
+    allList = [indexList] + groupIndexList
+    v1 = numpy.concatenate([numpy.frombuffer(li[1], dtype=numpy.uint8)
+        for li in allList])
+    v2 = numpy.concatenate([numpy.array(li[2], dtype=numpy.uint64)
+        for li in allList])
+    v3 = numpy.concatenate([numpy.array(li[3], dtype=numpy.uint64)
+        for li in allList])
+    order = numpy.lexsort((v2, v1))
+    return [[idList[i] for i in order], array('B', v1[order].tolist()),
+            array('L', v2[order].tolist()), array('I', v3[order].tolist())]
+#}}}
+def AppendIndexJournal(groupIndexList, journalfile):#{{{
+    """
+    Append the per-shard index lists of a chunk to journalfile, one record
+    "ID dbfile offset size" per line, followed by the line "#COMMIT". The
+    file is synced, so that the records of the chunk are kept after a crash
+    Return 0 on success and 1 on failure
+    """
+    try:
+        fpout = open(journalfile, "a")
+        for li in groupIndexList:
+            for i in range(len(li[0])):
+                fpout.write("%s %d %d %d\n"%(li[0][i], li[1][i], li[2][i],
+                    li[3][i]))
+        fpout.write("#COMMIT\n")
+        fpout.flush()
+        os.fsync(fpout.fileno())
+        fpout.close()
+        return 0
+    except IOError:
+        msg = "Failed to write index journal {}"
+        print(msg.format(journalfile), file=sys.stderr)
+        return 1
+#}}}
+def ReadIndexJournal(journalfile, excludeIdSet):#{{{
+    """
+    Read the records committed to journalfile, records after the last
+    "#COMMIT" line are written by an interrupted chunk and are ignored, so
+    are the records of IDs in excludeIdSet, which are already in the index
+    Return the index list
+    """
+    indexList = [[], array('B'), array('L'), array('I')]
+    pendingList = []
+    fpin = open(journalfile, "r")
+    for line in fpin:
+        if line == "#COMMIT\n":
+            for (idd, v1, v2, v3) in pendingList:
+                if idd in excludeIdSet:
+                    continue
+                indexList[0].append(idd)
+                indexList[1].append(v1)
+                indexList[2].append(v2)
+                indexList[3].append(v3)
+            pendingList = []
+            continue
+        strs = line.split()
+        if len(strs) == 4:
+            try:
+                pendingList.append((strs[0], int(strs[1]), int(strs[2]),
+                    int(strs[3])))
+            except ValueError:
+                pass
+    fpin.close()
+    return indexList
+#}}}
+def FormatDB_thread(idList, datapath, dataext, dataprefix, indexfile, #{{{
+        dbname):
+    """
+    Format the database with g_params['numThread'] threads, each thread
+    reads its share of the input files and writes to its own db file. After
+    each chunk of IDs, the per-shard indexes are appended to the journal
+    $indexfile.journal, and the index file is merged and replaced atomically
+    once at the end. In append mode, the journal of an interrupted build is
+    replayed and IDs already indexed are skipped, so that the build can be
+    resumed.
+    """
+    isQuiet = g_params['isQuiet']
+    formatindex = g_params['formatindex']
+    numThread = g_params['numThread']
+    chunkSize = g_params['chunkSize']
+    indexList = [[], array('B'), array('L'), array('I')]
+    indexFileHeaderText = ["DEF_VERSION %s"%version, "DEF_DBNAME %s"%dbname,
+            "DEF_EXTENSION %s"%dataext,"DEF_PREFIX %s"%dataprefix ]
+    journalfile = indexfile + ".journal"
+    journalIndexList = []  # index lists committed to the journal
+    shardPool = []  # db files that can be appended to
+    numDBFile = 0
+    if g_params['mode'] == MODE_APPEND and os.path.exists(indexfile):
+        (indexList, headerinfo, dbfileindexList) = ReadIndexByFormat(
+                indexfile, formatindex)
+        if indexList == None or len(indexList) < 4:
+            msg = "Fatal: Read index file {} failed in function {}. Exit."
+            print(msg.format(indexfile, sys._getframe().f_code.co_name), file=sys.stderr)
+            return 1
+        indexFileHeaderText = GetIndexFileHeaderText(headerinfo)
+    if g_params['mode'] == MODE_APPEND and os.path.exists(journalfile):
+        journalIndexList.append(ReadIndexJournal(journalfile,
+            set(indexList[0])))
+        if not isQuiet:
+            msg = "{} records replayed from the index journal {}."
+            print(msg.format(len(journalIndexList[0][0]), journalfile))
+    elif os.path.exists(journalfile):
+        os.remove(journalfile)
+    if g_params['mode'] == MODE_APPEND and (os.path.exists(indexfile) or
+            len(journalIndexList) > 0):
+        # db files of an interrupted build may exist after the last indexed
+        # one, they are reused
+        while os.path.exists(dbname+"%d.db"%(numDBFile)):
+            if os.path.getsize(dbname+"%d.db"%(numDBFile)) < MAXDBFILESIZE:
+                shardPool.append(numDBFile)
+            numDBFile += 1
+        shardPool = shardPool[-numThread:]
+    origIdListSet = set(indexList[0])
+    for li in journalIndexList:
+        origIdListSet.update(li[0])
+    numOrigRecord = len(indexList[0])
+    shardState = {'next': numDBFile, 'lock': threading.Lock()}
+
+    with ThreadPoolExecutor(max_workers=numThread) as executor:
+        for start in range(0, len(idList), chunkSize):
+            chunk = idList[start:start+chunkSize]
+            groupSize = (len(chunk)+numThread-1)//numThread
+            futureList = []
+            for i in range(0, len(chunk), groupSize):
+                cntdbfile = None
+                if len(shardPool) > 0:
+                    cntdbfile = shardPool.pop(0)
+                futureList.append(executor.submit(WriteDBForIDGroup,
+                    chunk[i:i+groupSize], origIdListSet, datapath, dataext,
+                    dataprefix, cntdbfile, dbname, shardState))
+            groupIndexList = []
+            for future in futureList:
+                (li, cntdbfile, size_dbfile) = future.result()
+                groupIndexList.append(li)
+                if size_dbfile < MAXDBFILESIZE:
+                    shardPool.append(cntdbfile)
+            shardPool.sort()
+            if shardState['next'] > 256:
+                msg = "Fatal: number of db files exceeds 256. Exit."
+                print(msg, file=sys.stderr)
+                return 1
+            groupIndexList = [li for li in groupIndexList if len(li[0]) > 0]
+            if len(groupIndexList) > 0:
+                for li in groupIndexList:
+                    origIdListSet.update(li[0])
+                if AppendIndexJournal(groupIndexList, journalfile) != 0:
+                    return 1
+                journalIndexList += groupIndexList
+    if len(journalIndexList) > 0:
+        indexList = MergeIndexList(indexList, journalIndexList)
+        if WriteIndexFile(indexFileHeaderText, indexList, formatindex,
+                indexfile) != 0:
+            return 1
+    if os.path.exists(journalfile):
+        os.remove(journalfile)
+    if not isQuiet:
+        msg = "{} records have been added to the database {}."
+        print(msg.format(len(indexList[0])-numOrigRecord, dbname))
+        print("indexfile %s output."%(indexfile))
+    return 0
+#}}}
+
 def FormatDB(idList, datapath, dataext, dataprefix, dbname):#{{{
     mode = g_params['mode']
     formatindex = g_params['formatindex']
@@ -216,9 +489,14 @@ def FormatDB(idList, datapath, dataext, dataprefix, dbname):#{{{
     indexfile=""
     if formatindex == FORMAT_BINARY:
         indexfile=dbname+".indexbin"
+    elif formatindex == FORMAT_HASH:
+        indexfile=dbname+".indexhash"
     else:
         indexfile=dbname+".index"
-    if mode == MODE_NEW or not os.path.exists(indexfile):
+    if g_params['numThread'] > 1:
+        FormatDB_thread(idList, datapath, dataext, dataprefix, indexfile,
+                dbname)
+    elif mode == MODE_NEW or not os.path.exists(indexfile):
         CreateNewFormattedDB(idList,datapath, dataext,dataprefix, indexfile,
                 dbname)
     elif mode == MODE_APPEND:
@@ -278,9 +556,17 @@ def main(g_params):#{{{
             elif sys.argv[i] in ["-format", "--format"]:
                 if sys.argv[i+1].lower()[0]== "b":
                     g_params['formatindex'] = FORMAT_BINARY
+                elif sys.argv[i+1].lower()[0]== "h":
+                    g_params['formatindex'] = FORMAT_HASH
                 else:
                     g_params['formatindex'] = FORMAT_TEXT
                 i += 2
+            elif sys.argv[i] in ["-cpu", "--cpu"]:
+                g_params['numThread'] = int(sys.argv[i+1])
+                i += 2
+            elif sys.argv[i] in ["-chunk", "--chunk"]:
+                g_params['chunkSize'] = int(sys.argv[i+1])
+                i += 2
             elif sys.argv[i] in ["-l", "--l", '-list', '--list']:
                 idListFile=sys.argv[i+1]
                 i += 2
@@ -329,6 +615,8 @@ def InitGlobalParameter():#{{{
     g_params['formatindex'] = FORMAT_BINARY; # format of the index file
     g_params['isQuiet'] = False
     g_params['isPrintWarning'] = False
+    g_params['numThread'] = 1
+    g_params['chunkSize'] = 100000
     return g_params
 #}}}
 
@@ -9,15 +9,30 @@
 
 import sys
 import os
+import mmap
+import hashlib
 from array import array
+import numpy as np
 import mybase
 
 FORMAT_BINARY = 0
 FORMAT_TEXT = 1
+FORMAT_HASH = 2
 TYPE_DICT = 0
 TYPE_LIST = 1
 LargeFileThresholdSize = 1.5*1024*1024*1024
 version = "1.4"
+# extension of the sorted hash index file stored next to the database
+SORTED_HASH_EXT = ".sortedhash.npy"
+# the hash index file (FORMAT_HASH), $dbname.indexhash, starts with
+#   HASH_INDEX_MAGIC, header text (uint32 size + text, as the binary index),
+#   numRecord, tableSize, sizeIDBlob (uint64), then the open-addressing hash
+#   table of tableSize slots (HASH_SLOT_DTYPE), the slot of each record in the
+#   order of the records (uint64 x numRecord) and the concatenated IDs
+HASH_INDEX_MAGIC = b"MYDBHASH"
+HASH_SLOT_DTYPE = np.dtype([('hash', '<u8'), ('offset', '<u8'),
+    ('idoffset', '<u8'), ('size', '<u4'), ('idlength', '<u2'),
+    ('dbfile', 'u1'), ('used', 'u1')])
 
 def GetIndexFileHeaderText(headerinfo):#{{{
     """
@@ -37,6 +52,14 @@ def GetIndexFile(dbname, formatindex):#{{{
     """
 # return (indexfile, formatindex)
     indexfile = ""
+    if formatindex == FORMAT_HASH:
+        indexfile = dbname + ".indexhash"
+        if os.path.exists(indexfile):
+            return (indexfile, formatindex)
+        msg = "Hash index file {} does not exist. "\
+                "Try looking for binary index file"
+        print(msg.format(indexfile), file=sys.stderr)
+        formatindex = FORMAT_BINARY
     if formatindex == FORMAT_BINARY:
         indexfile = dbname + ".indexbin"
         if not os.path.exists(indexfile):
@@ -61,6 +84,9 @@ def GetIndexFile(dbname, formatindex):#{{{
                 msg = "Binary index file {} does not exist"
                 print(msg.format(indexfile), file=sys.stderr)
                 indexfile = ""
+    if indexfile == "" and os.path.exists(dbname + ".indexhash"):
+        indexfile = dbname + ".indexhash"
+        formatindex = FORMAT_HASH
     return (indexfile, formatindex)
 #}}}
 def WriteIndexHeader(indexFileHeaderText, formatindex, fpindex):#{{{
@@ -71,7 +97,7 @@ def WriteIndexHeader(indexFileHeaderText, formatindex, fpindex):#{{{
         for s in indexFileHeaderText:
             print(s, file=fpindex)
     else:
-        dumpedtext='\n'.join(s for s in indexFileHeaderText)
+        dumpedtext='\n'.join(s for s in indexFileHeaderText).encode()
         vI = array('I')
         vI.append(len(dumpedtext))
         vI.tofile(fpindex)
@@ -102,7 +128,7 @@ def WriteIndexContent(indexList, formatindex, fpindex):#{{{
         else: #'I'
             v2 = array('I', [x for x in indexList[2]])
 
-        dumpedliststr = '\n'.join(s for s in idList)
+        dumpedliststr = '\n'.join(s for s in idList).encode()
 
         vI=array('I')
         vI.append(len(dumpedliststr))
@@ -117,6 +143,71 @@ def WriteIndexContent(indexList, formatindex, fpindex):#{{{
         v2.tofile(fpindex)
         v3.tofile(fpindex)
 #}}}
+def ParseIndexHeaderText(dumpedtext, indexfile, isPrintWarning = False):#{{{
+    """
+    Parse the header text of the binary index file
+    Return headerinfo (dbname, version, ext, prefix)
+    """
+    strs = dumpedtext.split("\n")
+    origdbname = ""
+    origversion = ""
+    origext = ""
+    origprefix = ""
+    for line in strs:
+        if not line or line[0] == "#":
+            continue
+        ss=line.split()
+        if ss[0] == "DEF_DBNAME":
+            if len(ss)>=2:
+                origdbname=ss[1]
+        elif ss[0] == "DEF_VERSION":
+            if len(ss)>=2:
+                origversion=ss[1]
+        elif ss[0] == "DEF_EXTENSION":
+            if len(ss)>=2:
+                origext=ss[1]
+        elif ss[0] == "DEF_PREFIX":
+            if len(ss)>=2:
+                origprefix=ss[1]
+    if isPrintWarning:
+        if origversion == "": 
+            msg = "{}: Warning! No version info in the index file {}"
+            print(msg.format(sys.argv[0],indexfile), file=sys.stderr)
+        elif origversion != version:
+            msg = "{}: Warning! Version conflicts. "\
+                    "Version of the index file {} ({}) "\
+                    "!= version of the program ({})"
+            print(msg.format(sys.argv[0], indexfile,
+                    origversion, version), file=sys.stderr)
+    return (origdbname, origversion, origext, origprefix)
+#}}}
+def WriteIndexFile(indexFileHeaderText, indexList, formatindex, #{{{
+        indexfile):
+    """
+    Write the whole index file, the index is written to a temporary file and
+    renamed after it is synced to disk, so that after a crash the index file
+    is either the old one or the new one
+    """
+    if formatindex == FORMAT_HASH:
+        return WriteIndex_hash(indexFileHeaderText, indexList, indexfile)
+    tmpfile = indexfile + ".tmp"
+    try:
+        if formatindex == FORMAT_TEXT:
+            fpindex = open(tmpfile, "w")
+        else:
+            fpindex = open(tmpfile, "wb")
+        WriteIndexHeader(indexFileHeaderText, formatindex, fpindex)
+        WriteIndexContent(indexList, formatindex, fpindex)
+        fpindex.flush()
+        os.fsync(fpindex.fileno())
+        fpindex.close()
+        os.replace(tmpfile, indexfile)
+        return 0
+    except IOError:
+        msg = "Failed to write index file {}"
+        print(msg.format(indexfile), file=sys.stderr)
+        return 1
+#}}}
 def ReadIndex_binary(indexfile, isPrintWarning = False):#{{{
     """
     Read the index file of the binary format
@@ -134,39 +225,8 @@ def ReadIndex_binary(indexfile, isPrintWarning = False):#{{{
         dumpedtext = fpin.read(vI[0])
         cntReadByte += vI[0]
 
-        strs = dumpedtext.split("\n")
-        origdbname = ""
-        origversion = ""
-        origext = ""
-        origprefix = ""
-        for line in strs:
-            if not line or line[0] == "#":
-                continue
-            ss=line.split()
-            if ss[0] == "DEF_DBNAME":
-                if len(ss)>=2:
-                    origdbname=ss[1]
-            elif ss[0] == "DEF_VERSION":
-                if len(ss)>=2:
-                    origversion=ss[1]
-            elif ss[0] == "DEF_EXTENSION":
-                if len(ss)>=2:
-                    origext=ss[1]
-            elif ss[0] == "DEF_PREFIX":
-                if len(ss)>=2:
-                    origprefix=ss[1]
-        if isPrintWarning:
-            if origversion == "": 
-                msg = "{}: Warning! No version info in the index file {}"
-                print(msg.format(sys.argv[0],indexfile), file=sys.stderr)
-            elif origversion != version:
-                msg = "{}: Warning! Version conflicts. "\
-                        "Version of the index file {} ({}) "\
-                        "!= version of the program ({})"
-                print(msg.format(sys.argv[0], indexfile,
-                        origversion, version), file=sys.stderr)
-
-        headerinfo = (origdbname, origversion, origext, origprefix)
+        headerinfo = ParseIndexHeaderText(dumpedtext.decode(), indexfile,
+                isPrintWarning)
         #read in other information
         vI = array('I')
         vI.fromfile(fpin,1)
@@ -175,7 +235,7 @@ def ReadIndex_binary(indexfile, isPrintWarning = False):#{{{
         dumpedidlist=fpin.read(vI[0])
         cntReadByte += vI[0]
 
-        idlist = dumpedidlist.split("\n")
+        idlist = dumpedidlist.decode().split("\n")
         vI=array('I')
         vI.fromfile(fpin,1)
         cntReadByte += vI.itemsize
@@ -285,3 +345,320 @@ def ReadIndex_text(indexfile, isPrintWarning = False):#{{{
         print(msg.format(indexfile, sys._getframe().f_code.co_name), file=sys.stderr)
         return (None, None, None)
 #}}}
+def GetIDBoundary(idBlob):#{{{
+    """
+    Get the begin and end of each ID in the newline-joined ID list idBlob
+    (a uint8 array), the ID of record i is idBlob[idBegin[i]:idEnd[i]]
+    Return (idBegin, idEnd)
+    """
+    if len(idBlob) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    posNewline = np.flatnonzero(idBlob == ord('\n'))
+    idBegin = np.concatenate(([0], posNewline+1))
+    idEnd = np.concatenate((posNewline, [len(idBlob)]))
+    return (idBegin, idEnd)
+#}}}
+def ReadIndex_binary_array(indexfile, isPrintWarning = False):#{{{
+    """
+    Read the index file of the binary format to numpy arrays by mmap, without
+    creating Python objects for each record
+    Return (indexArray, headerinfo, dbfileindexList), indexArray is
+    (idBlob, idBegin, idEnd, v1, v2, v3), see GetIDBoundary for the IDs,
+    v1, v2, v3 are the dbfile index, offset and block size of the records
+    """
+    try:
+        with open(indexfile, "rb") as fpin:
+            mm = mmap.mmap(fpin.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError):
+        msg = "Failed to read index file {} in function {}"
+        print(msg.format(indexfile, sys._getframe().f_code.co_name), file=sys.stderr)
+        return (None, None, None)
+    size_indexfile = len(mm)
+    pos = 0
+    sizeText = int(np.frombuffer(mm, dtype=np.dtype('I'), count=1, offset=pos)[0])
+    pos += 4
+    headerinfo = ParseIndexHeaderText(mm[pos:pos+sizeText].decode(),
+            indexfile, isPrintWarning)
+    pos += sizeText
+    sizeIDList = int(np.frombuffer(mm, dtype=np.dtype('I'), count=1, offset=pos)[0])
+    pos += 4
+    idBlob = np.frombuffer(mm, dtype=np.uint8, count=sizeIDList, offset=pos)
+    pos += sizeIDList
+    numRecord = int(np.frombuffer(mm, dtype=np.dtype('I'), count=1, offset=pos)[0])
+    pos += 4
+    (idBegin, idEnd) = GetIDBoundary(idBlob)
+    if numRecord != len(idBegin):
+        msg = "{}: numID ({}) != numRecord ({}) for indexfile {} "
+        print(msg.format(sys.argv[0], len(idBegin),
+                numRecord, indexfile), file=sys.stderr)
+
+    # offsets are array('I') or array('L'), decided by the size of the file
+    sizeRecord_I = 1 + np.dtype('I').itemsize + np.dtype('I').itemsize
+    sizeRecord_L = 1 + np.dtype('L').itemsize + np.dtype('I').itemsize
+    sizeRecord = mybase.FloatDivision(size_indexfile - pos, numRecord)
+    if abs(sizeRecord - sizeRecord_I) < abs(sizeRecord - sizeRecord_L):
+        dtypeOffset = np.dtype('I')
+    else:
+        dtypeOffset = np.dtype('L')
+    v1 = np.frombuffer(mm, dtype=np.uint8, count=numRecord, offset=pos)
+    pos += numRecord
+    v2 = np.frombuffer(mm, dtype=dtypeOffset, count=numRecord, offset=pos)
+    pos += numRecord*dtypeOffset.itemsize
+    v3 = np.frombuffer(mm, dtype=np.dtype('I'), count=numRecord, offset=pos)
+    if numRecord > 0:
+        dbfileindexList = list(range(int(v1[numRecord-1])+1))
+    else:
+        dbfileindexList = [0]
+    return ((idBlob, idBegin, idEnd, v1, v2, v3), headerinfo, dbfileindexList)
+#}}}
+def IndexListToArray(indexList):#{{{
+    """
+    Convert indexList returned by ReadIndex_text or ReadIndex_binary to
+    indexArray in the same form as returned by ReadIndex_binary_array
+    """
+    idBlob = np.frombuffer('\n'.join(indexList[0]).encode(), dtype=np.uint8)
+    (idBegin, idEnd) = GetIDBoundary(idBlob)
+    v1 = np.array(indexList[1], dtype=np.uint8)
+    v2 = np.array(indexList[2], dtype=np.uint64)
+    v3 = np.array(indexList[3], dtype=np.uint32)
+    return (idBlob, idBegin, idEnd, v1, v2, v3)
+#}}}
+def GetIDHash(idd):#{{{
+    """
+    Return the 64-bit hash of the record ID (str or bytes), the hash is the
+    same for all runs, unlike the built-in hash()
+    """
+    if isinstance(idd, str):
+        idd = idd.encode()
+    return int.from_bytes(hashlib.blake2b(idd, digest_size=8).digest(),
+            'little')
+#}}}
+def BuildSortedHashIndex(idBlob, idBegin, idEnd):#{{{
+    """
+    Build the sorted hash index of IDs
+    Return sortedHash, a uint64 array of shape (2, numRecord), row 0 is the
+    sorted hash values and row 1 the index of the corresponding record
+    """
+    buff = idBlob.tobytes()
+    numRecord = len(idBegin)
+    hashArray = np.fromiter((GetIDHash(buff[b:e]) for (b, e) in
+        zip(idBegin.tolist(), idEnd.tolist())), dtype=np.uint64,
+        count=numRecord)
+    order = np.argsort(hashArray, kind='stable')
+    return np.vstack((hashArray[order], order.astype(np.uint64)))
+#}}}
+def GetSortedHashIndex(dbname, indexfile, idBlob, idBegin, idEnd):#{{{
+    """
+    Load the sorted hash index file $dbname.sortedhash.npy by mmap, the file
+    is (re)created if it does not exist or is older than the indexfile
+    Return sortedHash, see BuildSortedHashIndex
+    """
+    hashfile = dbname + SORTED_HASH_EXT
+    if (os.path.exists(hashfile) and
+            os.path.getmtime(hashfile) >= os.path.getmtime(indexfile)):
+        sortedHash = np.load(hashfile, mmap_mode='r')
+        if sortedHash.shape == (2, len(idBegin)):
+            return sortedHash
+    sortedHash = BuildSortedHashIndex(idBlob, idBegin, idEnd)
+    try:
+        np.save(hashfile, sortedHash)
+    except IOError:
+        msg = "Failed to write sorted hash index file {}"
+        print(msg.format(hashfile), file=sys.stderr)
+    return sortedHash
+#}}}
+def LookupSortedHashIndex(sortedHash, idBlob, idBegin, idEnd, record_id):#{{{
+    """
+    Look up record_id in the sorted hash index
+    Return the index of the record, or -1 if not found
+    """
+    if isinstance(record_id, str):
+        record_id = record_id.encode()
+    h = np.uint64(GetIDHash(record_id))
+    lo = int(np.searchsorted(sortedHash[0], h, side='left'))
+    hi = int(np.searchsorted(sortedHash[0], h, side='right'))
+    for k in range(lo, hi):
+        idx = int(sortedHash[1][k])
+        if idBlob[idBegin[idx]:idEnd[idx]].tobytes() == record_id:
+            return idx
+    return -1
+#}}}
+def BuildHashTable(hashArray, tableSize):#{{{
+    """
+    Insert records with hash values hashArray into an open-addressing hash
+    table with linear probing, records are inserted by rounds in a vectorized
+    way, slots are never freed so that each record is reached by probing from
+    its home slot without passing an empty slot
+    Return slotArray, the slot of each record
+    """
+    mask = np.uint64(tableSize-1)
+    isUsed = np.zeros(tableSize, dtype=bool)
+    slotArray = np.zeros(len(hashArray), dtype=np.uint64)
+    pendingIdx = np.arange(len(hashArray))
+    probe = hashArray & mask
+    while len(pendingIdx) > 0:
+        isFree = ~isUsed[probe]
+        # the first record of the round for each free slot gets the slot
+        (freeSlot, firstIdx) = np.unique(probe[isFree], return_index=True)
+        placedIdx = np.flatnonzero(isFree)[firstIdx]
+        slotArray[pendingIdx[placedIdx]] = freeSlot
+        isUsed[freeSlot] = True
+        isPending = np.ones(len(pendingIdx), dtype=bool)
+        isPending[placedIdx] = False
+        pendingIdx = pendingIdx[isPending]
+        probe = probe[isPending]
+        probe = np.where(isUsed[probe], (probe+np.uint64(1)) & mask, probe)
+    return slotArray
+#}}}
+def WriteIndex_hash(indexFileHeaderText, indexList, indexfile):#{{{
+    """
+    Write the index file in the hash format (FORMAT_HASH), see
+    HASH_INDEX_MAGIC for the layout
+    indexList is (idList, dbfileindex, offset, blocksize) as for other formats
+    """
+    idList = indexList[0]
+    numRecord = len(idList)
+    tableSize = 1
+    while tableSize < 2*numRecord:
+        tableSize *= 2
+    idBytesList = [idd.encode() for idd in idList]
+    idLength = np.array([len(x) for x in idBytesList], dtype=np.uint64)
+    idOffset = np.cumsum(idLength) - idLength
+    hashArray = np.fromiter((GetIDHash(x) for x in idBytesList),
+            dtype=np.uint64, count=numRecord)
+    slotArray = BuildHashTable(hashArray, tableSize)
+
+    table = np.zeros(tableSize, dtype=HASH_SLOT_DTYPE)
+    table['hash'][slotArray] = hashArray
+    table['offset'][slotArray] = np.asarray(indexList[2], dtype=np.uint64)
+    table['idoffset'][slotArray] = idOffset
+    table['size'][slotArray] = np.asarray(indexList[3], dtype=np.uint32)
+    table['idlength'][slotArray] = idLength
+    table['dbfile'][slotArray] = np.asarray(indexList[1], dtype=np.uint8)
+    table['used'][slotArray] = 1
+    dumpedtext = '\n'.join(indexFileHeaderText).encode()
+    # write to a temporary file and rename, so that a crash does not leave a
+    # broken index file
+    tmpfile = indexfile + ".tmp"
+    try:
+        with open(tmpfile, "wb") as fpindex:
+            fpindex.write(HASH_INDEX_MAGIC)
+            np.array([len(dumpedtext)], dtype='<u4').tofile(fpindex)
+            fpindex.write(dumpedtext)
+            np.array([numRecord, tableSize, int(idLength.sum())],
+                    dtype='<u8').tofile(fpindex)
+            table.tofile(fpindex)
+            slotArray.astype('<u8').tofile(fpindex)
+            fpindex.write(b"".join(idBytesList))
+        os.replace(tmpfile, indexfile)
+        return 0
+    except IOError:
+        msg = "Failed to write index file {}"
+        print(msg.format(indexfile), file=sys.stderr)
+        return 1
+#}}}
+class HashIndex: #{{{
+# Description:
+#   Index file in the hash format (FORMAT_HASH) accessed by mmap, a lookup
+#   reads only the probed slots of the table, so that the time to open the
+#   index does not depend on the number of records
+# variables:
+#     numRecord       :  number of records
+#     headerinfo      :  (dbname, version, ext, prefix)
+#     dbfileindexList :  list of db file indices
+#
+# Functions:
+#     Lookup(id)      : return (dbfileindex, offset, size) of the record,
+#                       or None if not found
+#     GetIDList()     : list of IDs in the order of the records
+#     GetIndexList()  : (idList, dbfileindex, offset, size) in the order of
+#                       the records, the same as returned by ReadIndex_binary
+
+    def __init__(self, indexfile, isPrintWarning = False):#{{{
+        self.failure = False
+        self.indexfile = indexfile
+        try:
+            with open(indexfile, "rb") as fpin:
+                self.mm = mmap.mmap(fpin.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, ValueError):
+            msg = "Failed to read index file {}"
+            print(msg.format(indexfile), file=sys.stderr)
+            self.failure = True
+            return None
+        mm = self.mm
+        pos = len(HASH_INDEX_MAGIC)
+        if mm[:pos] != HASH_INDEX_MAGIC:
+            msg = "Wrong format of the hash index file {}"
+            print(msg.format(indexfile), file=sys.stderr)
+            self.failure = True
+            return None
+        sizeText = int(np.frombuffer(mm, dtype='<u4', count=1, offset=pos)[0])
+        pos += 4
+        self.headerinfo = ParseIndexHeaderText(mm[pos:pos+sizeText].decode(),
+                indexfile, isPrintWarning)
+        pos += sizeText
+        (self.numRecord, self.tableSize, sizeIDBlob) = [int(x) for x in
+                np.frombuffer(mm, dtype='<u8', count=3, offset=pos)]
+        pos += 3*8
+        self.table = np.frombuffer(mm, dtype=HASH_SLOT_DTYPE,
+                count=self.tableSize, offset=pos)
+        pos += self.tableSize*HASH_SLOT_DTYPE.itemsize
+        self.slotArray = np.frombuffer(mm, dtype='<u8', count=self.numRecord,
+                offset=pos)
+        pos += self.numRecord*8
+        self.idBlobOffset = pos
+        if self.numRecord > 0:
+            lastDBFileIndex = int(self.table['dbfile'][
+                self.slotArray[self.numRecord-1]])
+        else:
+            lastDBFileIndex = 0
+        self.dbfileindexList = list(range(lastDBFileIndex+1))
+#}}}
+    def GetID(self, slot):#{{{
+        b = self.idBlobOffset + int(self.table['idoffset'][slot])
+        return self.mm[b:b+int(self.table['idlength'][slot])]
+#}}}
+    def Lookup(self, record_id):#{{{
+        if isinstance(record_id, str):
+            record_id = record_id.encode()
+        if self.tableSize < 1:
+            return None
+        h = GetIDHash(record_id)
+        mask = self.tableSize-1
+        slot = h & mask
+        while self.table['used'][slot]:
+            entry = self.table[slot]
+            if int(entry['hash']) == h and self.GetID(slot) == record_id:
+                return (int(entry['dbfile']), int(entry['offset']),
+                        int(entry['size']))
+            slot = (slot+1) & mask
+        return None
+#}}}
+    def GetIDList(self):#{{{
+        return [self.GetID(slot).decode() for slot in self.slotArray]
+#}}}
+    def GetIndexList(self):#{{{
+        entries = self.table[self.slotArray]
+        return [self.GetIDList(), array('B', entries['dbfile'].tolist()),
+                array('L', entries['offset'].tolist()),
+                array('I', entries['size'].tolist())]
+#}}}
+    def close(self):#{{{
+        try:
+            self.mm.close()
+        except (AttributeError, BufferError):
+            pass
+#}}}
+#}}}
+def ReadIndex_hash(indexfile, isPrintWarning = False):#{{{
+    """
+    Read the index file of the hash format to the same form as
+    ReadIndex_binary
+    """
+# return (indexList, headerinfo, dbfileindexList)
+    hashIndex = HashIndex(indexfile, isPrintWarning)
+    if hashIndex.failure:
+        return (None, None, None)
+    return (hashIndex.GetIndexList(), hashIndex.headerinfo,
+            hashIndex.dbfileindexList)
+#}}}
@@ -11,6 +11,7 @@ import sys
 import os
 import re
 import random
+import mmap
 import mydb_common
 import copy
 import subprocess
@@ -23,6 +24,9 @@ import logging
 import logging.config
 GAP = "-"
 BLOCK_SIZE = 100000 #set a good value for reading text file by block reading
+FASTA_BLOCK_SIZE = 1048576 # size of blocks decoded at once by ScanFastaBlock
+FASTA_WHITESPACE_TABLE = str.maketrans("", "", " \t\n\r\v\f")
+RE_TOPO_IO = re.compile('[io]') # end of a TM helix in GetTMPosition
 TZ = "Europe/Stockholm"
 FORMAT_DATETIME = "%Y-%m-%d %H:%M:%S %Z"
 logger = logging.getLogger(__name__)
@@ -258,17 +262,27 @@ class MyDB: #{{{
 #   A class to handle a database of dumped data. The content for each query id
 #   can be accessed quickly by GetRecord(id)
 # variables:
-#     indexedIDList  :  list of record IDs
+#     indexedIDList  :  list of record IDs, None if isMmap
+#     isMmap         :  if True, db files are memory-mapped, the index is read
+#                       to numpy arrays and IDs are looked up in the sorted
+#                       hash index file $dbname.sortedhash.npy, so that the
+#                       init time does not grow with a Python dict of all IDs
+#                       always True for the hash index format (FORMAT_HASH)
 # 
 # Functions:
 #     GetRecord(id)  : retrieve record for id, 
-#                      return None if failed
+#                      return None if failed, if isMmap a memoryview of the
+#                      db file is returned instead of a copy
+#     GetRecords(idList): retrieve records for a list of IDs with sorted and
+#                      coalesced reads, yield (id, record) in the order of
+#                      idList, record is None if failed
 #     GetAllRecord() : retrieve all records in the form of list
 
     def __init__(self, dbname, index_format = mydb_common.FORMAT_BINARY,#{{{
-                    isPrintWarning = False):
+                    isPrintWarning = False, isMmap = False):
 #        print "Init", dbname
         self.failure = False
+        self.isMmap = isMmap
         self.index_type = mydb_common.TYPE_DICT
         self.dbname = dbname
         self.dbname_basename = os.path.basename(dbname)
@@ -278,10 +292,20 @@ class MyDB: #{{{
         self.index_format = index_format
         self.isPrintWarning = isPrintWarning
         self.fpdbList = []
+        self.mmdbList = []
+        self.hashIndex = None
         (self.indexfile, self.index_format) =\
                         mydb_common.GetIndexFile(self.dbname_full,
                                         self.index_format)
-        if self.indexfile != "":
+        if self.index_format == mydb_common.FORMAT_HASH:
+            self.isMmap = True
+        if self.indexfile != "" and self.isMmap:
+            if self.InitMmap() == 1:
+                msg = "Init database {} with mmap failed."
+                print(msg.format(self.dbname_full), file=sys.stderr)
+                self.failure = True
+            return None
+        elif self.indexfile != "":
             (self.indexList, self.headerinfo, self.dbfileindexList) =\
                             self.ReadIndex(self.indexfile, self.index_format)
             if self.indexList == None:
@@ -307,18 +331,15 @@ class MyDB: #{{{
           #}}}
     def __del__(self):#{{{
 #        print "Leaving %s"%(self.dbname)
-        try: 
-            for fp in self.fpdbList:
-                fp.close()
-            return 0
-        except IOError:
-            print("Failed to close db file", file=sys.stderr)
+        self.close()
         #}}}
     def ReadIndex(self, indexfile, index_format):#{{{
 # return (headerinfo, dbfileindexList, index, idList)
 # return (indexList, headerinfo, dbfileindexList)
         if index_format == mydb_common.FORMAT_TEXT:
             return mydb_common.ReadIndex_text(indexfile, self.isPrintWarning)
+        elif index_format == mydb_common.FORMAT_HASH:
+            return mydb_common.ReadIndex_hash(indexfile, self.isPrintWarning)
         else:
             return mydb_common.ReadIndex_binary(indexfile, self.isPrintWarning)
 #}}}
@@ -331,6 +352,96 @@ class MyDB: #{{{
                 print("Failed to read dbfile %s"%(dbfile), file=sys.stderr)
                 return 1
         return 0
+#}}}
+    def InitMmap(self):#{{{
+        """Read the index to arrays, load the sorted hash index and map the
+        db files. For the hash index format, the index file is mapped and no
+        sorted hash index is needed"""
+        if self.index_format == mydb_common.FORMAT_HASH:
+            self.hashIndex = mydb_common.HashIndex(self.indexfile,
+                    self.isPrintWarning)
+            if self.hashIndex.failure:
+                return 1
+            self.headerinfo = self.hashIndex.headerinfo
+            self.dbfileindexList = self.hashIndex.dbfileindexList
+            self.indexedIDList = None
+            self.numRecord = self.hashIndex.numRecord
+            return self.OpenDBFile_mmap()
+        if self.index_format == mydb_common.FORMAT_TEXT:
+            (indexList, self.headerinfo, self.dbfileindexList) =\
+                    mydb_common.ReadIndex_text(self.indexfile,
+                            self.isPrintWarning)
+            if indexList == None:
+                return 1
+            indexArray = mydb_common.IndexListToArray(indexList)
+        else:
+            (indexArray, self.headerinfo, self.dbfileindexList) =\
+                    mydb_common.ReadIndex_binary_array(self.indexfile,
+                            self.isPrintWarning)
+            if indexArray == None:
+                return 1
+        (self.idBlob, self.idBegin, self.idEnd) = indexArray[:3]
+        self.indexList = [None] + list(indexArray[3:])
+        self.indexedIDList = None
+        self.numRecord = len(self.idBegin)
+        self.sortedHash = mydb_common.GetSortedHashIndex(self.dbname_full,
+                self.indexfile, self.idBlob, self.idBegin, self.idEnd)
+        return self.OpenDBFile_mmap()
+#}}}
+    def OpenDBFile_mmap(self):#{{{
+        for i in self.dbfileindexList:
+            dbfile = self.dbname_full + "%d.db"%(i)
+            try:
+                with open(dbfile, "rb") as fpdb:
+                    if os.path.getsize(dbfile) > 0:
+                        self.mmdbList.append(mmap.mmap(fpdb.fileno(), 0,
+                            access=mmap.ACCESS_READ))
+                    else:
+                        self.mmdbList.append(b"")
+            except (IOError, ValueError):
+                print("Failed to read dbfile %s"%(dbfile), file=sys.stderr)
+                return 1
+        return 0
+#}}}
+    def GetRecordLocation(self, record_id):#{{{
+        """Return (dbfileindex, offset, size) of the record, or None if
+        record_id is not in the index"""
+        if self.hashIndex != None:
+            return self.hashIndex.Lookup(record_id)
+        if self.isMmap:
+            idxItem = mydb_common.LookupSortedHashIndex(self.sortedHash,
+                    self.idBlob, self.idBegin, self.idEnd, record_id)
+        elif self.index_type == mydb_common.TYPE_DICT:
+            idxItem = self.indexDict.get(record_id, -1)
+        else:
+            try:
+                idxItem = self.indexedIDList.index(record_id)
+            except ValueError:
+                idxItem = -1
+        if idxItem < 0:
+            return None
+        return (int(self.indexList[1][idxItem]),
+                int(self.indexList[2][idxItem]),
+                int(self.indexList[3][idxItem]))
+#}}}
+    def ReadBlock(self, dbfileindex, offset, size):#{{{
+        """Read size bytes at offset of the db file, a memoryview of the
+        mapped file is returned if isMmap"""
+        if self.isMmap:
+            return memoryview(self.mmdbList[dbfileindex])[offset:offset+size]
+        fpdb = self.fpdbList[dbfileindex]
+        fpdb.seek(offset)
+        return fpdb.read(size)
+#}}}
+    def GetRecordByMmap(self, record_id):#{{{
+        location = self.GetRecordLocation(record_id)
+        try:
+            if location == None:
+                raise KeyError(record_id)
+            return self.ReadBlock(*location)
+        except (KeyError, IndexError):
+            print("Failed to retrieve record %s"%(record_id), file=sys.stderr)
+            return None
 #}}}
     def GetRecordByIndexList(self, record_id):#{{{
         try:
@@ -355,10 +466,57 @@ class MyDB: #{{{
             return None
 #}}}
     def GetRecord(self, record_id):#{{{
-        if self.index_type == mydb_common.TYPE_LIST:
+        if self.isMmap:
+            return self.GetRecordByMmap(record_id)
+        elif self.index_type == mydb_common.TYPE_LIST:
             return self.GetRecordByIndexList(record_id)
         elif self.index_type == mydb_common.TYPE_DICT:
             return self.GetRecordByIndexDict(record_id)
+#}}}
+    def GetRecords(self, record_idList, batchSize=10000, maxGap=65536,#{{{
+            maxReadSize=64*1024*1024):
+        """
+        Retrieve records for a list of IDs, yield (record_id, record) in the
+        order of record_idList, record is None if failed.
+        Records of each batch of batchSize IDs are read in the order of
+        (dbfile, offset), records less than maxGap bytes apart are read by
+        one read of at most maxReadSize bytes, so that a large list of IDs is
+        retrieved by mostly sequential I/O instead of one seek per ID
+        """
+        record_idList = list(record_idList)
+        for b in range(0, len(record_idList), batchSize):
+            batchIDList = record_idList[b:b+batchSize]
+            numID = len(batchIDList)
+            locationList = [self.GetRecordLocation(idd) for idd in batchIDList]
+            recordList = [None]*numID
+            order = sorted([i for i in range(numID) if locationList[i] != None],
+                    key=lambda i: locationList[i][:2])
+            k = 0
+            while k < len(order):
+                (dbfileindex, runBegin, size) = locationList[order[k]]
+                runEnd = runBegin + size
+                m = k + 1
+                while m < len(order):
+                    (dbf, offset, size) = locationList[order[m]]
+                    if (dbf != dbfileindex or offset > runEnd + maxGap or
+                            max(runEnd, offset+size) - runBegin > maxReadSize):
+                        break
+                    runEnd = max(runEnd, offset+size)
+                    m += 1
+                try:
+                    buff = self.ReadBlock(dbfileindex, runBegin,
+                            runEnd-runBegin)
+                    for i in order[k:m]:
+                        (dbf, offset, size) = locationList[i]
+                        recordList[i] = buff[offset-runBegin:
+                                offset-runBegin+size]
+                except (IndexError, IOError):
+                    for i in order[k:m]:
+                        print("Failed to retrieve record %s"%(batchIDList[i]),
+                                file=sys.stderr)
+                k = m
+            for i in range(numID):
+                yield (batchIDList[i], recordList[i])
 #}}}
     def GetAllRecord(self): #{{{
         recordList = []
@@ -369,6 +527,15 @@ class MyDB: #{{{
         try: 
             for fp in self.fpdbList:
                 fp.close()
+            for mm in self.mmdbList:
+                try:
+                    mm.close()
+                except (AttributeError, BufferError):
+                    # memoryviews of records still in use, the map is closed
+                    # when they are released
+                    pass
+            if self.hashIndex != None:
+                self.hashIndex.close()
             return 0
         except IOError:
             print("Failed to close db file", file=sys.stderr)
@@ -477,6 +644,8 @@ class MyMPASeq:#{{{
 
 class ReadFastaByBlock:#{{{
 # Description: Read fasta seq by BLOCK reading, 
+#   the file is memory mapped and each readseq() returns the records of a
+#   block of about BLOCK_SIZE located by ScanFastaBlock
 # Function: 
 #   readseq()
 #   close()
@@ -498,67 +667,84 @@ class ReadFastaByBlock:#{{{
         self.failure = False
         self.filename = infile
         self.BLOCK_SIZE = BLOCK_SIZE
-        self.isEOFreached = False
         self.method_seqid = method_seqid
         self.method_seq = method_seq
+        self.fpin = None
+        self.buff = b""
         if infile.endswith('.gz'):
             self.filetype = 'gzip'
         else:
             self.filetype = 'text'
 
-        if self.filetype == 'text':
-            try: 
-                self.fpin = open(infile, "r")
-            except IOError:
-                print("Failed to read file %s"%(self.filename), file=sys.stderr)
-                self.failure = True
-                return None
-        elif self.filetype == 'gzip':
-            try: 
+        try:
+            if self.filetype == 'gzip':
+                # the decompressed content is read block by block
                 self.fpin = gzip.open(infile, "rb")
-            except IOError:
-                print("Failed to read file %s"%(self.filename), file=sys.stderr)
-                self.failure = True
-                return None
-        else:
-            print("Unrecognized filetype for the inputfile %s"%(self.filename), file=sys.stderr)
+                self.isEOFreached = False
+            else:
+                self.buff = OpenFastaBuffer(infile)
+                self.isEOFreached = True
+        except (IOError, OSError):
+            print("Failed to read file %s"%(self.filename), file=sys.stderr)
             self.failure = True
             return None
-
-        self.unprocessedBuff = ""
+        self.readSize = BLOCK_SIZE
+        self.tailBeg = 0 # beginning of the unprocessed part of self.buff
+        self.blockIter = ScanFastaBlock(self.buff,
+                isEOFreached=self.isEOFreached, BLOCK_SIZE=BLOCK_SIZE)
 #}}}
     def __del__(self):#{{{
         try:
-            self.fpin.close()
-        except IOError:
-            print("Failed to close file %s"%(self.filename), file=sys.stderr)
-            return 1
+            self.close()
+        except AttributeError:
+            pass
 #}}}
     def close(self):#{{{
         try:
-            self.fpin.close()
+            if self.fpin != None:
+                self.fpin.close()
+            CloseFastaBuffer(self.buff)
         except IOError:
             print("Failed to close file %s"%(self.filename), file=sys.stderr)
             return 1
 #}}}
-    def readseq(self):#{{{
-        if self.isEOFreached and not self.unprocessedBuff:
-            return None
+    def readblock(self, isGrow):#{{{
+        """
+        Read the next block of the gzip file, the unprocessed part of
+        self.buff is kept. The block size is doubled when no record is
+        complete in the previous block (isGrow), so that a long record is read
+        in linear time
+        """
+        if isGrow:
+            self.readSize *= 2
         else:
-            buff = self.fpin.read(self.BLOCK_SIZE)
-            if not buff:
-                self.isEOFreached = True
-            if self.unprocessedBuff:
-                buff = self.unprocessedBuff + buff
-
-            tmpRecordList = []
-            self.unprocessedBuff = ReadFastaFromBuffer(buff, tmpRecordList,
-                    self.isEOFreached, self.method_seqid, self.method_seq)
-            recordList = []
-            for rd in tmpRecordList:
-                rdc = MySeq(rd[0], rd[1], rd[2])
-                recordList.append(rdc)
-            return recordList
+            self.readSize = self.BLOCK_SIZE
+        buff = self.fpin.read(self.readSize)
+        if not buff:
+            self.isEOFreached = True
+        self.buff = self.buff[self.tailBeg:] + buff
+        self.tailBeg = 0
+        self.blockIter = ScanFastaBlock(self.buff,
+                isEOFreached=self.isEOFreached, BLOCK_SIZE=self.BLOCK_SIZE)
+#}}}
+    def readseq(self):#{{{
+        isGrow = False
+        while True:
+            item = next(self.blockIter, None)
+            if item != None:
+                break
+            if self.isEOFreached:
+                return None
+            self.readblock(isGrow)
+            isGrow = True
+        (recList, end) = item
+        self.tailBeg = end + 1
+        recordList = []
+        for rec in recList:
+            (seqid, anno, seq) = DecodeFastaRecord(rec, self.method_seqid,
+                    self.method_seq)
+            recordList.append(MySeq(seqid, anno, seq))
+        return recordList
 #}}}
 #}}}
 
@@ -1632,223 +1818,155 @@ def GetRemainPos(segPosList, length):#{{{
     return remainPosList
 #}}}
 
+def OpenFastaBuffer(infile):#{{{
+    """
+    Map the file infile into memory for ScanFastaBlock, an empty file gives
+    b"" since it can not be mapped
+    Raise IOError if infile can not be read
+    """
+    with open(infile, "rb") as fpin:
+        try:
+            return mmap.mmap(fpin.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b""
+#}}}
+def CloseFastaBuffer(buff):#{{{
+    """Close the buffer opened by OpenFastaBuffer"""
+    if isinstance(buff, mmap.mmap):
+        buff.close()
+#}}}
+def ScanFastaBlock(buff, beg=0, isEOFreached=True, #{{{
+        BLOCK_SIZE=FASTA_BLOCK_SIZE):
+    """
+    Scan FASTA records in buff (str, bytes or mmap) from the offset beg, block
+    by block. The boundary of each block of about BLOCK_SIZE is located by
+    find(), so that the records of a block are decoded and split at once and
+    records are never joined from pieces
+    Yield (recList, end), recList is the list of record texts (without the
+    leading '>') of buff[beg:end], to be parsed by DecodeFastaRecord, buff[end]
+    is the newline before the next record
+    Text before the first '>' is ignored. If isEOFreached is False, the last
+    record is not yielded since it may continue in the next block, it begins
+    at the last end+1
+    """
+    if isinstance(buff, str):
+        (char_beg, sep) = (">", "\n>")
+    else:
+        (char_beg, sep) = (b">", b"\n>")
+    size = len(buff)
+    beg = buff.find(char_beg, beg)
+    while beg >= 0:
+        end = buff.find(sep, beg+BLOCK_SIZE)
+        if end < 0:
+            if isEOFreached:
+                end = size
+            else:
+                end = buff.rfind(sep, beg)
+                if end < 0:
+                    return
+        block = buff[beg+1:end]
+        if not isinstance(block, str):
+            block = block.decode('utf-8', 'replace')
+        yield (block.split("\n>"), end)
+        if end >= size:
+            return
+        beg = end + 1
+#}}}
+def DecodeFastaRecord(rec, method_seqid=1, method_seq=0):#{{{
+    """
+    Get (seqID, anno, seq) of the record text rec from ScanFastaBlock, white
+    spaces in the sequence are removed
+    method_seqid (default: 1):
+        None: seqID is not parsed, return None for seqID
+        0: just get the first word in the description line
+        1: more complicated way
+    method_seq (default: 0)
+        0: simple fasta format
+        1: extended fasta format, additional information may be added after
+           sequence and enclosed by {}
+    """
+    (anno, tmp, seq) = rec.partition("\n")
+    anno = anno.rstrip("\r")
+    seq = seq.replace("\n", "")
+    if (" " in seq or "\r" in seq or "\t" in seq or "\v" in seq
+            or "\f" in seq):
+        seq = seq.translate(FASTA_WHITESPACE_TABLE)
+    if method_seq == 1:
+        b = seq.find('{')
+        if b >= 0:
+            e = seq.rfind('}')
+            if e > b:
+                seq = seq[:b] + seq[e+1:]
+    seqID = None
+    if method_seqid != None:
+        seqID = GetSeqIDFromAnnotation(anno, method_seqid)
+    return (seqID, anno, seq)
+#}}}
+def IterFastaRecord(infile, method_seqid=1, method_seq=0):#{{{
+    """
+    Generator of the records (seqID, anno, seq) of the FASTA file infile,
+    the file is memory mapped and decoded block by block
+    See DecodeFastaRecord for method_seqid and method_seq
+    Raise IOError if infile can not be read
+    """
+    buff = OpenFastaBuffer(infile)
+    try:
+        for (recList, end) in ScanFastaBlock(buff):
+            for rec in recList:
+                yield DecodeFastaRecord(rec, method_seqid, method_seq)
+    finally:
+        CloseFastaBuffer(buff)
+#}}}
 def ReadFasta(infile, BLOCK_SIZE=100000):#{{{
     """
     Read sequence file in FASTA format
+    BLOCK_SIZE is not used, it is kept for compatibility
     """
     idList=[]
     annotationList=[]
     seqList=[]
-    fpin = None
     try:
-        fpin=open(infile,"r")
+        for (seqID, anno, seq) in IterFastaRecord(infile):
+            idList.append(seqID)
+            annotationList.append(anno.lstrip('>'))
+            seqList.append(seq)
     except IOError:
         print("Failed to read fasta file %s "%(infile), file=sys.stderr)
         return ([], [], [])
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-
-                    idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-                    annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-                    annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
-
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-        annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-        seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-    fpin.close()
     return (idList, annotationList, seqList)
 #}}}
 def ReadFasta_without_annotation(infile, BLOCK_SIZE=100000):#{{{
     idList=[]
     seqList=[]
-    fpin = None
     try:
-        fpin=open(infile,"r")
+        for (seqID, anno, seq) in IterFastaRecord(infile):
+            idList.append(seqID)
+            seqList.append(seq)
     except IOError:
         print("Failed to read file %s."%(infile), file=sys.stderr)
         return (None, None)
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-
-                    idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
-
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-        seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-    fpin.close();   
     return (idList, seqList)
 #}}}
 def ReadFasta_without_id(infile, BLOCK_SIZE=100000):#{{{
     annotationList=[]
     seqList=[]
-    fpin = None
     try:
-        fpin=open(infile,"r")
+        for (seqID, anno, seq) in IterFastaRecord(infile, method_seqid=None):
+            annotationList.append(anno.lstrip('>'))
+            seqList.append(seq)
     except IOError:
         print("Failed to open file %s for read"%(infile), file=sys.stderr)
         return (None, None)
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-
-                    annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
-
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-        seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-    fpin.close();
     return (annotationList, seqList)
 #}}}
 def ReadFasta_simple(infile, BLOCK_SIZE=100000):#{{{
     seqList=[]
-    fpin = None
     try:
-        fpin=open(infile,"r")
+        for (seqID, anno, seq) in IterFastaRecord(infile, method_seqid=None):
+            seqList.append(seq)
     except IOError:
         print("Failed to open file %s for read"%(infile), file=sys.stderr)
         return None
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    seqList.append(seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
-
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        seqList.append(seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-    fpin.close();   
     return seqList
 #}}}
 
@@ -2044,32 +2162,14 @@ def ReadFastaFromBuffer(buff,recordList, isEOFreached, #{{{
     """
     if not buff:
         return ""
-    unprocessedBuffer=""
-    beg=0
-    end=0
-    while 1:
-        beg=buff.find(">",beg)
-        if beg >= 0:
-            end=buff.find("\n>",beg+1)
-            if end >=0:
-                seqWithAnno=buff[beg:end]
-                (seqid, seqanno, seq) =  ExtractFromSeqWithAnno(seqWithAnno, method_seqid, method_seq)
-                if not seq is None:
-                    recordList.append((seqid, seqanno, seq))
-                beg=end
-            else:
-                unprocessedBuffer = buff[beg:]
-                break
-        else:
-            unprocessedBuffer=buff[end:]
-            break
-    if isEOFreached and unprocessedBuffer:
-        seqWithAnno = unprocessedBuffer
-        (seqid, seqanno, seq) =  ExtractFromSeqWithAnno(seqWithAnno, method_seqid, method_seq)
-        if not seq is None:
-            recordList.append((seqid, seqanno, seq))
-        unprocessedBuffer = ""
-    return unprocessedBuffer
+    tailBeg = 0
+    for (recList, end) in ScanFastaBlock(buff, isEOFreached=isEOFreached):
+        for rec in recList:
+            recordList.append(DecodeFastaRecord(rec, method_seqid, method_seq))
+        tailBeg = end + 1
+    if isEOFreached:
+        return ""
+    return buff[tailBeg:]
 #}}}
 def ReadMPAFromBuffer(buff,recordList, isEOFreached, #{{{
         method_seqid=1, method_seq=0):
@@ -2085,30 +2185,15 @@ def ReadMPAFromBuffer(buff,recordList, isEOFreached, #{{{
     """
     if not buff:
         return ""
-    unprocessedBuffer=""
-    beg=0
-    end=0
-    while 1:
-        beg=buff.find(">",beg)
-        if beg >= 0:
-            end=buff.find("\n>",beg+1)
-            if end >=0:
-                seqWithAnno=buff[beg:end]
-                recordList.append(ExtractFromSeqWithAnno_MPA(seqWithAnno,
-                    method_seqid, method_seq))
-                beg=end
-            else:
-                unprocessedBuffer = buff[beg:]
-                break
-        else:
-            unprocessedBuffer=buff[end:]
-            break
-    if isEOFreached and unprocessedBuffer:
-        seqWithAnno = unprocessedBuffer
-        recordList.append(ExtractFromSeqWithAnno_MPA(seqWithAnno, method_seqid,
-            method_seq))
-        unprocessedBuffer = ""
-    return unprocessedBuffer
+    tailBeg = 0
+    for (recList, end) in ScanFastaBlock(buff, isEOFreached=isEOFreached):
+        for rec in recList:
+            recordList.append(ExtractFromSeqWithAnno_MPA(">"+rec,
+                method_seqid, method_seq))
+        tailBeg = end + 1
+    if isEOFreached:
+        return ""
+    return buff[tailBeg:]
 #}}}
 
 def coverage(a1,b1,a2,b2):#{{{
@@ -2220,13 +2305,13 @@ def GetFirstTMPosition(topo):#{{{
     lengthTopo = len(topo)
     b = topo.find('M',0)
     if b != -1:
-        m = re.search('[io]', topo[b+1:])
+        m = RE_TOPO_IO.search(topo, b+1)
         if m != None:
-            e = m.start(0)+b+1
+            e = m.start(0)
         else:
             e = lengthTopo
         if topo[e-1] == GAP:
-            e = topo[:e-1].rfind('M')+1
+            e = topo.rfind('M', b, e-1)+1
         if b == e:
             print("Error! topo[b-30:e+30]=", topo[b-30:e+30])
             return (-1,-1)
@@ -2240,6 +2325,7 @@ def GetTMPosition(topo):#{{{
     Get position of TM helices given a topology
     this version is much faster (~25 times) than using than finditer
     updated 2011-10-24
+    For a list of topologies, libtopologycmp.GetTMPositionList is faster
     """
     posTM=[]
     lengthTopo=len(topo)
@@ -2248,13 +2334,13 @@ def GetTMPosition(topo):#{{{
     while 1:
         b=topo.find('M',e)
         if b != -1:
-            m = re.search('[io]', topo[b+1:])
+            m = RE_TOPO_IO.search(topo, b+1)
             if m != None:
-                e = m.start(0)+b+1
+                e = m.start(0)
             else:
                 e=lengthTopo
             if topo[e-1] == GAP:
-                e=topo[:e-1].rfind('M')+1
+                e=topo.rfind('M', b, e-1)+1
 #           print (b,e)
             if b == e:
                 print("Error topo[b-10:e+10]=", topo[b-30:e+30])
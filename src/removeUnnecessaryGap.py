@@ -10,8 +10,15 @@ import myfunc
 @click.argument('alnfile')
 @click.option('--outfile', default="", help='write the output to file')
 @click.option('--method', default=1, help='0 for slower method, 1 for faster method')
+@click.option('--stream', is_flag=True, default=False,
+        help='read the alignment file by block twice instead of loading it in memory, for very large alignments')
 
-def action(method, alnfile, outfile):
+def action(method, stream, alnfile, outfile):
+    if stream:
+        if lcmp.RemoveUnnecessaryGapInFile(alnfile, outfile) is None:
+            click.echo("Failed to remove unnecessary gaps in %s"%(alnfile))
+            return 1
+        return 0
     (seqidList, seqAnnoList, seqList) = myfunc.ReadFasta(alnfile)
     if (method == 0):
         newSeqList = lcmp.RemoveUnnecessaryGap_old(seqList)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# check or record a stage of topoana_TMpro.sh in the manifest of a family
+import sys
+import os
+import myfunc
+import libpipeline
+
+progname =  os.path.basename(sys.argv[0])
+wspace = ''.join([" "]*len(progname))
+usage="""
+Usage:  %s -check|-record|-forget -manifest FILE -stage STR
+        %s [-i FILE [-i FILE ...]] [-o FILE [-o FILE ...]] [-param STR]
+Options:
+  -check           Check whether the stage is up to date, exit with 0 if it
+                   is up to date and 1 if it has to be run
+  -record          Record the stage after it has been run, exit with 1 if
+                   any of the outputs is missing
+  -forget          Remove the stage from the manifest, e.g. after it failed,
+                   so that it is run next time
+  -manifest FILE   Manifest of the family, e.g. $outpath/$id.manifest.json
+  -stage     STR   Name of the stage
+  -i        FILE   Input file of the stage, can be given multiple times
+  -o        FILE   Output file of the stage, can be given multiple times
+  -param     STR   Parameters of the stage, the stage is rerun if changed
+  -q               Quiet mode
+  -h, --help       Print this help message and exit
+
+Created 2026-10-18
+
+Examples:
+    %s -check -manifest PF00032.manifest.json -stage cleantopo \\
+            -i PF00032.topo -o PF00032.cleaned.topo -param "-min-rlty 0"
+"""%(progname, wspace, progname)
+
+def PrintHelp():
+    print(usage)
+
+def main(g_params):#{{{
+    argv = sys.argv
+    numArgv = len(argv)
+    if numArgv < 2:
+        PrintHelp()
+        return 1
+
+    action = ""
+    manifestfile = ""
+    stage = ""
+    inFileList = []
+    outFileList = []
+    param = ""
+
+    i = 1
+    isNonOptionArg=False
+    while i < numArgv:
+        if isNonOptionArg == True:
+            print("Error! Wrong argument:%s"%(argv[i]), file=sys.stderr)
+            return 1
+        elif argv[i] == "--":
+            isNonOptionArg = True
+            i += 1
+        elif argv[i][0] == "-":
+            if argv[i] in ["-h", "--help"]:
+                PrintHelp()
+                return 1
+            elif argv[i] in ["-check", "--check"]:
+                action = "check"
+                i += 1
+            elif argv[i] in ["-record", "--record"]:
+                action = "record"
+                i += 1
+            elif argv[i] in ["-forget", "--forget"]:
+                action = "forget"
+                i += 1
+            elif argv[i] in ["-manifest", "--manifest"]:
+                (manifestfile, i) = myfunc.my_getopt_str(argv, i)
+            elif argv[i] in ["-stage", "--stage"]:
+                (stage, i) = myfunc.my_getopt_str(argv, i)
+            elif argv[i] in ["-i", "--i", "-infile", "--infile"]:
+                (tmpstr, i) = myfunc.my_getopt_str(argv, i)
+                inFileList.append(tmpstr)
+            elif argv[i] in ["-o", "--o", "-outfile", "--outfile"]:
+                (tmpstr, i) = myfunc.my_getopt_str(argv, i)
+                outFileList.append(tmpstr)
+            elif argv[i] in ["-param", "--param"]:
+                # parameters start often with '-', so my_getopt_str is not
+                # used
+                if i+1 >= numArgv:
+                    print("Error! option '%s' must be followed by a string"%(
+                        argv[i]), file=sys.stderr)
+                    return 1
+                param = argv[i+1]
+                i += 2
+            elif argv[i] in ["-q", "--q"]:
+                g_params['isQuiet'] = True
+                i += 1
+            else:
+                print("Error! Wrong argument:%s"%(argv[i]), file=sys.stderr)
+                return 1
+        else:
+            print("Error! Wrong argument:%s"%(argv[i]), file=sys.stderr)
+            return 1
+
+    if action == "":
+        print("Error! None of -check, -record and -forget is set.",
+                file=sys.stderr)
+        return 1
+    if manifestfile == "" or stage == "":
+        print("Error! manifest or stage not set.", file=sys.stderr)
+        return 1
+
+    manifest = libpipeline.ReadManifest(manifestfile)
+    if action == "check":
+        reason = libpipeline.GetStageChange(manifest, stage, inFileList,
+                outFileList, param)
+        if reason == "":
+            if not g_params['isQuiet']:
+                print("Stage %s is up to date, skipped"%(stage))
+            return 0
+        if not g_params['isQuiet']:
+            print("Stage %s to be run: %s"%(stage, reason))
+        return 1
+    elif action == "forget":
+        libpipeline.ForgetStage(manifest, stage)
+        return libpipeline.WriteManifest(manifestfile, manifest)
+    else:
+        missingList = libpipeline.RecordStage(manifest, stage, inFileList,
+                outFileList, param)
+        if libpipeline.WriteManifest(manifestfile, manifest) != 0:
+            return 1
+        if len(missingList) > 0:
+            print("Stage %s not recorded, missing output %s"%(stage,
+                " ".join(missingList)), file=sys.stderr)
+            return 1
+        return 0
+#}}}
+
+def InitGlobalParameter():#{{{
+    g_params = {}
+    g_params['isQuiet'] = False
+    return g_params
+#}}}
+if __name__ == '__main__' :
+    g_params = InitGlobalParameter()
+    sys.exit(main(g_params))
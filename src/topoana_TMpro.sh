@@ -25,6 +25,9 @@
 #    renamed_msaInFastaFormat is cleaned after running
 # ChangeLog 2014-09-26
 #    add the option, -forcewrite
+# ChangeLog 2026-10-18
+#    steps of anamode 2 are recorded in the manifest $outpath/$id.manifest.json
+#    and skipped when their inputs and parameters are unchanged
 #}}}
 
 progname=`basename $0`
@@ -93,7 +96,8 @@ Options:
                       Topology file at \$datapath/\$id.topo
                       Msafile at \$datapath/\$id.msa.fa
     -startfrom INT    Start from step N.
-    -forcewrite       Force overwrite the existing result
+    -forcewrite       Force overwrite the existing result, steps recorded as
+                      up to date in the manifest are also run
     -min-rlty  FLOAT  Miminum reliability score
     -mcmp      INT    method for compareMSATopo
     -maxseq    INT    Set maximum number of sequences to be kept in the
@@ -113,6 +117,12 @@ Notes:
 
 to add arguments for FastTree using the flag -fasttree-args
 
+For anamode 2, the content digest of the inputs and the parameters of each
+step are recorded in \$outpath/\$id.manifest.json (see runstage.py). A step
+is skipped if it has been run on the same inputs and parameters and its
+outputs are unchanged, so that rerunning a set of families after a database
+update only recomputes the families whose sequences or topologies changed.
+
 
 "
 #export  GDFONTPATH=$DATADIR3/fonts/msttcorefonts/ 
@@ -149,8 +159,66 @@ IsAllSeqIDUnique(){ #{{{
 }
 #}}}
 exec_cmd(){ #{{{
+    # return the exit status of the command
     echo "$*"
     eval "$*"
+    return $?
+}
+#}}}
+RunStageManifest(){ #{{{
+    # usage: RunStageManifest -check|-record|-forget id stage "infile ..." "outfile ..." "param"
+    # check, record or forget a stage in the manifest $outpath/$id.manifest.json
+    local action=$1
+    local id=$2
+    local stage=$3
+    local param=$6
+    local args=()
+    local f
+    for f in $4; do
+        args+=(-i $f)
+    done
+    for f in $5; do
+        args+=(-o $f)
+    done
+    python $binpath/runstage.py $action -manifest $outpath/$id.manifest.json \
+        -stage $stage "${args[@]}" -param "$param"
+}
+#}}}
+IsStageUpToDate(){ #{{{
+    # usage: IsStageUpToDate id stage "infile ..." "outfile ..." "param"
+    # return 0 if the stage has been run on inputs with the same content and
+    # with the same parameters, and its outputs are unchanged. All stages are
+    # run with -forcewrite
+    if [ "$isOverwrite" == "1" ]; then
+        return 1
+    fi
+    RunStageManifest -check "$@"
+}
+#}}}
+RecordStage(){ #{{{
+    # usage: RecordStage id stage "infile ..." "outfile ..." "param"
+    RunStageManifest -record "$@"
+}
+#}}}
+ForgetStage(){ #{{{
+    # usage: ForgetStage id stage
+    # remove the stage from the manifest, so that it is run next time
+    RunStageManifest -forget $1 $2 "" "" ""
+}
+#}}}
+FinishStage(){ #{{{
+    # usage: FinishStage status id stage "infile ..." "outfile ..." "param"
+    # record the stage if all its commands succeeded (status 0), otherwise
+    # forget it, so that outputs of a previous run are not recorded against
+    # the new inputs
+    local status=$1
+    shift
+    if [ "$status" == "0" ]; then
+        RecordStage "$@"
+    else
+        echo Stage $2 failed for $1, not recorded in the manifest >&2
+        ForgetStage $1 $2
+    fi
 }
 #}}}
 RunTopoAna(){ #{{{
@@ -279,6 +347,7 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
     # == updated 2011-11-16
     local id=$1
     local fastaFile=$datapath/${id}${ext_fa}
+    local stageStatus=0 # 0 if all commands of the current stage succeeded
 
     if [ ! -s "$fastaFile" ]; then 
         echo seqfile \'$fastaFile\' does not exist or empty. Ignore. >&2
@@ -341,14 +410,24 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
                 echo Failed to predict topology for ID $id. Ignore. >&2
                 return 1
             fi
-            echo Step 2: Remove non TM proteins...
-            exec_cmd "python $binpath/cleanSingleSpanTMPro.py $topoFile -mintm 1 -o $topoFile_cleaned"
-
-            local tmp_topoFile=$topoFile.tmp
-            /bin/cp -f $topoFile_cleaned $tmp_topoFile
-            echo Step 3: remove TMpros predicted with reliability score smaller $MIN_RLTY
-            exec_cmd "python $binpath/cleanTMPro_by_RLTY.py $tmp_topoFile -min-rlty $MIN_RLTY  -o $topoFile_cleaned"
-            rm -f $tmp_topoFile
+            if IsStageUpToDate $id cleantopo "$topoFile" "$topoFile_cleaned" \
+                "-mintm 1 -min-rlty $MIN_RLTY"; then
+                echo Step 2: cleaned topology of $id is up to date
+            else
+                stageStatus=0
+                echo Step 2: Remove non TM proteins...
+                exec_cmd "python $binpath/cleanSingleSpanTMPro.py $topoFile -mintm 1 -o $topoFile_cleaned" \
+                    || stageStatus=1
+
+                local tmp_topoFile=$topoFile.tmp
+                /bin/cp -f $topoFile_cleaned $tmp_topoFile || stageStatus=1
+                echo Step 3: remove TMpros predicted with reliability score smaller $MIN_RLTY
+                exec_cmd "python $binpath/cleanTMPro_by_RLTY.py $tmp_topoFile -min-rlty $MIN_RLTY  -o $topoFile_cleaned" \
+                    || stageStatus=1
+                rm -f $tmp_topoFile
+                FinishStage $stageStatus $id cleantopo "$topoFile" "$topoFile_cleaned" \
+                    "-mintm 1 -min-rlty $MIN_RLTY"
+            fi
         fi
         # step 3. Get cleaned amino acid sequences
         local tmpcleanedidlistfile=$outpath/$id.cleaned.idlist 
@@ -358,10 +437,17 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
                 echo Failed to clean the topology for ID $id. Ignore. >&2
                 return 1
             fi
-            python $binpath/getfastaid.py $topoFile_cleaned -o $tmpcleanedidlistfile
-            python $binpath/selectfastaseq.py -f $fastaFile -l $tmpcleanedidlistfile \
-                -o $fastaFile_cleaned
-            rm -f $tmpcleanedidlistfile
+            if ! IsStageUpToDate $id cleanfasta "$topoFile_cleaned $fastaFile" \
+                "$fastaFile_cleaned" ""; then
+                stageStatus=0
+                python $binpath/getfastaid.py $topoFile_cleaned -o $tmpcleanedidlistfile \
+                    || stageStatus=1
+                python $binpath/selectfastaseq.py -f $fastaFile -l $tmpcleanedidlistfile \
+                    -o $fastaFile_cleaned || stageStatus=1
+                rm -f $tmpcleanedidlistfile
+                FinishStage $stageStatus $id cleanfasta "$topoFile_cleaned $fastaFile" \
+                    "$fastaFile_cleaned" ""
+            fi
         fi
         # Step 4 limit the number of sequences to MAX_NUM_SEQ
         local limitedFastaFile_cleaned=$outpath/$id.homology.cleaned.le${MAX_NUM_SEQ}.fa
@@ -370,55 +456,71 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
                 echo Failed to get cleaned fasta seq file for ID $id. Ignore. >&2
                 return 1
             fi
-            local tmpnrfastafile=$outpath/$id.homology.cdhit.nr.fa.tmp
-            $cdhit_bin/cd-hit -i $fastaFile_cleaned -o $tmpnrfastafile -c 1.0
-            if [ ! -s "$tmpnrfastafile" ]; then 
-                echo cd-hit failed for ID $id. just copy the fastaFile_cleaned >&2
-                /bin/cp -f $fastaFile_cleaned $tmpnrfastafile
+            local numseq
+            if IsStageUpToDate $id cdhit "$fastaFile_cleaned" \
+                "$limitedFastaFile_cleaned" "-maxseq $MAX_NUM_SEQ"; then
+                numseq=`python $binpath/countseq.py -nf $limitedFastaFile_cleaned`
+            else
+                stageStatus=0
+                local tmpnrfastafile=$outpath/$id.homology.cdhit.nr.fa.tmp
+                $cdhit_bin/cd-hit -i $fastaFile_cleaned -o $tmpnrfastafile -c 1.0
+                if [ ! -s "$tmpnrfastafile" ]; then 
+                    echo cd-hit failed for ID $id. just copy the fastaFile_cleaned >&2
+                    /bin/cp -f $fastaFile_cleaned $tmpnrfastafile || stageStatus=1
+                fi
+                numseq=`python $binpath/countseq.py -nf $tmpnrfastafile`
+                if [ $numseq -gt 1 ]; then 
+                    if [ $numseq -gt $MAX_NUM_SEQ ] ; then 
+                        # decrease the sequence identity threshold until 
+                        # threshold >=0.75 or numseq <= MAX_NUM_SEQ
+                        local tmpfile=$(mktemp /tmp/tmp.$progname.XXXXXXXXX) \
+                            || { echo Failed to create temp file >&2; exit 1; }   
+                        min_pid_threshold=75
+                        pid_threshold=95
+                        while [ 1 ] ; do
+                            if [ $pid_threshold -lt $min_pid_threshold ]; then 
+                                break
+                            fi
+                            if [ $numseq -le $MAX_NUM_SEQ ]; then 
+                                break
+                            fi
+                            seqidt_threshold=`$binpath/e $pid_threshold / 100.0` 
+                            $cdhit_bin/cd-hit -i $tmpnrfastafile -o $tmpfile \
+                                -c $seqidt_threshold || stageStatus=1
+                            /bin/mv -f $tmpfile $tmpnrfastafile || stageStatus=1
+                            ((pid_threshold-=5))
+                            numseq=`python $binpath/countseq.py -nf $tmpnrfastafile`
+                        done 
+
+                        # if still too many sequences, randomly select $MAX_NUM_SEQ of
+                        # sequences
+                        if [ $numseq -gt $MAX_NUM_SEQ ]; then 
+                            python $binpath/randfasta.py -i $tmpnrfastafile -n $MAX_NUM_SEQ \
+                                -o $limitedFastaFile_cleaned || stageStatus=1
+                        else
+                            /bin/cp -f $tmpnrfastafile $limitedFastaFile_cleaned \
+                                || stageStatus=1
+                        fi
+                        /bin/rm -f $tmpfile
+                    else 
+                        /bin/cp -f $tmpnrfastafile $limitedFastaFile_cleaned \
+                            || stageStatus=1
+                    fi
+                fi
+                #remove tmpfiles produced by cd-hit
+                /bin/rm -f ${tmpnrfastafile}*
+                if [ $numseq -gt 1 ]; then
+                    FinishStage $stageStatus $id cdhit "$fastaFile_cleaned" \
+                        "$limitedFastaFile_cleaned" "-maxseq $MAX_NUM_SEQ"
+                else
+                    ForgetStage $id cdhit
+                fi
             fi
-            local numseq=`python $binpath/countseq.py -nf $tmpnrfastafile`
             if [ $numseq -le 1 ]; then 
                 echo Too few \($numseq\) sequences in the cleaned topology file \
                     for ID $id. Ignore. >&2
                 return 1
-            else
-                if [ $numseq -gt $MAX_NUM_SEQ ] ; then 
-                    # decrease the sequence identity threshold until 
-                    # threshold >=0.75 or numseq <= MAX_NUM_SEQ
-                    local tmpfile=$(mktemp /tmp/tmp.$progname.XXXXXXXXX) \
-                        || { echo Failed to create temp file >&2; exit 1; }   
-                    min_pid_threshold=75
-                    pid_threshold=95
-                    while [ 1 ] ; do
-                        if [ $pid_threshold -lt $min_pid_threshold ]; then 
-                            break
-                        fi
-                        if [ $numseq -le $MAX_NUM_SEQ ]; then 
-                            break
-                        fi
-                        seqidt_threshold=`$binpath/e $pid_threshold / 100.0` 
-                        $cdhit_bin/cd-hit -i $tmpnrfastafile -o $tmpfile \
-                            -c $seqidt_threshold
-                        /bin/mv -f $tmpfile $tmpnrfastafile
-                        ((pid_threshold-=5))
-                        numseq=`python $binpath/countseq.py -nf $tmpnrfastafile`
-                    done 
-
-                    # if still too many sequences, randomly select $MAX_NUM_SEQ of
-                    # sequences
-                    if [ $numseq -gt $MAX_NUM_SEQ ]; then 
-                        python $binpath/randfasta.py -i $tmpnrfastafile -n $MAX_NUM_SEQ \
-                            -o $limitedFastaFile_cleaned
-                    else
-                        /bin/cp -f $tmpnrfastafile $limitedFastaFile_cleaned
-                    fi
-                    /bin/rm -f $tmpfile
-                else 
-                    /bin/cp -f $tmpnrfastafile $limitedFastaFile_cleaned
-                fi
             fi
-            #remove tmpfiles produced by cd-hit
-            /bin/rm -f ${tmpnrfastafile}*
         fi
 
         local msaInFastaFormat=${limitedFastaFile_cleaned%.*}.$msaProg.fasta
@@ -427,27 +529,37 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
                 echo Failed to get limited sequences for ID $id. Ignore. >&2
                 return 1
             fi
-            echo  Step 5: Running multiple sequence alignment for \
-                $limitedFastaFile_cleaned...
-            case $msaProg in 
-                kalignp)
-                    $run_kalignP_path/run_kalignP.sh  $limitedFastaFile_cleaned  \
-                        -f fasta -outpath $outpath -q 2> $errFile
-                    if [ -s $errFile -a ! -s $msaInFastaFormat ]; then
-                        echo Run KalignP with PSGP failed for $id. Try with no PSGP >&2
-                        $run_kalignP_path/run_kalignP.sh $limitedFastaFile_cleaned \
-                            -no-psgp \
+            if IsStageUpToDate $id msa "$limitedFastaFile_cleaned" \
+                "$msaInFastaFormat" "-alnprog $msaProg"; then
+                echo Step 5: multiple sequence alignment of $id is up to date
+            else
+                stageStatus=0
+                echo  Step 5: Running multiple sequence alignment for \
+                    $limitedFastaFile_cleaned...
+                case $msaProg in 
+                    kalignp)
+                        $run_kalignP_path/run_kalignP.sh  $limitedFastaFile_cleaned  \
                             -f fasta -outpath $outpath -q 2> $errFile
-                    fi
-                    ;;
-                clustalo)
-                    $clustalo_bin/clustalo -i $limitedFastaFile_cleaned \
-                        -o $msaInFastaFormat
-                    ;;
-                *)
-                    $kalign_bin/kalign -f fasta $limitedFastaFile_cleaned \
-                        -o $msaInFastaFormat
-            esac
+                        stageStatus=$?
+                        if [ -s $errFile -a ! -s $msaInFastaFormat ]; then
+                            echo Run KalignP with PSGP failed for $id. Try with no PSGP >&2
+                            $run_kalignP_path/run_kalignP.sh $limitedFastaFile_cleaned \
+                                -no-psgp \
+                                -f fasta -outpath $outpath -q 2> $errFile
+                            stageStatus=$?
+                        fi
+                        ;;
+                    clustalo)
+                        $clustalo_bin/clustalo -i $limitedFastaFile_cleaned \
+                            -o $msaInFastaFormat || stageStatus=1
+                        ;;
+                    *)
+                        $kalign_bin/kalign -f fasta $limitedFastaFile_cleaned \
+                            -o $msaInFastaFormat || stageStatus=1
+                esac
+                FinishStage $stageStatus $id msa "$limitedFastaFile_cleaned" \
+                    "$msaInFastaFormat" "-alnprog $msaProg"
+            fi
         fi
     else
         topoFile_cleaned=$topoFile
@@ -464,28 +576,42 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
     fi
 
     ### Step 6: get MSATopoSeq
+    # steps 6 and 7 are recorded as one stage, since msatopoSeqFile is
+    # deleted after step 7
     local msatopoSeqFile=$outpath/$id.cleaned.topomsa.fa
-    if [ $startfrom -le 6 ]; then
+    local topowithDGscoreFile=$outpath/$id.cleaned.topomsa.topowithdgscore
+    local dgStageInFileList="$msaInFastaFormat $topoFile_cleaned $fastaFile_cleaned"
+    local isDGStageUpToDate=0
+    stageStatus=0
+    if [ $startfrom -le 7 ] && IsStageUpToDate $id topowithdgscore \
+        "$dgStageInFileList" "$topowithDGscoreFile" ""; then
+        echo Steps 6 and 7: topology MSA with DG scores of $id is up to date
+        isDGStageUpToDate=1
+    fi
+    if [ $startfrom -le 6 -a $isDGStageUpToDate -eq 0 ]; then
         if [ ! -s $msaInFastaFormat ] ; then 
             echo Failed to generate multiple sequence alignment for $id. Ignore. >&2
             return 1
         fi
         echo Step 6: Matching Sequence MSA to topology MSA...
-        exec_cmd "$binpath/matchMSAtopo.py -msa $msaInFastaFormat -topo $topoFile_cleaned  -o $msatopoSeqFile"
+        exec_cmd "$binpath/matchMSAtopo.py -msa $msaInFastaFormat -topo $topoFile_cleaned  -o $msatopoSeqFile" \
+            || stageStatus=1
     fi
 
     ### Step 7 create dg files
-    if [ $startfrom -le 7 ]; then
+    if [ $startfrom -le 7 -a $isDGStageUpToDate -eq 0 ]; then
         echo Step 7: create dg files
-        exec_cmd "$binpath/getDGvalueTMOfTopo.sh -topo $msatopoSeqFile -aa $fastaFile_cleaned -outpath $outpath "
+        exec_cmd "$binpath/getDGvalueTMOfTopo.sh -topo $msatopoSeqFile -aa $fastaFile_cleaned -outpath $outpath " \
+            || stageStatus=1
         /bin/rm -f $outpath/$id.*.dgscorelist
         rm -f $msatopoSeqFile
+        FinishStage $stageStatus $id topowithdgscore "$dgStageInFileList" \
+            "$topowithDGscoreFile" ""
     fi
 
 
     ### Step 8: compare topologies 
     local mm=0
-    local topowithDGscoreFile=$outpath/$id.cleaned.topomsa.topowithdgscore
     local identicalMatrixFile=$outpath/$id.identicalmatrix.mm${mm}.json
     local dgscoreFile=$outpath/$id.cleaned.topomsa.dgscore
     local sortedOrigTopoMSAFile=$outpath/$id.sorted.orig.topomsa.fa
@@ -496,22 +622,36 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
     local groupedResultFile=$outpath/$id.grouped.diff.ana
     local invertedTopologyFile=$outpath/$id.inverted.info.txt
     maxdgdiff=1.0
+    local cmpStageOutFileList="$sortedOrigTopoMSAFile $resultfile \
+        $groupedResultFile $groupedSortedOrigTopoMSAFile \
+        $clusteredOrigTopoMSAAnnoFile $invertedTopologyFile \
+        $identicalMatrixFile"
+    local cmpStageParam="-mcmp $method_comparison -maxdgdiff $maxdgdiff"
     if [ $startfrom -le 8 ]; then
         echo Step 8: compare MSA topologies
         if [ ! -s $topowithDGscoreFile ] ; then 
             echo Failed to generate topowithDGscoreFile for $id. Ignore. >&2
             return 1
         fi
-        exec_cmd "python $binpath/compareMSATopo.py $topowithDGscoreFile -mcmp $method_comparison \
-            -maxdgdiff $maxdgdiff \
-            -wo $sortedOrigTopoMSAFile -o $resultfile \
-            -og $groupedResultFile -wog $groupedSortedOrigTopoMSAFile \
-            -woc $clusteredOrigTopoMSAFile \
-            -woinv $invertedTopologyFile \
-            -widtmatrix $identicalMatrixFile
-            "
-        grep "^>" $clusteredOrigTopoMSAFile > $clusteredOrigTopoMSAAnnoFile
-        rm -f $clusteredOrigTopoMSAFile
+        if IsStageUpToDate $id comparetopo "$topowithDGscoreFile" \
+            "$cmpStageOutFileList" "$cmpStageParam"; then
+            echo Step 8: comparison of MSA topologies of $id is up to date
+        else
+            stageStatus=0
+            exec_cmd "python $binpath/compareMSATopo.py $topowithDGscoreFile -mcmp $method_comparison \
+                -maxdgdiff $maxdgdiff \
+                -wo $sortedOrigTopoMSAFile -o $resultfile \
+                -og $groupedResultFile -wog $groupedSortedOrigTopoMSAFile \
+                -woc $clusteredOrigTopoMSAFile \
+                -woinv $invertedTopologyFile \
+                -widtmatrix $identicalMatrixFile
+                " || stageStatus=1
+            grep "^>" $clusteredOrigTopoMSAFile > $clusteredOrigTopoMSAAnnoFile \
+                || stageStatus=1
+            rm -f $clusteredOrigTopoMSAFile
+            FinishStage $stageStatus $id comparetopo "$topowithDGscoreFile" \
+                "$cmpStageOutFileList" "$cmpStageParam"
+        fi
 
         if [ -s "$topowithDGscoreFile" ]; then 
             awk '{if(NR%3== 0 || NR%3 == 1) print}' $topowithDGscoreFile > $dgscoreFile
@@ -543,26 +683,44 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
 
     ### Step 9: Create pictures
     # create thumbnail from non text orig
+    # drawMSATopo.py reads the amino acid sequences from $datapath/$id.fa
+    local drawStageInFileList="$sortedOrigTopoMSAFile $groupedSortedOrigTopoMSAFile \
+        $datapath/$id.fa"
+    local drawOption="-showTMidx -colorTMbox -pfm no"
+    local drawStageParam="-text n -text y $drawOption"
+    local drawStageOutFileList="$outpath/$id.sorted.orig.topomsa.png \
+        $outpath/thumb.$id.sorted.orig.topomsa.png \
+        $outpath/$id.grouped.sorted.orig.topomsa.png \
+        $outpath/thumb.$id.grouped.sorted.orig.topomsa.png"
     if [ $startfrom -le 9 ]; then
         echo Step 9: Draw figures
         if [ ! -s $sortedOrigTopoMSAFile -a ! -s $groupedSortedOrigTopoMSAFile ]; then
             echo Failed to generate sorted TopoMSA file for $id. >&2
             return 1
         fi
-        exec_cmd "python $binpath/drawMSATopo.py -text n -outpath $outpath\
-            $sortedOrigTopoMSAFile \
-            $groupedSortedOrigTopoMSAFile -aapath $datapath -showTMidx -colorTMbox -pfm no"
-
-        convert -thumbnail 200 $outpath/$id.sorted.orig.topomsa.png \
-            $outpath/thumb.$id.sorted.orig.topomsa.png
-        convert -thumbnail 200 $outpath/$id.grouped.sorted.orig.topomsa.png \
-            $outpath/thumb.$id.grouped.sorted.orig.topomsa.png
-
-        # create full size image with text (text is amino acid sequence)
-        exec_cmd "python $binpath/drawMSATopo.py -text y -outpath $outpath\
-            $sortedOrigTopoMSAFile \
-            $groupedSortedOrigTopoMSAFile\
-            -aapath $datapath -showTMidx -colorTMbox -pfm no"
+        if IsStageUpToDate $id draw "$drawStageInFileList" \
+            "$drawStageOutFileList" "$drawStageParam"; then
+            echo Step 9: figures of $id are up to date
+        else
+            stageStatus=0
+            exec_cmd "python $binpath/drawMSATopo.py -text n -outpath $outpath\
+                $sortedOrigTopoMSAFile \
+                $groupedSortedOrigTopoMSAFile -aapath $datapath $drawOption" \
+                || stageStatus=1
+
+            convert -thumbnail 200 $outpath/$id.sorted.orig.topomsa.png \
+                $outpath/thumb.$id.sorted.orig.topomsa.png || stageStatus=1
+            convert -thumbnail 200 $outpath/$id.grouped.sorted.orig.topomsa.png \
+                $outpath/thumb.$id.grouped.sorted.orig.topomsa.png || stageStatus=1
+
+            # create full size image with text (text is amino acid sequence)
+            exec_cmd "python $binpath/drawMSATopo.py -text y -outpath $outpath\
+                $sortedOrigTopoMSAFile \
+                $groupedSortedOrigTopoMSAFile\
+                -aapath $datapath $drawOption" || stageStatus=1
+            FinishStage $stageStatus $id draw "$drawStageInFileList" \
+                "$drawStageOutFileList" "$drawStageParam"
+        fi
 
         #rm -f $topoFile
         #rm -f $topoFile_cleaned
@@ -574,8 +732,13 @@ AnaMSATopo2(){ # $id #{{{  #using kalignP and a fasta file with multiple homolog
     local renamed_msaInFastaFormat=$outpath/$id.renamedid.msa.fasta
     exec_cmd "$binpath/renameSeqIDInFasta.py $msaInFastaFormat -o $renamed_msaInFastaFormat"
     treeFile=$outpath/$id.tree
-    if [  ! -s $treeFile  -o "$isOverwrite" == "1" ]; then 
-        exec_cmd "$fasttree_bin/FastTree $fasttree_args $renamed_msaInFastaFormat > $treeFile"
+    if ! IsStageUpToDate $id tree "$renamed_msaInFastaFormat" "$treeFile" \
+        "$fasttree_args"; then
+        stageStatus=0
+        exec_cmd "$fasttree_bin/FastTree $fasttree_args $renamed_msaInFastaFormat > $treeFile" \
+            || stageStatus=1
+        FinishStage $stageStatus $id tree "$renamed_msaInFastaFormat" "$treeFile" \
+            "$fasttree_args"
     fi
     $binpath/sortedTopoMSA2colordef.sh $sortedOrigTopoMSAFile > $outpath/$id.cmpclass.colordef.txt
     $binpath/clusteredTopoMSA2colordef.sh $clusteredOrigTopoMSAAnnoFile > $outpath/$id.cluster.colordef.txt